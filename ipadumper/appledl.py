@@ -1,32 +1,44 @@
 # stdlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import hashlib
+import io
+import json
 import os
-import pathlib
-import shutil
 import signal
 import subprocess
+import sys
 import tempfile
 import threading
 import time
 
 # external
-from cachetools import TTLCache  # dict with timout
-from scp import SCPClient  # ssh copy directories
-from tqdm import tqdm  # progress bar
-from zxtouch import touchtypes, toasttypes
-from zxtouch.client import zxtouch  # simulate touch input on device
-import frida  # run scripts on device
+from scp import SCPClient, SCPException  # ssh copy directories
 import paramiko  # ssh
 
 # internal
 import ipadumper
-from ipadumper.utils import get_logger, itunes_info, progress_helper, free_port
+from ipadumper.asyncdl import AsyncAppleDL, shared_loop
+from ipadumper.macho import encryption_info, fat_slices, is_fat
+from ipadumper.storage import StorageBudget
+from ipadumper.verify import Verifier, verify_ipa
+from ipadumper import failures, ingest, matcher, metrics, sinks, tracing, transfers
+from ipadumper.failures import Result, fail
+from ipadumper.utils import default_position_cache_path, get_logger, itunes_info
+
+
+# uploaded with the template images, contains hash and size of every image
+IMAGE_MANIFEST = '.ipadumper-manifest.json'
 
 
 class AppleDL:
     '''
     Downloader instance for a single device
-    On inititalization two iproxy process are started: one for ssh and one for zxtouch
-    Then a ssh and a frida connection will get established and the template images are copied with scp to the device
+    The device I/O (SSH, scp, Frida, zxtouch, usbmuxd, lockdownd and the tools of libimobiledevice) runs in an
+    AsyncAppleDL on an event loop thread which is shared by all instances of the process. AppleDL is its synchronous
+    wrapper: the methods run coroutines of the core and block until they are done.
+    On inititalization SSH, Frida and zxtouch are connected (through usbmuxd or iproxy) and the template images are
+    copied with scp to the device
     '''
 
     def __init__(
@@ -43,33 +55,75 @@ class AppleDL:
         timeout=15,
         log_level='info',
         init=True,
+        host_matching=True,
+        position_cache_path=default_position_cache_path(),
+        metrics_textfile=None,
+        trace_path=None,
+        frida_device=None,
+        tunnel='auto',
+        transfer_bus='host',
+        loop_thread=None,
     ):
+        '''
+        position_cache_path: JSON file with learned button positions for host side matching (None: not persisted)
+        metrics_textfile: write metrics in the Prometheus text format to this file after every app
+        trace_path: enable tracing and write spans as Chrome trace event JSON to this file on cleanup
+        frida_device: use this Frida device instead of the USB device (e.g. the mock device of the simulator)
+        tunnel: how SSH and zxtouch are reached: 'usbmux' (connect through usbmuxd), 'iproxy' (forward local ports)
+                or 'auto' (usbmux if usbmuxd is reachable)
+        transfer_bus: name of the USB bus (hub or host controller) of the device, devices on the same bus share
+                      its bandwidth budget in the transfer scheduler
+        loop_thread: asyncdl.LoopThread which runs the device I/O (default: the loop shared by the process)
+        '''
         self.udid = udid
         self.device_address = device_address
-        self.ssh_key_filename = ssh_key_filename
-        self.local_ssh_port = local_ssh_port
-        self.local_zxtouch_port = local_zxtouch_port
         self.image_base_path_device = image_base_path_device
         self.image_base_path_local = image_base_path_local
         self.theme = theme
         self.lang = lang
         self.timeout = timeout
         self.log_level = log_level
-        self.log = get_logger(log_level, name=__name__)
+        self.log = get_logger(log_level, name=__name__, device=udid)
+        self.host_matching = host_matching
+        self.position_cache_path = position_cache_path
+        self.metrics_textfile = metrics_textfile
+        self.trace_path = trace_path
+        self.loop_thread = loop_thread if loop_thread is not None else shared_loop()
+
+        async def create():
+            # asyncio primitives of the core belong to the loop
+            return AsyncAppleDL(
+                udid=udid,
+                device_address=device_address,
+                ssh_key_filename=ssh_key_filename,
+                local_ssh_port=local_ssh_port,
+                local_zxtouch_port=local_zxtouch_port,
+                timeout=timeout,
+                log_level=log_level,
+                frida_device=frida_device,
+                tunnel=tunnel,
+                transfer_bus=transfer_bus,
+                bridge=self.loop_thread.bridge,
+            )
+
+        self.core = self.loop_thread.run(create())
+        self.storage = StorageBudget(self.ssh_cmd, log_level=log_level, device=udid)
+        if trace_path is not None:
+            tracing.enable()
+        self.device_label = udid or device_address  # label of the metrics
+        self.matcher = None
+        self.touch_scale = None
 
-        signal.signal(signal.SIGINT, self.__signal_handler)
-        signal.signal(signal.SIGTERM, self.__signal_handler)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.__signal_handler)
+            signal.signal(signal.SIGTERM, self.__signal_handler)
 
         self.running = True
-        self.processes = []
-        # self.file_dict = {}
-        self.installed_cached = TTLCache(maxsize=1, ttl=2)
+        self.parallel = 3  # tuning of bulk_decrypt
+        self.timeout_per_MiB = 0.5
 
         self.log.debug('Logging is set to debug')
 
-        self.init_frida_done = False
-        self.init_ssh_done = False
-        self.init_zxtouch_done = False
         self.init_images_done = False
 
         if not self.device_connected():
@@ -79,30 +133,39 @@ class AppleDL:
                 self.cleanup()
 
     def __del__(self):
-        if self.running:
+        # the loop thread does not run anymore while the interpreter shuts down
+        if self.running and not sys.is_finalizing():
             self.cleanup()
 
     def __signal_handler(self, signum, frame):
         self.log.info('Received exit signal')
         self.cleanup()
 
+    def __run(self, coro):
+        '''
+        Run a coroutine of the core and return its result
+        '''
+        return self.loop_thread.run(coro)
+
     def cleanup(self):
         self.log.debug('Clean up...')
         self.running = False
 
+        if self.matcher is not None and self.matcher.position_cache is not None:
+            hits, misses, rate = self.matcher.position_cache.stats()['total']
+            if hits + misses > 0:
+                self.log.info(f'Button position cache: {hits} hits, {misses} misses ({rate:.0%} hit rate)')
+
+        if self.trace_path is not None:
+            self.log.info(f'Writing trace to {self.trace_path}')
+            tracing.TRACER.export_chrome(self.trace_path)
+
         self.log.info('Disconnecting from device')
         try:
-            self.finished.set()
-            self.device.disconnect()
-            self.sshclient.close()
-        except AttributeError:
-            pass
-
-        # close all processes
-        for idx, p in enumerate(self.processes, start=1):
-            self.log.debug(f'Stopping process {idx}/{len(self.processes)}')
-            p.terminate()
-            p.wait()
+            # running dumps are cancelled
+            self.loop_thread.submit(self.core.cleanup()).result(self.timeout)
+        except FutureTimeoutError:
+            self.log.warning(f'Disconnecting did not finish within {self.timeout}s')
 
         # threads
         for t in threading.enumerate():
@@ -112,110 +175,59 @@ class AppleDL:
 
     def init_all(self):
         '''
+        Initialize Frida, SSH + template images and zxtouch concurrently
         return success
         '''
         self.log.debug('Starting initialization')
-        if not self.init_frida() or not self.init_ssh() or not self.init_zxtouch or not self.init_images():
-            return False
-        return True
+        start = time.time()
+        frida_init, ssh_init, zxtouch_init = [
+            self.loop_thread.submit(coro)
+            for coro in (self.core.init_frida(), self.core.init_ssh(), self.core.init_zxtouch())
+        ]
+        # the images are synced while Frida and zxtouch connect
+        images = ssh_init.result() and self.init_images()
+        success = all([frida_init.result(), images, zxtouch_init.result()])
+        self.log.debug(f'Initialization finished after {time.time() - start:.2f}s (success: {success})')
+        return success
+
+    def recover(self, result):
+        '''
+        Prepare the retry of a failed stage (failures.Result), see AsyncAppleDL.recover
+        return success
+        '''
+        return self.__run(self.core.recover(result))
 
     def device_connected(self):
         '''
         return True if a device is available else return False
         '''
-        if self.udid is None:
-            returncode = subprocess.call(
-                ['ideviceinfo'], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            if returncode == 0:
-                return True
-            else:
-                self.log.error('No device found')
-                return False
-        else:
-            returncode = subprocess.call(
-                ['ideviceinfo', '--udid', self.udid], encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            if returncode == 0:
-                return True
-            else:
-                self.log.error(f'Device {self.udid} not found')
-                return False
+        return self.__run(self.core.device_connected())
+
+    def device_info(self, key):
+        '''
+        return lockdown value of the device (e.g. DeviceName, ProductVersion, ProductType) or None
+        '''
+        return self.__run(self.core.device_info(key))
 
     def init_frida(self):
         '''
         set frida device
         return success
         '''
-        self.log.debug('Setting frida device')
-        try:
-            if self.udid is None:
-                self.frida_device = frida.get_usb_device()
-            else:
-                self.frida_device = frida.get_device(self.udid)
-        except frida.InvalidArgumentError:
-            self.log.error('No Frida USB device found')
-            return False
-
-        self.init_frida_done = True
-        return True
+        return self.__run(self.core.init_frida())
 
     def init_ssh(self):
         '''
         Initializing SSH connection to device
         return success
         '''
-        self.log.debug('Initializing SSH connection to device')
-        # start iproxy for SSH
-        if self.local_ssh_port == 0:
-            self.local_ssh_port = free_port()
-        if self.udid is None:
-            self.__run_cmd(['iproxy', str(self.local_ssh_port), '22'])
-        else:
-            self.__run_cmd(['iproxy', '--udid', self.udid, str(self.local_ssh_port), '22'])
-        time.sleep(0.1)
-
-        self.log.debug('Connecting to device via SSH')
-        # pkey = paramiko.Ed25519Key.from_private_key_file(self.ssh_key_filename)
-        self.sshclient = paramiko.SSHClient()
-        # client.load_system_host_keys()
-        self.sshclient.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        try:
-            self.sshclient.connect(
-                'localhost', port=self.local_ssh_port, username='root', key_filename=self.ssh_key_filename
-            )
-        except FileNotFoundError:
-            self.log.error(f'Could not find ssh keyfile "{self.ssh_key_filename}"')
-            return False
-        except (EOFError, ConnectionResetError, paramiko.ssh_exception.SSHException) as e:
-            self.log.error('Could not connect to establish SSH connection')
-            self.log.debug(str(e))
-            return False
-
-        self.init_ssh_done = True
-        return True
+        return self.__run(self.core.init_ssh())
 
     def init_zxtouch(self):
-        self.log.debug('initialization zxtouch')
-        # start iproxy for zxtouch
-        if self.local_zxtouch_port == 0:
-            self.local_zxtouch_port = free_port()
-        if self.udid is None:
-            self.__run_cmd(['iproxy', str(self.local_zxtouch_port), '6000'])
-        else:
-            self.__run_cmd(['iproxy', '--udid', self.udid, str(self.local_zxtouch_port), '6000'])
-
-        time.sleep(1)
-        self.log.info(f'Connecting to device at {self.device_address}:{self.local_zxtouch_port}')
-        try:
-            self.device = zxtouch(self.device_address, port=self.local_zxtouch_port)
-        except ConnectionRefusedError:
-            self.log.error('Error connecting to zxtouch on device. Make sure iproxy is running')
-            self.cleanup()
-            return False
-
-        self.init_zxtouch_done = True
-        return True
+        '''
+        return success
+        '''
+        return self.__run(self.core.init_zxtouch())
 
     def init_images(self):
         '''
@@ -257,104 +269,88 @@ class AppleDL:
                 self.log.error(f'Image {image_name_unlabeled} not found in {theme_path}')
                 return False
 
-        # transfer images over SSH
-        try:
-            with SCPClient(self.sshclient.get_transport(), socket_timeout=self.timeout) as scp:
-                for labeled_img in image_names_labeled:
-                    scp.put(os.path.join(lang_path, labeled_img), self.image_base_path_device)
-                for unlabeled_img in image_names_unlabeled:
-                    unlabeled_img_path = os.path.join(theme_path, unlabeled_img)
-                    scp.put(unlabeled_img_path, self.image_base_path_device)
-        except OSError:
-            self.log.error('Could not copy template images to device')
+        # transfer changed images over SSH
+        images = [os.path.join(lang_path, name) for name in image_names_labeled]
+        images += [os.path.join(theme_path, name) for name in image_names_unlabeled]
+        if not self.__sync_images(images):
             return False
 
+        if self.host_matching:
+            if matcher.available():
+                device = self.udid or self.device_address
+                position_cache = matcher.PositionCache(self.position_cache_path, device=device)
+                self.matcher = matcher.ScreenMatcher(
+                    self.image_base_path_local,
+                    theme=self.theme,
+                    lang=self.lang,
+                    position_cache=position_cache,
+                    log_level=self.log_level,
+                )
+            else:
+                self.log.info('numpy or Pillow not installed, matching template images on device')
+
         self.init_images_done = True
         return True
 
-    def ssh_cmd(self, cmd):
+    def __sync_images(self, paths):
         '''
-        execute command via ssh and iproxy
-        return exitcode, stdout, stderr
+        Upload template images which are missing on the device or differ from the local ones
+        The device directory contains a manifest with the SHA-256 and size of the uploaded images.
+        return success
         '''
-        if not self.init_ssh_done:
-            if not self.init_ssh():
-                return 1, '', ''
-
-        self.log.debug(f'Run ssh cmd: {cmd}')
-        stdin, stdout, stderr = self.sshclient.exec_command(cmd)
-
-        exitcode = stdout.channel.recv_exit_status()
-
-        out = ''
-        err = ''
-        for line in stdout:
-            out += line
-        for line in stderr:
-            err += line
-
-        if exitcode != 0 or out != '' or err != '':
-            self.log.debug(f'Exitcode: {exitcode}\nSTDOUT:\n{out}STDERR:\n{err}DONE')
-        return exitcode, out, err
-
-    def __log_cmd(self, pipe, err):
-        with pipe:
-            for line in iter(pipe.readline, b''):  # b'\n'-separated lines
-                if err is True:
-                    self.log.warning(f"got err line from subprocess: {line.decode('utf-8').rstrip()}")
-                else:
-                    self.log.info(f"got out line from subprocess: {line.decode('utf-8').rstrip()}")
-
-        if err is True:
-            self.log.debug('Terminating stderr output thread')
-        else:
-            self.log.debug('Terminating stdout output thread')
+        manifest_path = f'{self.image_base_path_device}/{IMAGE_MANIFEST}'
+        local = {}
+        for p in paths:
+            with open(p, 'rb') as f:
+                local[os.path.basename(p)] = [hashlib.sha256(f.read()).hexdigest(), os.path.getsize(p)]
+
+        # read manifest and sizes of the images with one command
+        names = ' '.join(f"'{name}'" for name in local)
+        d = self.image_base_path_device
+        _, out, _ = self.ssh_cmd(f"mkdir -p '{d}' && cd '{d}' && cat {IMAGE_MANIFEST}; echo; wc -c {names}")
+        manifest_str, _, sizes_str = out.partition('\n')
+        try:
+            remote = json.loads(manifest_str)
+        except ValueError:
+            remote = {}
+        sizes = {}
+        for line in sizes_str.splitlines():
+            size, _, name = line.strip().partition(' ')
+            if size.isdigit():
+                sizes[name.strip()] = int(size)
+
+        changed = []
+        for p in paths:
+            name = os.path.basename(p)
+            if remote.get(name) != local[name] or sizes.get(name) != local[name][1]:
+                changed.append(p)
+        if len(changed) == 0:
+            self.log.debug('Template images on device are up to date')
+            return True
+
+        self.log.debug(f"Uploading template images: {', '.join(os.path.basename(p) for p in changed)}")
+        try:
+            with SCPClient(self.core.sshclient.get_transport(), socket_timeout=self.timeout) as scp:
+                for p in changed:
+                    scp.put(p, self.image_base_path_device)
+                scp.putfo(io.BytesIO(json.dumps(local).encode('utf-8')), manifest_path)
+        except (OSError, SCPException) as e:
+            self.log.error(f'Could not copy template images to device: {str(e)}')
+            return False
+        return True
 
-    def __run_cmd(self, cmd):
+    def ssh_cmd(self, cmd):
         '''
-        Start external program and log stdout + stderr
+        execute command via ssh
+        return exitcode, stdout, stderr
         '''
-        cmd_str = ' '.join(cmd)
-        self.log.info(f'Starting: {cmd_str}')
-
-        p = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        # start logging threads: one for stderr and one for stdout
-        t_out = threading.Thread(target=self.__log_cmd, args=(p.stdout, False))
-        t_err = threading.Thread(target=self.__log_cmd, args=(p.stderr, True))
-
-        self.processes.append(p)
-
-        # t_out.daemon = True
-        # t_err.daemon = True
-
-        t_out.name = ' '.join(cmd[:3])  # + '-out'
-        t_err.name = ' '.join(cmd[:3])  # + '-err'
-
-        t_out.start()
-        t_err.start()
+        return self.__run(self.core.ssh_cmd(cmd))
 
     def __is_installed(self, bundleId):
         '''
         return version code if app is installed else return False
         '''
-        try:
-            out = self.installed_cached[0]
-        except KeyError:
-            if self.udid is None:
-                out = subprocess.check_output(['ideviceinstaller', '-l'], encoding='utf-8')
-            else:
-                out = subprocess.check_output(['ideviceinstaller', '--udid', self.udid, '-l'], encoding='utf-8')
-            # cache output
-            self.installed_cached[0] = out
-
-        for line in out.splitlines()[1:]:
-            CFBundleIdentifier, CFBundleVersion, CFBundleDisplayName = line.split(', ')
-            if CFBundleIdentifier == bundleId:
-                version = CFBundleVersion.strip('"')
-                displayName = CFBundleDisplayName.strip('"')
-                self.log.debug(f'Found installed app {bundleId}: {version} ({displayName})')
-                return version
-        return False
+        return self.__run(self.core.is_installed(bundleId))
 
     def __match_image(self, image_name, acceptable_value=0.9, max_try_times=1, scaleRation=1):
         '''
@@ -364,7 +360,7 @@ class AppleDL:
         else return False
         '''
         path = f'{self.image_base_path_device}/{image_name}'
-        result_tuple = self.device.image_match(path, acceptable_value, max_try_times, scaleRation)
+        result_tuple = self.__run(self.core.device.image_match(path, acceptable_value, max_try_times, scaleRation))
 
         if result_tuple[0] is not True:
             raise Exception(f'Error while matching {image_name}: {result_tuple[1]}')
@@ -385,16 +381,93 @@ class AppleDL:
                 self.log.debug(f'Match failed. Cannot find {image_name} on screen.')
                 return False
 
+    def __screenshot(self):
+        '''
+        Take a screenshot with idevicescreenshot
+        return PIL image or None
+        '''
+        fd, path = tempfile.mkstemp(suffix='.png')
+        os.close(fd)
+        cmd = ['idevicescreenshot', path] if self.udid is None else ['idevicescreenshot', '--udid', self.udid, path]
+        try:
+            subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+            screenshot = matcher.Image.open(path)
+            screenshot.load()
+            return screenshot
+        except (subprocess.CalledProcessError, FileNotFoundError, OSError) as e:
+            self.log.warning(f'Could not take screenshot, matching template images on device: {str(e)}')
+            return None
+        finally:
+            os.remove(path)
+
+    def __screen_state(self, names):
+        '''
+        Match template images (dissallow, get, cloud, install) on the screen
+        With host matching one screenshot is taken and all templates are matched on the host.
+        Else every template is matched on the device, one after the other.
+        return name of the matched template (or matcher.STATE_LOADING), (x, y) or None
+        '''
+        with metrics.stage('match', self.device_label):
+            if self.matcher is not None:
+                screenshot = self.__screenshot()
+                if screenshot is None:
+                    self.matcher = None
+                else:
+                    if self.touch_scale is None:
+                        ok, size = self.__run(self.core.device.get_screen_size())
+                        self.touch_scale = float(size['width']) / screenshot.width if ok else 1
+                    state, xy = self.matcher.classify(screenshot, names)
+                    if xy is not None:
+                        xy = (int(xy[0] * self.touch_scale), int(xy[1] * self.touch_scale))
+                        self.log.debug(f'Matched {state}: {xy}')
+                    return state, xy
+
+            for name in names:
+                xy = self.__match_image(f'{name}.png')
+                if xy is not False:
+                    return name, xy
+            return matcher.STATE_LOADING, None
+
+    def __uninstall(self, bundleId):
+        '''
+        return Result (truthy on success, else with failure class)
+        '''
+        return self.__run(self.core.uninstall(bundleId))
+
+    def verify(self, path):
+        '''
+        Verify IPA in this process (zip integrity, all binaries decrypted)
+        return success
+        '''
+        with metrics.stage('verify', self.device_label) as stage:
+            result = verify_ipa(path)
+            if not result['ok']:
+                stage.fail()
+        if result['ok']:
+            self.log.info(f"{os.path.basename(path)}: verified {result['binaries']} binaries ({result['sha256']})")
+            if len(result['encrypted_extensions']) > 0:
+                extensions = '; '.join(result['encrypted_extensions'])
+                self.log.warning(f'{os.path.basename(path)}: app extensions are encrypted: {extensions}')
+        else:
+            self.log.error(f"{os.path.basename(path)}: verification failed: {'; '.join(result['errors'])}")
+        return result['ok']
+
+    def write_metrics(self):
+        '''
+        Write metrics to the textfile (if configured)
+        '''
+        if self.metrics_textfile is None:
+            return
+        try:
+            metrics.write_textfile(self.metrics_textfile)
+        except OSError as e:
+            self.log.warning(f'Could not write metrics to {self.metrics_textfile}: {str(e)}')
+
     def __tap(self, xy, message=''):
         '''
         Simulate touch input (single tap) and show toast message on device
         '''
-        x, y = xy
-        self.log.debug(f'Tapping {xy} {message}')
-        self.device.show_toast(toasttypes.TOAST_WARNING, f'{message} ({x},{y})', 1.5)
-        self.device.touch(touchtypes.TOUCH_DOWN, 1, x, y)
-        time.sleep(0.1)
-        self.device.touch(touchtypes.TOUCH_UP, 1, x, y)
+        self.__run(self.core.tap(xy, message))
 
     def __wake_up_device(self):
         '''
@@ -408,102 +481,274 @@ class AppleDL:
         time.sleep(0.5)
 
     def already_dumped(self, itunes_id, directory):
-        for filename in os.listdir(f'{directory}/.'):
+        if not os.path.isdir(directory):
+            return False
+        for filename in os.listdir(directory):
             if filename.startswith(f'{itunes_id}_'):
                 return True
         return False
 
-    def dump_fouldecrypt(self, target, output, timeout=120, disable_progress=False, copy=True):
+    def find_encrypted_binaries(self, app_path, scan_size=8192):
+        '''
+        Scan all Mach-O files of an app bundle on the device with one remote command
+        (plus one for the slices of fat binaries) and parse their load commands
+        scan_size: bytes of each header that are read
+        return number of cpus of the device, list of paths relative to app_path
+        or None, None on error
+        '''
+        mach_o_magics = '|'.join(['feedface', 'feedfacf', 'cefaedfe', 'cffaedfe', 'cafebabe', 'cafebabf'])
+        cmd = (
+            'sysctl -n hw.ncpu 2>/dev/null || echo 1; '
+            + f'find "{app_path}" -type f \\( -perm -u+x -o -name "*.dylib" \\) | while IFS= read -r f; do '
+            + 'm=$(od -An -tx1 -N4 "$f" | tr -d " \\n"); '
+            + f'case "$m" in {mach_o_magics}) '
+            + f'echo "$f"; od -An -tx1 -v -N {scan_size} "$f" | tr -d " \\n"; echo;; '
+            + 'esac; done'
+        )
+        ret, stdout, stderr = self.ssh_cmd(cmd)
+        if ret != 0:
+            self.log.error(f'scan returned {ret} {stderr}')
+            return None, None
+
+        lines = stdout.splitlines()
+        try:
+            ncpu = int(lines[0])
+        except (IndexError, ValueError):
+            ncpu = 1
+
+        encrypted = []
+        fat = []
+        for path, hexdata in zip(lines[1::2], lines[2::2]):
+            data = bytes.fromhex(hexdata)
+            if is_fat(data):
+                fat.append((path, fat_slices(data)))
+                continue
+            try:
+                info = encryption_info(data)
+                if info is not None and info[2] != 0:
+                    encrypted.append(path)
+            except ValueError as e:
+                self.log.warning(f'Could not parse {path} ({str(e)}), trying to decrypt it anyway')
+                encrypted.append(path)
+
+        if len(fat) > 0:
+            # read the header of every slice
+            cmds = []
+            for path, slices in fat:
+                for _, _, offset, _ in slices:
+                    bs, skip = (4096, offset // 4096) if offset % 4096 == 0 else (1, offset)
+                    cmds.append(
+                        f'echo "{path}"; dd if="{path}" bs={bs} skip={skip} count={scan_size // bs} 2>/dev/null '
+                        + '| od -An -tx1 -v | tr -d " \\n"; echo'
+                    )
+            ret, stdout, stderr = self.ssh_cmd('; '.join(cmds))
+            if ret != 0:
+                self.log.error(f'scan of fat binaries returned {ret} {stderr}')
+                return None, None
+            lines = stdout.splitlines()
+            for path, hexdata in zip(lines[0::2], lines[1::2]):
+                try:
+                    info = encryption_info(bytes.fromhex(hexdata))
+                except ValueError as e:
+                    self.log.warning(f'Could not parse slice of {path} ({str(e)}), trying to decrypt it anyway')
+                    info = (0, 0, 1, 0)
+                if info is not None and info[2] != 0 and path not in encrypted:
+                    encrypted.append(path)
+
+        prefix = app_path.rstrip('/') + '/'
+        return ncpu, [path[len(prefix) :] for path in encrypted if path.startswith(prefix)]
+
+    def decrypt_binaries(self, pairs, jobs=1):
+        '''
+        Decrypt binaries concurrently on the device with FoulDecrypt
+        pairs: list of (source, destination) paths on the device. If they differ, destination is replaced
+        jobs: number of concurrent FoulDecrypt processes
+        return list of (destination, exitcode, stderr, duration in seconds)
+        '''
+
+        parent = tracing.TRACER.inherited()
+
+        def decrypt(pair):
+            src, dst = pair
+            cmd = f'/usr/local/bin/fouldecrypt -v "{src}" "{dst}"'
+            if src != dst:
+                # never write into dst, it may be a hardlink to src
+                cmd = f'rm -f "{dst}" && {cmd}'
+            start = time.time()
+            with tracing.span('fouldecrypt', **parent, binary=os.path.basename(dst)):
+                ret, stdout, stderr = self.ssh_cmd(cmd)
+            return dst, ret, stderr, time.time() - start
+
+        # OpenSSH allows 10 sessions per connection by default
+        jobs = max(1, min(jobs, len(pairs), 8))
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='fouldecrypt') as executor:
+            return list(executor.map(decrypt, pairs))
+
+    def __size_MiB(self, paths):
+        '''
+        return total size of the files and directories at paths on the device in MiB or None if du failed
+        '''
+        if len(paths) == 0:
+            return 0
+        quoted = ' '.join(f'"{path}"' for path in paths)
+        ret, stdout, stderr = self.ssh_cmd(f'du -skc {quoted}')
+        try:
+            return int(stdout.splitlines()[-1].split()[0]) / 1024
+        except (IndexError, ValueError):
+            self.log.debug(f'du returned {ret} {stderr}')
+            return None
+
+    def dump_fouldecrypt(
+        self, target, output, timeout=120, disable_progress=False, copy=True, hardlink=True, jobs=0, sink=None
+    ):
         '''
         Dump IPA by using FoulDecrypt
+        output: path of the IPA or its name in sink (see sinks.py), the zip is streamed from the device into it
+        All encrypted binaries of the app (main executable, app extensions, frameworks, ...) are decrypted in parallel
         When copy is False, the app directory on the device is overwritten which is faster than copying everything
-        Return success
+        When copy and hardlink are True, the Payload directory is staged with hardlinks (or clones) of the app files
+        and only the decrypted binaries are written as new files. The installed app stays intact.
+        jobs: number of binaries which are decrypted concurrently (0: number of cpus of the device)
+        return Result (truthy on success, else with failure class)
         '''
-        if not self.init_ssh_done:
+        if not self.core.init_ssh_done:
             if not self.init_ssh():
-                return False
+                return fail(failures.TRANSIENT, 'no SSH connection', 'dump')
 
         self.log.debug(f'{target}: Start dumping with FoulDecrypt.')
 
         # get path of app
-        apps_dir = '/private/var/containers/Bundle/Application/'
-        cmd = f'grep --only-matching {target} {apps_dir}*/iTunesMetadata.plist'
-        ret, stdout, stderr = self.ssh_cmd(cmd)
-        if ret != 0:
-            self.log.error(f'grep returned {ret} {stderr}')
-            return False
-
-        target_dir = stdout.split('/iTunesMetadata.plist ')[0].split(' ')[-1]
-
-        # get app directory name
-        cmd = f'ls -d {target_dir}/*/'
-        ret, stdout, stderr = self.ssh_cmd(cmd)
-        if ret != 0:
-            self.log.error(f'ls -d returned {ret} {stderr}')
-            return False
-
-        app_dir = stdout.strip().rstrip('/').split('/')[-1]
-        if not app_dir.endswith('.app'):
-            self.log.error(f'App directory does not end with .app: {app_dir}')
-            return False
-
-        app_bin = app_dir[:-4]
+        container = self.core.containers.get(target)
+        if container is None:
+            self.log.error(f'{target}: App is not installed')
+            return fail(failures.ERROR, 'app is not installed', 'dump')
+
+        target_dir = self.core.containers.container_path(container)
+        app_dir = container.app_dir
+        app_bin = container.executable
+        orig_app_path = f'{target_dir}/{app_dir}'
+
+        # find encrypted binaries
+        ncpu, encrypted = self.find_encrypted_binaries(orig_app_path)
+        if encrypted is None:
+            self.log.warning(f'{target}: Could not scan for encrypted binaries, decrypting only main binary')
+            ncpu, encrypted = 1, [app_bin]
+        elif len(encrypted) == 0:
+            self.log.warning(f'{target}: No encrypted binaries found')
+        self.log.debug(f'{target}: Encrypted binaries: {encrypted}')
 
         if copy is True:
-            orig_target_dir = target_dir
+            # stage app in <container>_tmp/Payload
             target_dir = target_dir + '_tmp'
-            cmd = f'cp -r {orig_target_dir} {target_dir}'
-            ret, stdout, stderr = self.ssh_cmd(cmd)
+            payload_dir = f'{target_dir}/Payload'
+            staged_app_path = f'{payload_dir}/{app_dir}'
+            # hardlinks and clones only take space for the decrypted binaries, a copy for the whole app
+            # (the zip is streamed to the host)
+            stagings = [(['cp -al', 'cp -cR'], [f'{orig_app_path}/{b}' for b in encrypted])] if hardlink is True else []
+            stagings.append((['cp -R'], [orig_app_path]))
+            errors = ''
+            for staging_cmds, copied in stagings:
+                needed = self.__size_MiB(copied)
+                if needed is not None and not self.storage.fits(needed):
+                    available = self.storage.available_MiB()
+                    self.log.error(
+                        f'{target}: Not enough space on device to stage with {staging_cmds[0]}, '
+                        + f'need {needed:.0f} MiB, {available:.0f} MiB free'
+                    )
+                    return fail(failures.DEVICE_BUSY, f'not enough space, need {needed:.0f} MiB', 'dump')
+                attempts = [
+                    f'(rm -rf "{staged_app_path}"; {c} "{orig_app_path}" "{payload_dir}/" && echo {c})'
+                    for c in staging_cmds
+                ]
+                cmd = f'rm -rf "{target_dir}" && mkdir -p "{payload_dir}" && ({" || ".join(attempts)})'
+                ret, stdout, stderr = self.ssh_cmd(cmd)
+                if ret == 0:
+                    break
+                errors += stderr
             if ret != 0:
-                self.log.error(f'cp -r returned {ret} {stderr}')
-                return False
-
-        bin_path = target_dir + '/' + app_dir + '/' + app_bin
-
-        # decrypt binary and replace
-        self.log.debug(f'{target}: Decrypting binary with fouldecrypt')
-        cmd = f'/usr/local/bin/fouldecrypt -v {bin_path} {bin_path}'
-        ret, stdout, stderr = self.ssh_cmd(cmd)
-        if ret != 0:
-            self.log.error(f'fouldecrypt returned {ret} {stderr}')
-            return False
+                self.log.error(f'staging returned {ret} {stderr}')
+                return fail(failures.ERROR, f'staging returned {ret}', 'dump')
+            staging_cmd = stdout.strip()
+            if hardlink is True and staging_cmd == 'cp -R':
+                self.log.warning(
+                    f'{target}: Hardlinks and clones are not supported on device, copied app instead: '
+                    + (errors + stderr).strip()
+                )
+            elif stderr.strip() != '':
+                self.log.debug(f'{target}: Staged app with {staging_cmd} after: {stderr.strip()}')
+            else:
+                self.log.debug(f'{target}: Staged app with {staging_cmd}')
 
-        # prepare for zipping, create Payload folder
-        cmd = f'mkdir {target_dir}/Payload'
-        ret, stdout, stderr = self.ssh_cmd(cmd)
-        if ret != 0:
-            self.log.error(f'mkdir returned {ret} {stderr}')
-            return False
+            # decrypt from the installed app into new files in the staged app
+            pairs = [(f'{orig_app_path}/{b}', f'{staged_app_path}/{b}') for b in encrypted]
+        else:
+            # prepare for zipping, create Payload folder
+            cmd = f'mkdir {target_dir}/Payload'
+            ret, stdout, stderr = self.ssh_cmd(cmd)
+            if ret != 0:
+                self.log.error(f'mkdir returned {ret} {stderr}')
+                return fail(failures.ERROR, f'mkdir returned {ret}', 'dump')
 
-        cmd = f'mv "{target_dir}/{app_dir}" "{target_dir}/Payload"'
-        ret, stdout, stderr = self.ssh_cmd(cmd)
-        if ret != 0:
-            self.log.error(f'mv returned {ret} {stderr}')
-            return False
+            cmd = f'mv "{target_dir}/{app_dir}" "{target_dir}/Payload"'
+            ret, stdout, stderr = self.ssh_cmd(cmd)
+            if ret != 0:
+                self.log.error(f'mv returned {ret} {stderr}')
+                return fail(failures.ERROR, f'mv returned {ret}', 'dump')
+
+            # decrypt in place
+            pairs = [(f'{target_dir}/Payload/{app_dir}/{b}',) * 2 for b in encrypted]
+
+        # decrypt binaries and replace
+        jobs = jobs if jobs > 0 else ncpu
+        self.log.debug(f'{target}: Decrypting {len(pairs)} binaries with fouldecrypt ({jobs} jobs)')
+        failed = 0
+        with tracing.span('decrypt', device=self.device_label, app=target, binaries=len(pairs), jobs=jobs):
+            results = self.decrypt_binaries(pairs, jobs=jobs)
+        for path, ret, stderr, duration in results:
+            name = path.split(f'/{app_dir}/', 1)[-1]
+            if ret != 0:
+                failed += 1
+                self.log.error(f'{target}: fouldecrypt {name} returned {ret} {stderr}')
+            else:
+                self.log.info(f'{target}: Decrypted {name} in {duration:.1f}s')
+        if failed > 0:
+            self.log.error(f'{target}: Decrypting {failed}/{len(pairs)} binaries failed')
+            return fail(failures.ERROR, f'decrypting {failed}/{len(pairs)} binaries failed', 'dump')
 
         self.log.debug(f'{target}: Set access and modified date to 0 for reproducible zip files')
-        cmd = f'find "{target_dir}" -exec touch -m -d "1/1/1980" {{}} +'
+        if copy is True and staging_cmd == 'cp -al':
+            # hardlinked files are the inodes of the installed app, only directories and the decrypted binaries
+            # (new files with one link) are touched
+            cmd = f'find "{target_dir}" \\( ! -type f -o -links 1 \\) -exec touch -m -d "1/1/1980" {{}} +'
+        else:
+            cmd = f'find "{target_dir}" -exec touch -m -d "1/1/1980" {{}} +'
         ret, stdout, stderr = self.ssh_cmd(cmd)
         if ret != 0:
             self.log.error(f'find+touch returned {ret} {stderr}')
-            return False
+            return fail(failures.ERROR, f'find+touch returned {ret}', 'dump')
 
-        # zip
-        self.log.debug(f'{target}: Creating zip')
-        cmd = f'cd "{target_dir}" && zip -qrX out.zip . -i "Payload/*"'
-        ret, stdout, stderr = self.ssh_cmd(cmd)
-        if ret != 0:
-            self.log.error(f'zip returned {ret} {stderr}')
-            return False
-
-        # transfer out.zip
-        bar_fmt = '{desc:20.20} {percentage:3.0f}%|{bar:20}{r_bar}'
-        self.log.debug(f'{target}: Start transfer. {output}')
-
-        with tqdm(unit="B", unit_scale=True, miniters=1, bar_format=bar_fmt, disable=disable_progress) as t:
-            pr = progress_helper(t)
-            with SCPClient(self.sshclient.get_transport(), socket_timeout=self.timeout, progress=pr) as scp:
-                scp.get(target_dir + '/out.zip', output)
+        # zip on the device and stream it into the sink
+        self.log.debug(f'{target}: Creating zip and streaming it to {output}')
+        sink, name = (sink, output) if sink is not None else sinks.for_path(output)
+        cmd = f'cd "{target_dir}" && zip -qrX - . -i "Payload/*"'
+        with metrics.stage('package', self.device_label) as stage:
+            try:
+                with sink.open(name) as writer:
+                    ret, stderr = self.__run(self.core.ssh_stream(cmd, writer, disable_progress=disable_progress))
+                    if ret != 0:
+                        raise subprocess.CalledProcessError(ret, cmd, stderr=stderr)
+            except subprocess.CalledProcessError as e:
+                stage.fail()
+                self.log.error(f'zip returned {e.returncode} {e.stderr}')
+                return fail(failures.ERROR, f'zip returned {e.returncode}', 'dump')
+            except sinks.SinkError as e:
+                stage.fail()
+                self.log.error(f'{target}: Storing IPA in {sink} failed: {str(e)}')
+                return fail(failures.classify_exception(e), f'sink: {str(e)}', 'dump')
+            except (paramiko.SSHException, OSError) as e:
+                stage.fail()
+                self.log.error(f'{target}: Transfer of zip failed: {type(e).__name__}: {str(e)}')
+                return fail(failures.classify_exception(e), f'ssh: {str(e)}', 'dump')
 
         if copy is True:
             self.log.debug('Clean up temp directory on device')
@@ -511,9 +756,9 @@ class AppleDL:
             ret, stdout, stderr = self.ssh_cmd(cmd)
             if ret != 0:
                 self.log.error(f'rm returned {ret} {stderr}')
-                return False
+                return fail(failures.ERROR, f'rm returned {ret}', 'dump')
 
-        return True
+        return Result()
 
     def dump_frida(
         self,
@@ -522,223 +767,239 @@ class AppleDL:
         timeout=120,
         disable_progress=False,
         dumpjs_path=os.path.join(os.path.dirname(ipadumper.__file__), 'dump.js'),
+        selective=True,
+        priority=0,
+        sink=None,
     ):
-
         '''
+        Dump IPA with Frida, see AsyncAppleDL.dump_frida
         target: Bundle identifier of the target app
         output: Specify name of the decrypted IPA
-        dumpjs_path:  path to dump.js
-        timeout: timeout in for dump to finish
-        disable_progress: disable progress bars
-        return success
-
-
-        partly copied from
-        https://github.com/AloneMonkey/frida-ios-dump/blob/9e75f6bca34f649aa6fcbafe464eca5d624784d6/dump.py
-
-        MIT License
-
-        Copyright (c) 2017 Alone_Monkey
-
-        Permission is hereby granted, free of charge, to any person obtaining a copy
-        of this software and associated documentation files (the "Software"), to deal
-        in the Software without restriction, including without limitation the rights
-        to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
-        copies of the Software, and to permit persons to whom the Software is
-        furnished to do so, subject to the following conditions:
-
-        The above copyright notice and this permission notice shall be included in all
-        copies or substantial portions of the Software.
+        sink: store the IPA with the name output in a sink (see sinks.py), the zip is streamed into it
+        return Result (truthy on success, else with failure class)
+        '''
+        return self.__run(
+            self.core.dump_frida(
+                target,
+                output,
+                timeout=timeout,
+                disable_progress=disable_progress,
+                dumpjs_path=dumpjs_path,
+                selective=selective,
+                priority=priority,
+                sink=sink,
+            )
+        )
 
-        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
-        IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
-        FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
-        AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
-        LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
-        OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
-        SOFTWARE.
+    def bulk_decrypt(
+        self,
+        itunes_ids,
+        timeout_per_MiB=0.5,
+        parallel=3,
+        output_directory='ipa_output',
+        country='us',
+        verify=True,
+        verify_workers=2,
+        storage_headroom_MiB=1024,
+        window=1000,
+        retry_policies=None,
+        sink=None,
+    ):
         '''
-        if not self.init_ssh_done:
-            if not self.init_ssh():
-                return False
-        if not self.init_frida_done:
-            if not self.init_frida():
+        Installs apps, decrypts and uninstalls them
+        In parallel!
+        itunes_ids: iterable of int or ingest.Entry (e.g. ingest.read_entries(ingest.iter_lines(path, follow=True)))
+                    It is read lazily in a thread and in order. IDs which were seen before or are already dumped
+                    to output_directory are skipped.
+                    Or an ingest.Lease of a feed which is shared with other devices (see controller.py). When it is
+                    drained, installed apps are still dumped but queued ones are given back to the feed.
+        parallel, timeout_per_MiB: initial values of self.parallel and self.timeout_per_MiB, which are read in
+                                   every iteration and can be changed while bulk_decrypt runs
+        country: country of IDs without one
+        verify: check every IPA in a process pool, add it to catalog.jsonl in the output directory and
+                dump apps with invalid IPAs once more (the invalid IPA is moved to the subdirectory failed)
+        storage_headroom_MiB: an app is only installed if the space for installing and dumping it fits into the
+                              free space of the device minus this headroom (None: no storage admission)
+        window: number of IDs which are read ahead, within the window IDs with a higher priority go first
+        retry_policies: failure class -> failures.RetryPolicy (default: failures.DEFAULT_POLICIES)
+                        A failed stage is retried on its own, e.g. a failed dump is dumped again without reinstalling.
+                        Apps which fail for good are appended to dead_letters.jsonl in the output directory.
+        sink: where the IPAs are stored (see sinks.py, default: sinks.LocalSink(output_directory))
+              The catalog and the dead letters stay in output_directory. IPAs of a remote sink are not verified.
+        '''
+        os.makedirs(output_directory, exist_ok=True)
+        sink = sink if sink is not None else sinks.LocalSink(output_directory)
+        if isinstance(itunes_ids, ingest.Lease):
+            feed = itunes_ids  # deduplicated by the owner of the shared feed
+        else:
+            deduper = ingest.Deduper()
+            try:
+                seeded = deduper.seed(output_directory, names=sink.names())
+            except OSError as e:
+                self.log.error(f'Could not list the IPAs in {sink}: {str(e)}')
                 return False
+            self.log.debug(f'{seeded} apps are already dumped to {sink}')
+            feed = ingest.Feed(itunes_ids, window=window, deduper=deduper, log_level=self.log_level)
+        self.parallel = parallel
+        self.timeout_per_MiB = timeout_per_MiB
+        wait_for_install = []  # apps that are currently downloading and installing
+        done = 0  # apps that are uninstalled
+        waited_time = 0
 
-        bar_fmt = '{desc:20.20} {percentage:3.0f}%|{bar:20}{r_bar}'
-        temp_dir = tempfile.mkdtemp()
-        self.log.debug(f'{target}: Start dumping with Frida. Temp dir: {temp_dir}')
-        payload_dir = os.path.join(temp_dir, 'Payload')
-        os.mkdir(payload_dir)
-
-        self.finished = threading.Event()
-        file_dict = {}
-
-        def generate_ipa():
-            self.log.debug(f'{target}: Generate ipa')
-            for key, value in file_dict.items():
-                from_dir = os.path.join(payload_dir, key)
-                to_dir = os.path.join(payload_dir, file_dict['app'], value)
-                if key != 'app':
-                    # try:
-                    #     cmp = filecmp.cmp(from_dir, to_dir)
-                    # except FileNotFoundError:
-                    #     print(f'new: {from_dir}')
-                    # print(f'cmp is {cmp}, move {key} from {from_dir}  to  {to_dir}')
-                    shutil.move(from_dir, to_dir)
-
-            self.log.debug(f'{target}: Set access and modified date to 0 for reproducible zip files')
-            for f in pathlib.Path(temp_dir).glob('**/*'):
-                os.utime(f, (0, 0))
-
-            zip_args = ('zip', '-qrX', os.path.join(os.getcwd(), output), 'Payload')
-            self.log.debug(f'{target}: Run zip: {zip_args}')
-            try:
-                subprocess.check_call(zip_args, cwd=temp_dir)
-            except subprocess.CalledProcessError as err:
-                self.log.error(f'{target}: {zip_args} {str(err)}')
+        retry = deque()  # entries before the next one of the feed: apps with invalid IPAs (filled by the verifier)
+        requeued = set()
+        retrier = failures.Retrier(retry_policies, log_level=self.log_level, device=self.udid)
+        dead_letters = failures.DeadLetters(os.path.join(output_directory, 'dead_letters.jsonl'))
 
-        def on_message(message, data):
-            '''
-            callback function for dump messages
-            receives paths and copies them with scp
-            '''
-            t = threading.currentThread()
-            t.name = f'msg-{target}'
+        storage = self.storage if storage_headroom_MiB is not None else None
+        if storage is not None:
+            storage.headroom_MiB = storage_headroom_MiB
+        storage_full = False  # no install until an app is uninstalled
+
+        def on_verified(result, app):
+            metrics.observe('verify', self.device_label, result['seconds'], 'ok' if result['ok'] else 'error')
+            if result['ok']:
+                # encrypted app extensions are kept (recorded in the catalog), dumping again can't decrypt them
+                return
+            metrics.APPS_TOTAL.inc(device=self.device_label, outcome='invalid')
+            failed_dir = os.path.join(output_directory, 'failed')
             try:
-                payload = message['payload']
-            except KeyError:
-                self.log.warning(f'{target}: No payload in message')
-                self.log.debug(f'Message: {message}')
+                os.makedirs(failed_dir, exist_ok=True)
+                os.replace(result['path'], os.path.join(failed_dir, os.path.basename(result['path'])))
+            except OSError as e:
+                self.log.warning(f"Could not move {result['path']} to {failed_dir}: {str(e)}")
                 return
-
-            if 'info' in payload:
-                self.log.debug(f"{target}: {payload['info']}")
-
-            if 'warn' in payload:
-                self.log.warning(f"{target}: {payload['warn']}")
-
-            if 'dump' in payload:
-                index = payload['path'].find('.app/') + 5
-                file_dict[os.path.basename(payload['dump'])] = payload['path'][index:]
-
-                with tqdm(unit="B", unit_scale=True, miniters=1, bar_format=bar_fmt, disable=disable_progress) as t:
-                    pr = progress_helper(t)
-                    with SCPClient(self.sshclient.get_transport(), socket_timeout=self.timeout, progress=pr) as scp:
-                        scp.get(payload['dump'], payload_dir + '/')
-
-                chmod_dir = os.path.join(payload_dir, os.path.basename(payload['dump']))
-                chmod_args = ('chmod', '655', chmod_dir)
-                try:
-                    subprocess.check_call(chmod_args)
-                except subprocess.CalledProcessError as err:
-                    self.log.error(f'{target}: {chmod_args} {str(err)}')
-
-            if 'app' in payload:
-                with tqdm(unit="B", unit_scale=True, miniters=1, bar_format=bar_fmt, disable=disable_progress) as t:
-                    pr = progress_helper(t)
-                    with SCPClient(self.sshclient.get_transport(), socket_timeout=self.timeout, progress=pr) as scp:
-                        scp.get(payload['app'], payload_dir + '/', recursive=True)
-
-                chmod_dir = os.path.join(payload_dir, os.path.basename(payload['app']))
-                chmod_args = ('chmod', '755', chmod_dir)
-                try:
-                    subprocess.check_call(chmod_args)
-                except subprocess.CalledProcessError as err:
-                    self.log.error(f'{target}: {chmod_args} {str(err)}')
-
-                file_dict['app'] = os.path.basename(payload['app'])
-
-            if 'done' in payload:
-                self.finished.set()
-
-        self.log.debug(f'{target}: Opening app')
-        self.ssh_cmd(f'open {target}')
-        time.sleep(0.1)
-
-        # create frida session
-        apps = self.frida_device.enumerate_applications()
-        session = None
-        for app in apps:
-            if app.identifier == target:
-                if app.pid == 0:
-                    self.log.error(f'{target}: Could not start app')
-                    return
-                session = self.frida_device.attach(app.pid)
-
-        # run script
-        with open(dumpjs_path) as f:
-            jsfile = f.read()
-        script = session.create_script(jsfile)
-        script.on('message', on_message)
-        self.log.debug(f'{target}: Loading script')
-        script.load()
-        script.post('dump')
-
-        success = False
-        if self.finished.wait(timeout=timeout):
-            if self.running:
-                generate_ipa()
-                self.log.debug(f'{target}: Dumping finished. Clean up temp dir {temp_dir}')
-
-                success = True
+            if app['itunes_id'] not in requeued:
+                self.log.warning(f"{app['bundleId']}: Dumping again because the IPA is invalid")
+                requeued.add(app['itunes_id'])
+                retry.append(ingest.Entry(app['itunes_id'], app['country']))
             else:
-                self.log.debug(f'{target}: Cancelling dump. Clean up temp dir {temp_dir}')
-        else:
-            self.log.error(f'{target}: Timeout of {timeout}s exceeded. Clean up temp dir {temp_dir}')
+                dead_letters.add(app, fail(failures.ERROR, '; '.join(result['errors']), 'verify'))
 
-        shutil.rmtree(temp_dir)
+        verifier = None
+        if verify and sink.local_path('') is None:
+            self.log.warning(f'IPAs are not verified, they are streamed to {sink}')
+        elif verify:
+            catalog_path = os.path.join(output_directory, 'catalog.jsonl')
+            verifier = Verifier(catalog_path, workers=verify_workers, on_result=on_verified, log_level=self.log_level)
 
-        if session:
-            session.detach()
-        return success
+        def verifying():
+            return verifier is not None and verifier.busy()
 
-    def bulk_decrypt(self, itunes_ids, timeout_per_MiB=0.5, parallel=3, output_directory='ipa_output', country='us'):
-        '''
-        Installs apps, decrypts and uninstalls them
-        In parallel!
-        itunes_ids: list of int with the iTunes IDs
-        '''
-        if type(itunes_ids[0]) != int:
-            self.log.error('bulk_decrypt: list of int needed')
-            return False
-        total = len(itunes_ids)
-        wait_for_install = []  # apps that are currently downloading and installing
-        done = []  # apps that are uninstalled
-        waited_time = 0
-        while len(itunes_ids) > 0 or len(wait_for_install) > 0:
-            self.log.debug(f'Done {len(done)}/{total}, installing: {len(wait_for_install)}')
-            if len(itunes_ids) > 0 and len(wait_for_install) < parallel:
+        def requeue():
+            '''
+            Give back apps which are not done to the other devices of a shared feed
+            Installing apps are only given back if the device was stopped, else they are dumped first.
+            '''
+            unfinished = list(retry)
+            if not self.running:
+                unfinished += [ingest.Entry(app['itunes_id'], app['country']) for app in wait_for_install]
+            for entry in unfinished:
+                feed.requeue(entry)
+            retry.clear()
+            if len(unfinished) > 0:
+                self.log.info(f'Requeued {len(unfinished)} apps')
+
+        def finish():
+            feed.close()
+            if verifier is not None:
+                verifier.shutdown()
+            if isinstance(feed, ingest.Lease):
+                requeue()
+
+        while self.running and (not feed.done() or len(retry) > 0 or len(wait_for_install) > 0 or verifying()):
+            if len(retry) > 0 and isinstance(feed, ingest.Lease) and feed.drained.is_set():
+                requeue()
+                continue
+            entry = None
+            if len(wait_for_install) < self.parallel and not storage_full:
+                entry = retry.popleft() if len(retry) > 0 else feed.get()
+            if entry is None and len(wait_for_install) == 0:
+                # nothing is installing: wait for IDs (of a followed file) or verifications (they may requeue apps)
+                if verifying():
+                    verifier.wait(timeout=1)
+                else:
+                    feed.wait(timeout=1)
+                continue
+            self.log.debug(f'Done {done}, installing: {len(wait_for_install)}')
+            if entry is not None:
                 # install app
                 self.log.info(f'Installing, len: {len(wait_for_install)}')
 
-                itunes_id = itunes_ids.pop()
-                if self.already_dumped(itunes_id, output_directory):
-                    self.log.warning(f'{itunes_id}: Skipping, app is already dumped.')
-                    continue
-
-                trackName, version, bundleId, fileSizeMiB, price, currency = itunes_info(
-                    itunes_id, log_level=self.log_level, country=country
-                )
-
-                if not bundleId:
-                    self.log.warning(f'{itunes_id}: Skipping, app not found.')
+                itunes_id = entry.itunes_id
+                app_country = entry.country or country
+                found = {}
+
+                def metadata():
+                    info = itunes_info(itunes_id, log_level=self.log_level, country=app_country)
+                    if info is None or not info[2]:
+                        return fail(failures.NOT_AVAILABLE, f'not found in storefront {app_country}')
+                    found['info'] = info
+                    return Result()
+
+                with tracing.span('itunes_info', device=self.device_label, app=itunes_id), metrics.stage(
+                    'metadata', self.device_label
+                ) as stage:
+                    result = retrier.run('metadata', metadata, label=itunes_id)
+                    if not result:
+                        stage.fail(result.failure)
+                if not result:
+                    self.log.warning(f'{itunes_id}: Skipping, app not found ({result.message}).')
+                    metrics.APPS_TOTAL.inc(device=self.device_label, outcome='not_found')
+                    dead_letters.add({'itunes_id': itunes_id, 'country': app_country}, result)
                     continue
+                trackName, version, bundleId, fileSizeMiB, price, currency = found['info']
 
-                app = {'bundleId': bundleId, 'fileSizeMiB': fileSizeMiB, 'itunes_id': itunes_id, 'version': version}
+                app = {
+                    'bundleId': bundleId,
+                    'fileSizeMiB': fileSizeMiB,
+                    'itunes_id': itunes_id,
+                    'country': app_country,
+                    'version': version,
+                    'install_start': time.perf_counter(),
+                }
 
                 if price != 0:
                     self.log.warning(f'{bundleId}: Skipping, app is not for free ({price} {currency})')
+                    metrics.APPS_TOTAL.inc(device=self.device_label, outcome='not_free')
+                    dead_letters.add(app, fail(failures.NOT_FREE, f'{price} {currency}', 'metadata'))
                     continue
 
                 if self.__is_installed(bundleId) is not False:
                     self.log.info(f'{bundleId}: Skipping, app already installed')
-                    total -= 1
                     # subprocess.check_output(['ideviceinstaller', '--uninstall', bundleId])
                     continue
 
+                if storage is not None and not storage.reserve(itunes_id, fileSizeMiB):
+                    needed, available = storage.needed_MiB(fileSizeMiB), storage.available_MiB()
+                    if len(wait_for_install) == 0:
+                        self.log.error(
+                            f'{bundleId}: Skipping, needs {needed:.0f} MiB on device, {available:.0f} MiB available'
+                        )
+                        metrics.APPS_TOTAL.inc(device=self.device_label, outcome='no_space')
+                        dead_letters.add(app, fail(failures.DEVICE_BUSY, f'needs {needed:.0f} MiB', 'install'))
+                        continue
+                    self.log.info(f'{bundleId}: Waiting for free space on device ({needed:.0f} MiB needed)')
+                    retry.appendleft(entry)  # next app after an uninstall
+                    storage_full = True
+                    continue
+
+                with tracing.span('install', device=self.device_label, app=bundleId), metrics.stage(
+                    'install', self.device_label
+                ) as stage:
+                    result = retrier.run(
+                        'install', lambda: self.install(itunes_id), recover=self.recover, label=bundleId
+                    )
+                    if not result:
+                        stage.fail(result.failure)
+                if not result:
+                    self.log.error(f'{bundleId}: Skipping, installing failed ({result.failure}: {result.message})')
+                    metrics.APPS_TOTAL.inc(device=self.device_label, outcome='failed')
+                    dead_letters.add(app, result)
+                    if storage is not None:
+                        storage.release(itunes_id)
+                    continue
                 wait_for_install.append(app)
-                self.install(itunes_id)
                 self.log.info(f'{bundleId}: Waiting for download and installation to finish ({fileSizeMiB} MiB)')
             else:
                 # check if an app installation has finished
@@ -747,7 +1008,7 @@ class AppleDL:
 
                 install_finished = False
                 to_download_size = 0
-                for app in wait_for_install:
+                for app in list(wait_for_install):
                     if self.__is_installed(app['bundleId']) is not False:
                         # dump app
 
@@ -755,32 +1016,72 @@ class AppleDL:
                             f"{app['bundleId']}: Download and installation finished. Opening app and starting dump"
                         )
                         install_finished = True
+                        now = time.perf_counter()
+                        metrics.observe('install_wait', self.device_label, now - app['install_start'])
+                        tracing.TRACER.add(
+                            'install_wait',
+                            app['install_start'],
+                            now,
+                            track=f"install {app['bundleId']}",
+                            device=self.device_label,
+                            app=app['bundleId'],
+                            MiB=app['fileSizeMiB'],
+                        )
                         waited_time = 0
                         # waited_time -= app['fileSizeMiB'] * timeout_per_MiB
                         # if waited_time < 0:
                         #     waited_time = 0
                         wait_for_install.remove(app)
-
-                        try:
-                            os.mkdir(output_directory)
-                        except FileExistsError:
-                            pass
+                        if storage is not None:
+                            storage.installed(app['itunes_id'])
 
                         name = f"{app['itunes_id']}_{app['bundleId']}_{app['version']}.ipa"
-                        output = os.path.join(output_directory, name)
                         timeout = self.timeout + app['fileSizeMiB'] // 2
                         disable_progress = False if self.log_level == 'debug' else True
 
-                        self.dump_frida(app['bundleId'], output, timeout=timeout, disable_progress=disable_progress)
-                        # uninstall app after dump
-                        self.log.info(f"{app['bundleId']}: Uninstalling")
-                        if self.udid is None:
-                            subprocess.check_output(['ideviceinstaller', '--uninstall', app['bundleId']])
-                        else:
-                            subprocess.check_output(
-                                ['ideviceinstaller', '--udid', self.udid, '--uninstall', app['bundleId']]
+                        with tracing.span('app', device=self.device_label, app=app['bundleId']) as span:
+                            with tracing.span('dump_frida'), metrics.stage('dump', self.device_label) as stage:
+                                # the app stays installed while the dump is retried
+                                dumped = retrier.run(
+                                    'dump',
+                                    lambda: self.dump_frida(
+                                        app['bundleId'],
+                                        name,
+                                        timeout=timeout,
+                                        disable_progress=disable_progress,
+                                        priority=transfers.PRIORITY_UNINSTALL,
+                                        sink=sink,
+                                    ),
+                                    recover=self.recover,
+                                    label=app['bundleId'],
+                                )
+                                if not dumped:
+                                    stage.fail(dumped.failure)
+                            if not dumped:
+                                dead_letters.add(app, dumped)
+                            # uninstall app after dump
+                            self.log.info(f"{app['bundleId']}: Uninstalling")
+                            retrier.run(
+                                'uninstall',
+                                lambda: self.__uninstall(app['bundleId']),
+                                recover=self.recover,
+                                label=app['bundleId'],
                             )
-                        done.append(app)
+                            if storage is not None:
+                                storage.release(app['itunes_id'])
+                            storage_full = False
+                            size = 0
+                            try:
+                                size = sink.size(name) if dumped else 0
+                            except OSError as e:
+                                self.log.warning(f'{name}: Could not get size from {sink}: {str(e)}')
+                            span.set(dumped=bool(dumped), bytes=size)
+                        metrics.APPS_TOTAL.inc(device=self.device_label, outcome='dumped' if dumped else 'failed')
+                        if dumped and verifier is not None:
+                            info = {k: app[k] for k in ('itunes_id', 'country', 'bundleId', 'version')}
+                            verifier.submit(sink.local_path(name), info)
+                        self.write_metrics()
+                        done += 1
                     else:
                         # recalculate remaining download size
                         to_download_size += app['fileSizeMiB']
@@ -788,77 +1089,92 @@ class AppleDL:
                 # wait for an app to finish installation
                 if install_finished is False:
                     self.log.debug(f'Need to download {to_download_size} MiB')
-                    if waited_time > self.timeout + timeout_per_MiB * to_download_size:
+                    if waited_time > self.timeout + self.timeout_per_MiB * to_download_size:
                         self.log.error(
                             f'Timeout exceeded. Waited time: {waited_time}. Need to download: {to_download_size} MiB'
                         )
                         self.log.debug(f'Wait for install queue: {wait_for_install}')
+                        for app in wait_for_install:
+                            metrics.observe(
+                                'install_wait', self.device_label, time.perf_counter() - app['install_start'], 'timeout'
+                            )
+                            result = fail(failures.TIMEOUT, f'not installed after {waited_time}s', 'install')
+                            dead_letters.add(app, result)
+                        wait_for_install.clear()
+                        finish()
+                        self.write_metrics()
                         return False
                     else:
                         waited_time += 1
                         time.sleep(1)
 
+        finish()
+        self.log.info(f'{done} apps processed, {feed.read} IDs read, {feed.duplicates} duplicates skipped')
+        if len(dead_letters) > 0:
+            counts = ', '.join(f'{n} {failure}' for failure, n in dead_letters.counts().items())
+            self.log.warning(f'{len(dead_letters)} apps failed ({counts}), see {dead_letters.path}')
+        if len(retrier.retries) > 0:
+            self.log.info(f'Retried stages: {retrier.retries}')
+
     def install(self, itunes_id):
         '''
         Opens app in appstore on device and simulates touch input to download and installs the app.
         If there is a cloud button then press that and done
         Else if there is a load button, press that and confirm with install button.
-        return success
+        return Result (truthy on success, else with failure class)
         '''
-        if not self.init_ssh_done:
+        if not self.core.init_ssh_done:
             if not self.init_ssh():
-                return 1, '', ''
+                return fail(failures.TRANSIENT, 'no SSH connection', 'install')
         if not self.init_images_done:
             if not self.init_images():
-                return False
-        if not self.init_zxtouch_done:
+                return fail(failures.ERROR, 'could not upload images', 'install')
+        if not self.core.init_zxtouch_done:
             if not self.init_zxtouch():
-                return False
+                return fail(failures.TRANSIENT, 'no zxtouch connection', 'install')
         # get rid of permission request popups
         while True:
-            dissallow_xy = self.__match_image('dissallow.png')
-            if dissallow_xy is not False:
+            state, xy = self.__screen_state(['dissallow'])
+            if state == 'dissallow':
                 self.log.debug('Dissallow permission request')
-                self.__tap(dissallow_xy, message='dissallow')
+                self.__tap(xy, message='dissallow')
                 time.sleep(0.1)
             else:
                 break
 
         self.ssh_cmd(f'uiopen https://apps.apple.com/de/app/id{str(itunes_id)}')
 
+        # first wait for get or cloud button, after tapping get wait for install button
         self.log.debug(f'ID {itunes_id}: Waiting for get or cloud button to appear')
-        dl_btn_wait_time = 0
-        while dl_btn_wait_time <= self.timeout:
-            dl_btn_wait_time += 1
-            time.sleep(1)
-            dl_btn_xy = self.__match_image('get.png')
-            if dl_btn_xy is False:
-                dl_btn_xy = self.__match_image('cloud.png')
-                if dl_btn_xy is False:
-                    continue
-                else:
-                    # tap and done
-                    self.__tap(dl_btn_xy, 'cloud')
-                    return True
-            else:
-                self.__tap(dl_btn_xy, 'get')
-                break
-
-        if dl_btn_wait_time > self.timeout:
+        # popups are only checked with host matching, where they don't need an extra round trip
+        popups = ['dissallow'] if self.matcher is not None else []
+        buttons = popups + ['get', 'cloud']
+        poll = matcher.AdaptivePoll()
+        start = time.time()
+        while time.time() - start <= self.timeout:
+            time.sleep(poll.next())
+            state, xy = self.__screen_state(buttons)
+            if state == 'dissallow':
+                self.__tap(xy, message='dissallow')
+                poll.reset()
+            elif state == 'cloud':
+                # tap and done
+                self.__tap(xy, 'cloud')
+                return Result()
+            elif state == 'get':
+                # tap and need to wait and confirm with install button
+                self.__tap(xy, 'get')
+                self.__tap(xy, 'load')
+                self.log.debug(f'ID {itunes_id}: Waiting for install button to appear')
+                buttons = popups + ['install']
+                poll.reset()
+                start = time.time()
+            elif state == 'install':
+                self.__tap(xy, 'install')
+                return Result()
+
+        if 'get' in buttons:
             self.log.warning(f'ID {itunes_id}: No download button found after {self.timeout}s')
-            return False
-
-        # tap and need to wait and confirm with install button
-        self.__tap(dl_btn_xy, 'load')
-        self.log.debug(f'ID {itunes_id}: Waiting for install button to appear')
-        install_btn_wait_time = 0
-        while install_btn_wait_time <= self.timeout:
-            install_btn_wait_time += 1
-            time.sleep(1)
-            install_btn_xy = self.__match_image('install.png')
-            if install_btn_xy is not False:
-                self.__tap(install_btn_xy, 'install')
-                return True
-
+            return fail(failures.TIMEOUT, f'no download button after {self.timeout}s', 'install')
         self.log.warning(f'ID {itunes_id}: No install button found after {self.timeout}s')
-        return False
+        return fail(failures.TIMEOUT, f'no install button after {self.timeout}s', 'install')
@@ -0,0 +1,1112 @@
+# stdlib
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import os
+import shlex
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+# external
+from cachetools import TTLCache  # dict with timout
+from zxtouch import datahandler, deviceinfotasktypes, tasktypes, toasttypes, touchtypes
+import frida  # run scripts on device
+import paramiko  # ssh
+
+# internal
+import ipadumper
+from ipadumper.containers import ContainerIndex
+from ipadumper.fridasession import FridaSession
+from ipadumper.lockdown import InstallationProxy, Lockdown, LockdownError
+from ipadumper.usbmux import Usbmux
+from ipadumper.utils import free_port, get_logger
+from ipadumper import failures, metrics, sinks, tracing, transfers
+from ipadumper.failures import Result, fail
+
+
+class ChannelReader:
+    '''
+    Reads a paramiko channel in the event loop
+    The channel is polled with its fileno() (a pipe which paramiko makes readable when data or EOF arrives),
+    so no thread is blocked while the command runs. stderr is collected in self.stderr.
+    '''
+
+    def __init__(self, channel, timeout=None):
+        '''
+        timeout: raise socket.timeout if no data arrives within timeout seconds (None: wait forever)
+        '''
+        self.channel = channel
+        self.timeout = timeout
+        self.fd = channel.fileno()
+        self.buffer = bytearray()
+        self.stderr = bytearray()
+        self.eof = False
+
+    def __ready(self):
+        c = self.channel
+        return c.recv_ready() or c.recv_stderr_ready() or c.eof_received or c.closed
+
+    async def __wait(self):
+        '''
+        Wait until the channel has data, stderr data or EOF
+        The reader is only registered while waiting: the pipe stays readable until the data is read.
+        '''
+        if self.__ready():
+            return
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+
+        def on_readable():
+            if not readable.done():
+                readable.set_result(None)
+
+        loop.add_reader(self.fd, on_readable)
+        try:
+            await asyncio.wait_for(readable, self.timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout(f'No data from the device within {self.timeout}s')
+        finally:
+            loop.remove_reader(self.fd)
+
+    async def fill(self):
+        '''
+        Read available data into the buffer
+        return False on EOF
+        '''
+        while not self.eof:
+            await self.__wait()
+            if self.channel.recv_stderr_ready():
+                self.stderr += self.channel.recv_stderr(65536)
+            if self.channel.recv_ready():
+                data = self.channel.recv(1048576)
+                if data:
+                    self.buffer += data
+                    return True
+                self.eof = True
+            elif self.channel.eof_received or self.channel.closed:
+                self.eof = True
+        return False
+
+    async def read(self, size=-1):
+        '''
+        return up to size bytes (all buffered bytes if size is -1), b'' on EOF
+        '''
+        if len(self.buffer) == 0 and not await self.fill():
+            return b''
+        size = len(self.buffer) if size < 0 else size
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    async def readline(self):
+        while b'\n' not in self.buffer:
+            if not await self.fill():
+                break
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return line
+
+    async def readall(self):
+        while await self.fill():
+            pass
+        # stderr which arrived together with EOF
+        while self.channel.recv_stderr_ready():
+            self.stderr += self.channel.recv_stderr(65536)
+        return await self.read()
+
+    async def exit_status(self, timeout=15):
+        '''
+        return exit status of the command (-1 if it was not received)
+        '''
+        deadline = time.monotonic() + timeout
+        while not self.channel.exit_status_ready():
+            if time.monotonic() > deadline:
+                return -1
+            # the pipe stays readable after EOF, so the status is polled
+            await asyncio.sleep(0.005)
+        return self.channel.recv_exit_status()
+
+
+class AsyncZXTouch:
+    '''
+    zxtouch client on asyncio streams (same wire format as zxtouch.client, see zxtouch.datahandler)
+    Requests with a reply are serialized, touches have no reply.
+    '''
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.lock = asyncio.Lock()
+
+    async def request(self, task_type, *data):
+        '''
+        return result tuple (success, list of values or error message)
+        '''
+        async with self.lock:
+            self.writer.write(datahandler.format_socket_data(task_type, *data))
+            await self.writer.drain()
+            return datahandler.decode_socket_data(await self.reader.readuntil(b'\r\n'))
+
+    async def touch(self, type, finger_index, x, y):
+        data = '1{}{:02d}{:05d}{:05d}'.format(type, finger_index, int(x * 10), int(y * 10))
+        self.writer.write(datahandler.format_socket_data(tasktypes.TASK_PERFORM_TOUCH, data))
+        await self.writer.drain()
+
+    async def show_toast(self, toast_type, content, duration, position=0, fontSize=0):
+        return await self.request(tasktypes.TASK_SHOW_TOAST, toast_type, content, duration, position, fontSize)
+
+    async def image_match(self, template_path, acceptable_value=0.8, max_try_times=4, scaleRation=0.8):
+        ok, result = await self.request(
+            tasktypes.TASK_TEMPLATE_MATCH, template_path, max_try_times, acceptable_value, scaleRation
+        )
+        if not ok:
+            return False, result
+        return True, dict(zip(['x', 'y', 'width', 'height'], result))
+
+    async def get_screen_size(self):
+        ok, result = await self.request(
+            tasktypes.TASK_GET_DEVICE_INFO, deviceinfotasktypes.DEVICE_INFO_TASK_GET_SCREEN_SIZE
+        )
+        if not ok:
+            return False, result
+        return True, {'width': result[0], 'height': result[1]}
+
+    async def disconnect(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+class FridaBridge:
+    '''
+    Runs the blocking calls of Frida in a small thread pool which is shared by all devices
+    and forwards Frida callbacks (which run in a thread of Frida) into the event loop
+    '''
+
+    def __init__(self, workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='frida')
+
+    async def call(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    def queue(self):
+        '''
+        return asyncio.Queue and a callback for Frida which puts (message, data) into it
+        '''
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        def callback(message, data):
+            # a dump which failed early leaves the script sending until it's unloaded, the loop may be gone
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(queue.put_nowait, (message, data))
+
+        return queue, callback
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+async def run_tool(args, timeout=None, cwd=None):
+    '''
+    Run a tool (e.g. of libimobiledevice) as asyncio subprocess
+    return returncode, stdout, stderr (-1 and the error as stderr if it could not be run or timed out)
+    '''
+    try:
+        p = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, cwd=cwd
+        )
+    except OSError as e:
+        return -1, '', str(e)
+    try:
+        stdout, stderr = await asyncio.wait_for(p.communicate(), timeout)
+    except asyncio.TimeoutError:
+        p.kill()
+        await p.wait()
+        return -1, '', f'{args[0]} timed out after {timeout}s'
+    return p.returncode, stdout.decode('utf-8', errors='replace'), stderr.decode('utf-8', errors='replace')
+
+
+class AsyncAppleDL:
+    '''
+    asyncio core for a single device: SSH commands and transfers, usbmuxd and lockdownd, the tools of
+    libimobiledevice, zxtouch and Frida without a thread per operation
+    One event loop can drive many devices; threads are only used by paramiko (one per connection),
+    by the shared FridaBridge and for blocking calls (opening SSH channels, lockdownd, sink writes).
+
+        async with AsyncAppleDL(udid) as a:
+            await a.dump_frida('com.app.name', 'app.ipa')
+
+    AppleDL runs these coroutines on a LoopThread for its synchronous API.
+    '''
+
+    def __init__(
+        self,
+        udid=None,
+        device_address='localhost',
+        ssh_key_filename='iphone',
+        local_ssh_port=0,
+        local_zxtouch_port=0,
+        timeout=15,
+        log_level='info',
+        frida_device=None,
+        tunnel='auto',
+        transfer_bus='host',
+        bridge=None,
+    ):
+        '''
+        bridge: FridaBridge shared by the devices of the event loop (default: own bridge)
+        other arguments as for AppleDL
+        Create it in the event loop which runs it.
+        '''
+        self.udid = udid
+        self.device_address = device_address
+        self.ssh_key_filename = ssh_key_filename
+        self.local_ssh_port = local_ssh_port
+        self.local_zxtouch_port = local_zxtouch_port
+        self.timeout = timeout
+        self.log_level = log_level
+        self.log = get_logger(log_level, name=__name__, device=udid)
+        self.frida_device = frida_device
+        self.custom_frida_device = frida_device is not None
+        self.tunnel = tunnel
+        self.transfer_bus = transfer_bus
+        self.own_bridge = bridge is None
+        self.bridge = FridaBridge() if bridge is None else bridge
+        self.device_label = udid or device_address
+        self.usbmux = Usbmux(timeout=timeout)
+        self.usbmux_device = None
+        self.lockdown = None
+        self.installation_proxy = None  # False if lockdownd is not usable, ideviceinstaller is used then
+        self.lockdown_lock = asyncio.Lock()
+        self.installed_cached = TTLCache(maxsize=1, ttl=2)
+        self.processes = []
+        self.log_tasks = []
+        self.sshclient = None
+        self.containers = None  # ContainerIndex, once SSH is connected
+        self.device = None  # AsyncZXTouch
+        self.frida_session = None
+        self.dump_queues = set()  # message queues of running dumps, cleanup cancels them
+        self.running = True
+
+        self.init_frida_done = False
+        self.init_ssh_done = False
+        self.init_zxtouch_done = False
+
+    async def __aenter__(self):
+        if not await self.init_all():
+            await self.cleanup()
+            raise ConnectionError(f'Could not connect to device {self.device_label}')
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.cleanup()
+
+    async def init_all(self):
+        '''
+        Connect Frida, SSH and zxtouch concurrently
+        return success
+        '''
+        start = time.perf_counter()
+        if not await self.device_connected():
+            return False
+        results = await asyncio.gather(self.init_frida(), self.init_ssh(), self.init_zxtouch())
+        self.log.debug(f'Initialization finished after {time.perf_counter() - start:.2f}s (success: {all(results)})')
+        return all(results)
+
+    async def cleanup(self):
+        '''
+        Cancel running dumps, disconnect and stop iproxy
+        '''
+        self.running = False
+        for queue in self.dump_queues:
+            queue.put_nowait(({'type': 'cancelled'}, None))
+        loop = asyncio.get_running_loop()
+        if self.installation_proxy:
+            # waits for a command of another thread
+            await loop.run_in_executor(None, self.installation_proxy.close)
+            await loop.run_in_executor(None, self.lockdown.close)
+        if self.device is not None:
+            await self.device.disconnect()
+        if self.sshclient is not None:
+            await loop.run_in_executor(None, self.sshclient.close)
+        for idx, p in enumerate(self.processes, start=1):
+            self.log.debug(f'Stopping process {idx}/{len(self.processes)}')
+            if p.returncode is None:
+                p.terminate()
+                await p.wait()
+        if len(self.log_tasks) > 0:
+            await asyncio.gather(*self.log_tasks)
+        if self.own_bridge:
+            self.bridge.shutdown()
+
+    async def recover(self, result):
+        '''
+        Prepare the retry of a failed stage (failures.Result)
+        After a lost connection or a timeout SSH is reconnected if its transport is gone and the Frida device and
+        session layer are created again, so the next dump attaches to a fresh session.
+        return success
+        '''
+        if not self.running:
+            return False
+        if result.failure not in (failures.TRANSIENT, failures.TIMEOUT, failures.CRASHED):
+            return True
+        if self.init_ssh_done:
+            transport = self.sshclient.get_transport()
+            if transport is None or not transport.is_active():
+                self.log.info('SSH connection lost, reconnecting')
+                self.sshclient.close()
+                self.init_ssh_done = False
+        if not self.init_ssh_done and not await self.init_ssh():
+            return False
+        if result.failure == failures.CRASHED:
+            return True  # the crashed app is spawned again
+        # the cached device may be the dead handle of the lost connection, look it up again
+        # (a device passed in can't be looked up, it's only dropped when Frida reports it lost)
+        if not self.custom_frida_device or (self.frida_device is not None and self.frida_device.is_lost()):
+            self.frida_device = None
+        self.init_frida_done = False
+        return await self.init_frida()
+
+    async def __use_usbmux(self):
+        '''
+        return True if connections are opened through usbmuxd instead of iproxy
+        '''
+        if self.tunnel == 'iproxy':
+            return False
+        if self.usbmux_device is None:
+            loop = asyncio.get_running_loop()
+            try:
+                self.usbmux_device = await loop.run_in_executor(None, self.usbmux.device, self.udid)
+            except OSError as e:
+                if self.tunnel == 'usbmux':
+                    self.log.error(f'Could not connect to usbmuxd at {self.usbmux.address}: {str(e)}')
+        return self.usbmux_device is not None
+
+    async def __usbmux_connect(self, port):
+        return await asyncio.get_running_loop().run_in_executor(None, self.usbmux.connect, self.usbmux_device, port)
+
+    async def __log_output(self, stream, log, name):
+        async for line in stream:
+            log(f"{name}: {line.decode('utf-8', errors='replace').rstrip()}")
+
+    async def __iproxy(self, device_port):
+        '''
+        Start iproxy for a device port and log its output
+        return local port
+        '''
+        local_port = free_port()
+        args = ['iproxy', str(local_port), str(device_port)]
+        if self.udid is not None:
+            args[1:1] = ['--udid', self.udid]
+        self.log.info(f"Starting: {' '.join(args)}")
+        p = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        self.processes.append(p)
+        name = ' '.join(args[:3])
+        self.log_tasks.append(asyncio.ensure_future(self.__log_output(p.stdout, self.log.info, name)))
+        self.log_tasks.append(asyncio.ensure_future(self.__log_output(p.stderr, self.log.warning, name)))
+        return local_port
+
+    async def device_connected(self):
+        '''
+        return True if a device is available else return False
+        '''
+        if await self.__use_usbmux():
+            if await self.__installation_proxy():
+                name, version = await self.device_info('DeviceName'), await self.device_info('ProductVersion')
+                self.log.debug(f'Connected to {name} (iOS {version})')
+            return True
+        if self.tunnel == 'usbmux':
+            self.log.error(f'Device {self.udid or ""} not found by usbmuxd')
+            return False
+        args = ['ideviceinfo'] if self.udid is None else ['ideviceinfo', '--udid', self.udid]
+        returncode, _, _ = await run_tool(args, timeout=self.timeout)
+        if returncode != 0:
+            self.log.error(f'Device {self.udid or ""} not found')
+            return False
+        return True
+
+    async def __installation_proxy(self):
+        '''
+        return InstallationProxy of the device or None if lockdownd can't be reached through usbmuxd
+        '''
+        async with self.lockdown_lock:
+            if self.installation_proxy is None:
+                self.installation_proxy = False
+                if await self.__use_usbmux():
+                    self.lockdown = Lockdown(
+                        self.udid, usbmux=self.usbmux, timeout=self.timeout, log_level=self.log_level
+                    )
+                    try:
+                        await asyncio.get_running_loop().run_in_executor(None, self.lockdown.connect)
+                        self.installation_proxy = InstallationProxy(self.lockdown, log_level=self.log_level)
+                    except (OSError, ssl.SSLError, KeyError) as e:
+                        self.log.warning(f'Could not connect to lockdownd, using libimobiledevice tools: {str(e)}')
+                        self.lockdown.close()
+        return self.installation_proxy or None
+
+    async def device_info(self, key):
+        '''
+        return lockdown value of the device (e.g. DeviceName, ProductVersion, ProductType) or None
+        '''
+        if await self.__installation_proxy():
+            try:
+                return await asyncio.get_running_loop().run_in_executor(None, self.lockdown.get_value, key)
+            except (OSError, ssl.SSLError) as e:
+                self.log.warning(f'Could not get {key} from lockdownd: {str(e)}')
+                return None
+        args = ['ideviceinfo', '-k', key] if self.udid is None else ['ideviceinfo', '--udid', self.udid, '-k', key]
+        returncode, out, _ = await run_tool(args, timeout=self.timeout)
+        return out.strip() if returncode == 0 else None
+
+    async def init_frida(self):
+        '''
+        set frida device
+        return success
+        '''
+        self.log.debug('Setting frida device')
+        try:
+            if self.frida_device is not None:
+                pass
+            elif self.udid is None:
+                self.frida_device = await self.bridge.call(frida.get_usb_device)
+            else:
+                self.frida_device = await self.bridge.call(frida.get_device, self.udid)
+        except frida.InvalidArgumentError:
+            self.log.error('No Frida USB device found')
+            return False
+        except (frida.TransportError, frida.ServerNotRunningError) as e:
+            self.log.error(f'Could not connect to Frida: {str(e)}')
+            return False
+        self.frida_session = FridaSession(self.frida_device, log_level=self.log_level, device=self.udid)
+        self.init_frida_done = True
+        return True
+
+    async def init_ssh(self):
+        '''
+        Connect SSH, the handshake runs in the default executor
+        return success
+        '''
+        self.log.debug('Initializing SSH connection to device')
+        use_usbmux = await self.__use_usbmux()
+        if not use_usbmux and self.local_ssh_port == 0:
+            self.local_ssh_port = await self.__iproxy(22)
+        self.sshclient = paramiko.SSHClient()
+        self.sshclient.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        loop = asyncio.get_running_loop()
+        # poll until iproxy listens and the device side is connected
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                sock = await self.__usbmux_connect(22) if use_usbmux else None
+                connect = functools.partial(
+                    self.sshclient.connect,
+                    'localhost',
+                    port=self.local_ssh_port,
+                    username='root',
+                    key_filename=self.ssh_key_filename,
+                    timeout=self.timeout,
+                    sock=sock,
+                )
+                await loop.run_in_executor(None, connect)
+                break
+            except FileNotFoundError:
+                self.log.error(f'Could not find ssh keyfile "{self.ssh_key_filename}"')
+                return False
+            except paramiko.ssh_exception.AuthenticationException as e:
+                self.log.error(f'SSH authentication failed: {str(e)}')
+                return False
+            except (EOFError, OSError, paramiko.ssh_exception.SSHException) as e:
+                if time.monotonic() > deadline:
+                    self.log.error(f'Could not establish SSH connection: {str(e)}')
+                    return False
+                await asyncio.sleep(0.05)
+        self.containers = ContainerIndex(
+            self.sshclient, timeout=self.timeout, log_level=self.log_level, device=self.udid
+        )
+        self.init_ssh_done = True
+        return True
+
+    async def init_zxtouch(self):
+        '''
+        return success
+        '''
+        use_usbmux = await self.__use_usbmux()
+        if use_usbmux:
+            self.log.info('Connecting to zxtouch through usbmuxd')
+        else:
+            if self.local_zxtouch_port == 0:
+                self.local_zxtouch_port = await self.__iproxy(6000)
+            self.log.info(f'Connecting to device at {self.device_address}:{self.local_zxtouch_port}')
+        # poll until iproxy listens or the tweak accepts connections
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                if use_usbmux:
+                    reader, writer = await asyncio.open_connection(sock=await self.__usbmux_connect(6000))
+                else:
+                    reader, writer = await asyncio.open_connection(self.device_address, self.local_zxtouch_port)
+                break
+            except OSError as e:
+                if time.monotonic() > deadline:
+                    self.log.error(f'Could not connect to zxtouch: {str(e)}')
+                    return False
+                await asyncio.sleep(0.05)
+        self.device = AsyncZXTouch(reader, writer)
+        self.init_zxtouch_done = True
+        return True
+
+    async def __exec(self, cmd, timeout=None):
+        '''
+        Open a channel and run cmd, opening waits for the reply of the device and runs in the default executor
+        timeout: of the reads (see ChannelReader)
+        return ChannelReader
+        '''
+
+        def open_channel():
+            transport = self.sshclient.get_transport()
+            if transport is None or not transport.is_active():
+                raise paramiko.ssh_exception.SSHException('SSH connection lost')
+            channel = transport.open_session(timeout=self.timeout)
+            channel.exec_command(cmd)
+            return channel
+
+        return ChannelReader(await asyncio.get_running_loop().run_in_executor(None, open_channel), timeout)
+
+    async def ssh_cmd(self, cmd):
+        '''
+        execute command via ssh
+        return exitcode, stdout, stderr
+        '''
+        if not self.init_ssh_done and not await self.init_ssh():
+            return 1, '', ''
+
+        self.log.debug(f'Run ssh cmd: {cmd}')
+        with tracing.span('ssh_cmd', device=self.device_label, cmd=cmd[:200]) as span:
+            try:
+                r = await self.__exec(cmd)
+            except (OSError, paramiko.ssh_exception.SSHException) as e:
+                self.log.error(f'Could not run ssh cmd: {str(e)}')
+                return 1, '', ''
+            try:
+                out = (await r.readall()).decode('utf-8', errors='replace')
+                exitcode = await r.exit_status(self.timeout)
+            finally:
+                r.channel.close()
+            err = r.stderr.decode('utf-8', errors='replace')
+            span.set(exitcode=exitcode, bytes=len(out))
+
+        if exitcode != 0 or out != '' or err != '':
+            self.log.debug(f'Exitcode: {exitcode}\nSTDOUT:\n{out}STDERR:\n{err}DONE')
+        return exitcode, out, err
+
+    async def __consume(self, t, nbytes):
+        '''
+        Account nbytes of the transfer t in the transfer scheduler
+        '''
+        if transfers.SCHEDULER.throttled(t):
+            # waits for the budget without blocking the loop
+            await asyncio.get_running_loop().run_in_executor(None, t.consume, nbytes)
+        else:
+            t.consume(nbytes)
+
+    async def scp_get(self, remote_path, local_path, recursive=False, disable_progress=False, priority=0):
+        '''
+        Copy file or directory from device (sink side of the scp protocol) through the transfer scheduler
+        priority: transfers with a higher priority get the bandwidth first (transfers.PRIORITY_UNINSTALL)
+        return number of transferred bytes or None if scp reported an error
+        raise socket.timeout if the device stops sending, OSError or SSHException if the connection is lost
+        '''
+        with metrics.stage('transfer', self.device_label) as stage, tracing.span('scp', path=remote_path) as span:
+            start = time.perf_counter()
+            with transfers.SCHEDULER.transfer(
+                self.device_label, self.transfer_bus, priority, name=remote_path, disable_progress=disable_progress
+            ) as t:
+                r = await self.__exec(f"scp {'-r ' if recursive else ''}-f {shlex.quote(remote_path)}", self.timeout)
+                try:
+                    copied = await self.__scp_sink(r, remote_path, local_path, t)
+                finally:
+                    r.channel.close()
+                    metrics.transfer(self.device_label, t.bytes, time.perf_counter() - start)
+                    span.set(bytes=t.bytes)
+            if copied is None:
+                stage.fail()
+        return copied
+
+    async def __scp_sink(self, r, remote_path, local_path, t):
+        '''
+        Receive files and directories of scp -f into local_path
+        return number of transferred bytes or None if scp reported an error
+        '''
+        directories = [local_path]
+        r.channel.sendall(b'\0')
+        while True:
+            line = await r.readline()
+            if line == b'':
+                return t.bytes
+            kind, rest = line[:1], line[1:].rstrip(b'\n').decode('utf-8', errors='surrogateescape')
+            if kind in (b'\x01', b'\x02'):
+                self.log.error(f'scp {remote_path}: {rest}')
+                return None
+            if kind == b'E':
+                directories.pop()
+            elif kind in (b'C', b'D'):
+                mode, size, name = rest.split(' ', 2)
+                base = directories[-1]
+                path = os.path.join(base, name) if os.path.isdir(base) else base
+                if kind == b'D':
+                    os.makedirs(path, exist_ok=True)
+                    os.chmod(path, int(mode, 8))
+                    directories.append(path)
+                else:
+                    r.channel.sendall(b'\0')
+                    await self.__receive_file(r, path, int(size), t)
+                    os.chmod(path, int(mode, 8))
+                    await r.read(1)  # status of the source
+            r.channel.sendall(b'\0')
+
+    async def __receive_file(self, r, path, size, t):
+        with open(path, 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                data = await r.read(min(remaining, 1048576))
+                if data == b'':
+                    raise EOFError(f'scp: connection closed, {remaining} bytes of {path} are missing')
+                f.write(data)
+                remaining -= len(data)
+                await self.__consume(t, len(data))
+
+    async def ssh_stream(self, cmd, writer, disable_progress=False, priority=0):
+        '''
+        Run cmd on the device and stream its stdout into writer (of a sink) through the transfer scheduler
+        The writes run in the default executor, writes to a sink may block (e.g. uploads).
+        return exit status and stderr of cmd
+        '''
+        loop = asyncio.get_running_loop()
+        with metrics.stage('transfer', self.device_label), tracing.span('stream', cmd=cmd) as span:
+            start = time.perf_counter()
+            with transfers.SCHEDULER.transfer(
+                self.device_label, self.transfer_bus, priority, name=cmd, disable_progress=disable_progress
+            ) as t:
+                r = await self.__exec(cmd, self.timeout)
+                try:
+                    while True:
+                        data = await r.read(sinks.CHUNK_SIZE)
+                        if data == b'':
+                            break
+                        await self.__consume(t, len(data))
+                        await loop.run_in_executor(None, writer.write, data)
+                    await r.readall()
+                    ret = await r.exit_status(self.timeout)
+                finally:
+                    r.channel.close()
+            metrics.transfer(self.device_label, t.bytes, time.perf_counter() - start)
+            span.set(bytes=t.bytes)
+        return ret, r.stderr.decode('utf-8', errors='replace')
+
+    async def installed_apps(self):
+        '''
+        return dict bundleId -> (CFBundleVersion, CFBundleDisplayName) of the installed user apps
+        Browsed with installation_proxy over a kept open connection or with ideviceinstaller -l.
+        '''
+        proxy = await self.__installation_proxy()
+        if proxy is not None:
+            attributes = ['CFBundleIdentifier', 'CFBundleVersion', 'CFBundleDisplayName']
+            try:
+                apps = await asyncio.get_running_loop().run_in_executor(None, proxy.browse, attributes)
+                return {
+                    app['CFBundleIdentifier']: (app.get('CFBundleVersion', ''), app.get('CFBundleDisplayName', ''))
+                    for app in apps
+                }
+            except (OSError, ssl.SSLError) as e:
+                self.log.warning(f'Browsing apps with installation_proxy failed, using ideviceinstaller: {str(e)}')
+
+        args = ['ideviceinstaller', '-l'] if self.udid is None else ['ideviceinstaller', '--udid', self.udid, '-l']
+        returncode, out, err = await run_tool(args, timeout=self.timeout)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args, output=out, stderr=err)
+        installed = {}
+        for line in out.splitlines()[1:]:
+            CFBundleIdentifier, CFBundleVersion, CFBundleDisplayName = line.split(', ')
+            installed[CFBundleIdentifier] = (CFBundleVersion.strip('"'), CFBundleDisplayName.strip('"'))
+        return installed
+
+    async def is_installed(self, bundleId):
+        '''
+        return version code if app is installed else return False
+        The installed apps are cached for two seconds.
+        '''
+        try:
+            installed = self.installed_cached[0]
+        except KeyError:
+            installed = await self.installed_apps()
+            self.installed_cached[0] = installed
+
+        if bundleId in installed:
+            version, displayName = installed[bundleId]
+            self.log.debug(f'Found installed app {bundleId}: {version} ({displayName})')
+            return version
+        return False
+
+    async def uninstall(self, bundleId):
+        '''
+        return Result (truthy on success, else with failure class)
+        '''
+        proxy = await self.__installation_proxy()
+        with metrics.stage('uninstall', self.device_label) as stage:
+            if proxy is not None:
+                try:
+                    await asyncio.get_running_loop().run_in_executor(
+                        None,
+                        functools.partial(
+                            proxy.uninstall,
+                            bundleId,
+                            progress=lambda percent, status: self.log.debug(f'{bundleId}: {status} {percent}%'),
+                        ),
+                    )
+                except (OSError, ssl.SSLError) as e:
+                    self.log.error(f'{bundleId}: Uninstalling failed: {str(e)}')
+                    stage.fail()
+                    # an error reply (e.g. app not installed) does not change with a retry
+                    failure = failures.ERROR if isinstance(e, LockdownError) else failures.TRANSIENT
+                    return fail(failure, f'installation_proxy: {str(e)}', 'uninstall')
+            else:
+                args = ['ideviceinstaller', '--uninstall', bundleId]
+                if self.udid is not None:
+                    args[1:1] = ['--udid', self.udid]
+                returncode, out, err = await run_tool(args, timeout=self.timeout * 4)
+                if returncode != 0:
+                    self.log.error(f'{bundleId}: Uninstalling failed: {err.strip()}')
+                    stage.fail()
+                    # ideviceinstaller fails if usbmuxd or lockdownd lost the device
+                    return fail(failures.TRANSIENT, f'ideviceinstaller: {err.strip()}', 'uninstall')
+        if self.containers is not None:
+            self.containers.remove(bundleId)
+        self.installed_cached.clear()
+        return Result()
+
+    async def tap(self, xy, message=''):
+        '''
+        Simulate touch input (single tap) and show toast message on device
+        '''
+        x, y = xy
+        self.log.debug(f'Tapping {xy} {message}')
+        with tracing.span('tap', device=self.device_label, button=message):
+            await self.device.show_toast(toasttypes.TOAST_WARNING, f'{message} ({x},{y})', 1.5)
+            await self.device.touch(touchtypes.TOUCH_DOWN, 1, x, y)
+            await asyncio.sleep(0.1)
+            await self.device.touch(touchtypes.TOUCH_UP, 1, x, y)
+
+    async def dump_frida(
+        self,
+        target,
+        output,
+        timeout=120,
+        disable_progress=False,
+        dumpjs_path=os.path.join(os.path.dirname(ipadumper.__file__), 'dump.js'),
+        selective=True,
+        priority=0,
+        sink=None,
+    ):
+        '''
+        target: Bundle identifier of the target app
+        output: Specify name of the decrypted IPA
+        sink: store the IPA with the name output in a sink (see sinks.py), the zip is streamed into it
+        dumpjs_path:  path to dump.js
+        timeout: timeout in for dump to finish
+        disable_progress: disable progress bars
+        selective: only load and dump the main executable and encrypted images (the rest is in the app bundle)
+        priority: priority of the transfers (transfers.PRIORITY_UNINSTALL if an uninstall waits for the dump)
+        The messages of dump.js are handled in the event loop, modules are copied with scp_get while the next
+        module is dumped.
+        return Result (truthy on success, else with failure class)
+
+
+        partly copied from
+        https://github.com/AloneMonkey/frida-ios-dump/blob/9e75f6bca34f649aa6fcbafe464eca5d624784d6/dump.py
+
+        MIT License
+
+        Copyright (c) 2017 Alone_Monkey
+
+        Permission is hereby granted, free of charge, to any person obtaining a copy
+        of this software and associated documentation files (the "Software"), to deal
+        in the Software without restriction, including without limitation the rights
+        to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+        copies of the Software, and to permit persons to whom the Software is
+        furnished to do so, subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be included in all
+        copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+        IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+        FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+        AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+        LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+        OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+        SOFTWARE.
+        '''
+        if not self.running:
+            return fail(failures.ERROR, 'cancelled', 'dump')
+        if not self.init_ssh_done and not await self.init_ssh():
+            return fail(failures.TRANSIENT, 'no SSH connection', 'dump')
+        if not self.init_frida_done and not await self.init_frida():
+            return fail(failures.TRANSIENT, 'no Frida device', 'dump')
+
+        sink, name = (sink, output) if sink is not None else sinks.for_path(output)
+        temp_dir = tempfile.mkdtemp()
+        self.log.debug(f'{target}: Start dumping with Frida. Temp dir: {temp_dir}')
+        payload_dir = os.path.join(temp_dir, 'Payload')
+        os.mkdir(payload_dir)
+        file_dict = {}
+        queue, post = self.bridge.queue()
+        self.dump_queues.add(queue)
+        session = None
+        try:
+            # create frida session, spawned apps stay suspended until the script is loaded
+            self.log.debug(f'{target}: Opening app')
+            with metrics.stage('frida_attach', self.device_label) as stage:
+                try:
+                    session, pid, spawned = await self.bridge.call(self.frida_session.open, target)
+                except (frida.ExecutableNotFoundError, frida.NotSupportedError) as e:
+                    stage.fail()
+                    self.log.error(f'{target}: Could not start app: {str(e)}')
+                    return fail(failures.ERROR, f'could not start app: {str(e)}', 'dump')
+                except (frida.ProcessNotFoundError, frida.TransportError, frida.ServerNotRunningError) as e:
+                    stage.fail()
+                    self.log.error(f'{target}: Could not start app: {str(e)}')
+                    return fail(failures.classify_exception(e), f'could not start app: {str(e)}', 'dump')
+
+            # run script
+            session.on('detached', lambda reason, crash: post({'type': 'detached', 'reason': reason}, None))
+            script = await self.bridge.call(self.frida_session.create_script, session, dumpjs_path)
+            script.on('message', post)
+            self.log.debug(f'{target}: Loading script')
+            await self.bridge.call(script.load)
+            if spawned:
+                gate = await self.bridge.call(lambda: script.exports_sync.armlaunchgate())
+                await self.bridge.call(self.frida_session.resume, pid)
+                if not gate:
+                    self.log.warning(f'{target}: Could not find entry point, dumping without waiting for launch')
+                else:
+                    try:
+                        launched = self.__handle_messages(target, queue, file_dict, 'launched')
+                        result = await asyncio.wait_for(launched, self.timeout)
+                    except asyncio.TimeoutError:
+                        result = fail(failures.CRASHED, f'no launch within {self.timeout}s', 'dump')
+                    if not result:
+                        self.log.error(f'{target}: App did not launch within {self.timeout}s ({result.message})')
+                        # a half launched app is not attached to again
+                        await self.bridge.call(self.frida_session.kill, target, pid)
+                        return result
+            await self.bridge.call(script.post, {'type': 'dump', 'selective': selective})
+
+            try:
+                result = await asyncio.wait_for(
+                    self.__handle_messages(
+                        target, queue, file_dict, 'done', payload_dir, disable_progress, priority
+                    ),
+                    timeout,
+                )
+            except asyncio.TimeoutError:
+                self.log.error(f'{target}: Timeout of {timeout}s exceeded. Clean up temp dir {temp_dir}')
+                return fail(failures.TIMEOUT, f'dump not finished within {timeout}s', 'dump')
+            if not result:
+                self.log.error(f'{target}: Dump failed ({result.message}). Clean up temp dir {temp_dir}')
+                return result
+            if not self.running:
+                self.log.debug(f'{target}: Cancelling dump. Clean up temp dir {temp_dir}')
+                return fail(failures.ERROR, 'cancelled', 'dump')
+            with tracing.span('generate_ipa', device=self.device_label, app=target):
+                result = await self.__package(target, sink, name, temp_dir, payload_dir, file_dict)
+            self.log.debug(f'{target}: Dumping finished. Clean up temp dir {temp_dir}')
+            return result
+        finally:
+            self.dump_queues.discard(queue)
+            if session is not None:
+                try:
+                    await self.bridge.call(session.detach)
+                except frida.InvalidOperationError:
+                    pass  # already detached
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    async def __handle_messages(
+        self, target, queue, file_dict, until, payload_dir=None, disable_progress=False, priority=0
+    ):
+        '''
+        Handle messages of dump.js until a payload with the key until arrives
+        Detaching the session (the app crashed or the connection was lost) and cleanup end the dump.
+        return Result, failed if dump.js sent an error, copying a dumped file failed or the dump ended
+        '''
+        while True:
+            message, data = await queue.get()
+            if message.get('type') == 'cancelled':
+                return fail(failures.ERROR, 'cancelled', 'dump')
+            if message.get('type') == 'detached':
+                reason = message['reason']
+                if reason == 'application-requested':
+                    continue
+                if reason in ('connection-terminated', 'device-lost'):
+                    return fail(failures.TRANSIENT, f'Frida session detached: {reason}', 'dump')
+                return fail(failures.CRASHED, f'app terminated: {reason}', 'dump')
+
+            payload = message.get('payload')
+            if not isinstance(payload, dict):
+                self.log.warning(f'{target}: No payload in message')
+                self.log.debug(f'Message: {message}')
+                continue
+            if 'info' in payload:
+                self.log.debug(f"{target}: {payload['info']}")
+            if 'launched' in payload:
+                self.log.debug(f'{target}: App launched')
+            if 'warn' in payload:
+                self.log.warning(f"{target}: {payload['warn']}")
+            if 'error' in payload:
+                # e.g. a module was copied incompletely
+                self.log.error(f"{target}: {payload['error']}")
+                return fail(failures.ERROR, payload['error'], 'dump')
+            if 'dump' in payload:
+                if 'stats' in payload:
+                    stats = payload['stats']
+                    self.log.debug(
+                        f"{target}: Dumped {os.path.basename(payload['path'])}: {stats['bytes']} bytes copied with "
+                        + f"{stats['method']} in {stats['copy_ms']}ms, {stats['patched']} bytes patched in "
+                        + f"{stats['patch_ms']}ms"
+                    )
+                index = payload['path'].find('.app/') + 5
+                file_dict[os.path.basename(payload['dump'])] = payload['path'][index:]
+                result = await self.__copy(
+                    target, payload['dump'], payload_dir, 0o655, disable_progress=disable_progress, priority=priority
+                )
+                if not result:
+                    return result
+            if 'app' in payload:
+                result = await self.__copy(
+                    target,
+                    payload['app'],
+                    payload_dir,
+                    0o755,
+                    recursive=True,
+                    disable_progress=disable_progress,
+                    priority=priority,
+                )
+                if not result:
+                    return result
+                file_dict['app'] = os.path.basename(payload['app'])
+            if until in payload:
+                return Result()
+
+    async def __copy(self, target, remote_path, payload_dir, mode, recursive=False, disable_progress=False, priority=0):
+        '''
+        Copy a dumped module or the app into the payload directory
+        return Result
+        '''
+        try:
+            copied = await self.scp_get(
+                remote_path,
+                payload_dir + '/',
+                recursive=recursive,
+                disable_progress=disable_progress,
+                priority=priority,
+            )
+        except (EOFError, OSError, paramiko.ssh_exception.SSHException) as e:
+            # e.g. the SSH connection was lost or timed out, the dump can't be complete
+            self.log.error(f'{target}: Copying dumped files failed: {type(e).__name__}: {str(e)}')
+            return fail(failures.classify_exception(e), f'scp: {str(e)}', 'dump')
+        if copied is None:
+            self.log.error(f'{target}: Copying {remote_path} failed')
+            return fail(failures.ERROR, f'scp: copying {remote_path} failed', 'dump')
+        os.chmod(os.path.join(payload_dir, os.path.basename(remote_path)), mode)
+        return Result()
+
+    async def __package(self, target, sink, name, temp_dir, payload_dir, file_dict):
+        '''
+        Move the dumped modules into the app and zip it into the sink
+        Runs in the default executor, writes to the sink (e.g. uploads) block.
+        return Result
+        '''
+
+        def package():
+            self.log.debug(f'{target}: Generate ipa')
+            for key, value in file_dict.items():
+                if key != 'app':
+                    shutil.move(os.path.join(payload_dir, key), os.path.join(payload_dir, file_dict['app'], value))
+            self.log.debug(f'{target}: Set access and modified date to 0 for reproducible zip files')
+            for directory, dirnames, filenames in os.walk(temp_dir):
+                for filename in dirnames + filenames:
+                    os.utime(os.path.join(directory, filename), (0, 0))
+            self.log.debug(f'{target}: Run zip into {name} in {sink}')
+            with sink.open(name) as writer:
+                sinks.pipe(['zip', '-qrX', '-', 'Payload'], writer, cwd=temp_dir)
+
+        with metrics.stage('package', self.device_label) as stage:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, package)
+            except subprocess.CalledProcessError as e:
+                stage.fail()
+                self.log.error(f"{target}: zip returned {e.returncode} {e.stderr.decode('utf-8', errors='replace')}")
+                return fail(failures.ERROR, f'zip: {str(e)}', 'dump')
+            except OSError as e:
+                stage.fail()
+                self.log.error(f'{target}: Storing IPA in {sink} failed: {str(e)}')
+                return fail(failures.classify_exception(e), f'sink: {str(e)}', 'dump')
+        return Result()
+
+
+class LoopThread:
+    '''
+    Event loop in a background thread with a FridaBridge for the devices it drives
+    '''
+
+    def __init__(self, name='asyncdl', frida_workers=4):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self.thread.start()
+        self.bridge = FridaBridge(workers=frida_workers)
+
+    def submit(self, coro):
+        '''
+        Schedule coroutine in the loop
+        return concurrent.futures.Future of its result
+        '''
+        if threading.current_thread() is self.thread:
+            raise RuntimeError('Waiting for the loop in its own thread would block it')
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        '''
+        Run coroutine in the loop and return its result
+        '''
+        return self.submit(coro).result(timeout)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.bridge.shutdown()
+
+
+_shared_loop = None
+_shared_loop_lock = threading.Lock()
+
+
+def shared_loop():
+    '''
+    return the LoopThread which drives the devices of all AppleDL instances of this process
+    '''
+    global _shared_loop
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            _shared_loop = LoopThread(frida_workers=16)
+        return _shared_loop
@@ -0,0 +1,328 @@
+# stdlib
+import asyncio
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# external
+import frida  # run scripts on device
+
+# internal
+import ipadumper
+from ipadumper import metrics
+from ipadumper.macho import fat_slices
+from ipadumper.utils import get_logger
+
+
+def first_arch(path):
+    '''
+    return cputype, cpusubtype of the first slice if path is a fat Mach-O else 0, 0
+    '''
+    with open(path, 'rb') as f:
+        header = f.read(4096)
+    try:
+        slices = fat_slices(header)
+    except ValueError:
+        slices = []
+    if len(slices) == 0:
+        return 0, 0
+    return slices[0][0], slices[0][1]
+
+
+def bench_dump_copy(
+    fixtures=[],
+    size_MiB=64,
+    bufsizes=[4096, 8 * 2**20],
+    repeat=3,
+    dumpjs_path=os.path.join(os.path.dirname(ipadumper.__file__), 'dump.js'),
+    log_level='info',
+):
+    '''
+    Run the copy engine of dump.js against local fixture files
+    The script is loaded into a local helper process, so no device is needed.
+    fixtures: list of paths to files. When empty a random fixture with size_MiB is generated
+    bufsizes: buffer sizes for the pread/pwrite loop (4096 is the size of the old copy loop)
+    return list of results (dict with fixture, method, bufsize, bytes, ms, MiB/s)
+    '''
+    log = get_logger(log_level, name=__name__)
+    temp_dir = tempfile.mkdtemp()
+
+    if len(fixtures) == 0:
+        fixture = os.path.join(temp_dir, f'fixture_{size_MiB}MiB')
+        log.info(f'Generating fixture {fixture}')
+        with open(fixture, 'wb') as f:
+            for _ in range(size_MiB):
+                f.write(os.urandom(2**20))
+        fixtures = [fixture]
+
+    device = frida.get_local_device()
+    pid = device.spawn(['/bin/sleep', '3600'])
+    session = device.attach(pid)
+
+    def on_message(message, data):
+        if message['type'] == 'send' and 'warn' in message['payload']:
+            log.debug(f"dump.js: {message['payload']['warn']}")
+        elif message['type'] == 'send' and 'error' in message['payload']:
+            log.error(f"dump.js: {message['payload']['error']}")
+        elif message['type'] == 'error':
+            log.error(f"dump.js: {message.get('description')}")
+
+    with open(dumpjs_path) as f:
+        script = session.create_script(f.read())
+    script.on('message', on_message)
+    script.load()
+
+    # runs: (method, bufsize, usecopyfile)
+    runs = [('pread/pwrite', bufsize, False) for bufsize in bufsizes] + [('copyfile', 0, True)]
+
+    results = []
+    try:
+        for fixture in fixtures:
+            cputype, cpusubtype = first_arch(fixture)
+            dst = os.path.join(temp_dir, os.path.basename(fixture) + '.fid')
+            for method, bufsize, usecopyfile in runs:
+                best = None
+                for _ in range(repeat):
+                    stats = script.exports_sync.copymacho(
+                        os.path.abspath(fixture), dst, cputype, cpusubtype, bufsize or 4096, usecopyfile
+                    )
+                    if stats is None:
+                        break
+                    if best is None or stats['ms'] < best['ms']:
+                        best = stats
+                if best is None or best['method'] != method:
+                    log.info(f'{os.path.basename(fixture)}: {method} not available')
+                    continue
+                speed = best['bytes'] / 2**20 / max(best['ms'], 1) * 1000
+                result = {
+                    'fixture': fixture,
+                    'method': method,
+                    'bufsize': bufsize,
+                    'bytes': best['bytes'],
+                    'ms': best['ms'],
+                    'MiB/s': round(speed, 1),
+                }
+                log.info(
+                    f"{os.path.basename(fixture)}: {method:13} bufsize {bufsize:>9}: "
+                    + f"{best['bytes']} bytes in {best['ms']}ms ({result['MiB/s']} MiB/s)"
+                )
+                results.append(result)
+    finally:
+        script.unload()
+        session.detach()
+        device.kill(pid)
+        shutil.rmtree(temp_dir)
+
+    return results
+
+
+def peak_rss_MiB():
+    '''
+    return peak resident set size of this process in MiB
+    '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def stage_latencies(device):
+    '''
+    return dict stage -> (count, mean seconds, total seconds) of a device from the metrics
+    '''
+    stages = {}
+    with metrics.STAGE_SECONDS.lock:
+        items = list(metrics.STAGE_SECONDS.values.items())
+    for (stage, label, _), (counts, total) in items:
+        if label != device:
+            continue
+        count, seconds = stages.get(stage, (0, 0))
+        stages[stage] = (count + sum(counts), seconds + total)
+    return {stage: (count, seconds / count, seconds) for stage, (count, seconds) in stages.items() if count > 0}
+
+
+def bench_simulated(
+    command='bulk_decrypt',
+    apps=10,
+    parallel=3,
+    app_size_MiB=4,
+    frameworks=1,
+    install_latency=2.0,
+    bandwidth_MiBps=50,
+    decrypt_MiBps=200,
+    popup_rate=0.0,
+    storage_MiB=65536,
+    host_matching=True,
+    log_level='info',
+):
+    '''
+    Run bulk_decrypt, dump_frida or dump_fouldecrypt against a simulated device (see simulator.py)
+    For the dump commands all apps are installed before the timer starts.
+    return dict with apps, dumped, seconds, apps/hour, peak RSS and latency of every stage
+    '''
+    # imported here, the simulator is not needed for the other benchmarks
+    from ipadumper.appledl import AppleDL
+    from ipadumper.simulator import Simulator
+
+    log = get_logger(log_level, name=__name__)
+    output_directory = tempfile.mkdtemp()
+    environ = dict(os.environ)
+    sim = Simulator(
+        apps=apps,
+        app_size_MiB=app_size_MiB,
+        frameworks=frameworks,
+        install_latency=install_latency,
+        bandwidth_MiBps=bandwidth_MiBps,
+        decrypt_MiBps=decrypt_MiBps,
+        popup_rate=popup_rate,
+        storage_MiB=storage_MiB,
+        log_level=log_level,
+    )
+    a = None
+    try:
+        sim.start()
+        os.environ.update(sim.environ())
+        a = AppleDL(
+            udid=sim.udid,
+            ssh_key_filename=sim.client_key_path,
+            frida_device=sim.frida_device(),
+            position_cache_path=None,
+            host_matching=host_matching,
+            init=False,
+            log_level=log_level,
+        )
+        if not a.running or not a.init_all():
+            log.error('Could not connect to the simulated device')
+            return None
+
+        device = sim.devices[sim.udid]
+        catalogue = list(sim.catalogue.values())
+        if command != 'bulk_decrypt':
+            for app in catalogue:
+                device.install_now(app)
+
+        start = time.time()
+        if command == 'bulk_decrypt':
+            a.bulk_decrypt([app.itunes_id for app in catalogue], parallel=parallel, output_directory=output_directory)
+        else:
+            dump = a.dump_frida if command == 'dump_frida' else a.dump_fouldecrypt
+            for app in catalogue:
+                dump(app.bundleId, os.path.join(output_directory, f'{app.bundleId}.ipa'), disable_progress=True)
+        seconds = time.time() - start
+
+        dumped = len([f for f in os.listdir(output_directory) if f.endswith('.ipa')])
+        result = {
+            'command': command,
+            'apps': apps,
+            'dumped': dumped,
+            'seconds': round(seconds, 2),
+            'apps/hour': round(dumped / seconds * 3600, 1),
+            'peak_rss_MiB': round(peak_rss_MiB(), 1),
+            'stages': stage_latencies(a.device_label),
+        }
+        log.info(
+            f"{command}: {dumped}/{apps} apps in {result['seconds']}s ({result['apps/hour']} apps/hour), "
+            + f"peak RSS {result['peak_rss_MiB']} MiB"
+        )
+        for stage in metrics.STAGES:
+            if stage in result['stages']:
+                count, mean, total = result['stages'][stage]
+                log.info(f'{stage:13} {count:5}x  mean {mean * 1000:9.1f}ms  total {total:8.2f}s')
+        return result
+    finally:
+        if a is not None:
+            a.cleanup()
+        sim.stop()
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(output_directory)
+
+
+def bench_async(devices=4, apps=10, app_size_MiB=4, frameworks=1, decrypt_MiBps=200, log_level='info'):
+    '''
+    Dump all apps of several simulated devices with AsyncAppleDL in one event loop
+    The devices run concurrently, the apps of a device one after the other.
+    return dict with devices, apps, dumped, seconds, apps/hour, peak threads and peak RSS
+    '''
+    # imported here, the simulator is not needed for the other benchmarks
+    from ipadumper.asyncdl import AsyncAppleDL, FridaBridge
+    from ipadumper.simulator import Simulator
+
+    log = get_logger(log_level, name=__name__)
+    output_directory = tempfile.mkdtemp()
+    environ = dict(os.environ)
+    sim = Simulator(
+        apps=apps,
+        app_size_MiB=app_size_MiB,
+        frameworks=frameworks,
+        devices=devices,
+        decrypt_MiBps=decrypt_MiBps,
+        log_level=log_level,
+    )
+    peak_threads = [0]
+
+    async def device_job(a, catalogue):
+        dumped = 0
+        for app in catalogue:
+            output = os.path.join(output_directory, f'{a.udid}_{app.bundleId}.ipa')
+            dumped += bool(await a.dump_frida(app.bundleId, output, disable_progress=True))
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+        return dumped
+
+    async def run():
+        bridge = FridaBridge()
+        dls = [
+            AsyncAppleDL(
+                udid=udid,
+                ssh_key_filename=sim.client_key_path,
+                frida_device=sim.frida_device(udid),
+                bridge=bridge,
+                log_level=log_level,
+            )
+            for udid in sim.devices
+        ]
+        try:
+            if not all(await asyncio.gather(*[a.init_all() for a in dls])):
+                log.error('Could not connect to the simulated devices')
+                return None
+            start = time.time()
+            dumped = await asyncio.gather(*[device_job(a, list(sim.catalogue.values())) for a in dls])
+            return sum(dumped), time.time() - start
+        finally:
+            await asyncio.gather(*[a.cleanup() for a in dls])
+            bridge.shutdown()
+
+    try:
+        sim.start()
+        os.environ.update(sim.environ())
+        for device in sim.devices.values():
+            for app in sim.catalogue.values():
+                device.install_now(app)
+        done = asyncio.run(run())
+        if done is None:
+            return None
+        dumped, seconds = done
+        result = {
+            'command': 'async_dump_frida',
+            'devices': devices,
+            'apps': apps * devices,
+            'dumped': dumped,
+            'seconds': round(seconds, 2),
+            'apps/hour': round(dumped / seconds * 3600, 1),
+            'peak_threads': peak_threads[0],
+            'peak_rss_MiB': round(peak_rss_MiB(), 1),
+        }
+        log.info(
+            f"async_dump_frida: {dumped}/{result['apps']} apps on {devices} devices in {result['seconds']}s "
+            + f"({result['apps/hour']} apps/hour), {result['peak_threads']} threads, "
+            + f"peak RSS {result['peak_rss_MiB']} MiB"
+        )
+        return result
+    finally:
+        sim.stop()
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(output_directory)
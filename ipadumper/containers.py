@@ -0,0 +1,151 @@
+# stdlib
+from collections import namedtuple
+import io
+import plistlib
+import re
+import tarfile
+import threading
+
+# internal
+from ipadumper.utils import get_logger
+
+
+Container = namedtuple('Container', ['uuid', 'app_dir', 'executable', 'version'])
+UUID_PATTERN = re.compile(r'^[0-9A-Fa-f]{8}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{12}$')
+
+
+class ContainerIndex:
+    '''
+    Index of the apps installed on a device: bundleId -> Container(uuid, app_dir, executable, version)
+    The index is built with one remote pass (all Info.plist files are transferred as one tar stream)
+    and afterwards only new containers are read. Lookups use the exact bundleId and read the Info.plist of the
+    cached container again, a reinstall or update can move or change the app.
+    '''
+
+    apps_dir = '/private/var/containers/Bundle/Application'
+
+    def __init__(self, sshclient, timeout=15, log_level='info', device=None):
+        self.sshclient = sshclient
+        self.timeout = timeout
+        self.log = get_logger(log_level, name=__name__, device=device)
+        self.lock = threading.RLock()
+        self.apps = {}  # bundleId -> Container
+        self.uuids = {}  # uuid -> bundleId
+        self.built = False
+
+    def __exec(self, cmd):
+        '''
+        return exitcode, stdout (bytes), stderr
+        '''
+        self.log.debug(f'Run ssh cmd: {cmd}')
+        stdin, stdout, stderr = self.sshclient.exec_command(cmd, timeout=self.timeout)
+        out = stdout.read()
+        err = stderr.read().decode('utf-8', errors='replace')
+        return stdout.channel.recv_exit_status(), out, err
+
+    def __read(self, uuids=None):
+        '''
+        Read Info.plist of the given containers (or all containers) with one command and add them to the index
+        return success
+        '''
+        paths = '*/*.app/Info.plist' if uuids is None else ' '.join(f'{u}/*.app/Info.plist' for u in uuids)
+        ret, out, err = self.__exec(f'cd {self.apps_dir} && tar -cf - {paths}')
+        if ret != 0 and len(out) == 0:
+            # new containers have no Info.plist while the app is still being installed
+            if uuids is None:
+                self.log.error(f'Could not read containers: tar returned {ret} {err}')
+            else:
+                self.log.debug(f'Could not read containers {uuids}: tar returned {ret} {err}')
+            return False
+
+        with tarfile.open(fileobj=io.BytesIO(out)) as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                uuid, app_dir, _ = member.name.split('/', 2)
+                try:
+                    info = plistlib.loads(tar.extractfile(member).read())
+                    bundleId = info['CFBundleIdentifier']
+                except (plistlib.InvalidFileException, KeyError, ValueError) as e:
+                    self.log.warning(f'Could not parse {member.name}: {str(e)}')
+                    continue
+                container = Container(
+                    uuid, app_dir, info.get('CFBundleExecutable', app_dir[:-4]), info.get('CFBundleShortVersionString')
+                )
+                self.apps[bundleId] = container
+                self.uuids[uuid] = bundleId
+        return True
+
+    def build(self):
+        '''
+        (Re)build the whole index
+        return success
+        '''
+        with self.lock:
+            self.apps = {}
+            self.uuids = {}
+            self.built = self.__read()
+            self.log.debug(f'Container index has {len(self.apps)} apps')
+            return self.built
+
+    def update(self):
+        '''
+        Remove deleted containers from the index and read new ones
+        return success
+        '''
+        with self.lock:
+            if not self.built:
+                return self.build()
+
+            ret, out, err = self.__exec(f'ls -1 {self.apps_dir}')
+            if ret != 0:
+                self.log.error(f'ls returned {ret} {err}')
+                return False
+            # skip everything else like staging directories (<uuid>_tmp)
+            uuids = set(u for u in out.decode('utf-8').split() if UUID_PATTERN.match(u))
+
+            for uuid in set(self.uuids) - uuids:
+                self.apps.pop(self.uuids.pop(uuid), None)
+
+            new = uuids - set(self.uuids)
+            if len(new) == 0:
+                return True
+            return self.__read(sorted(new))
+
+    def get(self, bundleId):
+        '''
+        return Container of the app or None if it is not installed
+        The index is updated if the app is not in it or its cached container is gone or has another app now.
+        '''
+        with self.lock:
+            container = self.apps.pop(bundleId, None)
+            if container is not None:
+                # a reinstall moves the app to a new container, an update can change it in place
+                self.uuids.pop(container.uuid, None)
+                self.__read([container.uuid])
+                if bundleId not in self.apps:
+                    self.log.debug(f'{bundleId}: Container {container.uuid} is stale, updating index')
+            if bundleId not in self.apps:
+                self.update()
+            return self.apps.get(bundleId)
+
+    def remove(self, bundleId):
+        '''
+        Remove app from the index (after uninstalling it)
+        '''
+        with self.lock:
+            container = self.apps.pop(bundleId, None)
+            if container is not None:
+                self.uuids.pop(container.uuid, None)
+
+    def path(self, bundleId):
+        '''
+        return path of the container of the app or None if it is not installed
+        '''
+        container = self.get(bundleId)
+        if container is None:
+            return None
+        return self.container_path(container)
+
+    def container_path(self, container):
+        return f'{self.apps_dir}/{container.uuid}'
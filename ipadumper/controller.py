@@ -1,92 +1,351 @@
+# stdlib
 import os
+import signal
+import threading
+import time
 
+# external
 import commentjson
 
+# internal
 import ipadumper
-from ipadumper.appledl import AppleDL
-from ipadumper.utils import itunes_info, get_logger
+from ipadumper import ingest, sinks, transfers
+from ipadumper.utils import get_logger
+
+
+REQUIRED = [
+    'name',
+    'udid',
+    'address',
+    'local_ssh_port',
+    'ssh_key_filename',
+    'local_zxtouch_port',
+    'image_base_path_device',
+    'image_base_path_local',
+    'theme',
+    'lang',
+    'timeout',
+    'log_level',
+    'country',
+    'parallel',
+    'timeout_per_MiB',
+    'output_directory',
+]
+
+# keys which are applied to a running session, a change of any other key restarts the session of the device
+TUNING = ['parallel', 'timeout_per_MiB', 'timeout', 'MiBps']
+
+
+def load_config(config_file):
+    '''
+    Read the config file and merge default into every device
+    Optional device keys: MiBps (bandwidth budget of the device), bus (USB bus, see transfers.py),
+    sink (where the IPAs are stored: local, cas or s3://bucket/prefix, see sinks.py)
+    return dict name -> device config
+    raise ValueError if the config is invalid, OSError if it can't be read
+    '''
+    with open(config_file) as f:
+        try:
+            config = commentjson.load(f)
+        except commentjson.JSONLibraryException as e:
+            raise ValueError(str(e))
+    if not isinstance(config, dict):
+        raise ValueError('Config is not an object')
+    default = config.get('default', {})
+    if not isinstance(default, dict) or not isinstance(config.get('devices', []), list):
+        raise ValueError('default must be an object and devices a list')
+
+    devices = {}
+    for device in config.get('devices', []):
+        if not isinstance(device, dict):
+            raise ValueError(f'Device {device!r} is not an object')
+        device = {**default, **device}
+        missing = [key for key in REQUIRED if key not in device]
+        if len(missing) > 0:
+            raise ValueError(f"Device {device.get('name', '')}: config entry {', '.join(missing)} is missing")
+        if device['name'] in devices:
+            raise ValueError(f"Device name {device['name']} is used twice")
+        sinks.parse_url(device.get('sink'))
+        if device['image_base_path_local'] == '':
+            device['image_base_path_local'] = os.path.join(os.path.dirname(ipadumper.__file__), 'appstore_images')
+        devices[device['name']] = device
+
+    if len(devices) > 1 and any(device['udid'] == '' for device in devices.values()):
+        raise ValueError('Please specify UDID when multiple devices are used')
+    return devices
+
+
+class Session:
+    '''
+    A device of the pool: an AppleDL which runs bulk_decrypt in a thread on a lease of the shared feed
+    '''
+
+    def __init__(self, name, config, lease):
+        self.name = name
+        self.config = config
+        self.lease = lease
+        self.a = None
+        self.thread = None
+        self.restart = False  # start again with the changed config once drained
+        self.failed = False
+        self.failures = 0  # sessions in a row which failed
 
 
 class MultiDevice:
     '''
     Mass downloading and dumping with multiple devices
+    All devices take the iTunes IDs from one feed. The config file is watched and changes are applied live:
+    - a new device gets a session
+    - a removed device is drained: installing apps are dumped, its queued apps go to the other devices
+    - changes of parallel, timeout_per_MiB, timeout and MiBps are applied to the running session
+    - other changes of a device restart its session after it is drained
+
+        MultiDevice('config.json', 'itunes_ids.txt').run()
     '''
 
-    def __init__(self, config_file, itunes_ids_file, log_level='info'):
+    def __init__(
+        self,
+        config_file,
+        itunes_ids_file,
+        log_level='info',
+        follow=False,
+        poll=2.0,
+        window=1000,
+        factory=None,
+        metrics_textfile=None,
+        trace_path=None,
+    ):
+        '''
+        follow: wait for IDs which are appended to itunes_ids_file (until SIGINT or SIGTERM)
+        poll: seconds between checks of the config file
+        metrics_textfile, trace_path: passed to the AppleDL of every device, metrics and spans of all devices are
+                                      written to the same file
+        factory: called with the AppleDL arguments of a device, returns an AppleDL (default: AppleDL)
+                 (e.g. to pass the frida_device of the simulator)
+        '''
+        if factory is None:
+            # imported here, the planner reads configs without frida, paramiko, etc.
+            from ipadumper.appledl import AppleDL
+
+            factory = AppleDL
+        self.config_file = config_file
+        self.itunes_ids_file = itunes_ids_file
         self.log_level = log_level
         self.log = get_logger(log_level, name=__name__)
+        self.follow = follow
+        self.poll = poll
+        self.window = window
+        self.factory = factory
+        self.metrics_textfile = metrics_textfile
+        self.trace_path = trace_path
+        self.lock = threading.RLock()  # also taken by the signal handler
+        self.stopping = threading.Event()
+        self.devices = {}  # name -> config
+        self.sessions = {}  # name -> Session
+        self.restart_at = {}  # name -> time when a failed session is started again
+        self.mtime = None
+        self.feed = None
 
+    def run(self):
+        '''
+        Dump the apps with all devices until all IDs are done (or until stopped if following)
+        return False if the config is invalid
+        '''
         try:
-            with open(config_file) as f:
-                self.config = commentjson.load(f)
-            with open(itunes_ids_file) as f:
-                self.itunes_ids = f
-        except FileNotFoundError:
-            self.log.error(f'File {config_file} not found')
-            return
+            self.mtime = os.stat(self.config_file).st_mtime_ns
+            self.devices = load_config(self.config_file)
+        except (OSError, ValueError) as e:
+            self.log.error(f'Invalid config {self.config_file}: {str(e)}')
+            return False
+        self.log.debug(commentjson.dumps(self.devices, indent=2))
 
-        default = self.config['default']
+        deduper = ingest.Deduper()
+        for output_directory, url in {(d['output_directory'], d.get('sink')) for d in self.devices.values()}:
+            sink = sinks.from_url(url, output_directory, log_level=self.log_level)
+            try:
+                seeded = deduper.seed(output_directory, names=sink.names())
+            except OSError as e:
+                self.log.error(f'Could not list the IPAs in {sink}: {str(e)}')
+                return False
+            self.log.debug(f'{seeded} apps are already dumped to {sink}')
+        lines = ingest.iter_lines(self.itunes_ids_file, follow=self.follow, stop=self.stopping)
+        entries = ingest.read_entries(lines, log_level=self.log_level)
+        self.feed = ingest.Feed(entries, window=self.window, deduper=deduper, log_level=self.log_level)
 
-        devices = []
-        for device in self.config['devices']:
-            for key in default:
-                device[key] = device.get(key, default[key])
-            devices.append(device)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.__signal_handler)
+            signal.signal(signal.SIGTERM, self.__signal_handler)
 
-        self.log.debug(commentjson.dumps(devices, indent=2))
+        with self.lock:
+            for name, config in self.devices.items():
+                self.__start(name, config)
 
-        countries = set()
-        for device in devices:
-            try:
-                name = device['name']
-                udid = device['udid']
-                address = device['address']
-                local_ssh_port = device['local_ssh_port']
-                ssh_key_filename = device['ssh_key_filename']
-                local_zxtouch_port = device['local_zxtouch_port']
-                image_base_path_device = device['image_base_path_device']
-                image_base_path_local = device['image_base_path_local']
-                theme = device['theme']
-                lang = device['lang']
-                timeout = device['timeout']
-                log_level = device['log_level']
-
-                country = device['country']
-                parallel = device['parallel']
-                timeout_per_MiB = device['timeout_per_MiB']
-                output_directory = device['output_directory']
-            except KeyError as e:
-                self.log.error(f'Config entry {str(e)} is missing')
-                return
+        idle = False
+        while True:
+            self.stopping.wait(self.poll)
+            if not self.stopping.is_set():
+                self.reload()
+            with self.lock:
+                alive = self.__reap()
+            if alive == 0 and (self.stopping.is_set() or self.feed.done()):
+                break
+            if alive == 0 and len(self.devices) == 0 and not idle:
+                self.log.warning(f'No devices in {self.config_file}, waiting for one to be added')
+            idle = alive == 0 and len(self.devices) == 0
 
-            countries.add(country)
+        self.feed.close()
+        self.log.info(f'{self.feed.read} IDs read, {self.feed.duplicates} duplicates skipped')
+        if not self.feed.done():
+            self.log.warning('Stopped before all IDs were dumped')
+        return True
 
-            if image_base_path_local == '':
-                image_base_path_local = os.path.join(os.path.dirname(ipadumper.__file__), 'appstore_images')
+    def __signal_handler(self, signum, frame):
+        if self.stopping.is_set():
+            self.log.info('Received second exit signal, stopping all devices')
+            with self.lock:
+                for session in self.sessions.values():
+                    if session.a is not None:
+                        session.a.cleanup()
+            return
+        self.log.info('Received exit signal, draining all devices (send it again to stop them now)')
+        self.stopping.set()
+        with self.lock:
+            for session in self.sessions.values():
+                session.lease.drain()
 
-            if udid == '' and len(devices) > 1:
-                self.log.error('Please specify UDID when multiple devices are used')
-                return
+    def reload(self):
+        '''
+        Apply the changes of the config file if it was modified, an invalid config is ignored
+        '''
+        try:
+            mtime = os.stat(self.config_file).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        try:
+            devices = load_config(self.config_file)
+        except (OSError, ValueError) as e:
+            self.log.error(f'Ignoring changed config {self.config_file}: {str(e)}')
+            return
+
+        with self.lock:
+            for name in self.devices.keys() - devices.keys():
+                self.restart_at.pop(name, None)
+                if name in self.sessions:
+                    self.log.info(f'{name}: Removed from config, draining')
+                    self.sessions[name].lease.drain()
+            for name in devices.keys() - self.devices.keys():
+                self.log.info(f'{name}: Added to config')
+                self.__start(name, devices[name])
+            for name in devices.keys() & self.devices.keys():
+                old, new = self.devices[name], devices[name]
+                changed = sorted(key for key in old.keys() | new.keys() if old.get(key) != new.get(key))
+                if len(changed) == 0 or name not in self.sessions:
+                    continue
+                session = self.sessions[name]
+                if set(changed) <= set(TUNING):
+                    self.log.info(f"{name}: Applying {', '.join(f'{key}={new.get(key)}' for key in changed)}")
+                    self.__tune(session, new)
+                else:
+                    self.log.info(f"{name}: {', '.join(changed)} changed, restarting session after draining")
+                    session.restart = True
+                    session.lease.drain()
+            self.devices = devices
+
+    def __start(self, name, config):
+        session = Session(name, config, ingest.Lease(self.feed))
+        session.thread = threading.Thread(target=self.__run_session, args=(session,), name=f'device-{name}')
+        self.sessions[name] = session
+        session.thread.start()
 
-            self.log.warning('Not implemented')
+    def __tune(self, session, config):
+        session.config = config
+        a = session.a
+        if a is None:
             return
-            # TODO
-
-            self.log.info(f'Initialising device {name}...')
-            AppleDL(
-                udid=udid,
-                device_address=address,
-                local_ssh_port=local_ssh_port,
-                ssh_key_filename=ssh_key_filename,
-                local_zxtouch_port=local_zxtouch_port,
-                image_base_path_device=image_base_path_device,
-                image_base_path_local=image_base_path_local,
-                theme=theme,
-                lang=lang,
-                timeout=timeout,
-                log_level=log_level,
+        a.parallel = config['parallel']
+        a.timeout_per_MiB = config['timeout_per_MiB']
+        a.timeout = config['timeout']
+        MiBps = config.get('MiBps')
+        transfers.SCHEDULER.set_limit(device=a.device_label, rate=MiBps * 2**20 if MiBps else None)
+
+    def __run_session(self, session):
+        config = session.config
+        self.log.info(f'{session.name}: Initialising device...')
+        a = None
+        try:
+            a = self.factory(
+                udid=config['udid'] or None,
+                device_address=config['address'],
+                local_ssh_port=config['local_ssh_port'],
+                ssh_key_filename=config['ssh_key_filename'],
+                local_zxtouch_port=config['local_zxtouch_port'],
+                image_base_path_device=config['image_base_path_device'],
+                image_base_path_local=config['image_base_path_local'],
+                theme=config['theme'],
+                lang=config['lang'],
+                timeout=config['timeout'],
+                log_level=config['log_level'],
+                transfer_bus=config.get('bus', 'host'),
+                metrics_textfile=self.metrics_textfile,
+                trace_path=self.trace_path,
             )
-        for itunes_id in itunes_ids:
-            info
-            for country in countries:
-                itunes_info(intunes_id, country)
+            if not a.running:
+                self.log.error(f'{session.name}: Could not connect to device')
+                session.failed = True
+                return
+            with self.lock:
+                session.a = a
+                self.__tune(session, session.config)
+                config = session.config
+            success = a.bulk_decrypt(
+                session.lease,
+                timeout_per_MiB=config['timeout_per_MiB'],
+                parallel=config['parallel'],
+                output_directory=config['output_directory'],
+                country=config['country'],
+                sink=sinks.from_url(config.get('sink'), config['output_directory'], log_level=config['log_level']),
+            )
+            session.failed = success is False or not a.running
+        except Exception:
+            self.log.exception(f'{session.name}: Session failed')
+            session.failed = True
+        finally:
+            if a is not None and a.running:
+                a.cleanup()
+
+    def __reap(self):
+        '''
+        Remove finished sessions and start them again if the device is still in the config and IDs are left
+        return number of running sessions and sessions which will be started again
+        '''
+        now = time.monotonic()
+        for name, session in list(self.sessions.items()):
+            if session.thread.is_alive():
+                continue
+            del self.sessions[name]
+            if name not in self.devices or self.stopping.is_set():
+                self.log.info(f'{name}: Session ended')
+            elif session.restart:
+                self.__start(name, self.devices[name])
+            elif self.feed.done():
+                continue
+            elif session.failed:
+                failures = session.failures + 1
+                delay = min(300, 10 * 2 ** (failures - 1))
+                self.log.warning(f'{name}: Session failed, starting it again in {delay}s')
+                self.restart_at[name] = (now + delay, failures)
+            else:
+                # IDs were given back by a drained device after this one had finished
+                self.__start(name, self.devices[name])
+
+        for name, (at, failures) in list(self.restart_at.items()):
+            if self.stopping.is_set() or name not in self.devices:
+                del self.restart_at[name]
+            elif now >= at:
+                del self.restart_at[name]
+                self.__start(name, self.devices[name])
+                self.sessions[name].failures = failures
+        return len(self.sessions) + len(self.restart_at)
@@ -0,0 +1,452 @@
+# stdlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import itertools
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+
+# internal
+from ipadumper import failures, ingest, metrics, sinks, transfers
+from ipadumper.usbmux import Usbmux
+from ipadumper.utils import LOG_DATEFMT, LOG_FORMAT, get_logger, itunes_info
+
+
+# jobs which need a device session
+DEVICE_COMMANDS = ['bulk_decrypt', 'dump', 'install', 'ssh_cmd']
+
+
+def default_socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(runtime_dir, f'ipadumper-{os.getuid()}.sock')
+
+
+def attached_udids():
+    '''
+    return list of UDIDs of the attached devices
+    '''
+    try:
+        return list(dict.fromkeys(device.udid for device in Usbmux().devices()))
+    except OSError:
+        pass
+    try:
+        out = subprocess.check_output(['idevice_id', '-l'], encoding='utf-8', stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    return [line.strip() for line in out.splitlines() if line.strip()]
+
+
+class _JobLogHandler(logging.Handler):
+    '''
+    Forward the log records of a job to the client
+    Records of the device of the job and records without device from the thread of the job are forwarded.
+    '''
+
+    def __init__(self, emit, device, thread):
+        super().__init__()
+        self.send = emit
+        self.device = device
+        self.thread = thread
+        self.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATEFMT))
+
+    def emit(self, record):
+        device = getattr(record, 'device', None)
+        if device is None and self.device is not None and record.thread != self.thread:
+            return
+        if device is not None and device != self.device:
+            return
+        if not hasattr(record, 'device_prefix'):
+            record.device_prefix = f'[{device}] ' if device else ''
+        try:
+            self.send({'log': self.format(record), 'level': record.levelname})
+        except OSError:
+            pass  # client is gone, the job continues
+
+
+class Session:
+    '''
+    Warm AppleDL instance of a device, jobs on the same device are run one after another
+    '''
+
+    def __init__(self, udid, appledl_args, log_level='info'):
+        self.udid = udid
+        self.appledl_args = appledl_args
+        self.log_level = log_level
+        self.lock = threading.Lock()
+        self.a = None
+        self.jobs = 0
+
+    def create(self):
+        '''
+        Create the AppleDL instance without connecting (signal handlers can only be set in the main thread)
+        '''
+        from ipadumper.appledl import AppleDL
+
+        self.a = AppleDL(udid=self.udid, log_level=self.log_level, init=False, **self.appledl_args)
+
+    def healthy(self):
+        if self.a is None or not self.a.running or not self.a.core.init_ssh_done:
+            return False
+        transport = self.a.core.sshclient.get_transport()
+        return transport is not None and transport.is_active()
+
+    def warm(self):
+        '''
+        Connect to the device (again if the connection was lost)
+        return success
+        '''
+        if self.healthy():
+            return True
+        if self.a is None or self.a.core.init_ssh_done or not self.a.running:
+            # connection lost
+            if self.a is not None:
+                self.a.cleanup()
+            self.create()
+        if not self.a.running:
+            return False
+        return self.a.init_all()
+
+    def close(self):
+        if self.a is not None and self.a.running:
+            self.a.cleanup()
+
+
+class Daemon:
+    '''
+    Keeps warm AppleDL sessions for all attached devices and runs jobs submitted over a Unix socket
+    Every connection sends one job as JSON line and receives log lines ({"log": ...}) and finally {"result": ...}
+    A job with "stream": true is followed by the lines of its input (e.g. iTunes IDs of bulk_decrypt) until the
+    client shuts down writing. A job with "connection" (AppleDL arguments like ssh_key_filename) is rejected if the
+    daemon was started with other values, its sessions can't use them. The "options" of a job (bandwidth budgets
+    and metrics) are applied to its session while it runs.
+
+        {"command": "dump", "udid": null, "args": {"bundleID": "com.app.name", "output": "/tmp/app.ipa"}}
+    '''
+
+    def __init__(self, socket_path=None, udids=None, appledl_args={}, log_level='info', metrics_port=None):
+        '''
+        udids: devices to keep sessions for (default: all attached devices or the only device)
+        appledl_args: arguments for AppleDL (ssh_key_filename, theme, ...)
+        metrics_port: serve Prometheus metrics on this port
+        '''
+        self.socket_path = socket_path or default_socket_path()
+        self.log_level = log_level
+        self.log = get_logger(log_level, name=__name__)
+        if udids is None:
+            udids = attached_udids() or [None]
+        self.appledl_args = appledl_args
+        self.sessions = {udid: Session(udid, appledl_args, log_level=log_level) for udid in udids}
+        self.server = None
+        self.stopping = threading.Lock()
+        self.stopped = threading.Event()
+        self.job_ids = itertools.count(1)
+        self.metrics_port = metrics_port
+        self.metrics_servers = {}  # port -> server
+
+    def start(self):
+        '''
+        Connect to all devices in parallel and listen on the socket
+        return success
+        '''
+        for s in self.sessions.values():
+            s.create()
+        # AppleDL sets signal handlers which only clean up one session
+        signal.signal(signal.SIGINT, self.__signal_handler)
+        signal.signal(signal.SIGTERM, self.__signal_handler)
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=len(self.sessions), thread_name_prefix='warm') as executor:
+            warm = list(executor.map(lambda s: s.warm(), self.sessions.values()))
+        for s, ok in zip(self.sessions.values(), warm):
+            if not ok:
+                self.log.error(f'Could not connect to device {s.udid or ""}, retrying on the first job')
+        self.log.info(f'{sum(warm)}/{len(warm)} device sessions ready after {time.time() - start:.1f}s')
+
+        if os.path.exists(self.socket_path):
+            if submit({'command': 'status'}, self.socket_path, on_log=None) is not None:
+                self.log.error(f'Another daemon is listening on {self.socket_path}')
+                return False
+            os.unlink(self.socket_path)  # stale socket
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                daemon.handle(self.rfile, self.wfile)
+
+        if self.metrics_port is not None:
+            self.serve_metrics(self.metrics_port)
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self.server.daemon_threads = True
+        os.chmod(self.socket_path, 0o600)
+        threading.Thread(target=self.server.serve_forever, name='daemon', daemon=True).start()
+        self.log.info(f'Listening on {self.socket_path}')
+        return True
+
+    def wait(self):
+        '''
+        Block until the daemon is stopped (by a signal or a shutdown job)
+        '''
+        while not self.stopped.wait(timeout=1):
+            pass
+
+    def stop(self):
+        if not self.stopping.acquire(blocking=False):
+            return
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            try:
+                os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+        for server in self.metrics_servers.values():
+            server.shutdown()
+            server.server_close()
+        for s in self.sessions.values():
+            s.close()
+        self.stopped.set()
+
+    def __signal_handler(self, signum, frame):
+        self.log.info('Received exit signal')
+        threading.Thread(target=self.stop, name='stop').start()
+
+    def serve_metrics(self, port):
+        '''
+        Serve Prometheus metrics on port unless they are served there already
+        '''
+        if port in self.metrics_servers:
+            return
+        try:
+            self.metrics_servers[port] = metrics.start_http_server(port)
+        except OSError as e:
+            self.log.warning(f'Could not serve metrics on port {port}: {str(e)}')
+
+    @contextmanager
+    def job_options(self, a, options):
+        '''
+        Apply the options of a job to the AppleDL instance of its session until the job is finished
+        options: bus_MiBps, device_MiBps (budgets in the transfer scheduler), metrics_textfile, metrics_port
+                 missing options keep the values of the daemon
+        '''
+        scheduler = transfers.SCHEDULER
+        bus = a.core.transfer_bus
+        if options.get('device_MiBps') is not None:
+            scheduler.set_limit(device=a.device_label, rate=options['device_MiBps'] * 2**20)
+        if options.get('bus_MiBps') is not None:
+            scheduler.set_limit(bus=bus, rate=options['bus_MiBps'] * 2**20)
+        if options.get('metrics_port') is not None:
+            self.serve_metrics(options['metrics_port'])
+        metrics_textfile = a.metrics_textfile
+        if options.get('metrics_textfile') is not None:
+            a.metrics_textfile = options['metrics_textfile']
+        try:
+            yield
+        finally:
+            a.metrics_textfile = metrics_textfile
+            if options.get('device_MiBps') is not None:
+                scheduler.set_limit(device=a.device_label, rate=scheduler.device_rate)
+            if options.get('bus_MiBps') is not None:
+                scheduler.set_limit(bus=bus, rate=scheduler.bus_rate)
+
+    def session(self, udid):
+        '''
+        return session of the device or None
+        '''
+        if udid is None and len(self.sessions) == 1:
+            return next(iter(self.sessions.values()))
+        return self.sessions.get(udid)
+
+    def handle(self, rfile, wfile):
+        threading.current_thread().name = f'job-{next(self.job_ids)}'
+        lock = threading.Lock()
+
+        def emit(message):
+            with lock:
+                wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+                wfile.flush()
+
+        try:
+            job = json.loads(rfile.readline())
+            command = job['command']
+        except (ValueError, KeyError, TypeError):
+            emit({'result': {'success': False, 'error': 'invalid job'}})
+            return
+
+        start = time.time()
+        try:
+            lines = (line.decode('utf-8', 'replace') for line in rfile) if job.get('stream') else None
+            result = self.run(
+                command,
+                job.get('udid'),
+                job.get('args', {}),
+                emit,
+                lines=lines,
+                connection=job.get('connection'),
+                options=job.get('options'),
+            )
+        except Exception as e:
+            self.log.exception(f'Job {command} failed')
+            result = {'success': False, 'error': f'{type(e).__name__}: {str(e)}'}
+        self.log.debug(f'Job {command} finished in {time.time() - start:.3f}s')
+        try:
+            emit({'result': result})
+        except OSError:
+            pass
+
+    def run(self, command, udid, args, emit, lines=None, connection=None, options=None):
+        '''
+        Run a job
+        lines: iterator over the streamed input of the job or None
+        connection: AppleDL arguments the job needs (e.g. ssh_key_filename), have to match the ones of the daemon
+        options: bandwidth and metrics options of the job (see job_options())
+        return result dict (success and command specific fields)
+        '''
+        if command == 'status':
+            return {
+                'success': True,
+                'sessions': [
+                    {'udid': s.udid, 'ready': s.healthy(), 'busy': s.lock.locked(), 'jobs': s.jobs}
+                    for s in self.sessions.values()
+                ],
+            }
+        if command == 'shutdown':
+            threading.Thread(target=self.stop, name='stop').start()
+            return {'success': True}
+        if command == 'itunes_info':
+            info = itunes_info(args['itunes_id'], log_level=self.log_level, country=args.get('country', 'us'))
+            if info is None:
+                return {'success': False}
+            keys = ['trackName', 'version', 'bundleId', 'fileSizeMiB', 'price', 'currency']
+            return {'success': True, **dict(zip(keys, info))}
+        if command not in DEVICE_COMMANDS:
+            return {'success': False, 'error': f'unknown command {command}'}
+        mismatched = [
+            f'{k} (daemon: {self.appledl_args.get(k)}, job: {v})'
+            for k, v in (connection or {}).items()
+            if self.appledl_args.get(k) != v
+        ]
+        if mismatched:
+            return {
+                'success': False,
+                'error': 'the daemon was started with other connection options: '
+                + ', '.join(mismatched)
+                + '. Restart the daemon with them or pass --no_daemon',
+            }
+
+        session = self.session(udid)
+        if session is None:
+            return {'success': False, 'error': f'no session for device {udid}'}
+
+        handler = _JobLogHandler(emit, session.udid, threading.get_ident())
+        package_logger = logging.getLogger(__package__)
+        package_logger.addHandler(handler)
+        try:
+            with session.lock:
+                session.jobs += 1
+                if not session.warm():
+                    return {'success': False, 'error': 'could not connect to device'}
+                with self.job_options(session.a, options or {}):
+                    return self.run_device(session.a, command, args, lines=lines)
+        finally:
+            package_logger.removeHandler(handler)
+
+    def run_device(self, a, command, args, lines=None):
+        if command == 'ssh_cmd':
+            exitcode, stdout, stderr = a.ssh_cmd(args['cmd'])
+            return {'success': exitcode == 0, 'exitcode': exitcode, 'stdout': stdout, 'stderr': stderr}
+        if command == 'install':
+            return result_dict(a.install(args['itunes_id']))
+        if command == 'dump':
+            if args.get('frida', False):
+                success = a.dump_frida(
+                    args['bundleID'],
+                    args['output'],
+                    args.get('timeout', 120),
+                    disable_progress=True,
+                    selective=not args.get('all_modules', False),
+                )
+            else:
+                success = a.dump_fouldecrypt(
+                    args['bundleID'],
+                    args['output'],
+                    args.get('timeout', 120),
+                    disable_progress=True,
+                    copy=not args.get('nocopy', False),
+                    hardlink=not args.get('nohardlink', False),
+                    jobs=args.get('jobs', 0),
+                )
+            if success and args.get('verify', True):
+                success = a.verify(args['output'])
+            return result_dict(success)
+        if command == 'bulk_decrypt':
+            if 'itunes_ids' in args:
+                itunes_ids = list(args['itunes_ids'])
+            else:
+                itunes_ids = ingest.read_entries(lines or [], log_level=self.log_level)
+            success = a.bulk_decrypt(
+                itunes_ids,
+                timeout_per_MiB=args.get('timeout_per_MiB', 0.5),
+                parallel=args.get('parallel', 3),
+                output_directory=args['output'],
+                country=args.get('country', 'us'),
+                verify=args.get('verify', True),
+                verify_workers=args.get('verify_workers', 2),
+                storage_headroom_MiB=args.get('storage_headroom_MiB', 1024),
+                sink=sinks.from_url(args.get('sink'), args['output'], log_level=self.log_level),
+            )
+            return {'success': success is not False}
+
+
+def result_dict(result):
+    '''
+    return result dict of a job for a success bool or a failures.Result
+    '''
+    if isinstance(result, failures.Result) and not result:
+        return {'success': False, **result.as_dict()}
+    return {'success': bool(result)}
+
+
+def submit(job, socket_path=None, on_log=print, timeout=None, stream=None):
+    '''
+    Submit a job to the daemon and call on_log with every log line
+    stream: iterable of lines which are sent after the job in a thread (job gets "stream": true)
+    return result dict or None if no daemon is listening
+    '''
+    socket_path = socket_path or default_socket_path()
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        s.close()
+        return None
+
+    def send_stream():
+        try:
+            for line in stream:
+                s.sendall(line.rstrip('\n').encode('utf-8') + b'\n')
+            s.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass  # the daemon finished the job or is gone
+
+    with s, s.makefile('rb') as f:
+        if stream is not None:
+            job = {**job, 'stream': True}
+        s.sendall(json.dumps(job).encode('utf-8') + b'\n')
+        if stream is not None:
+            threading.Thread(target=send_stream, name='stream', daemon=True).start()
+        for line in f:
+            message = json.loads(line)
+            if 'result' in message:
+                return message['result']
+            if on_log is not None:
+                on_log(message['log'])
+    return {'success': False, 'error': 'daemon closed the connection'}
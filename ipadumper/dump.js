@@ -2,6 +2,8 @@
 Original from https://github.com/AloneMonkey/frida-ios-dump/blob/f606152240ef0b284f9367395823c0e0eaa2a7ee/dump.js
 Changes:
 - replace console.log() with send()
+- copy modules with large buffers (or copyfile) instead of 4 KiB chunks and report timing
+- selective mode: parse load commands first and only load and dump encrypted images
 
 MIT License
 
@@ -26,12 +28,14 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 */
 
-Module.ensureInitialized('Foundation');
+if (typeof ObjC !== "undefined" && ObjC.available) {
+    Module.ensureInitialized('Foundation');
+}
 
 var O_RDONLY = 0;
 var O_WRONLY = 1;
 var O_RDWR = 2;
-var O_CREAT = 512;
+var O_CREAT = Process.platform == "linux" ? 64 : 512;
 
 var SEEK_SET = 0;
 var SEEK_CUR = 1;
@@ -134,7 +138,11 @@ function malloc(size) {
 
 function getExportFunction(type, name, ret, args) {
     var nptr;
-    nptr = Module.findExportByName(null, name);
+    if (typeof Module.findGlobalExportByName === "function") {
+        nptr = Module.findGlobalExportByName(name);
+    } else {
+        nptr = Module.findExportByName(null, name);
+    }
     if (nptr === null) {
         send({ warn: "cannot find " + name });
         return null;
@@ -166,6 +174,12 @@ var close = getExportFunction("f", "close", "int", ["int"]);
 var remove = getExportFunction("f", "remove", "int", ["pointer"]);
 var access = getExportFunction("f", "access", "int", ["pointer", "int"]);
 var dlopen = getExportFunction("f", "dlopen", "pointer", ["pointer", "int"]);
+var pread = getExportFunction("f", "pread", "long", ["int", "pointer", "ulong", "int64"]);
+var pwrite = getExportFunction("f", "pwrite", "long", ["int", "pointer", "ulong", "int64"]);
+var copyfile = getExportFunction("f", "copyfile", "int", ["pointer", "pointer", "pointer", "uint"]);
+
+var COPYFILE_DATA = 1 << 3;
+var COPY_BUFSIZE = 8 * 1024 * 1024;
 
 function getDocumentDir() {
     var NSDocumentDirectory = 9;
@@ -218,6 +232,122 @@ function swap32(value) {
     return parseInt(result, 16)
 }
 
+function toNumber(value) {
+    if (typeof value == "number") {
+        return value;
+    }
+    return parseInt(value.toString(), 10);
+}
+
+var copyBuffers = {};
+function getCopyBuffer(bufsize) {
+    if (!(bufsize in copyBuffers)) {
+        copyBuffers[bufsize] = malloc(bufsize);
+    }
+    return copyBuffers[bufsize];
+}
+
+/*
+Copy size bytes (or everything up to EOF if size is negative) from fdin at inoffset
+to fdout at outoffset with one pread/pwrite pair per bufsize bytes.
+Returns the number of copied bytes or -1 on a read error, a short read (EOF before size bytes)
+or a short write.
+*/
+function copyRange(fdin, fdout, inoffset, outoffset, size, bufsize) {
+    var buffer = getCopyBuffer(bufsize);
+    var copied = 0;
+    while (size < 0 || copied < size) {
+        var want = bufsize;
+        if (size >= 0 && size - copied < bufsize) {
+            want = size - copied;
+        }
+        var readLen = toNumber(pread(fdin, buffer, want, inoffset + copied));
+        if (readLen < 0) {
+            return -1;
+        }
+        if (readLen == 0) {
+            break;
+        }
+        if (toNumber(pwrite(fdout, buffer, readLen, outoffset + copied)) != readLen) {
+            return -1;
+        }
+        copied += readLen;
+    }
+    if (size >= 0 && copied != size) {
+        return -1;
+    }
+    return copied;
+}
+
+/*
+Copy the slice matching cputype/cpusubtype (or the whole file if it is thin) from oldpath to newpath.
+Thin files are copied with a single copyfile() call if usecopyfile is set and copyfile is available.
+Returns {bytes, ms, method} or null on failure. A failed copy sends an error, the dump can't be complete.
+*/
+function copyMachO(oldpath, newpath, cputype, cpusubtype, bufsize, usecopyfile) {
+    var start = Date.now();
+    var foldmodule = open(oldpath, O_RDONLY, 0);
+    if (foldmodule == -1) {
+        send({ warn: "Cannot open file " + oldpath });
+        return null;
+    }
+
+    var header = getCopyBuffer(4096);
+    pread(foldmodule, header, 4096, 0);
+
+    var fileoffset = 0;
+    var filesize = -1;
+    var magic = header.readU32();
+    if (magic == FAT_CIGAM || magic == FAT_MAGIC) {
+        filesize = 0;
+        var off = 4;
+        var archs = swap32(header.add(off).readU32());
+        for (var i = 0; i < archs; i++) {
+            if (cputype == swap32(header.add(off + 4).readU32()) && cpusubtype == swap32(header.add(off + 8).readU32())) {
+                fileoffset = swap32(header.add(off + 12).readU32());
+                filesize = swap32(header.add(off + 16).readU32());
+                break;
+            }
+            off += 20;
+        }
+
+        if (fileoffset == 0 || filesize == 0) {
+            send({ warn: "Cannot find matching architecture in " + oldpath });
+            close(foldmodule);
+            return null;
+        }
+    }
+
+    if (!access(allocStr(newpath), 0)) {
+        remove(allocStr(newpath));
+    }
+
+    var method = "pread/pwrite";
+    var copied = -1;
+    if (filesize < 0 && usecopyfile && copyfile != null) {
+        method = "copyfile";
+        if (copyfile(allocStr(oldpath), allocStr(newpath), NULL, COPYFILE_DATA) == 0) {
+            copied = toNumber(lseek(foldmodule, 0, SEEK_END));
+        }
+    } else {
+        var fmodule = open(newpath, O_CREAT | O_RDWR, 420);
+        if (fmodule == -1) {
+            send({ warn: "Cannot open file " + newpath });
+            close(foldmodule);
+            return null;
+        }
+        copied = copyRange(foldmodule, fmodule, fileoffset, 0, filesize, bufsize);
+        close(fmodule);
+    }
+    close(foldmodule);
+
+    if (copied < 0) {
+        send({ error: "Copying " + oldpath + " with " + method + " failed" });
+        return null;
+    }
+    return { bytes: copied, ms: Date.now() - start, method: method };
+}
+
 function dumpModule(name) {
     if (modules == null) {
         modules = getAllAppModules();
@@ -232,90 +362,34 @@ function dumpModule(name) {
     }
     if (targetmod == null) {
         send({ warn: "Cannot find module" });
-        return;
+        return null;
     }
-    var modbase = modules[i].base;
-    var modsize = modules[i].size;
-    var newmodname = modules[i].name;
+    var modbase = targetmod.base;
+    var newmodname = targetmod.name;
     var newmodpath = getDocumentDir() + "/" + newmodname + ".fid";
-    var oldmodpath = modules[i].path;
-
-
-    if (!access(allocStr(newmodpath), 0)) {
-        remove(allocStr(newmodpath));
-    }
+    var oldmodpath = targetmod.path;
 
-    var fmodule = open(newmodpath, O_CREAT | O_RDWR, 0);
-    var foldmodule = open(oldmodpath, O_RDONLY, 0);
-
-    if (fmodule == -1 || foldmodule == -1) {
-        send({ warn: "Cannot open file" + newmodpath });
-        return;
-    }
-
-    var is64bit = false;
     var size_of_mach_header = 0;
     var magic = getU32(modbase);
     var cur_cpu_type = getU32(modbase.add(4));
     var cur_cpu_subtype = getU32(modbase.add(8));
     if (magic == MH_MAGIC || magic == MH_CIGAM) {
-        is64bit = false;
         size_of_mach_header = 28;
     } else if (magic == MH_MAGIC_64 || magic == MH_CIGAM_64) {
-        is64bit = true;
         size_of_mach_header = 32;
     }
 
-    var BUFSIZE = 4096;
-    var buffer = malloc(BUFSIZE);
-
-    read(foldmodule, buffer, BUFSIZE);
-
-    var fileoffset = 0;
-    var filesize = 0;
-    magic = getU32(buffer);
-    if (magic == FAT_CIGAM || magic == FAT_MAGIC) {
-        var off = 4;
-        var archs = swap32(getU32(buffer.add(off)));
-        for (var i = 0; i < archs; i++) {
-            var cputype = swap32(getU32(buffer.add(off + 4)));
-            var cpusubtype = swap32(getU32(buffer.add(off + 8)));
-            if (cur_cpu_type == cputype && cur_cpu_subtype == cpusubtype) {
-                fileoffset = swap32(getU32(buffer.add(off + 12)));
-                filesize = swap32(getU32(buffer.add(off + 16)));
-                break;
-            }
-            off += 20;
-        }
-
-        if (fileoffset == 0 || filesize == 0)
-            return;
-
-        lseek(fmodule, 0, SEEK_SET);
-        lseek(foldmodule, fileoffset, SEEK_SET);
-        for (var i = 0; i < parseInt(filesize / BUFSIZE); i++) {
-            read(foldmodule, buffer, BUFSIZE);
-            write(fmodule, buffer, BUFSIZE);
-        }
-        if (filesize % BUFSIZE) {
-            read(foldmodule, buffer, filesize % BUFSIZE);
-            write(fmodule, buffer, filesize % BUFSIZE);
-        }
-    } else {
-        var readLen = 0;
-        lseek(foldmodule, 0, SEEK_SET);
-        lseek(fmodule, 0, SEEK_SET);
-        while (readLen = read(foldmodule, buffer, BUFSIZE)) {
-            write(fmodule, buffer, readLen);
-        }
+    var copy = copyMachO(oldmodpath, newmodpath, cur_cpu_type, cur_cpu_subtype, COPY_BUFSIZE, true);
+    if (copy == null) {
+        return null;
     }
 
+    var start = Date.now();
     var ncmds = getU32(modbase.add(16));
     var off = size_of_mach_header;
     var offset_cryptid = -1;
     var crypt_off = 0;
     var crypt_size = 0;
-    var segments = [];
     for (var i = 0; i < ncmds; i++) {
         var cmd = getU32(modbase.add(off));
         var cmdsize = getU32(modbase.add(off + 4));
@@ -328,20 +402,136 @@ function dumpModule(name) {
     }
 
     if (offset_cryptid != -1) {
+        var fmodule = open(newmodpath, O_RDWR, 0);
+        if (fmodule == -1) {
+            send({ warn: "Cannot open file " + newmodpath });
+            return null;
+        }
         var tpbuf = malloc(8);
         putU64(tpbuf, 0);
-        lseek(fmodule, offset_cryptid, SEEK_SET);
-        write(fmodule, tpbuf, 4);
-        lseek(fmodule, crypt_off, SEEK_SET);
-        write(fmodule, modbase.add(crypt_off), crypt_size);
+        pwrite(fmodule, tpbuf, 4, offset_cryptid);
+        pwrite(fmodule, modbase.add(crypt_off), crypt_size, crypt_off);
+        close(fmodule);
     }
 
-    close(fmodule);
-    close(foldmodule);
-    return newmodpath
+    return {
+        path: newmodpath,
+        bytes: copy.bytes,
+        patched: offset_cryptid != -1 ? crypt_size : 0,
+        copy_ms: copy.ms,
+        patch_ms: Date.now() - start,
+        method: copy.method
+    };
+}
+
+function normPath(path) {
+    path = path.toString();
+    if (path.indexOf("/private/var/") == 0) {
+        return path.substring("/private".length);
+    }
+    return path;
 }
 
-function loadAllDynamicLibrary(app_path) {
+/*
+Parse the load commands of the slice matching cputype/cpusubtype in the file at path
+return true if it has an LC_ENCRYPTION_INFO(_64) load command with a non-zero cryptid
+*/
+function isEncrypted(path, cputype, cpusubtype) {
+    var fd = open(path.toString(), O_RDONLY, 0);
+    if (fd == -1) {
+        send({ warn: "Cannot open file " + path });
+        return false;
+    }
+
+    var header = malloc(32);
+    var fileoffset = 0;
+    pread(fd, header, 8, 0);
+    var magic = header.readU32();
+    if (magic == FAT_CIGAM || magic == FAT_MAGIC) {
+        var archs = swap32(header.add(4).readU32());
+        var fatarchs = malloc(archs * 20);
+        pread(fd, fatarchs, archs * 20, 8);
+        for (var i = 0; i < archs; i++) {
+            var fatarch = fatarchs.add(i * 20);
+            if (cputype == swap32(fatarch.readU32()) && cpusubtype == swap32(fatarch.add(4).readU32())) {
+                fileoffset = swap32(fatarch.add(8).readU32());
+                break;
+            }
+        }
+    }
+
+    var encrypted = false;
+    pread(fd, header, 32, fileoffset);
+    magic = header.readU32();
+    if (magic == MH_MAGIC || magic == MH_MAGIC_64) {
+        var size_of_mach_header = magic == MH_MAGIC_64 ? 32 : 28;
+        var ncmds = header.add(16).readU32();
+        var sizeofcmds = header.add(20).readU32();
+        var cmds = malloc(sizeofcmds);
+        pread(fd, cmds, sizeofcmds, fileoffset + size_of_mach_header);
+        var off = 0;
+        for (var i = 0; i < ncmds && off < sizeofcmds; i++) {
+            var cmd = cmds.add(off).readU32();
+            if (cmd == LC_ENCRYPTION_INFO || cmd == LC_ENCRYPTION_INFO_64) {
+                encrypted = cmds.add(off + 16).readU32() != 0;
+                break;
+            }
+            off += cmds.add(off + 4).readU32();
+        }
+    }
+    close(fd);
+    return encrypted;
+}
+
+/*
+Walk the app bundle like loadAllDynamicLibrary and collect the (normalized) paths
+of all frameworks and dylibs which are encrypted
+*/
+function findEncryptedImages(app_path, cputype, cpusubtype, result) {
+    var defaultManager = ObjC.classes.NSFileManager.defaultManager();
+    var errorPtr = Memory.alloc(Process.pointerSize);
+    Memory.writePointer(errorPtr, NULL);
+    var filenames = defaultManager.contentsOfDirectoryAtPath_error_(app_path, errorPtr);
+    for (var i = 0, l = filenames.count(); i < l; i++) {
+        var file_name = filenames.objectAtIndex_(i);
+        var file_path = app_path.stringByAppendingPathComponent_(file_name);
+        if (file_name.hasSuffix_(".framework")) {
+            // resource-only frameworks have no executable
+            var bundle = ObjC.classes.NSBundle.bundleWithPath_(file_path);
+            var executable = bundle == null ? null : bundle.executablePath();
+            if (executable == null) {
+                continue;
+            }
+            if (isEncrypted(executable, cputype, cpusubtype)) {
+                result.push(normPath(executable));
+            }
+        } else if (file_name.hasSuffix_(".bundle") ||
+            file_name.hasSuffix_(".momd") ||
+            file_name.hasSuffix_(".strings") ||
+            file_name.hasSuffix_(".appex") ||
+            file_name.hasSuffix_(".app") ||
+            file_name.hasSuffix_(".lproj") ||
+            file_name.hasSuffix_(".storyboardc")) {
+            continue;
+        } else {
+            var isDirPtr = Memory.alloc(Process.pointerSize);
+            Memory.writePointer(isDirPtr, NULL);
+            defaultManager.fileExistsAtPath_isDirectory_(file_path, isDirPtr);
+            if (Memory.readPointer(isDirPtr) == 1) {
+                findEncryptedImages(file_path, cputype, cpusubtype, result);
+            } else if (file_name.hasSuffix_(".dylib") && isEncrypted(file_path, cputype, cpusubtype)) {
+                result.push(normPath(file_path));
+            }
+        }
+    }
+    return result;
+}
+
+/*
+Load all frameworks and dylibs of the app bundle
+If encrypted is a list of paths only these images are loaded
+*/
+function loadAllDynamicLibrary(app_path, encrypted) {
     var defaultManager = ObjC.classes.NSFileManager.defaultManager();
     var errorPtr = Memory.alloc(Process.pointerSize);
     Memory.writePointer(errorPtr, NULL);
@@ -351,6 +541,12 @@ function loadAllDynamicLibrary(app_path) {
         var file_path = app_path.stringByAppendingPathComponent_(file_name);
         if (file_name.hasSuffix_(".framework")) {
             var bundle = ObjC.classes.NSBundle.bundleWithPath_(file_path);
+            if (bundle == null || bundle.executablePath() == null) {
+                continue;
+            }
+            if (encrypted != null && encrypted.indexOf(normPath(bundle.executablePath())) == -1) {
+                continue;
+            }
             if (bundle.isLoaded()) {
                 send({ info: "[frida-ios-dump]: " + file_name + " has been loaded. " });
             } else {
@@ -373,9 +569,12 @@ function loadAllDynamicLibrary(app_path) {
             Memory.writePointer(isDirPtr, NULL);
             defaultManager.fileExistsAtPath_isDirectory_(file_path, isDirPtr);
             if (Memory.readPointer(isDirPtr) == 1) {
-                loadAllDynamicLibrary(file_path);
+                loadAllDynamicLibrary(file_path, encrypted);
             } else {
                 if (file_name.hasSuffix_(".dylib")) {
+                    if (encrypted != null && encrypted.indexOf(normPath(file_path)) == -1) {
+                        continue;
+                    }
                     var is_loaded = 0;
                     for (var j = 0; j < modules.length; j++) {
                         if (modules[j].path.indexOf(file_name) != -1) {
@@ -398,16 +597,60 @@ function loadAllDynamicLibrary(app_path) {
     }
 }
 
+/*
+message: {selective: true} dumps only the main executable and encrypted images
+and loads only those into the process. Everything else is copied with the app bundle.
+*/
 function handleMessage(message) {
+    var selective = message != null && message.selective === true;
     modules = getAllAppModules();
-    var app_path = ObjC.classes.NSBundle.mainBundle().bundlePath();
-    loadAllDynamicLibrary(app_path);
+    var mainBundle = ObjC.classes.NSBundle.mainBundle();
+    var app_path = mainBundle.bundlePath();
+    var main_path = normPath(mainBundle.executablePath());
+    var encrypted = null;
+    if (selective) {
+        var mainmod = null;
+        for (var i = 0; i < modules.length; i++) {
+            if (normPath(modules[i].path) == main_path) {
+                mainmod = modules[i];
+                break;
+            }
+        }
+        if (mainmod == null) {
+            send({ warn: "Cannot find main executable " + main_path + ". Dumping all modules" });
+            selective = false;
+        } else {
+            var cputype = getU32(mainmod.base.add(4));
+            var cpusubtype = getU32(mainmod.base.add(8));
+            encrypted = findEncryptedImages(app_path, cputype, cpusubtype, []);
+            send({ info: "found " + encrypted.length + " encrypted images besides the main executable" });
+        }
+    }
+    loadAllDynamicLibrary(app_path, encrypted);
     // start dump
     modules = getAllAppModules();
     for (var i = 0; i < modules.length; i++) {
+        var path = normPath(modules[i].path);
+        if (selective && path != main_path && encrypted.indexOf(path) == -1) {
+            continue;
+        }
         send({ info: "start dump " + modules[i].path });
         var result = dumpModule(modules[i].path);
-        send({ dump: result, path: modules[i].path });
+        if (result == null) {
+            send({ warn: "dump " + modules[i].path + " failed" });
+            continue;
+        }
+        send({
+            dump: result.path,
+            path: modules[i].path,
+            stats: {
+                bytes: result.bytes,
+                patched: result.patched,
+                copy_ms: result.copy_ms,
+                patch_ms: result.patch_ms,
+                method: result.method
+            }
+        });
     }
     send({ app: app_path.toString() });
     send({ done: "ok" });
@@ -415,3 +658,51 @@ function handleMessage(message) {
 }
 
 recv(handleMessage);
+
+var LC_MAIN = 0x80000028;
+var launchListener = null;
+
+/*
+Hook main() of the main executable of a spawned (suspended) app and send {launched} when it is reached.
+At this point all linked images are loaded and the ObjC runtime is ready.
+return false if the entry point could not be found
+*/
+function armLaunchGate() {
+    var mainmod = getAllAppModules()[0];
+    if (typeof mainmod === "undefined") {
+        return false;
+    }
+    var magic = getU32(mainmod.base);
+    var off = (magic == MH_MAGIC_64 || magic == MH_CIGAM_64) ? 32 : 28;
+    var ncmds = getU32(mainmod.base.add(16));
+    for (var i = 0; i < ncmds; i++) {
+        var cmd = getU32(mainmod.base.add(off));
+        if (cmd == LC_MAIN) {
+            var entryoff = getU64(mainmod.base.add(off + 8)).toNumber();
+            launchListener = Interceptor.attach(mainmod.base.add(entryoff), {
+                onEnter: function () {
+                    setTimeout(function () {
+                        if (launchListener != null) {
+                            launchListener.detach();
+                            launchListener = null;
+                        }
+                    }, 0);
+                    send({ launched: mainmod.path });
+                }
+            });
+            return true;
+        }
+        off += getU32(mainmod.base.add(off + 4));
+    }
+    return false;
+}
+
+rpc.exports = {
+    // used by the benchmark harness to run the copy engine against local files
+    copymacho: function (oldpath, newpath, cputype, cpusubtype, bufsize, usecopyfile) {
+        return copyMachO(oldpath, newpath, cputype, cpusubtype, bufsize, usecopyfile);
+    },
+    armlaunchgate: function () {
+        return armLaunchGate();
+    }
+};
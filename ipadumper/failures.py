@@ -0,0 +1,223 @@
+# stdlib
+import json
+import socket
+import threading
+import time
+
+# internal
+from ipadumper.utils import get_logger
+
+
+# failure classes
+TRANSIENT = 'transient'  # SSH, SCP, usbmux or Frida connection lost or timed out
+DEVICE_BUSY = 'device_busy'  # the device can't take the work right now (e.g. no free space)
+CRASHED = 'crashed'  # the app crashed or did not launch
+NOT_FREE = 'not_free'
+NOT_AVAILABLE = 'not_available'  # not in the storefront of the country
+TIMEOUT = 'timeout'
+ERROR = 'error'  # everything else, retrying does not help
+
+CLASSES = [TRANSIENT, DEVICE_BUSY, CRASHED, NOT_FREE, NOT_AVAILABLE, TIMEOUT, ERROR]
+
+
+class Result:
+    '''
+    Outcome of a stage, truthy on success
+    failure: failure class (None on success), message: what went wrong, stage: name of the stage
+    attempts: number of tries (set by Retrier)
+    '''
+
+    __slots__ = ('failure', 'message', 'stage', 'attempts')
+
+    def __init__(self, failure=None, message='', stage=None):
+        self.failure = failure
+        self.message = message
+        self.stage = stage
+        self.attempts = 1
+
+    def __bool__(self):
+        return self.failure is None
+
+    def __repr__(self):
+        if self.failure is None:
+            return 'Result(ok)'
+        return f'Result({self.failure}, {self.message!r}, stage={self.stage})'
+
+    def as_dict(self):
+        return {'failure': self.failure, 'message': self.message, 'stage': self.stage}
+
+
+def ok():
+    return Result()
+
+
+def fail(failure, message, stage=None):
+    return Result(failure, message, stage)
+
+
+def as_result(value, stage=None):
+    '''
+    return Result for a Result or a plain success bool
+    '''
+    if isinstance(value, Result):
+        if value.stage is None:
+            value.stage = stage
+        return value
+    return Result(stage=stage) if value else Result(ERROR, 'failed', stage)
+
+
+# exceptions by class name, so Frida, paramiko and requests are only imported by the modules which use them
+TRANSIENT_EXCEPTIONS = {
+    'TransportError',  # frida
+    'ServerNotRunningError',  # frida
+    'SSHException',  # paramiko
+    'NoValidConnectionsError',  # paramiko
+    'SCPException',
+    'ConnectionError',  # requests and builtin
+    'ChunkedEncodingError',  # requests
+}
+TIMEOUT_EXCEPTIONS = {'TimedOutError', 'Timeout', 'ReadTimeout', 'ConnectTimeout'}
+CRASHED_EXCEPTIONS = {'ProcessNotFoundError', 'ProcessNotRespondingError'}
+
+
+def classify_exception(e):
+    '''
+    return failure class of an exception raised while talking to the device or the App Store
+    '''
+    names = {cls.__name__ for cls in type(e).__mro__}
+    if names & CRASHED_EXCEPTIONS:
+        return CRASHED
+    if names & TIMEOUT_EXCEPTIONS or isinstance(e, socket.timeout):
+        return TIMEOUT
+    if names & TRANSIENT_EXCEPTIONS or isinstance(e, (ConnectionError, EOFError)):
+        return TRANSIENT
+    return ERROR
+
+
+class RetryPolicy:
+    '''
+    How often a failure class is retried and how long to wait before a retry (exponential backoff)
+    '''
+
+    def __init__(self, attempts=0, backoff=0.0, factor=2.0, max_backoff=300.0):
+        '''
+        attempts: retries after the first try
+        '''
+        self.attempts = attempts
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+
+    def delay(self, retry):
+        '''
+        return seconds to wait before the retry (1 is the first retry)
+        '''
+        return min(self.max_backoff, self.backoff * self.factor ** (retry - 1))
+
+
+DEFAULT_POLICIES = {
+    TRANSIENT: RetryPolicy(3, 2),
+    DEVICE_BUSY: RetryPolicy(5, 10),
+    CRASHED: RetryPolicy(2, 5),
+    TIMEOUT: RetryPolicy(1, 0),
+    NOT_FREE: RetryPolicy(0),
+    NOT_AVAILABLE: RetryPolicy(0),
+    ERROR: RetryPolicy(0),
+}
+
+
+class Retrier:
+    '''
+    Runs a stage and retries only this stage by the policy of its failure class
+    recover is called with the failed Result before a retry (e.g. reconnect SSH, re-attach Frida).
+
+        retrier = Retrier()
+        result = retrier.run('dump', lambda: a.dump_frida(bundleId, output), recover=a.recover)
+        if not result:
+            dead_letters.add(app, result)
+    '''
+
+    def __init__(self, policies=None, log_level='info', device=None, sleep=time.sleep):
+        '''
+        policies: failure class -> RetryPolicy, missing classes use DEFAULT_POLICIES
+        '''
+        self.policies = {**DEFAULT_POLICIES, **(policies or {})}
+        self.log = get_logger(log_level, name=__name__, device=device)
+        self.sleep = sleep
+        self.retries = {}  # failure class -> number of retries
+
+    def run(self, stage, func, recover=None, label=''):
+        '''
+        return Result of the last attempt
+        '''
+        retry = 0
+        while True:
+            try:
+                result = as_result(func(), stage)
+            except Exception as e:
+                failure = classify_exception(e)
+                if failure == ERROR:
+                    self.log.exception(f'{label}: {stage} failed')
+                result = Result(failure, f'{type(e).__name__}: {str(e)}', stage)
+            result.attempts = retry + 1
+            if result:
+                return result
+
+            policy = self.policies.get(result.failure, self.policies[ERROR])
+            if retry >= policy.attempts:
+                if policy.attempts > 0:
+                    self.log.error(f'{label}: {stage} failed {retry + 1} times ({result.failure}): {result.message}')
+                return result
+            retry += 1
+            self.retries[result.failure] = self.retries.get(result.failure, 0) + 1
+            delay = policy.delay(retry)
+            self.log.warning(
+                f'{label}: {stage} failed ({result.failure}: {result.message}), '
+                + f'retry {retry}/{policy.attempts} in {delay:.1f}s'
+            )
+            self.sleep(delay)
+            if recover is not None:
+                recover(result)
+
+
+class DeadLetters:
+    '''
+    Apps which failed for good with the failed stage and failure class
+    They are appended to a JSON lines file, which bulk_decrypt can read again once the cause is fixed.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = []
+
+    def add(self, app, result):
+        '''
+        app: dict with itunes_id and optionally country, bundleId, version
+        '''
+        entry = {
+            **{k: app[k] for k in ('itunes_id', 'country', 'bundleId', 'version') if k in app},
+            **result.as_dict(),
+            'attempts': result.attempts,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        with self.lock:
+            self.entries.append(entry)
+            if self.path is not None:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+        return entry
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def counts(self):
+        '''
+        return dict failure class -> number of apps
+        '''
+        with self.lock:
+            counts = {}
+            for entry in self.entries:
+                counts[entry['failure']] = counts.get(entry['failure'], 0) + 1
+            return counts
@@ -0,0 +1,113 @@
+# stdlib
+import threading
+
+# external
+import frida  # run scripts on device
+
+# internal
+from ipadumper.utils import get_logger
+
+
+class FridaSession:
+    '''
+    Session layer for the Frida connection of a single device
+    Apps are spawned suspended and only resumed after the script is loaded, so there is no polling race.
+    Pids of spawned apps are cached (bundleId -> pid) and scripts are compiled once per device. A cached pid is only
+    reused while the device reports the app running with it (pids are reused by other processes).
+    '''
+
+    def __init__(self, frida_device, log_level='info', device=None):
+        self.frida_device = frida_device
+        self.log = get_logger(log_level, name=__name__, device=device)
+        self.lock = threading.Lock()
+        self.pids = {}  # bundleId -> pid
+        self.compiled = {}  # script path -> bytecode or source
+
+    def __forget(self, bundleId, pid):
+        with self.lock:
+            if self.pids.get(bundleId) == pid:
+                del self.pids[bundleId]
+
+    def pid(self, bundleId):
+        '''
+        return cached pid of a running app or None
+        '''
+        with self.lock:
+            return self.pids.get(bundleId)
+
+    def __running(self, bundleId, pid):
+        '''
+        return True if the device reports the app running with pid
+        '''
+        try:
+            apps = self.frida_device.enumerate_applications(identifiers=[bundleId], scope='minimal')
+        except (frida.TransportError, frida.InvalidOperationError) as e:
+            self.log.debug(f'{bundleId}: Could not enumerate applications: {str(e)}')
+            return False
+        return any(app.identifier == bundleId and app.pid == pid for app in apps)
+
+    def kill(self, bundleId, pid):
+        '''
+        Kill the app (e.g. a spawned app which did not launch) and forget its pid
+        '''
+        self.__forget(bundleId, pid)
+        try:
+            self.frida_device.kill(pid)
+        except (frida.ProcessNotFoundError, frida.TransportError, frida.InvalidOperationError) as e:
+            self.log.debug(f'{bundleId}: Could not kill pid {pid}: {str(e)}')
+
+    def open(self, bundleId):
+        '''
+        Attach to the running app or spawn it suspended
+        return session, pid, spawned (if True the app has to be resumed with resume())
+        '''
+        pid = self.pid(bundleId)
+        if pid is not None and not self.__running(bundleId, pid):
+            self.log.debug(f'{bundleId}: Cached pid {pid} is not the app anymore')
+            self.__forget(bundleId, pid)
+            pid = None
+        if pid is not None:
+            try:
+                session = self.frida_device.attach(pid)
+                self.log.debug(f'{bundleId}: Attached to cached pid {pid}')
+                return session, pid, False
+            except (frida.ProcessNotFoundError, frida.TransportError):
+                self.__forget(bundleId, pid)
+
+        pid = self.frida_device.spawn([bundleId])
+        session = self.frida_device.attach(pid)
+        with self.lock:
+            self.pids[bundleId] = pid
+
+        def on_detached(reason, crash):
+            # the app keeps running if we detached ourselves
+            if reason != 'application-requested':
+                self.__forget(bundleId, pid)
+
+        session.on('detached', on_detached)
+        self.log.debug(f'{bundleId}: Spawned with pid {pid}')
+        return session, pid, True
+
+    def resume(self, pid):
+        self.frida_device.resume(pid)
+
+    def create_script(self, session, path):
+        '''
+        Create script from file. The file is read and compiled only once.
+        '''
+        with self.lock:
+            if path not in self.compiled:
+                with open(path) as f:
+                    source = f.read()
+                try:
+                    self.compiled[path] = session.compile_script(source, name='dump')
+                    self.log.debug(f'Compiled {path}')
+                except (AttributeError, frida.NotSupportedError, frida.InvalidArgumentError) as e:
+                    # old Frida or runtime without bytecode support
+                    self.log.debug(f'Could not compile {path}: {str(e)}')
+                    self.compiled[path] = source
+            code = self.compiled[path]
+
+        if isinstance(code, bytes):
+            return session.create_script_from_bytes(code)
+        return session.create_script(code)
@@ -0,0 +1,344 @@
+# stdlib
+from collections import namedtuple
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+
+# internal
+from ipadumper.utils import get_logger
+
+
+Entry = namedtuple('Entry', ['itunes_id', 'country', 'priority'], defaults=(None, 0))
+
+ID_PATTERN = re.compile(r'^(?:id)?(\d+)$')
+IPA_PATTERN = re.compile(r'^(\d+)_.*\.ipa$')
+
+
+def parse_line(line):
+    '''
+    Parse a line with an iTunes ID
+    Lines are either JSON objects (itunes_id or trackId, country, priority) or an ID followed by an optional
+    country code and priority, separated by whitespace or commas. Everything after # is a comment.
+    return Entry or None for blank lines and comments
+    raise ValueError for invalid lines
+    '''
+    line = line.strip()
+    if line.startswith('{'):
+        obj = json.loads(line)
+        itunes_id = obj.get('itunes_id', obj.get('trackId', obj.get('id')))
+        if itunes_id is None:
+            raise ValueError('no itunes_id')
+        return Entry(int(itunes_id), obj.get('country'), int(obj.get('priority', 0)))
+
+    line = line.split('#', 1)[0]
+    fields = line.replace(',', ' ').split()
+    if len(fields) == 0:
+        return None
+    m = ID_PATTERN.match(fields[0])
+    if m is None:
+        raise ValueError(f'invalid iTunes ID {fields[0]}')
+    country, priority = None, 0
+    for field in fields[1:]:
+        if re.match(r'^-?\d+$', field):
+            priority = int(field)
+        elif len(field) == 2 and field.isalpha():
+            country = field.lower()
+        else:
+            raise ValueError(f'invalid field {field}')
+    return Entry(int(m.group(1)), country, priority)
+
+
+def iter_lines(path, follow=False, poll=1.0, stop=None):
+    '''
+    Yield lines of a file or of stdin ('-') without reading it at once
+    follow: like tail -f, wait for appended lines (a truncated or replaced file is read from the start again)
+    stop: threading.Event which ends following
+    '''
+    if path == '-':
+        yield from sys.stdin
+        return
+
+    f = open(path, 'r', encoding='utf-8', errors='replace')
+    try:
+        partial = ''
+        while True:
+            line = f.readline()
+            if line.endswith('\n'):
+                yield partial + line
+                partial = ''
+                continue
+            partial += line  # a writer may be in the middle of a line
+            if not follow:
+                if partial:
+                    yield partial
+                return
+            if stop is not None and stop.is_set():
+                return
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                st = None
+            if st is not None and (st.st_ino != os.fstat(f.fileno()).st_ino or st.st_size < f.tell()):
+                f.close()
+                f = open(path, 'r', encoding='utf-8', errors='replace')
+                partial = ''
+                continue
+            time.sleep(poll)
+    finally:
+        f.close()
+
+
+def read_entries(lines, log_level='info'):
+    '''
+    Yield Entry for every valid line, blank lines and comments are skipped and invalid lines are logged
+    '''
+    log = get_logger(log_level, name=__name__)
+    for lineno, line in enumerate(lines, start=1):
+        try:
+            entry = parse_line(line)
+        except ValueError as e:
+            log.warning(f'Line {lineno}: skipping {line.strip()[:80]!r}: {str(e)}')
+            continue
+        if entry is not None:
+            yield entry
+
+
+class BloomFilter:
+    '''
+    Set of integers with false positives (error_rate) but without false negatives
+    Needs about 3.6 bytes per entry for an error rate of 1e-6.
+    '''
+
+    def __init__(self, capacity, error_rate=1e-6):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __positions(self, key):
+        digest = hashlib.blake2b(key.to_bytes(8, 'little', signed=True), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        '''
+        return True if the key was possibly added before
+        '''
+        present = True
+        for p in self.__positions(key):
+            byte, bit = divmod(p, 8)
+            if not self.bits[byte] & (1 << bit):
+                present = False
+                self.bits[byte] |= 1 << bit
+        if not present:
+            self.count += 1
+        return present
+
+    def __contains__(self, key):
+        return all(self.bits[p // 8] & (1 << (p % 8)) for p in self.__positions(key))
+
+
+class Deduper:
+    '''
+    Remembers iTunes IDs in growing Bloom filters (memory grows with the number of IDs, not with the queue)
+    Seeded from the output directory: dumped IPAs (<itunes_id>_*.ipa) and the catalog of verified IPAs.
+    '''
+
+    def __init__(self, capacity=100000, error_rate=1e-6):
+        self.error_rate = error_rate
+        self.filters = [BloomFilter(capacity, error_rate / 2)]
+        self.lock = threading.Lock()
+
+    def seen(self, itunes_id):
+        '''
+        Add the ID
+        return True if it was (possibly) seen before
+        '''
+        with self.lock:
+            last = self.filters[-1]
+            if last.count >= last.capacity:
+                # the error rates sum up to less than error_rate
+                self.filters.append(BloomFilter(last.capacity * 2, last.error_rate / 2))
+            if any(itunes_id in f for f in self.filters[:-1]):
+                return True
+            return self.filters[-1].add(itunes_id)
+
+    def seed(self, output_directory, names=None):
+        '''
+        Add the IDs of dumped IPAs and of the catalog in output_directory
+        names: names of the dumped IPAs if they are not stored in output_directory (see Sink.names())
+        return number of IDs
+        '''
+        count = 0
+        if names is None:
+            try:
+                names = os.listdir(output_directory)
+            except FileNotFoundError:
+                return 0
+        for name in names:
+            m = IPA_PATTERN.match(name)
+            if m is not None:
+                self.seen(int(m.group(1)))
+                count += 1
+        try:
+            with open(os.path.join(output_directory, 'catalog.jsonl')) as f:
+                for line in f:
+                    try:
+                        self.seen(int(json.loads(line)['itunes_id']))
+                        count += 1
+                    except (ValueError, KeyError, TypeError):
+                        pass
+        except FileNotFoundError:
+            pass
+        return count
+
+
+class Feed:
+    '''
+    Reads entries in a thread into a bounded buffer, so a consumer never blocks on the input
+    (e.g. a followed file) and memory does not grow with the input
+    Entries are taken in input order, only within the buffer a higher priority goes first.
+    Duplicates (by Deduper) are skipped while reading.
+
+        feed = Feed(read_entries(iter_lines(path)), deduper=deduper)
+        while not feed.done():
+            entry = feed.get(timeout=1)
+    '''
+
+    def __init__(self, entries, window=1000, deduper=None, log_level='info'):
+        self.log = get_logger(log_level, name=__name__)
+        self.window = window
+        self.deduper = deduper
+        self.cond = threading.Condition()
+        self.heap = []  # (-priority, seq, entry)
+        self.seq = itertools.count()
+        self.front = itertools.count(-1, -1)  # sequence of requeued entries, they go before the read ones
+        self.exhausted = False
+        self.closed = False
+        self.read = 0
+        self.duplicates = 0
+        self.thread = threading.Thread(target=self.__run, args=(entries,), name='feed', daemon=True)
+        self.thread.start()
+
+    def __run(self, entries):
+        try:
+            for entry in entries:
+                if not isinstance(entry, Entry):
+                    entry = Entry(int(entry))
+                self.read += 1
+                if self.deduper is not None and self.deduper.seen(entry.itunes_id):
+                    self.duplicates += 1
+                    self.log.debug(f'{entry.itunes_id}: Skipping, duplicate or already dumped')
+                    continue
+                with self.cond:
+                    self.cond.wait_for(lambda: len(self.heap) < self.window or self.closed)
+                    if self.closed:
+                        return
+                    heapq.heappush(self.heap, (-entry.priority, next(self.seq), entry))
+                    self.cond.notify_all()
+        except Exception:
+            self.log.exception('Could not read iTunes IDs')
+        finally:
+            with self.cond:
+                self.exhausted = True
+                self.cond.notify_all()
+
+    def get(self, timeout=0):
+        '''
+        return next Entry or None if none is available within timeout
+        '''
+        with self.cond:
+            if not self.cond.wait_for(lambda: len(self.heap) > 0 or self.exhausted, timeout=timeout):
+                return None
+            if len(self.heap) == 0:
+                return None
+            entry = heapq.heappop(self.heap)[2]
+            self.cond.notify_all()
+            return entry
+
+    def requeue(self, entry):
+        '''
+        Put back an entry which was taken but not done (e.g. by a drained device), it is taken again first
+        '''
+        with self.cond:
+            heapq.heappush(self.heap, (-entry.priority, next(self.front), entry))
+            self.cond.notify_all()
+
+    def wait(self, timeout=None):
+        '''
+        Wait until an entry is available or the input is exhausted
+        '''
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.heap) > 0 or self.exhausted, timeout=timeout)
+
+    def ready(self):
+        '''
+        return True if an entry is available
+        '''
+        with self.cond:
+            return len(self.heap) > 0
+
+    def done(self):
+        '''
+        return True if the input is exhausted and all entries are taken
+        '''
+        with self.cond:
+            return self.exhausted and len(self.heap) == 0
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class Lease:
+    '''
+    Share of a Feed for one of several consumers (e.g. a device of MultiDevice)
+    It has the interface of Feed. After drain() no more entries are taken, entries which were taken but not
+    started are given back with requeue() and go to the other consumers.
+    '''
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.drained = threading.Event()
+        self.read = 0  # entries taken
+        self.duplicates = 0  # duplicates are skipped by the feed
+
+    def get(self, timeout=0):
+        if self.drained.is_set():
+            return None
+        entry = self.feed.get(timeout)
+        if entry is not None:
+            self.read += 1
+        return entry
+
+    def requeue(self, entry):
+        self.read -= 1
+        self.feed.requeue(entry)
+
+    def wait(self, timeout=None):
+        if not self.drained.is_set():
+            self.feed.wait(timeout)
+
+    def ready(self):
+        return not self.drained.is_set() and self.feed.ready()
+
+    def done(self):
+        return self.drained.is_set() or self.feed.done()
+
+    def drain(self):
+        self.drained.set()
+
+    def close(self):
+        '''
+        The feed is closed by its owner
+        '''
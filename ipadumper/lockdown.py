@@ -0,0 +1,291 @@
+# stdlib
+import os
+import plistlib
+import ssl
+import struct
+import tempfile
+import threading
+
+# internal
+from ipadumper.usbmux import Usbmux, UsbmuxError
+from ipadumper.utils import get_logger
+
+
+LOCKDOWN_PORT = 62078
+INSTALLATION_PROXY = 'com.apple.mobile.installation_proxy'
+
+# attributes of installed apps which ipadumper needs
+APP_ATTRIBUTES = ['CFBundleIdentifier', 'CFBundleVersion', 'CFBundleShortVersionString', 'CFBundleDisplayName', 'Path']
+
+LENGTH = struct.Struct('>I')
+
+
+class LockdownError(ConnectionError):
+    '''
+    Error reply of lockdownd or a service (a lost connection or a timeout raises OSError)
+    '''
+
+
+class PlistConnection:
+    '''
+    Connection to lockdownd or a lockdown service: XML plists with a big endian 32 bit length prefix
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def send(self, message):
+        payload = plistlib.dumps(message)
+        self.sock.sendall(LENGTH.pack(len(payload)) + payload)
+
+    def recv(self):
+        (length,) = LENGTH.unpack(self.__recv(LENGTH.size))
+        try:
+            return plistlib.loads(self.__recv(length))
+        except plistlib.InvalidFileException as e:
+            raise LockdownError(f'Invalid plist: {str(e)}')
+
+    def __recv(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionResetError('Device closed the connection')
+            data += chunk
+        return data
+
+    def request(self, message):
+        '''
+        Send message and return the reply
+        raise LockdownError if the reply has an error
+        '''
+        self.send(message)
+        reply = self.recv()
+        if 'Error' in reply:
+            raise LockdownError(f"{message.get('Request', message.get('Command'))}: {reply['Error']}")
+        return reply
+
+    def start_tls(self, pair_record):
+        '''
+        Wrap the socket in TLS with the host certificate of the pair record
+        '''
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        # the pair records of older iOS versions have 1024 bit keys and SHA-1 signatures
+        context.set_ciphers('ALL:@SECLEVEL=0')
+        # ssl can only load certificates from files
+        fd, path = tempfile.mkstemp(suffix='.pem')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(pair_record['HostCertificate'] + b'\n' + pair_record['HostPrivateKey'])
+            context.load_cert_chain(path)
+        finally:
+            os.unlink(path)
+        self.sock = context.wrap_socket(self.sock)
+
+    def close(self):
+        self.sock.close()
+
+
+class Lockdown:
+    '''
+    Client for lockdownd of a device, connected through usbmuxd
+    A session is started with the pair record of usbmuxd. Without a pair record (e.g. a device which was never
+    trusted) only the values lockdownd returns without session are available.
+    With a timeout a hung lockdownd or service is handled like a lost connection (socket.timeout is an OSError).
+
+        lockdown = Lockdown(udid)
+        version = lockdown.get_value('ProductVersion')
+        proxy = InstallationProxy(lockdown)
+    '''
+
+    def __init__(self, udid=None, usbmux=None, label='ipadumper', timeout=None, log_level='info'):
+        '''
+        timeout: timeout in seconds of the lockdownd and service connections (None: wait forever)
+        '''
+        self.udid = udid
+        self.usbmux = usbmux or Usbmux()
+        self.label = label
+        self.timeout = timeout
+        self.log = get_logger(log_level, name=__name__, device=udid)
+        self.lock = threading.Lock()
+        self.device = None
+        self.conn = None
+        self.pair_record = None
+        self.session_id = None
+        self.values = {}  # (domain, key) -> value, device info does not change while connected
+
+    def connect(self):
+        '''
+        Connect to lockdownd and start a session if the device is paired
+        raise LockdownError or UsbmuxError
+        '''
+        self.device = self.usbmux.device(self.udid)
+        if self.device is None:
+            raise LockdownError(f'Device {self.udid or ""} not found by usbmuxd')
+        self.conn = PlistConnection(self.usbmux.connect(self.device, LOCKDOWN_PORT, timeout=self.timeout))
+        reply = self.conn.request({'Label': self.label, 'Request': 'QueryType'})
+        if reply.get('Type') != 'com.apple.mobile.lockdown':
+            raise LockdownError(f"Unexpected service type {reply.get('Type')}")
+
+        try:
+            self.pair_record = self.usbmux.read_pair_record(self.device.udid)
+        except UsbmuxError as e:
+            self.log.debug(f'No pair record, lockdown without session: {str(e)}')
+            return
+        reply = self.conn.request(
+            {
+                'Label': self.label,
+                'Request': 'StartSession',
+                'HostID': self.pair_record['HostID'],
+                'SystemBUID': self.pair_record['SystemBUID'],
+            }
+        )
+        self.session_id = reply['SessionID']
+        if reply.get('EnableSessionSSL', False):
+            self.conn.start_tls(self.pair_record)
+
+    def __connected(self):
+        if self.conn is None:
+            self.connect()
+        return self.conn
+
+    def __request(self, message):
+        '''
+        Send a request, reconnect once if the connection was lost
+        '''
+        message = {'Label': self.label, **message}
+        with self.lock:
+            try:
+                return self.__connected().request(message)
+            except LockdownError:
+                raise
+            except (OSError, ssl.SSLError) as e:
+                self.log.debug(f'Lockdown connection lost, reconnecting: {str(e)}')
+                self.close_connection()
+                return self.__connected().request(message)
+
+    def get_value(self, key=None, domain=None):
+        '''
+        return value of a key (e.g. ProductVersion, DeviceName, UniqueDeviceID) or dict of all values of the domain
+        '''
+        if (domain, key) not in self.values:
+            message = {'Request': 'GetValue'}
+            if key is not None:
+                message['Key'] = key
+            if domain is not None:
+                message['Domain'] = domain
+            self.values[(domain, key)] = self.__request(message).get('Value')
+        return self.values[(domain, key)]
+
+    def start_service(self, name):
+        '''
+        Start a lockdown service
+        return PlistConnection to the service
+        '''
+        reply = self.__request({'Request': 'StartService', 'Service': name})
+        conn = PlistConnection(self.usbmux.connect(self.device, reply['Port'], timeout=self.timeout))
+        if reply.get('EnableServiceSSL', False):
+            conn.start_tls(self.pair_record)
+        return conn
+
+    def close_connection(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except OSError:
+                pass
+        self.conn = None
+        self.session_id = None
+
+    def close(self):
+        with self.lock:
+            self.close_connection()
+
+
+class InstallationProxy:
+    '''
+    Client for the installation_proxy service, the service connection is kept open for all commands
+
+        proxy = InstallationProxy(Lockdown(udid))
+        apps = proxy.browse()
+        proxy.uninstall('com.app.name', progress=lambda percent, status: print(percent, status))
+    '''
+
+    def __init__(self, lockdown, log_level='info'):
+        self.lockdown = lockdown
+        self.log = get_logger(log_level, name=__name__, device=lockdown.udid)
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def __command(self, message, on_reply=None):
+        '''
+        Send a command and read replies until it is complete, reconnect once if the connection was lost
+        on_reply: called with every reply
+        return last reply
+        '''
+        with self.lock:
+            for attempt in range(2):
+                if self.conn is None:
+                    self.conn = self.lockdown.start_service(INSTALLATION_PROXY)
+                try:
+                    self.conn.send(message)
+                    while True:
+                        reply = self.conn.recv()
+                        if 'Error' in reply:
+                            description = reply.get('ErrorDescription', '')
+                            raise LockdownError(f"{message['Command']}: {reply['Error']} {description}".strip())
+                        if on_reply is not None:
+                            on_reply(reply)
+                        if reply.get('Status') == 'Complete':
+                            return reply
+                except (OSError, ssl.SSLError) as e:
+                    if isinstance(e, LockdownError) or attempt == 1:
+                        raise
+                    self.log.debug(f'installation_proxy connection lost, reconnecting: {str(e)}')
+                    self.close_connection()
+
+    def browse(self, attributes=APP_ATTRIBUTES, application_type='User'):
+        '''
+        return list of dicts with the attributes of the installed apps
+        '''
+        apps = []
+        options = {'ApplicationType': application_type, 'ReturnAttributes': list(attributes)}
+        self.__command(
+            {'Command': 'Browse', 'ClientOptions': options}, on_reply=lambda r: apps.extend(r.get('CurrentList', []))
+        )
+        return apps
+
+    def lookup(self, bundle_ids, attributes=APP_ATTRIBUTES):
+        '''
+        return dict bundleId -> attributes of the installed apps among bundle_ids
+        '''
+        options = {'BundleIDs': list(bundle_ids), 'ReturnAttributes': list(attributes)}
+        reply = self.__command({'Command': 'Lookup', 'ClientOptions': options})
+        return reply.get('LookupResult', {})
+
+    def uninstall(self, bundleId, progress=None):
+        '''
+        Uninstall app
+        progress: called with percent and status of every progress reply
+        raise LockdownError if the app could not be uninstalled
+        '''
+
+        def on_reply(reply):
+            if progress is not None and 'PercentComplete' in reply:
+                progress(reply['PercentComplete'], reply.get('Status', ''))
+
+        self.__command({'Command': 'Uninstall', 'ApplicationIdentifier': bundleId}, on_reply=on_reply)
+
+    def close_connection(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except OSError:
+                pass
+        self.conn = None
+
+    def close(self):
+        with self.lock:
+            self.close_connection()
@@ -0,0 +1,104 @@
+# stdlib
+import struct
+
+
+FAT_MAGIC = 0xCAFEBABE
+FAT_MAGIC_64 = 0xCAFEBABF
+MH_MAGIC = 0xFEEDFACE
+MH_MAGIC_64 = 0xFEEDFACF
+MH_CIGAM = 0xCEFAEDFE
+MH_CIGAM_64 = 0xCFFAEDFE
+LC_ENCRYPTION_INFO = 0x21
+LC_ENCRYPTION_INFO_64 = 0x2C
+
+
+def magic(data):
+    '''
+    return big endian magic of data or None if data is too short
+    '''
+    if len(data) < 4:
+        return None
+    return struct.unpack('>I', data[:4])[0]
+
+
+def is_fat(data):
+    return magic(data) in (FAT_MAGIC, FAT_MAGIC_64)
+
+
+def is_macho(data):
+    '''
+    return True if data starts with a fat or thin Mach-O header
+    '''
+    return magic(data) in (FAT_MAGIC, FAT_MAGIC_64, MH_MAGIC, MH_MAGIC_64, MH_CIGAM, MH_CIGAM_64)
+
+
+def fat_slices(data):
+    '''
+    data: bytes starting at a fat header
+    return list of (cputype, cpusubtype, offset, size) or [] if data is not a fat Mach-O
+    '''
+    m = magic(data)
+    if m not in (FAT_MAGIC, FAT_MAGIC_64):
+        return []
+    nfat_arch = struct.unpack('>I', data[4:8])[0]
+    slices = []
+    off = 8
+    for _ in range(nfat_arch):
+        if m == FAT_MAGIC:
+            if off + 20 > len(data):
+                raise ValueError('fat header is truncated')
+            cputype, cpusubtype, offset, size, _ = struct.unpack('>IIIII', data[off : off + 20])
+            off += 20
+        else:
+            if off + 32 > len(data):
+                raise ValueError('fat header is truncated')
+            cputype, cpusubtype, offset, size, _, _ = struct.unpack('>IIQQII', data[off : off + 32])
+            off += 32
+        slices.append((cputype, cpusubtype, offset, size))
+    return slices
+
+
+def encryption_info(data):
+    '''
+    data: bytes starting at a thin Mach-O header
+    return (cryptoff, cryptsize, cryptid, cryptid_offset) of the LC_ENCRYPTION_INFO(_64) load command
+    or None if there is no such load command
+    cryptid_offset is relative to the start of data
+    raise ValueError if data is not a thin Mach-O or the load commands are truncated
+    '''
+    m = magic(data)
+    if m in (MH_MAGIC, MH_MAGIC_64):
+        endian = '>'
+    elif m in (MH_CIGAM, MH_CIGAM_64):
+        endian = '<'
+    else:
+        raise ValueError('not a thin Mach-O')
+
+    header_size = 32 if m in (MH_MAGIC_64, MH_CIGAM_64) else 28
+    if len(data) < header_size:
+        raise ValueError('Mach-O header is truncated')
+    ncmds, sizeofcmds = struct.unpack(endian + 'II', data[16:24])
+
+    off = header_size
+    for _ in range(ncmds):
+        if off + 8 > len(data):
+            raise ValueError('load commands are truncated')
+        cmd, cmdsize = struct.unpack(endian + 'II', data[off : off + 8])
+        if cmd in (LC_ENCRYPTION_INFO, LC_ENCRYPTION_INFO_64):
+            if off + 20 > len(data):
+                raise ValueError('load commands are truncated')
+            cryptoff, cryptsize, cryptid = struct.unpack(endian + 'III', data[off + 8 : off + 20])
+            return cryptoff, cryptsize, cryptid, off + 16
+        if cmdsize < 8:
+            raise ValueError('invalid load command size')
+        off += cmdsize
+    return None
+
+
+def is_encrypted(data):
+    '''
+    data: bytes starting at a thin Mach-O header
+    return True if the Mach-O has a non-zero cryptid
+    '''
+    info = encryption_info(data)
+    return info is not None and info[2] != 0
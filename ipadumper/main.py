@@ -1,13 +1,15 @@
 # stdlib
 from argparse import ArgumentParser, HelpFormatter
 from importlib.metadata import metadata
+import json
 from os import path
+import sys
 
 # internal
+# AppleDL and the benchmarks are imported when needed, frida, paramiko, etc. take long to import
 import ipadumper
-from ipadumper.appledl import AppleDL
-from ipadumper.utils import itunes_info
-from ipadumper.controller import MultiDevice
+from ipadumper.daemon import DEVICE_COMMANDS, default_socket_path, submit
+from ipadumper.utils import default_position_cache_path, itunes_info, setup_logging
 
 
 class F(HelpFormatter):
@@ -25,6 +27,23 @@ def main():
         choices=['warning', 'info', 'debug'],
         default='info',
     )
+    parser.add_argument(
+        '--log_file',
+        help='Log file, rotated every 10 MiB. Empty string disables it (default: <date>_<time>.log)',
+        default=None,
+        metavar='PATH',
+    )
+    parser.add_argument(
+        '--socket',
+        help='Unix socket of the daemon (default: %(default)s)',
+        default=default_socket_path(),
+        metavar='PATH',
+    )
+    parser.add_argument(
+        '--no_daemon',
+        help='Do not submit jobs to a running daemon, connect to the device directly',
+        action='store_true',
+    )
     subparsers = parser.add_subparsers(help='Desired action to perform', dest='command')
 
     # help
@@ -42,7 +61,135 @@ def main():
     # multi dump
     d = 'Download, install,dump and uninstall apps using multiple devices in parallel'
     parser_itunes_info = subparsers.add_parser('multidump', help=d, description=d)
-    parser_itunes_info.add_argument('config_file', help='config file', default='config.json', metavar='PATH')
+    parser_itunes_info.add_argument(
+        'config_file', help='config file, changes are applied while running', default='config.json', metavar='PATH'
+    )
+    parser_itunes_info.add_argument('itunes_ids', help='File with iTunes IDs (- for stdin)', metavar='PATH')
+    parser_itunes_info.add_argument(
+        '--follow', help='Wait for IDs which are appended to the file (like tail -f)', action='store_true'
+    )
+    parser_itunes_info.add_argument(
+        '--metrics_port',
+        help='Serve Prometheus metrics of all devices on http://0.0.0.0:PORT/metrics (default: disabled)',
+        type=int,
+        default=None,
+        metavar='PORT',
+    )
+    parser_itunes_info.add_argument(
+        '--metrics_textfile',
+        help='Write Prometheus metrics of all devices to this file after every app (default: disabled)',
+        default=None,
+        metavar='PATH',
+    )
+    parser_itunes_info.add_argument(
+        '--trace',
+        help='Write a timeline of all devices as Chrome trace event JSON to this file (default: disabled)',
+        default=None,
+        metavar='PATH',
+    )
+
+    # benchmark
+    d = 'Benchmark the copy engine of dump.js against local fixture files'
+    parser_benchmark = subparsers.add_parser('benchmark', help=d, description=d, formatter_class=F)
+    parser_benchmark.add_argument(
+        'fixtures', help='Fixture files (default: generate a random file)', nargs='*', metavar='PATH'
+    )
+    parser_benchmark.add_argument(
+        '--size_MiB', help='Size of the generated fixture (default: %(default)s)', type=int, default=64
+    )
+    parser_benchmark.add_argument(
+        '--bufsize',
+        help='Buffer size of the copy loop, can be used multiple times (default: 4096 and 8388608)',
+        type=int,
+        action='append',
+        metavar='BYTES',
+    )
+    parser_benchmark.add_argument('--repeat', help='Runs per method (default: %(default)s)', type=int, default=3)
+
+    # plan
+    d = 'Predict a bulk job offline and recommend parallel and timeout_per_MiB'
+    parser_plan = subparsers.add_parser('plan', help=d, description=d, formatter_class=F)
+    parser_plan.add_argument(
+        'metadata', help='JSON lines with itunes_id, fileSizeMiB or fileSizeBytes, price, country (- for stdin)'
+    )
+    parser_plan.add_argument('config_file', help='Device pool config of multidump', metavar='CONFIG')
+    parser_plan.add_argument(
+        '--history',
+        help='Metrics textfile or trace of a previous run, can be used multiple times',
+        action='append',
+        default=[],
+        metavar='PATH',
+    )
+    parser_plan.add_argument(
+        '--sample', help='Simulate at most this many apps (default: %(default)s)', type=int, default=20000
+    )
+    parser_plan.add_argument('--deadline', help='Also estimate the devices needed', type=float, metavar='HOURS')
+    parser_plan.add_argument(
+        '--storage_MiB', help='Free space of devices without storage_MiB in the config', type=int, metavar='MIB'
+    )
+    parser_plan.add_argument(
+        '--download_MiBps', help='Download speed of devices without download_MiBps in the config', type=float
+    )
+    parser_plan.add_argument('--seed', help='Random seed (default: %(default)s)', type=int, default=0)
+    parser_plan.add_argument('--json', help='Print the report as JSON', action='store_true')
+
+    # simulate
+    d = 'Benchmark bulk_decrypt or a dump method against a simulated device'
+    parser_simulate = subparsers.add_parser('simulate', help=d, description=d, formatter_class=F)
+    parser_simulate.add_argument(
+        'benchmark',
+        help='Command to benchmark (default: %(default)s)',
+        nargs='?',
+        choices=['bulk_decrypt', 'dump_frida', 'dump_fouldecrypt', 'async_dump_frida'],
+        default='bulk_decrypt',
+    )
+    parser_simulate.add_argument('--apps', help='Number of apps (default: %(default)s)', type=int, default=10)
+    parser_simulate.add_argument(
+        '--devices',
+        help='Number of devices, only for async_dump_frida (default: %(default)s)',
+        type=int,
+        default=4,
+    )
+    parser_simulate.add_argument(
+        '--parallel', help='How many apps get installed in parallel (default: %(default)s)', type=int, default=3
+    )
+    parser_simulate.add_argument(
+        '--app_size_MiB', help='Size of the binaries of an app (default: %(default)s)', type=int, default=4
+    )
+    parser_simulate.add_argument(
+        '--install_latency',
+        help='Seconds from tapping install until the app is installed (default: %(default)s)',
+        type=float,
+        default=2.0,
+        metavar='SECONDS',
+    )
+    parser_simulate.add_argument(
+        '--bandwidth_MiBps', help='Download speed of the device (default: %(default)s)', type=float, default=50
+    )
+    parser_simulate.add_argument(
+        '--popup_rate', help='Probability of a permission popup (default: %(default)s)', type=float, default=0.0
+    )
+    parser_simulate.add_argument(
+        '--storage_MiB', help='Storage of the device (default: %(default)s)', type=int, default=65536, metavar='MIB'
+    )
+    parser_simulate.add_argument(
+        '--device_matching',
+        help='Match template images on the (simulated) device instead of on the host (default: %(default)s)',
+        action='store_true',
+    )
+
+    # match
+    d = 'Classify recorded screenshots with the host side template matcher'
+    parser_match = subparsers.add_parser('match', help=d, description=d, formatter_class=F)
+    parser_match.add_argument('screenshots', help='Screenshots', nargs='+', metavar='PATH')
+    parser_match.add_argument(
+        '--imagedir',
+        help='Path to appstore images (default: %(default)s)',
+        default=path.join(path.dirname(ipadumper.__file__), 'appstore_images'),
+        metavar='PATH',
+    )
+    parser_match.add_argument('--theme', help='Theme of device dark/light (default: %(default)s)', default='dark')
+    parser_match.add_argument('--lang', help='Language of device (2 letter code) (default: %(default)s)', default='en')
 
     # Create parent subparser for with common arguments
     parent_parser = ArgumentParser(add_help=False, formatter_class=F)
@@ -75,6 +222,53 @@ def main():
     parent_parser.add_argument(
         '--udid', help='UDID (Unique Device Identifier) of device (default: %(default)s)', default=None, metavar='UDID'
     )
+    parent_parser.add_argument(
+        '--tunnel',
+        help='Reach SSH and zxtouch through usbmuxd, iproxy or usbmuxd if it is running (default: %(default)s)',
+        choices=['auto', 'usbmux', 'iproxy'],
+        default='auto',
+    )
+    parent_parser.add_argument(
+        '--device_matching',
+        help='Match template images on device instead of on the host (default: %(default)s)',
+        action='store_true',
+    )
+    parent_parser.add_argument(
+        '--position_cache',
+        help='JSON file with learned button positions (default: %(default)s)',
+        default=default_position_cache_path(),
+        metavar='PATH',
+    )
+    parent_parser.add_argument(
+        '--no_position_cache', help='Do not persist learned button positions', action='store_true'
+    )
+    parent_parser.add_argument(
+        '--trace',
+        help='Write a timeline of all steps as Chrome trace event JSON to this file (default: disabled)',
+        default=None,
+        metavar='PATH',
+    )
+    parent_parser.add_argument(
+        '--usb_bus',
+        help='Name of the USB hub or host controller of the device, devices on the same bus share --bus_MiBps '
+        + '(default: %(default)s)',
+        default='host',
+        metavar='NAME',
+    )
+    parent_parser.add_argument(
+        '--bus_MiBps',
+        help='Bandwidth budget of every USB bus for transfers from devices (default: unlimited)',
+        type=float,
+        default=None,
+        metavar='MIBPS',
+    )
+    parent_parser.add_argument(
+        '--device_MiBps',
+        help='Bandwidth budget of every device for transfers (default: unlimited)',
+        type=float,
+        default=None,
+        metavar='MIBPS',
+    )
     parent_parser.add_argument(
         '--base_timeout',
         help='Base timeout for various things (default: %(default)s)',
@@ -90,8 +284,16 @@ def main():
     parser_bulk_decrypt = subparsers.add_parser(
         'bulk_decrypt', parents=[parent_parser], help=d, description=d, formatter_class=F
     )
-    parser_bulk_decrypt.add_argument('itunes_ids', help='File containing lines with iTunes IDs')
+    parser_bulk_decrypt.add_argument(
+        'itunes_ids',
+        help='File with one iTunes ID per line or - for stdin. A line may add a country code and a priority '
+        + '("123456789 de 5"), be a JSON object ({"itunes_id": ..., "country": ...}) or a # comment. '
+        + 'Duplicates and apps which are already in the output directory are skipped.',
+    )
     parser_bulk_decrypt.add_argument('output', help='Output directory')
+    parser_bulk_decrypt.add_argument(
+        '--follow', help='Keep reading IDs which are appended to the file, like tail -f', action='store_true'
+    )
     parser_bulk_decrypt.add_argument(
         '--parallel', help='How many apps get installed in parallel (default: %(default)s)', type=int, default=3
     )
@@ -99,6 +301,55 @@ def main():
         '--timeout_per_MiB', help='Timeout per MiB (default: %(default)s)', type=float, default=0.5, metavar='SECONDS'
     )
     parser_bulk_decrypt.add_argument('--country', help='Two letter country code (default: %(default)s)', default='us')
+    parser_bulk_decrypt.add_argument(
+        '--no_verify', help='Do not verify IPAs and do not write catalog.jsonl', action='store_true'
+    )
+    parser_bulk_decrypt.add_argument(
+        '--verify_workers', help='Processes which verify IPAs (default: %(default)s)', type=int, default=2
+    )
+    parser_bulk_decrypt.add_argument(
+        '--storage_headroom_MiB',
+        help='Only install an app if installing and dumping it leaves this much space free on the device '
+        + '(default: %(default)s)',
+        type=float,
+        default=1024,
+        metavar='MIB',
+    )
+    parser_bulk_decrypt.add_argument(
+        '--no_storage_check', help='Install apps without checking the free space on the device', action='store_true'
+    )
+    parser_bulk_decrypt.add_argument(
+        '--sink',
+        help='Where the IPAs are stored: local (the output directory), cas (content addressed in the output '
+        + 'directory) or s3://bucket/prefix (S3 compatible storage, configured by AWS_ENDPOINT_URL, AWS_REGION, '
+        + 'AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY; IPAs are not verified) (default: %(default)s)',
+        default='local',
+        metavar='URL',
+    )
+    parser_bulk_decrypt.add_argument(
+        '--metrics_port',
+        help='Serve Prometheus metrics on http://0.0.0.0:PORT/metrics (default: disabled)',
+        type=int,
+        default=None,
+        metavar='PORT',
+    )
+    parser_bulk_decrypt.add_argument(
+        '--metrics_textfile',
+        help='Write Prometheus metrics to this file after every app (default: disabled)',
+        default=None,
+        metavar='PATH',
+    )
+
+    # daemon
+    d = 'Keep connections to all attached devices open and run the jobs of the other commands'
+    parser_daemon = subparsers.add_parser('daemon', parents=[parent_parser], help=d, description=d, formatter_class=F)
+    parser_daemon.add_argument(
+        '--metrics_port',
+        help='Serve Prometheus metrics on http://0.0.0.0:PORT/metrics (default: disabled)',
+        type=int,
+        default=None,
+        metavar='PORT',
+    )
 
     # dump
     d = 'Decrypt app binary und dump IPA'
@@ -108,12 +359,31 @@ def main():
     parser_dump.add_argument(
         '--frida', help='Use Frida instead of FoulDecrypt (default: %(default)s)', action='store_true'
     )
+    parser_dump.add_argument(
+        '--all_modules',
+        help='Frida: load and dump all modules, not only encrypted ones (default: %(default)s)',
+        action='store_true',
+    )
     parser_dump.add_argument(
         '--nocopy',
         help='FoulDecrypt: decrypt and package inplace without copying '
         + '(faster but app is broken afterwards) (default: %(default)s)',
         action='store_true',
     )
+    parser_dump.add_argument(
+        '--nohardlink',
+        help='FoulDecrypt: copy the app instead of staging it with hardlinks or clones (default: %(default)s)',
+        action='store_true',
+    )
+    parser_dump.add_argument(
+        '--jobs',
+        help='FoulDecrypt: binaries decrypted in parallel. 0 means number of CPUs of device (default: %(default)s)',
+        type=int,
+        default=0,
+    )
+    parser_dump.add_argument(
+        '--no_verify', help='Do not check that the IPA is complete and decrypted', action='store_true'
+    )
     parser_dump.add_argument(
         '--timeout',
         help='Dump timeout (default: %(default)s)',
@@ -132,6 +402,7 @@ def main():
     parser_install.add_argument('itunes_id', help='iTunes ID', type=int)
 
     args = parser.parse_args()
+    setup_logging(log_file=args.log_file)
     # print(vars(args))
 
     if args.command == 'help' or args.command is None:
@@ -165,12 +436,127 @@ def main():
             hn = hn.rstrip('optional arguments:\n')
             print(f"\n\n{p_str}:\n{hn}")
         exit()
+    if getattr(args, 'sink', None) is not None:
+        from ipadumper.sinks import parse_url
+
+        try:
+            parse_url(args.sink)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.command in DEVICE_COMMANDS and not args.no_daemon:
+        exitcode = submit_job(args, parent_parser.parse_args([]))
+        if exitcode is not None:
+            exit(exitcode)
+
+    if hasattr(args, 'bus_MiBps'):
+        from ipadumper import transfers
+
+        transfers.SCHEDULER.configure(
+            bus_rate=None if args.bus_MiBps is None else args.bus_MiBps * 2**20,
+            device_rate=None if args.device_MiBps is None else args.device_MiBps * 2**20,
+        )
+
     exitcode = 0
     if args.command == 'itunes_info':
         itunes_info(args.itunes_id, log_level='debug', country=args.country)
+    elif args.command == 'benchmark':
+        from ipadumper.benchmark import bench_dump_copy
+
+        bufsizes = args.bufsize if args.bufsize else [4096, 8 * 2**20]
+        bench_dump_copy(
+            args.fixtures, size_MiB=args.size_MiB, bufsizes=bufsizes, repeat=args.repeat, log_level=args.verbosity
+        )
+    elif args.command == 'simulate' and args.benchmark == 'async_dump_frida':
+        from ipadumper.benchmark import bench_async
+
+        result = bench_async(args.devices, apps=args.apps, app_size_MiB=args.app_size_MiB, log_level=args.verbosity)
+        if result is None:
+            exit(1)
+    elif args.command == 'simulate':
+        from ipadumper.benchmark import bench_simulated
+
+        result = bench_simulated(
+            args.benchmark,
+            apps=args.apps,
+            parallel=args.parallel,
+            app_size_MiB=args.app_size_MiB,
+            install_latency=args.install_latency,
+            bandwidth_MiBps=args.bandwidth_MiBps,
+            popup_rate=args.popup_rate,
+            storage_MiB=args.storage_MiB,
+            host_matching=not args.device_matching,
+            log_level=args.verbosity,
+        )
+        if result is None:
+            exit(1)
+    elif args.command == 'match':
+        from ipadumper import matcher
+
+        position_cache = matcher.PositionCache()
+        m = matcher.ScreenMatcher(
+            args.imagedir, theme=args.theme, lang=args.lang, position_cache=position_cache, log_level=args.verbosity
+        )
+        for screenshot in args.screenshots:
+            state, xy = m.classify(matcher.Image.open(screenshot))
+            print(f'{screenshot}: {state} {xy if xy else ""}')
+        hits, misses, rate = position_cache.stats()['total']
+        print(f'Position cache: {hits} hits, {misses} misses ({rate:.0%} hit rate)')
+    elif args.command == 'plan':
+        from ipadumper import planner
+
+        try:
+            report = planner.plan(
+                args.metadata,
+                args.config_file,
+                history_paths=args.history,
+                sample=args.sample,
+                deadline_hours=args.deadline,
+                storage_MiB=args.storage_MiB,
+                download_MiBps=args.download_MiBps,
+                seed=args.seed,
+                log_level=args.verbosity,
+            )
+        except (OSError, ValueError) as e:
+            print(f'Could not plan: {str(e)}', file=sys.stderr)
+            exit(1)
+        if args.json:
+            print(json.dumps(report, indent=2, default=str))
+        else:
+            print('\n'.join(planner.format_report(report)))
     elif args.command == 'multidump':
-        MultiDevice(args.config_file, log_level=args.verbosity)
+        from ipadumper.controller import MultiDevice
+        from ipadumper import metrics
+
+        if args.metrics_port is not None:
+            metrics.start_http_server(args.metrics_port)
+        m = MultiDevice(
+            args.config_file,
+            args.itunes_ids,
+            log_level=args.verbosity,
+            follow=args.follow,
+            metrics_textfile=args.metrics_textfile,
+            trace_path=args.trace,
+        )
+        if not m.run():
+            exit(1)
+    elif args.command == 'daemon':
+        from ipadumper.daemon import Daemon
+
+        d = Daemon(
+            args.socket,
+            udids=None if args.udid is None else [args.udid],
+            appledl_args=connection_args(args),
+            log_level=args.verbosity,
+            metrics_port=args.metrics_port,
+        )
+        if not d.start():
+            d.stop()
+            exit(1)
+        d.wait()
     else:
+        from ipadumper.appledl import AppleDL
+        from ipadumper import metrics
+
         a = AppleDL(
             udid=args.udid,
             device_address=args.device_address,
@@ -183,33 +569,146 @@ def main():
             timeout=args.base_timeout,
             log_level=args.verbosity,
             init=False,
+            host_matching=not args.device_matching,
+            position_cache_path=None if args.no_position_cache else args.position_cache,
+            metrics_textfile=getattr(args, 'metrics_textfile', None),
+            trace_path=args.trace,
+            tunnel=args.tunnel,
+            transfer_bus=args.usb_bus,
         )
         if not a.running:
             exit(1)
         if args.command == 'bulk_decrypt':
+            if args.metrics_port is not None:
+                metrics.start_http_server(args.metrics_port)
             if a.init_all():
-                with open(args.itunes_ids) as fp:
-                    itunes_ids = fp.read().splitlines()
-                itunes_ids = [int(i) for i in itunes_ids]
+                from ipadumper import ingest, sinks
 
+                lines = ingest.iter_lines(args.itunes_ids, follow=args.follow)
                 a.bulk_decrypt(
-                    itunes_ids,
+                    ingest.read_entries(lines, log_level=args.verbosity),
                     timeout_per_MiB=args.timeout_per_MiB,
                     parallel=args.parallel,
                     output_directory=args.output,
+                    country=args.country,
+                    verify=not args.no_verify,
+                    verify_workers=args.verify_workers,
+                    storage_headroom_MiB=None if args.no_storage_check else args.storage_headroom_MiB,
+                    sink=sinks.from_url(args.sink, args.output, log_level=args.verbosity),
                 )
         elif args.command == 'dump':
             if args.frida:
-                exitcode = a.dump_frida(args.bundleID, args.output, args.timeout)
+                result = a.dump_frida(args.bundleID, args.output, args.timeout, selective=not args.all_modules)
             else:
-                exitcode = a.dump_fouldecrypt(args.bundleID, args.output, args.timeout, copy=not args.nocopy)
+                result = a.dump_fouldecrypt(
+                    args.bundleID,
+                    args.output,
+                    args.timeout,
+                    copy=not args.nocopy,
+                    hardlink=not args.nohardlink,
+                    jobs=args.jobs,
+                )
+            if result and not args.no_verify:
+                result = a.verify(args.output)
+            exitcode = 0 if result else 1
         elif args.command == 'ssh_cmd':
             exitcode, stdout, stderr = a.ssh_cmd(args.cmd)
             print(stdout)
             print(stderr)
         elif args.command == 'install':
-            exitcode = a.install(args.itunes_id)
+            exitcode = 0 if a.install(args.itunes_id) else 1
 
         a.cleanup()
 
     exit(exitcode)
+
+
+def connection_args(args):
+    '''
+    return AppleDL arguments of the connection options, a daemon keeps the ones it was started with
+    '''
+    return dict(
+        device_address=args.device_address,
+        ssh_key_filename=path.abspath(args.ssh_key),
+        local_ssh_port=args.local_ssh_port,
+        local_zxtouch_port=args.local_zxtouch_port,
+        image_base_path_local=path.abspath(args.imagedir),
+        theme=args.theme,
+        lang=args.lang,
+        timeout=args.base_timeout,
+        host_matching=not args.device_matching,
+        position_cache_path=None if args.no_position_cache else path.abspath(args.position_cache),
+        trace_path=None if args.trace is None else path.abspath(args.trace),
+        tunnel=args.tunnel,
+        transfer_bus=args.usb_bus,
+    )
+
+
+def submit_job(args, defaults):
+    '''
+    Run the command on a running daemon, its log is written to stderr
+    defaults: parsed defaults of the connection options, the options which were set are sent with the job and the
+              daemon rejects the job if it was started with other values
+    The bandwidth budgets and metrics options are sent with the job and apply to its session.
+    return exitcode or None if no daemon is running
+    '''
+    job_args = {}
+    stream = None
+    if args.command == 'bulk_decrypt':
+        from ipadumper import ingest
+
+        # the daemon parses the lines while they are streamed
+        stream = ingest.iter_lines(args.itunes_ids, follow=args.follow)
+        job_args = dict(
+            output=path.abspath(args.output),
+            parallel=args.parallel,
+            timeout_per_MiB=args.timeout_per_MiB,
+            country=args.country,
+            verify=not args.no_verify,
+            verify_workers=args.verify_workers,
+            storage_headroom_MiB=None if args.no_storage_check else args.storage_headroom_MiB,
+            sink=args.sink,
+        )
+    elif args.command == 'dump':
+        job_args = dict(
+            bundleID=args.bundleID,
+            output=path.abspath(args.output),
+            timeout=args.timeout,
+            frida=args.frida,
+            all_modules=args.all_modules,
+            nocopy=args.nocopy,
+            nohardlink=args.nohardlink,
+            jobs=args.jobs,
+            verify=not args.no_verify,
+        )
+    elif args.command == 'ssh_cmd':
+        job_args = {'cmd': args.cmd}
+    elif args.command == 'install':
+        job_args = {'itunes_id': args.itunes_id}
+
+    default_connection = connection_args(defaults)
+    connection = {k: v for k, v in connection_args(args).items() if v != default_connection[k]}
+    metrics_textfile = getattr(args, 'metrics_textfile', None)
+    options = dict(
+        bus_MiBps=args.bus_MiBps,
+        device_MiBps=args.device_MiBps,
+        metrics_textfile=None if metrics_textfile is None else path.abspath(metrics_textfile),
+        metrics_port=getattr(args, 'metrics_port', None),
+    )
+    job = {
+        'command': args.command,
+        'udid': args.udid,
+        'args': job_args,
+        'connection': connection,
+        'options': {k: v for k, v in options.items() if v is not None},
+    }
+    result = submit(job, args.socket, on_log=lambda line: print(line, file=sys.stderr), stream=stream)
+    if result is None:
+        return None
+    if 'error' in result:
+        print(f"Daemon: {result['error']}", file=sys.stderr)
+    if args.command == 'ssh_cmd' and 'exitcode' in result:
+        print(result['stdout'])
+        print(result['stderr'])
+        return result['exitcode']
+    return 0 if result['success'] else 1
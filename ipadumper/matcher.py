@@ -0,0 +1,294 @@
+# stdlib
+import json
+import os
+import tempfile
+import threading
+
+# external (optional)
+try:
+    from PIL import Image
+    import numpy as np
+except ImportError:
+    np = None
+
+# internal
+from ipadumper.utils import get_logger
+
+
+STATE_LOADING = 'loading'
+
+# template name -> path relative to the theme directory
+TEMPLATES = {
+    'dissallow': os.path.join('{lang}', 'dissallow.png'),
+    'get': os.path.join('{lang}', 'get.png'),
+    'cloud': 'cloud.png',
+    'install': os.path.join('{lang}', 'install.png'),
+}
+
+# if multiple templates match, the first one in this list wins
+PRIORITY = ['dissallow', 'install', 'cloud', 'get']
+
+
+def available():
+    '''
+    return True if the optional dependencies (numpy, Pillow) for host side matching are installed
+    '''
+    return np is not None
+
+
+def _integral(a):
+    '''
+    return integral image of a with a leading row and column of zeros
+    '''
+    ii = np.zeros((a.shape[0] + 1, a.shape[1] + 1), dtype=np.float64)
+    ii[1:, 1:] = a.cumsum(0).cumsum(1)
+    return ii
+
+
+def _window_sums(ii, h, w):
+    '''
+    return sums of all h x w windows from an integral image
+    '''
+    return ii[h:, w:] - ii[:-h, w:] - ii[h:, :-w] + ii[:-h, :-w]
+
+
+def _ncc(img, t, t_norm, spectrum=None, ii=None, ii2=None):
+    '''
+    Normalized cross-correlation of template t (zero mean, norm t_norm) with img
+    spectrum, ii, ii2: precomputed rfft2 and integral images of img (computed if None)
+    return score, (x, y) of the top left corner of the best match
+    '''
+    H, W = img.shape
+    h, w = t.shape
+    if h > H or w > W or t_norm == 0:
+        return 0.0, None
+    if spectrum is None:
+        spectrum = np.fft.rfft2(img)
+    if ii is None:
+        ii = _integral(img)
+    if ii2 is None:
+        ii2 = _integral(img * img)
+    corr = np.fft.irfft2(spectrum * np.conj(np.fft.rfft2(t, s=(H, W))), s=(H, W))[: H - h + 1, : W - w + 1]
+    s1 = _window_sums(ii, h, w)
+    s2 = _window_sums(ii2, h, w)
+    variance = np.maximum(s2 - s1 * s1 / (h * w), 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ncc = np.where(variance > 1e-6, corr / (np.sqrt(variance) * t_norm), 0)
+    y, x = np.unravel_index(np.argmax(ncc), ncc.shape)
+    return float(ncc[y, x]), (int(x), int(y))
+
+
+class PositionCache:
+    '''
+    Learned positions of matched templates, persisted as JSON file
+    Keys contain the device, the screenshot size, theme, language and template name.
+    '''
+
+    lock = threading.Lock()  # shared by all instances, they may use the same file
+
+    def __init__(self, path=None, device='default'):
+        '''
+        path: JSON file (default: $XDG_CACHE_HOME/ipadumper/positions.json), None or '' to keep the cache in memory
+        '''
+        self.path = path
+        self.device = device
+        self.positions = {}
+        self.hits = {}  # name -> count
+        self.misses = {}  # name -> count
+        if self.path:
+            try:
+                with open(self.path) as f:
+                    self.positions = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def key(self, size, theme, lang, name):
+        return f'{self.device}/{size[0]}x{size[1]}/{theme}/{lang}/{name}'
+
+    def get(self, key):
+        '''
+        return predicted (x, y) of the center or None
+        '''
+        xy = self.positions.get(key)
+        return tuple(xy) if xy is not None else None
+
+    def set(self, key, xy):
+        '''
+        Remember position and write it to the cache file if it moved
+        '''
+        old = self.positions.get(key)
+        if old is not None and abs(old[0] - xy[0]) <= 2 and abs(old[1] - xy[1]) <= 2:
+            return
+        self.positions[key] = list(xy)
+        if not self.path:
+            return
+        with self.lock:
+            # only this key is written, the file may have newer positions of other devices and processes
+            try:
+                with open(self.path) as f:
+                    positions = json.load(f)
+            except (FileNotFoundError, ValueError):
+                positions = {}
+            positions[key] = list(xy)
+            self.positions = {**self.positions, **positions}
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(positions, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+
+    def record(self, name, hit):
+        counter = self.hits if hit else self.misses
+        counter[name] = counter.get(name, 0) + 1
+
+    def stats(self):
+        '''
+        return dict name -> (hits, misses, hit rate) and 'total'
+        '''
+        stats = {}
+        for name in sorted(set(self.hits) | set(self.misses)):
+            hits, misses = self.hits.get(name, 0), self.misses.get(name, 0)
+            stats[name] = (hits, misses, hits / (hits + misses))
+        hits, misses = sum(self.hits.values()), sum(self.misses.values())
+        stats['total'] = (hits, misses, hits / (hits + misses) if hits + misses > 0 else 0.0)
+        return stats
+
+
+class ScreenMatcher:
+    '''
+    Host side template matching for the App Store buttons
+    All templates of a theme and language are matched on one screenshot with normalized cross-correlation.
+    If a position cache is given, a template is first matched in a small region around its last position
+    and only if that misses on the whole screen. The FFT of the screenshot is computed once and shared by all
+    templates which need a full screen search.
+    '''
+
+    def __init__(
+        self,
+        image_base_path_local,
+        theme='dark',
+        lang='en',
+        acceptable_value=0.9,
+        scale=0.5,
+        position_cache=None,
+        roi_margin=48,
+        log_level='info',
+    ):
+        '''
+        scale: screenshot and templates are resized by this factor before matching
+        position_cache: PositionCache or None
+        roi_margin: pixels (in screenshot coordinates) around the predicted template position which are searched
+        '''
+        if not available():
+            raise ImportError('Host side matching needs numpy and Pillow (pip install ipadumper[match])')
+        self.log = get_logger(log_level, name=__name__)
+        self.theme = theme
+        self.lang = lang
+        self.acceptable_value = acceptable_value
+        self.scale = scale
+        self.position_cache = position_cache
+        self.roi_margin = roi_margin
+
+        self.templates = {}  # name -> zero mean template, norm
+        theme_path = os.path.join(image_base_path_local, theme)
+        for name, path in TEMPLATES.items():
+            img = self.__prepare(Image.open(os.path.join(theme_path, path.format(lang=lang))))
+            t = img - img.mean()
+            self.templates[name] = (t, np.sqrt((t * t).sum()))
+
+    def __prepare(self, img):
+        '''
+        return grayscale float array of a PIL image resized by self.scale
+        '''
+        img = img.convert('L')
+        if self.scale != 1:
+            size = (max(1, round(img.width * self.scale)), max(1, round(img.height * self.scale)))
+            img = img.resize(size, Image.BILINEAR)
+        return np.asarray(img, dtype=np.float64)
+
+    def __match_roi(self, img, name, center):
+        '''
+        Match template in the region around the predicted center
+        return score, (x, y) of the center in screenshot coordinates
+        '''
+        t, t_norm = self.templates[name]
+        h, w = t.shape
+        margin = round(self.roi_margin * self.scale)
+        cx, cy = round(center[0] * self.scale), round(center[1] * self.scale)
+        x0, y0 = max(0, cx - w // 2 - margin), max(0, cy - h // 2 - margin)
+        x1, y1 = min(img.shape[1], cx + (w + 1) // 2 + margin), min(img.shape[0], cy + (h + 1) // 2 + margin)
+        score, xy = _ncc(img[y0:y1, x0:x1], t, t_norm)
+        if xy is None:
+            return score, None
+        return score, (int((x0 + xy[0] + w / 2) / self.scale), int((y0 + xy[1] + h / 2) / self.scale))
+
+    def match(self, screenshot, names=None):
+        '''
+        screenshot: PIL image
+        names: template names to match (default: all)
+        return dict name -> (score, (x, y)) with the center of the best match in screenshot coordinates
+        '''
+        names = list(self.templates) if names is None else names
+        img = self.__prepare(screenshot)
+        full = None  # spectrum and integral images of the whole screenshot
+
+        results = {}
+        for name in names:
+            key = None
+            if self.position_cache is not None:
+                key = self.position_cache.key(screenshot.size, self.theme, self.lang, name)
+                center = self.position_cache.get(key)
+                if center is not None:
+                    score, xy = self.__match_roi(img, name, center)
+                    hit = score >= self.acceptable_value
+                    self.position_cache.record(name, hit)
+                    if hit:
+                        results[name] = (score, xy)
+                        continue
+
+            if full is None:
+                full = (np.fft.rfft2(img), _integral(img), _integral(img * img))
+            t, t_norm = self.templates[name]
+            score, xy = _ncc(img, t, t_norm, *full)
+            if xy is not None:
+                xy = (int((xy[0] + t.shape[1] / 2) / self.scale), int((xy[1] + t.shape[0] / 2) / self.scale))
+                if key is not None and score >= self.acceptable_value:
+                    self.position_cache.set(key, xy)
+            results[name] = (score, xy)
+        return results
+
+    def classify(self, screenshot, names=None):
+        '''
+        Classify the screen state
+        names: template names which are relevant in the current state (default: all)
+        return name of the matched template (or STATE_LOADING), (x, y) or None
+        '''
+        results = self.match(screenshot, names)
+        self.log.debug(', '.join(f'{name}: {score:.3f}' for name, (score, _) in results.items()))
+        for name in PRIORITY:
+            if name in results and results[name][0] >= self.acceptable_value:
+                return name, results[name][1]
+        return STATE_LOADING, None
+
+
+class AdaptivePoll:
+    '''
+    Polling interval which starts short and grows after every tick without change
+    '''
+
+    def __init__(self, minimum=0.2, maximum=1, factor=1.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.interval = minimum
+
+    def reset(self):
+        self.interval = self.minimum
+
+    def next(self):
+        '''
+        return time to sleep before the next tick
+        '''
+        interval = self.interval
+        self.interval = min(self.interval * self.factor, self.maximum)
+        return interval
@@ -0,0 +1,242 @@
+# stdlib
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import tempfile
+import threading
+import time
+
+# internal
+from ipadumper import tracing
+
+
+# stages of an app in bulk_decrypt
+STAGES = [
+    'metadata',
+    'install',
+    'install_wait',
+    'match',
+    'frida_attach',
+    'dump',
+    'transfer',
+    'package',
+    'uninstall',
+    'verify',
+]
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    '''
+    Monotonic counter with labels
+    '''
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> value
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(tuple(str(labels[n]) for n in self.labelnames), 0)
+
+    def expose(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [f'{self.name}{_labels(self.labelnames, key)} {_number(value)}' for key, value in items]
+
+
+class Histogram:
+    '''
+    Histogram with labels, buckets are upper bounds in seconds
+    '''
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> [bucket counts, sum]
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        counts, _ = self.values.get(tuple(str(labels[n]) for n in self.labelnames), ([0], 0))
+        return sum(counts)
+
+    def expose(self):
+        with self.lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(
+                    f'{self.name}_bucket{_labels(self.labelnames, key, [("le", _number(float(bound)))])} {cumulative}'
+                )
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    '''
+    Collection of metrics which can be exposed in the Prometheus text format
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}  # name -> metric
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                return self.metrics[metric.name]
+            self.metrics[metric.name] = metric
+            return metric
+
+    def expose(self):
+        '''
+        return metrics in the Prometheus text format
+        '''
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines += metric.expose()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(
+    Histogram('ipadumper_stage_duration_seconds', 'Duration of a stage', ['stage', 'device', 'outcome'])
+)
+STAGE_TOTAL = REGISTRY.register(Counter('ipadumper_stage_total', 'Finished stages', ['stage', 'device', 'outcome']))
+TRANSFER_BYTES = REGISTRY.register(
+    Counter('ipadumper_transfer_bytes_total', 'Bytes transferred from the device', ['device'])
+)
+TRANSFER_SECONDS = REGISTRY.register(
+    Counter('ipadumper_transfer_seconds_total', 'Time spent transferring files from the device', ['device'])
+)
+APPS_TOTAL = REGISTRY.register(Counter('ipadumper_apps_total', 'Processed apps', ['device', 'outcome']))
+
+
+def observe(stage, device, seconds, outcome='ok'):
+    STAGE_SECONDS.observe(seconds, stage=stage, device=device, outcome=outcome)
+    STAGE_TOTAL.inc(stage=stage, device=device, outcome=outcome)
+
+
+class _Stage:
+    def __init__(self):
+        self.outcome = 'ok'
+
+    def fail(self, outcome='error'):
+        self.outcome = outcome
+
+
+@contextmanager
+def stage(name, device):
+    '''
+    Measure duration of a stage, it is also recorded as span if tracing is enabled
+    The outcome is 'ok' unless an exception is raised or fail() is called on the yielded object
+
+        with metrics.stage('uninstall', device) as s:
+            if not uninstall():
+                s.fail()
+    '''
+    s = _Stage()
+    with tracing.span(name, device=device) as span:
+        start = time.perf_counter()
+        try:
+            yield s
+        except BaseException:
+            s.fail()
+            raise
+        finally:
+            observe(name, device, time.perf_counter() - start, s.outcome)
+            span.set(outcome=s.outcome)
+
+
+def transfer(device, nbytes, seconds):
+    TRANSFER_BYTES.inc(nbytes, device=device)
+    TRANSFER_SECONDS.inc(seconds, device=device)
+
+
+def write_textfile(path, registry=REGISTRY):
+    '''
+    Write metrics atomically to a file (for the textfile collector of the node exporter)
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.metrics')
+    with os.fdopen(fd, 'w') as f:
+        f.write(registry.expose())
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+
+
+def start_http_server(port, addr='0.0.0.0', registry=REGISTRY):
+    '''
+    Serve metrics on http://addr:port/metrics in a daemon thread
+    return server
+    '''
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.expose().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    return server
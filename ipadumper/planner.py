@@ -0,0 +1,721 @@
+# stdlib
+import bisect
+from collections import deque, namedtuple
+import heapq
+import json
+import math
+import random
+import re
+import sys
+
+# internal
+from ipadumper import metrics
+from ipadumper.controller import load_config
+from ipadumper.utils import get_logger
+
+
+# stages on the loop of bulk_decrypt, they block the device
+SERIAL_STAGES = ['metadata', 'install', 'dump', 'uninstall']
+# phases of a simulated device: the serial stages and why the loop waits
+PHASES = SERIAL_STAGES + ['install_wait', 'storage', 'restart']
+
+# without history (seconds, MiB/s)
+DEFAULT_SECONDS = {'metadata': 0.5, 'install': 8.0, 'dump': 5.0, 'uninstall': 2.0}
+DEFAULT_INSTALL_LATENCY = 5.0  # from the end of the download until the app is installed
+DEFAULT_DOWNLOAD_MIBPS = 20.0
+DEFAULT_DUMP_MIBPS = 40.0
+DEFAULT_STORAGE_MIB = 32768
+
+# reservations of storage.StorageBudget, an installed app takes about its fileSize
+INSTALL_FACTOR = 2.0
+DUMP_FACTOR = 1.0
+HEADROOM_MIB = 1024
+
+RESTART_SECONDS = 20  # backoff of a failed MultiDevice session and connecting again
+
+SWEEP_PARALLEL = [1, 2, 3, 4, 5, 6, 8]
+SWEEP_TIMEOUT_PER_MIB = [0.1, 0.25, 0.5, 1.0, 2.0, 4.0]
+
+App = namedtuple('App', ['itunes_id', 'size_MiB', 'price', 'country', 'available'])
+
+METRIC_PATTERN = re.compile(r'^(\w+)\{(.*)\}\s+(\S+)$')
+LABEL_PATTERN = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_app(obj):
+    '''
+    return App of a result of the iTunes search API or of a dict with itunes_id, fileSizeMiB, price, country
+    Apps without size or with "available": false are not in the storefront.
+    '''
+    itunes_id = obj.get('itunes_id', obj.get('trackId'))
+    if itunes_id is None:
+        raise ValueError('no itunes_id')
+    if 'fileSizeMiB' in obj:
+        size_MiB = float(obj['fileSizeMiB'])
+    elif 'fileSizeBytes' in obj:
+        size_MiB = int(obj['fileSizeBytes']) / 2**20
+    else:
+        size_MiB = None
+    available = bool(obj.get('available', size_MiB is not None))
+    return App(int(itunes_id), size_MiB or 0.0, float(obj.get('price', 0) or 0), obj.get('country'), available)
+
+
+def read_apps(path, sample=20000, seed=0, log_level='info'):
+    '''
+    Read the resolved metadata of a plan (JSON lines, - for stdin) and keep a random sample in input order
+    Only the sample is parsed, the totals of larger plans are estimated from it.
+    return list of App (at most sample), dict with totals of all apps
+    '''
+    log = get_logger(log_level, name=__name__)
+    rng = random.Random(seed)
+    reservoir = []  # (line number, line)
+    # reservoir sampling with geometric skips (Li's algorithm L), memory does not grow with the plan
+    w = math.exp(math.log(1 - rng.random()) / sample)
+    following = sample + int(math.log(1 - rng.random()) / math.log(1 - w)) + 1
+    n = 0
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        for lineno, line in enumerate(f, start=1):
+            if line.isspace() or line.startswith('#'):
+                continue
+            n += 1
+            if n <= sample:
+                reservoir.append((lineno, line))
+            elif n == following:
+                reservoir[rng.randrange(sample)] = (lineno, line)
+                w *= math.exp(math.log(1 - rng.random()) / sample)
+                following += int(math.log(1 - rng.random()) / math.log(1 - w)) + 1
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+    apps = []
+    for lineno, line in sorted(reservoir):
+        try:
+            apps.append(parse_app(json.loads(line)))
+        except (ValueError, TypeError, AttributeError) as e:
+            log.warning(f'{path}:{lineno}: skipping invalid metadata: {str(e)}')
+    scale = n / len(reservoir) if reservoir else 0
+    countries = {}
+    for app in apps:
+        countries[app.country or ''] = countries.get(app.country or '', 0) + 1
+    totals = {
+        'apps': round(len(apps) * scale),
+        'MiB': sum(app.size_MiB for app in apps) * scale,
+        'not_free': round(sum(1 for app in apps if app.available and app.price != 0) * scale),
+        'not_available': round(sum(1 for app in apps if not app.available) * scale),
+        'countries': {country: round(count * scale) for country, count in countries.items()},
+    }
+    return apps, totals
+
+
+class Distribution:
+    '''
+    Durations of a stage, sampled from observed values or from the buckets of a histogram
+    '''
+
+    def __init__(self, values=None, buckets=None):
+        '''
+        values: list of seconds
+        buckets: list of (upper bound, count) of a histogram, not cumulative
+        '''
+        self.values = list(values or [])
+        self.bounds = []  # (lower, upper)
+        self.cumulative = []
+        total = 0
+        lower = 0.0
+        for upper, count in buckets or []:
+            if count > 0:
+                if math.isinf(upper):
+                    upper = lower * 2 or 1.0
+                total += count
+                self.bounds.append((lower, upper))
+                self.cumulative.append(total)
+            lower = upper
+        if len(self.values) == 0 and total == 0:
+            raise ValueError('no observations')
+
+    @classmethod
+    def constant(cls, seconds):
+        return cls(values=[seconds])
+
+    def sample(self, rng):
+        if self.values:
+            return self.values[int(rng.random() * len(self.values))]
+        i = bisect.bisect_right(self.cumulative, rng.random() * self.cumulative[-1])
+        lower, upper = self.bounds[min(i, len(self.bounds) - 1)]
+        return lower + (upper - lower) * rng.random()
+
+
+def fit_line(points):
+    '''
+    Least squares fit of y = a + b * x
+    return a, b or None if b can't be estimated
+    '''
+    n = len(points)
+    if n < 3:
+        return None
+    mx = sum(x for x, _ in points) / n
+    my = sum(y for _, y in points) / n
+    sxx = sum((x - mx) ** 2 for x, _ in points)
+    if sxx == 0:
+        return None
+    b = sum((x - mx) * (y - my) for x, y in points) / sxx
+    if b <= 0:
+        return None
+    return my - b * mx, b
+
+
+class Timings:
+    '''
+    Stage timings of previous runs, read from metrics textfiles (metrics_textfile) or Chrome traces (trace_path)
+    Traces also have app sizes, so download bandwidth and dump speed are fitted from them, with metrics only
+    their defaults (or the values of the device config) are used.
+    '''
+
+    def __init__(self, log_level='info'):
+        self.log = get_logger(log_level, name=__name__)
+        self.durations = {}  # stage -> list of seconds
+        self.buckets = {}  # stage -> {upper bound: count}
+        self.outcomes = {}  # stage -> {outcome: count}
+        self.install_waits = []  # (seconds, MiB, concurrent installs)
+        self.dumps = []  # (seconds, MiB)
+        self.distributions = {}
+        self.install_latency = None
+        self.download_MiBps = None
+        self.dump_seconds_per_MiB = None
+
+    def load(self, path):
+        with open(path) as f:
+            text = f.read()
+        if text.lstrip().startswith(('{', '[')):
+            self.add_trace(json.loads(text))
+        else:
+            self.add_metrics(text)
+
+    def __outcome(self, stage, outcome, count=1):
+        outcomes = self.outcomes.setdefault(stage, {})
+        outcomes[outcome] = outcomes.get(outcome, 0) + count
+
+    def add_metrics(self, text):
+        '''
+        Add the stage histograms of a Prometheus textfile (summed over all devices)
+        '''
+        cumulative = {}  # (stage, device, outcome) -> [(le, count)]
+        for line in text.splitlines():
+            m = METRIC_PATTERN.match(line.strip())
+            if m is None or m.group(1) != metrics.STAGE_SECONDS.name + '_bucket':
+                continue
+            labels = dict(LABEL_PATTERN.findall(m.group(2)))
+            key = (labels.get('stage'), labels.get('device'), labels.get('outcome', 'ok'))
+            cumulative.setdefault(key, []).append((float(labels['le']), int(float(m.group(3)))))
+        for (stage, device, outcome), points in cumulative.items():
+            points.sort()
+            previous = 0
+            for le, count in points:
+                buckets = self.buckets.setdefault(stage, {})
+                buckets[le] = buckets.get(le, 0) + count - previous
+                previous = count
+            self.__outcome(stage, outcome, previous)
+
+    def add_trace(self, trace):
+        '''
+        Add the stage spans of a Chrome trace of tracing.py
+        '''
+        events = trace['traceEvents'] if isinstance(trace, dict) else trace
+        waits = {}  # pid -> [(start, end, MiB, app)]
+        dumps = []  # (pid, app, seconds)
+        for event in events:
+            if event.get('ph') != 'X':
+                continue
+            name, args, seconds = event['name'], event.get('args', {}), event['dur'] / 1e6
+            if name == 'install_wait':
+                waits.setdefault(event['pid'], []).append(
+                    (event['ts'], event['ts'] + event['dur'], args.get('MiB'), args.get('app'))
+                )
+                self.__outcome(name, args.get('outcome', 'ok'))
+            elif name in SERIAL_STAGES:
+                self.durations.setdefault(name, []).append(seconds)
+                self.__outcome(name, args.get('outcome', 'ok'))
+                if name == 'dump':
+                    dumps.append((event['pid'], args.get('app'), seconds))
+
+        sizes = {}  # (pid, app) -> MiB
+        for pid, spans in waits.items():
+            # mean number of installs which shared the bandwidth of the device with a span
+            spans.sort()
+            shared = [0.0] * len(spans)
+            for i, (start, end, _, _) in enumerate(spans):
+                for j in range(i + 1, len(spans)):
+                    if spans[j][0] >= end:
+                        break
+                    overlap = min(end, spans[j][1]) - spans[j][0]
+                    shared[i] += overlap
+                    shared[j] += overlap
+            for (start, end, MiB, app), overlap in zip(spans, shared):
+                if MiB is None or end <= start:
+                    continue
+                sizes[(pid, app)] = MiB
+                self.install_waits.append(((end - start) / 1e6, MiB, 1 + overlap / (end - start)))
+        for pid, app, seconds in dumps:
+            if (pid, app) in sizes:
+                self.dumps.append((seconds, sizes[(pid, app)]))
+
+    def fit(self):
+        '''
+        Build the distributions of the stages, missing stages get defaults
+        '''
+        defaults = []
+        for stage in SERIAL_STAGES:
+            if stage in self.durations:
+                self.distributions[stage] = Distribution(values=self.durations[stage])
+            elif stage in self.buckets:
+                self.distributions[stage] = Distribution(buckets=sorted(self.buckets[stage].items()))
+            else:
+                self.distributions[stage] = Distribution.constant(DEFAULT_SECONDS[stage])
+                defaults.append(stage)
+
+        # install_wait = latency + MiB * concurrent installs / bandwidth
+        line = fit_line([(MiB * concurrent, seconds) for seconds, MiB, concurrent in self.install_waits])
+        if line is not None:
+            _, b = line
+            self.download_MiBps = 1 / b
+            latencies = [max(0.0, seconds - MiB * concurrent * b) for seconds, MiB, concurrent in self.install_waits]
+            self.install_latency = Distribution(values=latencies)
+        else:
+            # only traces have the app sizes of install_wait
+            self.install_latency = Distribution.constant(DEFAULT_INSTALL_LATENCY)
+            defaults.append('download speed and install latency')
+
+        # dump = base + MiB * seconds_per_MiB
+        line = fit_line([(MiB, seconds) for seconds, MiB in self.dumps])
+        if line is not None:
+            _, b = line
+            self.dump_seconds_per_MiB = b
+            self.distributions['dump'] = Distribution(values=[max(0.0, s - MiB * b) for s, MiB in self.dumps])
+        elif 'dump' in defaults:
+            self.dump_seconds_per_MiB = 1 / DEFAULT_DUMP_MIBPS
+        else:
+            self.dump_seconds_per_MiB = 0.0  # observed dump durations already include the transfer
+
+        if len(defaults) > 0:
+            self.log.warning(f"No history for {', '.join(defaults)}, using defaults")
+        return self
+
+    def failure_rate(self, stage):
+        outcomes = self.outcomes.get(stage, {})
+        total = sum(outcomes.values())
+        if total == 0:
+            return 0.0
+        return (total - outcomes.get('ok', 0)) / total
+
+    def stuck_rate(self):
+        '''
+        return fraction of installs which never finish (they run into the install timeout)
+        '''
+        outcomes = self.outcomes.get('install_wait', {})
+        total = sum(outcomes.values())
+        return outcomes.get('timeout', 0) / total if total > 0 else 0.0
+
+    def sample(self, stage, rng):
+        return self.distributions[stage].sample(rng)
+
+    def dump(self, MiB, rng):
+        return self.distributions['dump'].sample(rng) + MiB * self.dump_seconds_per_MiB
+
+
+class Install:
+    __slots__ = ('app', 'remaining', 'latency', 'installed_at')
+
+    def __init__(self, app, remaining, latency, installed_at=None):
+        self.app = app
+        self.remaining = remaining  # MiB to download
+        self.latency = latency
+        self.installed_at = installed_at  # known once the download is finished (inf: never)
+
+
+class DeviceModel:
+    '''
+    One device running the loop of bulk_decrypt in simulated time
+    Serial stages block the loop while the downloads of up to parallel apps share the bandwidth of the device.
+    The loop polls installs once per second and gives up like bulk_decrypt, after timeout + timeout_per_MiB *
+    MiB of the installing apps without a finished install. Storage is admitted like storage.StorageBudget.
+    '''
+
+    def __init__(
+        self,
+        name,
+        timings,
+        rng,
+        parallel=3,
+        timeout=15,
+        timeout_per_MiB=0.5,
+        storage_MiB=DEFAULT_STORAGE_MIB,
+        download_MiBps=DEFAULT_DOWNLOAD_MIBPS,
+    ):
+        self.name = name
+        self.timings = timings
+        self.rng = rng
+        self.parallel = parallel
+        self.timeout = timeout
+        self.timeout_per_MiB = timeout_per_MiB
+        self.storage_MiB = storage_MiB
+        self.download_MiBps = download_MiBps
+        self.install_failure = timings.failure_rate('install')
+        self.dump_failure = timings.failure_rate('dump')
+        self.stuck = timings.stuck_rate()
+
+        self.t = 0.0
+        self.downloaded_until = 0.0
+        self.waiting = []  # Install, like wait_for_install
+        self.retry = deque()
+        self.storage_full = False
+        self.waited = 0
+        self.used_MiB = 0.0
+        self.peak_MiB = 0.0
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.downloading = 0.0  # seconds with at least one download
+        self.outcomes = {}
+
+    def __count(self, outcome, n=1):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + n
+
+    def __use(self, MiB):
+        self.used_MiB += MiB
+        self.peak_MiB = max(self.peak_MiB, self.used_MiB)
+
+    def spend(self, phase, seconds):
+        self.advance(self.t + seconds)
+        self.t += seconds
+        self.seconds[phase] += seconds
+
+    def advance(self, to):
+        '''
+        Download until time to, the active downloads share the bandwidth equally
+        '''
+        now = self.downloaded_until
+        while now < to:
+            active = [i for i in self.waiting if i.remaining > 0]
+            if not active:
+                break
+            rate = self.download_MiBps / len(active)
+            first = min(active, key=lambda i: i.remaining)
+            dt = min(first.remaining / rate, to - now)
+            for i in active:
+                i.remaining -= rate * dt
+            now += dt
+            self.downloading += dt
+            # downloads of the same size finish together
+            for i in active:
+                if i.remaining <= 1e-9:
+                    i.remaining = 0
+                    i.installed_at = now + i.latency
+        self.downloaded_until = max(self.downloaded_until, to)
+
+    def next_install(self):
+        '''
+        return time when the next app is installed if no other app is added
+        '''
+        times = [i.installed_at for i in self.waiting if i.remaining == 0]
+        active = sorted((i for i in self.waiting if i.remaining > 0), key=lambda i: i.remaining)
+        now, previous = self.downloaded_until, 0.0
+        for k, i in enumerate(active):
+            now += (i.remaining - previous) * (len(active) - k) / self.download_MiBps
+            previous = i.remaining
+            times.append(now + i.latency)
+        return min(times, default=math.inf)
+
+    def step(self, apps):
+        '''
+        Run one iteration of the loop
+        return False if the device is done
+        '''
+        if len(self.waiting) < self.parallel and not self.storage_full:
+            app = self.retry.popleft() if self.retry else next(apps, None)
+            if app is not None:
+                self.take(app)
+                return True
+        if not self.waiting:
+            return False
+        self.poll()
+        return True
+
+    def take(self, app):
+        self.spend('metadata', self.timings.sample('metadata', self.rng))
+        if not app.available:
+            self.__count('not_available')
+            return
+        if app.price != 0:
+            self.__count('not_free')
+            return
+        needed = (INSTALL_FACTOR + DUMP_FACTOR) * app.size_MiB
+        if self.used_MiB + needed > self.storage_MiB - HEADROOM_MIB:
+            if not self.waiting:
+                self.__count('no_space')
+                return
+            self.retry.appendleft(app)
+            self.storage_full = True
+            return
+        self.__use(needed)
+        self.spend('install', self.timings.sample('install', self.rng))
+        if self.rng.random() < self.install_failure:
+            self.__count('failed')
+            self.__use(-needed)
+            return
+        latency = self.timings.install_latency.sample(self.rng)
+        if self.rng.random() < self.stuck:
+            self.waiting.append(Install(app, 0, latency, math.inf))
+        else:
+            self.waiting.append(Install(app, app.size_MiB, latency))
+
+    def poll(self):
+        finished = False
+        for i in list(self.waiting):
+            if i.installed_at is None or i.installed_at > self.t:
+                continue
+            finished = True
+            self.waiting.remove(i)
+            size = i.app.size_MiB
+            self.__use((1 - INSTALL_FACTOR) * size)  # the installed app replaces the reservation for installing
+            self.spend('dump', self.timings.dump(size, self.rng))
+            self.__count('failed' if self.rng.random() < self.dump_failure else 'dumped')
+            self.spend('uninstall', self.timings.sample('uninstall', self.rng))
+            self.__use(-(1 + DUMP_FACTOR) * size)
+            self.storage_full = False
+            self.waited = 0
+        if finished:
+            return
+
+        limit = self.timeout + self.timeout_per_MiB * sum(i.app.size_MiB for i in self.waiting)
+        if self.waited > limit:
+            # bulk_decrypt gives up on all installing apps and MultiDevice starts the session again
+            self.__count('timeout', len(self.waiting))
+            for i in self.waiting:
+                self.__use(-(INSTALL_FACTOR + DUMP_FACTOR) * i.app.size_MiB)
+            self.waiting = []
+            self.storage_full = False
+            self.waited = 0
+            self.spend('restart', RESTART_SECONDS)
+            return
+        # sleep in steps of a second until an install finishes or the timeout is reached
+        sleeps = min(max(1, math.ceil(self.next_install() - self.t)), math.floor(limit - self.waited) + 1)
+        self.spend('storage' if self.storage_full else 'install_wait', sleeps)
+        self.waited += sleeps
+
+
+def device_models(devices, timings, seed=0, storage_MiB=None, download_MiBps=None, **overrides):
+    '''
+    devices: dict name -> device config (see controller.load_config)
+    storage_MiB, download_MiBps: defaults for devices without them in their config
+    overrides: settings for all devices (e.g. parallel, timeout_per_MiB)
+    '''
+    models = []
+    for index, (name, config) in enumerate(sorted(devices.items())):
+        config = {**config, **overrides}
+        models.append(
+            DeviceModel(
+                name,
+                timings,
+                random.Random(seed * 1000003 + index),
+                parallel=config['parallel'],
+                timeout=config['timeout'],
+                timeout_per_MiB=config['timeout_per_MiB'],
+                storage_MiB=config.get('storage_MiB', storage_MiB or DEFAULT_STORAGE_MIB),
+                download_MiBps=config.get(
+                    'download_MiBps', download_MiBps or timings.download_MiBps or DEFAULT_DOWNLOAD_MIBPS
+                ),
+            )
+        )
+    return models
+
+
+def simulate(apps, models, total=None):
+    '''
+    Run the devices on a shared feed of apps (ordered by simulated time like MultiDevice)
+    total: number of apps the sample stands for, times and counts are scaled
+    return report dict
+    '''
+    feed = iter(apps)
+    heap = [(0.0, index) for index in range(len(models))]
+    while heap:
+        _, index = heapq.heappop(heap)
+        model = models[index]
+        if model.step(feed):
+            heapq.heappush(heap, (model.t, index))
+
+    scale = (total or len(apps)) / max(1, len(apps))
+    wall = max((model.t for model in models), default=0.0)
+    outcomes, phases = {}, dict.fromkeys(PHASES, 0.0)
+    devices = {}
+    for model in models:
+        for outcome, n in model.outcomes.items():
+            outcomes[outcome] = outcomes.get(outcome, 0) + n
+        for phase, seconds in model.seconds.items():
+            phases[phase] += seconds
+        busy = sum(model.seconds[stage] for stage in SERIAL_STAGES)
+        devices[model.name] = {
+            'apps': round(sum(model.outcomes.values()) * scale),
+            'dumped': round(model.outcomes.get('dumped', 0) * scale),
+            'busy': busy / wall if wall > 0 else 0.0,
+            'downloading': model.downloading / wall if wall > 0 else 0.0,
+            'peak_storage_MiB': round(model.peak_MiB),
+            'parallel': model.parallel,
+            'timeout_per_MiB': model.timeout_per_MiB,
+        }
+    return {
+        'apps': total or len(apps),
+        'simulated': len(apps),
+        'wall_seconds': wall * scale,
+        'outcomes': {outcome: round(n * scale) for outcome, n in sorted(outcomes.items())},
+        'devices': devices,
+        'phases': {phase: seconds * scale for phase, seconds in phases.items()},
+        'bottleneck': max(phases, key=phases.get) if wall > 0 else None,
+        'peak_storage_MiB': max((model.peak_MiB for model in models), default=0),
+    }
+
+
+def sweep(
+    apps,
+    devices,
+    timings,
+    total,
+    parallels=SWEEP_PARALLEL,
+    timeouts_per_MiB=SWEEP_TIMEOUT_PER_MIB,
+    apps_per_device=400,
+    seed=0,
+    **defaults,
+):
+    '''
+    Simulate one device of every distinct config with all combinations of parallel and timeout_per_MiB
+    return list of dicts (parallel, timeout_per_MiB, dumped/hour of the pool, wall_seconds, lost, peak_storage_MiB),
+    best first
+    '''
+    # devices which only differ in name, udid, ports, etc. are simulated once
+    profiles = {}
+    for name, config in devices.items():
+        key = tuple(config.get(k) for k in ('timeout', 'storage_MiB', 'download_MiBps'))
+        profiles.setdefault(key, (name, config, []))[2].append(name)
+    sample = apps[:: max(1, len(apps) // apps_per_device)][:apps_per_device]
+
+    results = []
+    for parallel in parallels:
+        for timeout_per_MiB in timeouts_per_MiB:
+            rate, dumped_rate, lost, peak = 0.0, 0.0, 0, 0.0
+            for name, config, names in profiles.values():
+                (model,) = device_models(
+                    {name: config}, timings, seed, parallel=parallel, timeout_per_MiB=timeout_per_MiB, **defaults
+                )
+                report = simulate(sample, [model])
+                if report['wall_seconds'] > 0:
+                    rate += len(names) * len(sample) / report['wall_seconds']
+                    dumped_rate += len(names) * report['outcomes'].get('dumped', 0) / report['wall_seconds']
+                lost += report['outcomes'].get('timeout', 0) * len(names)
+                peak = max(peak, report['peak_storage_MiB'])
+            results.append(
+                {
+                    'parallel': parallel,
+                    'timeout_per_MiB': timeout_per_MiB,
+                    'dumped/hour': dumped_rate * 3600,
+                    'wall_seconds': total / rate if rate > 0 else math.inf,
+                    'lost': lost / (len(sample) * len(devices)) if sample else 0.0,
+                    'peak_storage_MiB': round(peak),
+                }
+            )
+    # most dumped apps per hour, within 2% of the best the smallest parallel (less storage, fewer apps in flight)
+    # and the longest timeout (no app is lost to a slower download than in the history)
+    best = max((r['dumped/hour'] for r in results), default=0)
+    results.sort(
+        key=lambda r: (r['dumped/hour'] < best * 0.98, r['parallel'], -round(r['dumped/hour']), -r['timeout_per_MiB'])
+    )
+    return results
+
+
+def plan(
+    metadata_path,
+    config_file,
+    history_paths=[],
+    sample=20000,
+    deadline_hours=None,
+    storage_MiB=None,
+    download_MiBps=None,
+    seed=0,
+    log_level='info',
+):
+    '''
+    Predict a bulk job with the device pool of config_file offline: a discrete-event simulation of bulk_decrypt on
+    every device with stage timings of previous runs
+    Plans with more than sample apps are simulated with a random sample and scaled.
+    deadline_hours: also return how many devices (like the first one with the recommended settings) are needed
+    return report dict (see simulate) with recommendations and the sweep
+    '''
+    log = get_logger(log_level, name=__name__)
+    timings = Timings(log_level=log_level)
+    for path in history_paths:
+        timings.load(path)
+    timings.fit()
+    devices = load_config(config_file)
+    if len(devices) == 0:
+        raise ValueError(f'No devices in {config_file}')
+    apps, totals = read_apps(metadata_path, sample=sample, seed=seed, log_level=log_level)
+    if len(apps) == 0:
+        raise ValueError(f'No apps in {metadata_path}')
+    log.debug(f"{totals['apps']} apps, simulating {len(apps)}")
+
+    defaults = {'storage_MiB': storage_MiB, 'download_MiBps': download_MiBps}
+    report = simulate(apps, device_models(devices, timings, seed, **defaults), total=totals['apps'])
+    report['totals'] = totals
+    report['download_MiBps'] = timings.download_MiBps
+    report['sweep'] = sweep(apps, devices, timings, totals['apps'], seed=seed, **defaults)
+    report['recommended'] = {k: report['sweep'][0][k] for k in ('parallel', 'timeout_per_MiB')}
+    if deadline_hours is not None:
+        best = report['sweep'][0]
+        per_device = totals['apps'] / best['wall_seconds'] / len(devices) if best['wall_seconds'] > 0 else 0
+        report['devices_for_deadline'] = (
+            math.ceil(totals['apps'] / (per_device * deadline_hours * 3600)) if per_device > 0 else None
+        )
+    return report
+
+
+def format_duration(seconds):
+    if math.isinf(seconds):
+        return 'never'
+    days, seconds = divmod(int(seconds), 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return (f'{days}d ' if days else '') + f'{hours:02}:{minutes:02}:{seconds:02}'
+
+
+def format_report(report, top=5):
+    '''
+    return lines of a report of plan()
+    '''
+    totals = report['totals']
+    lines = [
+        f"Apps: {totals['apps']} ({totals['MiB'] / 1024:.1f} GiB), {totals['not_free']} not free, "
+        + f"{totals['not_available']} not available"
+        + (f", simulated a sample of {report['simulated']}" if report['simulated'] < report['apps'] else ''),
+        f"Predicted wall time: {format_duration(report['wall_seconds'])}",
+        f"Outcomes: {', '.join(f'{n} {outcome}' for outcome, n in report['outcomes'].items())}",
+        f"Bottleneck: {report['bottleneck']}",
+        f"Peak device storage: {report['peak_storage_MiB'] / 1024:.1f} GiB",
+        '',
+        f"{'device':20} {'apps':>8} {'busy':>6} {'download':>9} {'storage':>9} {'parallel':>9} {'t/MiB':>6}",
+    ]
+    for name, device in report['devices'].items():
+        lines.append(
+            f"{name[:20]:20} {device['apps']:8} {device['busy']:6.0%} {device['downloading']:9.0%} "
+            + f"{device['peak_storage_MiB'] / 1024:7.1f}Gi {device['parallel']:9} {device['timeout_per_MiB']:6}"
+        )
+    total = sum(report['phases'].values()) or 1
+    lines += ['', 'Device time by phase: ' + ', '.join(f'{p} {s / total:.0%}' for p, s in report['phases'].items())]
+    lines += ['', f"{'parallel':>8} {'t/MiB':>6} {'dumped/h':>9} {'wall time':>14} {'lost':>6} {'storage':>9}"]
+    for r in report['sweep'][:top]:
+        lines.append(
+            f"{r['parallel']:8} {r['timeout_per_MiB']:6} {r['dumped/hour']:9.0f} "
+            + f"{format_duration(r['wall_seconds']):>14} {r['lost']:6.1%} {r['peak_storage_MiB'] / 1024:7.1f}Gi"
+        )
+    recommended = report['recommended']
+    lines.append(f"Recommended: parallel {recommended['parallel']}, timeout_per_MiB {recommended['timeout_per_MiB']}")
+    if 'devices_for_deadline' in report:
+        lines.append(f"Devices needed for the deadline: {report['devices_for_deadline']}")
+    return lines
@@ -0,0 +1,1318 @@
+# stdlib
+from collections import namedtuple
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import plistlib
+import random
+import re
+import shutil
+import socket
+import socketserver
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlsplit
+import uuid
+from xml.sax.saxutils import escape
+
+# external
+import frida  # exceptions of the mock device are the real ones
+import paramiko  # ssh server
+
+# external (optional)
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# internal
+import ipadumper
+from ipadumper import lockdown, macho, usbmux
+from ipadumper.utils import get_logger
+
+
+SimApp = namedtuple('SimApp', ['itunes_id', 'bundleId', 'name', 'version', 'size_MiB', 'frameworks', 'purchased'])
+
+# frida.Application of the mock Frida device
+MockApplication = namedtuple('MockApplication', ['identifier', 'name', 'pid'])
+
+# paths which are mapped into the fake device tree
+DEVICE_PREFIXES = ['/private/var', '/var', '/usr/local/bin', '/Applications']
+DEVICE_PATH_PATTERN = re.compile(r'(?<![\w.~/-])(' + '|'.join(re.escape(p) for p in DEVICE_PREFIXES) + r')(?=/|\b)')
+
+STUB = '''#!{python} -S
+import json, os, socket, sys
+s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+s.connect(os.environ['IPADUMPER_SIM_SOCKET'])
+request = {{'argv': [os.path.basename(sys.argv[0])] + sys.argv[1:], 'udid': os.environ.get('IPADUMPER_SIM_UDID')}}
+s.sendall(json.dumps(request).encode() + b'\\n')
+f = s.makefile('rb')
+reply = json.loads(f.readline())
+sys.stdout.write(reply.get('stdout', ''))
+sys.stderr.write(reply.get('stderr', ''))
+sys.stdout.flush()
+if reply.get('hold'):
+    f.read()  # keep running until killed
+sys.exit(reply.get('returncode', 0))
+'''
+
+HOST_COMMANDS = ['ideviceinstaller', 'ideviceinfo', 'iproxy', 'idevicescreenshot']
+DEVICE_COMMANDS = ['uiopen', 'activator', 'open', 'df']
+
+# port of the fake installation_proxy service
+INSTALLATION_PROXY_PORT = 49152
+
+CPU_TYPE_ARM64 = 0x0100000C
+MH_EXECUTE = 2
+MH_DYLIB = 6
+
+
+def fake_macho(path, size, filetype=MH_EXECUTE, cryptid=1):
+    '''
+    Write a thin arm64 Mach-O with a LC_ENCRYPTION_INFO_64 load command
+    '''
+    cryptoff = 0x4000
+    header = struct.pack('<IiiIIIII', macho.MH_MAGIC_64, CPU_TYPE_ARM64, 0, filetype, 1, 24, 0, 0)
+    header += struct.pack('<IIIIII', macho.LC_ENCRYPTION_INFO_64, 24, cryptoff, max(0, size - cryptoff), cryptid, 0)
+    with open(path, 'wb') as f:
+        f.write(header)
+        # random content, so zip and transfers cost about as much as with real binaries
+        remaining = size - len(header)
+        while remaining > 0:
+            f.write(os.urandom(min(remaining, 2**20)))
+            remaining -= 2**20
+    os.chmod(path, 0o755)
+
+
+def decrypt_macho(src, dst):
+    '''
+    "Decrypt" a fake Mach-O: copy it and set cryptid to 0
+    return number of bytes
+    '''
+    if os.path.abspath(src) != os.path.abspath(dst):
+        shutil.copyfile(src, dst)
+        shutil.copymode(src, dst)
+    with open(dst, 'r+b') as f:
+        info = macho.encryption_info(f.read(4096))
+        if info is not None:
+            f.seek(info[3])
+            f.write(struct.pack('<I', 0))
+    return os.path.getsize(dst)
+
+
+class SimDevice:
+    '''
+    State of a simulated device: fake file system, installed apps and the App Store screen
+    Coordinates of taps and template matches are in points, screenshots in pixels (points * scale).
+    '''
+
+    apps_dir = '/private/var/containers/Bundle/Application'
+    tmp_dir = '/private/var/mobile/tmp'
+
+    # top left corner of the buttons in pixels
+    LAYOUT = {'get': (620, 560), 'cloud': (640, 560), 'install': (312, 1560), 'dissallow': (280, 1000)}
+
+    def __init__(
+        self,
+        root,
+        udid,
+        catalogue,
+        install_latency=2.0,
+        bandwidth_MiBps=50,
+        decrypt_MiBps=200,
+        popup_rate=0.0,
+        page_latency=0.3,
+        image_base_path_local=os.path.join(os.path.dirname(ipadumper.__file__), 'appstore_images'),
+        theme='dark',
+        lang='en',
+        screen_size=(414, 896),
+        scale=2,
+        storage_MiB=65536,
+        seed=0,
+        log_level='info',
+    ):
+        '''
+        catalogue: dict itunes_id -> SimApp
+        storage_MiB: size of the data partition, an installation fails if the app does not fit
+        install_latency: seconds from tapping the install button until the app is installed (plus size / bandwidth)
+        decrypt_MiBps: speed of the fake fouldecrypt and dump
+        popup_rate: probability that a permission popup is shown when a page is opened
+        page_latency: seconds until buttons appear after opening a page or tapping get
+        '''
+        self.root = root
+        self.udid = udid
+        self.catalogue = catalogue
+        self.install_latency = install_latency
+        self.bandwidth_MiBps = bandwidth_MiBps
+        self.decrypt_MiBps = decrypt_MiBps
+        self.popup_rate = popup_rate
+        self.storage_MiB = storage_MiB
+        self.page_latency = page_latency
+        self.image_base_path_local = image_base_path_local
+        self.theme = theme
+        self.lang = lang
+        self.screen_size = screen_size
+        self.scale = scale
+        self.random = random.Random(seed)
+        self.log = get_logger(log_level, name=__name__)
+
+        self.lock = threading.RLock()
+        self.page = None  # itunes_id of the opened App Store page
+        self.button = None  # visible button on the page
+        self.button_time = 0  # time when the button appears
+        self.popup = False
+        self.installing = {}  # bundleId -> time when the installation is done
+        self.installed = {}  # bundleId -> container uuid
+        self.taps = 0
+        self.templates = {}  # name -> PIL image
+
+        for d in [self.apps_dir, self.tmp_dir, '/private/var/root', '/private/var/mobile/Library/ZXTouch/scripts']:
+            os.makedirs(self.path(d), exist_ok=True)
+        os.makedirs(self.path('/usr/local/bin'), exist_ok=True)
+        if not os.path.exists(os.path.join(root, 'var')):
+            os.symlink('private/var', os.path.join(root, 'var'))
+
+    # paths
+
+    def path(self, device_path):
+        '''
+        return host path of a device path
+        '''
+        return self.root + device_path
+
+    def rewrite(self, cmd):
+        '''
+        Rewrite device paths in a shell command
+        '''
+        return DEVICE_PATH_PATTERN.sub(lambda m: self.root + m.group(1), cmd)
+
+    def unrewrite(self, text):
+        return text.replace(self.root, '')
+
+    # apps
+
+    def install_now(self, app):
+        '''
+        Create container of the app
+        return device path of the container
+        '''
+        container = str(uuid.uuid4()).upper()
+        app_dir = f'{self.apps_dir}/{container}/{app.name}.app'
+        os.makedirs(self.path(app_dir))
+        info = {
+            'CFBundleIdentifier': app.bundleId,
+            'CFBundleExecutable': app.name,
+            'CFBundleShortVersionString': app.version,
+            'CFBundleVersion': app.version,
+            'CFBundleDisplayName': app.name,
+        }
+        with open(self.path(f'{app_dir}/Info.plist'), 'wb') as f:
+            plistlib.dump(info, f)
+
+        size = app.size_MiB * 2**20
+        framework_size = size // (2 * app.frameworks) if app.frameworks > 0 else 0
+        fake_macho(self.path(f'{app_dir}/{app.name}'), size - framework_size * app.frameworks)
+        for i in range(app.frameworks):
+            framework = f'{app_dir}/Frameworks/Lib{i}.framework'
+            os.makedirs(self.path(framework))
+            fake_macho(self.path(f'{framework}/Lib{i}'), framework_size, filetype=MH_DYLIB)
+        with open(self.path(f'{app_dir}/Assets.car'), 'wb') as f:
+            f.write(os.urandom(64 * 1024))
+
+        with self.lock:
+            self.installed[app.bundleId] = container
+        return f'{self.apps_dir}/{container}'
+
+    def uninstall(self, bundleId):
+        with self.lock:
+            container = self.installed.pop(bundleId, None)
+        if container is None:
+            return False
+        shutil.rmtree(self.path(f'{self.apps_dir}/{container}'), ignore_errors=True)
+        shutil.rmtree(self.path(f'{self.apps_dir}/{container}_tmp'), ignore_errors=True)
+        shutil.rmtree(self.path(self.data_dir(bundleId)), ignore_errors=True)
+        return True
+
+    def data_dir(self, bundleId):
+        '''
+        return device path of the data container (the dumps of Frida are written to it)
+        '''
+        return f'{self.tmp_dir}/{bundleId}'
+
+    def app(self, bundleId):
+        for app in self.catalogue.values():
+            if app.bundleId == bundleId:
+                return app
+        return None
+
+    def app_path(self, bundleId):
+        '''
+        return device path of the .app directory or None
+        '''
+        with self.lock:
+            container = self.installed.get(bundleId)
+        if container is None:
+            return None
+        app = self.app(bundleId)
+        return f'{self.apps_dir}/{container}/{app.name}.app'
+
+    def tick(self):
+        '''
+        Finish installations which are due
+        '''
+        now = time.time()
+        with self.lock:
+            due = [bundleId for bundleId, t in self.installing.items() if t <= now]
+            for bundleId in due:
+                del self.installing[bundleId]
+        for bundleId in due:
+            app = self.app(bundleId)
+            if self.used_MiB() + app.size_MiB > self.storage_MiB:
+                self.log.warning(f'{self.udid}: Installation of {bundleId} failed, not enough space')
+                continue
+            self.install_now(app)
+            self.log.debug(f'{self.udid}: Installed {bundleId}')
+
+    def used_MiB(self):
+        '''
+        return MiB used by files of the device and by downloads of installing apps
+        '''
+        used = 0
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                try:
+                    used += os.lstat(os.path.join(directory, name)).st_size
+                except FileNotFoundError:
+                    pass
+        with self.lock:
+            installing = list(self.installing)
+        return used / 2**20 + sum(self.app(bundleId).size_MiB for bundleId in installing)
+
+    # App Store screen
+
+    def open_url(self, url):
+        m = re.search(r'/id(\d+)', url)
+        if m is None:
+            return False
+        with self.lock:
+            self.page = int(m.group(1))
+            app = self.catalogue.get(self.page)
+            self.button = None if app is None else ('cloud' if app.purchased else 'get')
+            self.button_time = time.time() + self.page_latency
+            self.popup = self.random.random() < self.popup_rate
+        return True
+
+    def buttons(self):
+        '''
+        return list of (name, (x, y, width, height)) of the visible buttons in pixels
+        '''
+        with self.lock:
+            if self.popup:
+                name = 'dissallow'
+            elif self.button is not None and time.time() >= self.button_time:
+                name = self.button
+            else:
+                return []
+        width, height = self.template(name).size
+        x, y = self.LAYOUT[name]
+        return [(name, (x, y, width, height))]
+
+    def tap(self, x, y):
+        '''
+        Tap at x, y (points)
+        '''
+        px, py = x * self.scale, y * self.scale
+        self.taps += 1
+        for name, (bx, by, width, height) in self.buttons():
+            if bx <= px < bx + width and by <= py < by + height:
+                self.log.debug(f'{self.udid}: Tapped {name}')
+                with self.lock:
+                    if name == 'dissallow':
+                        self.popup = False
+                    elif name == 'get':
+                        # confirmation sheet with install button
+                        self.button = 'install'
+                        self.button_time = time.time() + self.page_latency
+                    elif name in ('install', 'cloud'):
+                        app = self.catalogue[self.page]
+                        latency = self.install_latency + app.size_MiB / self.bandwidth_MiBps
+                        self.installing[app.bundleId] = time.time() + latency
+                        self.button = None
+                return name
+        return None
+
+    def template(self, name):
+        if name not in self.templates:
+            path = os.path.join(self.image_base_path_local, self.theme)
+            path = os.path.join(path, 'cloud.png' if name == 'cloud' else os.path.join(self.lang, f'{name}.png'))
+            self.templates[name] = Image.open(path).convert('RGB')
+        return self.templates[name]
+
+    def screenshot(self, path):
+        if Image is None:
+            raise RuntimeError('Pillow is needed for screenshots')
+        size = (self.screen_size[0] * self.scale, self.screen_size[1] * self.scale)
+        img = Image.new('RGB', size, (0, 0, 0) if self.theme == 'dark' else (255, 255, 255))
+        for name, (x, y, _, _) in self.buttons():
+            img.paste(self.template(name), (x, y))
+        img.save(path)
+
+    def image_match(self, template_path):
+        '''
+        return x, y, width, height of the template in points or zeros
+        '''
+        name = os.path.splitext(os.path.basename(template_path))[0]
+        for button, (x, y, width, height) in self.buttons():
+            if button == name:
+                return x / self.scale, y / self.scale, width / self.scale, height / self.scale
+        return 0, 0, 0, 0
+
+    # commands
+
+    def installed_apps(self):
+        '''
+        return list of dicts with the Info.plist values of the installed apps
+        '''
+        self.tick()
+        with self.lock:
+            installed = list(self.installed)
+        apps = []
+        for bundleId in installed:
+            app = self.app(bundleId)
+            apps.append(
+                {
+                    'CFBundleIdentifier': bundleId,
+                    'CFBundleVersion': app.version,
+                    'CFBundleShortVersionString': app.version,
+                    'CFBundleDisplayName': app.name,
+                    'Path': self.app_path(bundleId),
+                    'ApplicationType': 'User',
+                }
+            )
+        return apps
+
+    def ideviceinstaller(self, args):
+        if '-l' in args:
+            lines = ['CFBundleIdentifier, CFBundleVersion, CFBundleDisplayName']
+            for app in self.installed_apps():
+                lines.append(
+                    f"{app['CFBundleIdentifier']}, \"{app['CFBundleVersion']}\", \"{app['CFBundleDisplayName']}\""
+                )
+            return 0, '\n'.join(lines) + '\n', ''
+        if '--uninstall' in args:
+            bundleId = args[args.index('--uninstall') + 1]
+            time.sleep(0.2)
+            if self.uninstall(bundleId):
+                return 0, f'Uninstalling {bundleId}\nComplete\n', ''
+            return 1, '', f'ERROR: {bundleId} is not installed\n'
+        return 1, '', 'Unknown arguments\n'
+
+    def df(self, args):
+        used = int(self.used_MiB() * 1024)
+        total = self.storage_MiB * 1024
+        lines = [
+            'Filesystem     1024-blocks     Used Available Capacity  Mounted on',
+            f'/dev/disk0s1s2 {total:11} {used:8} {max(total - used, 0):9} {used * 100 // total:7}%  /private/var',
+        ]
+        return 0, '\n'.join(lines) + '\n', ''
+
+    def fouldecrypt(self, args):
+        paths = [a for a in args if not a.startswith('-')]
+        if len(paths) != 2:
+            return 1, '', 'usage: fouldecrypt [-v] src dst\n'
+        try:
+            size = decrypt_macho(*paths)
+        except OSError as e:
+            return 1, '', f'{str(e)}\n'
+        time.sleep(size / 2**20 / self.decrypt_MiBps)
+        return 0, f'Decrypted {paths[1]}\n', ''
+
+
+class ZXTouchHandler:
+    '''
+    Fake zxtouch tweak: task id (2 digits) followed by ;; separated data, terminated by \\r\\n
+    '''
+
+    def __init__(self, device, sock):
+        self.device = device
+        self.sock = sock
+
+    def reply(self, *data):
+        self.sock.sendall(('0' + ''.join(f';;{d}' for d in data) + '\r\n').encode())
+
+    def handle(self):
+        buffer = b''
+        with self.sock:
+            while True:
+                try:
+                    data = self.sock.recv(4096)
+                except OSError:
+                    return
+                if not data:
+                    return
+                buffer += data
+                while b'\r\n' in buffer:
+                    line, buffer = buffer.split(b'\r\n', 1)
+                    self.task(line.decode('utf-8', errors='replace'))
+
+    def task(self, line):
+        task, data = int(line[:2]), line[2:].split(';;')
+        if task == 10:
+            # count, then per event: type (1), finger (2), x * 10 (5), y * 10 (5)
+            events = data[0]
+            for i in range(int(events[0])):
+                event = events[1 + i * 13 : 14 + i * 13]
+                if event[0] == '0':  # TOUCH_UP
+                    self.device.tap(int(event[3:8]) / 10, int(event[8:13]) / 10)
+            # touch has no reply
+        elif task == 21:
+            self.reply(*self.device.image_match(data[0]))
+        elif task == 25:
+            if data[0] == '1':
+                self.reply(*self.device.screen_size)
+            elif data[0] == '3':
+                self.reply(self.device.scale)
+            else:
+                self.reply()
+        else:
+            self.reply()
+
+
+class LockdownHandler:
+    '''
+    Fake lockdownd: device values, sessions without TLS and the installation_proxy service
+    '''
+
+    def __init__(self, device, sock):
+        self.device = device
+        self.conn = lockdown.PlistConnection(sock)
+
+    def handle(self):
+        with self.conn.sock:
+            while True:
+                try:
+                    request = self.conn.recv()
+                except (OSError, lockdown.LockdownError, struct.error):
+                    return
+                self.conn.send(self.reply(request))
+
+    def reply(self, request):
+        name = request.get('Request')
+        if name == 'QueryType':
+            return {'Request': name, 'Type': 'com.apple.mobile.lockdown'}
+        if name == 'StartSession':
+            return {'Request': name, 'SessionID': str(uuid.uuid4()), 'EnableSessionSSL': False}
+        if name == 'GetValue':
+            values = {
+                'DeviceName': 'Simulated',
+                'ProductType': 'iPhone12,1',
+                'ProductVersion': '14.4',
+                'UniqueDeviceID': self.device.udid,
+            }
+            key = request.get('Key')
+            if key is None:
+                return {'Request': name, 'Value': values}
+            if key not in values:
+                return {'Request': name, 'Error': 'MissingValue'}
+            return {'Request': name, 'Key': key, 'Value': values[key]}
+        if name == 'StartService':
+            if request.get('Service') != lockdown.INSTALLATION_PROXY:
+                return {'Request': name, 'Error': 'InvalidService'}
+            return {'Request': name, 'Port': INSTALLATION_PROXY_PORT, 'EnableServiceSSL': False}
+        return {'Request': name, 'Error': 'InvalidRequest'}
+
+
+class InstallationProxyHandler:
+    '''
+    Fake installation_proxy: Browse (in pages like the real service), Lookup and Uninstall with progress
+    '''
+
+    page_size = 20
+
+    def __init__(self, device, sock):
+        self.device = device
+        self.conn = lockdown.PlistConnection(sock)
+
+    def handle(self):
+        with self.conn.sock:
+            while True:
+                try:
+                    request = self.conn.recv()
+                    self.command(request)
+                except (OSError, lockdown.LockdownError, struct.error):
+                    return
+
+    def filter(self, app, attributes):
+        return {k: v for k, v in app.items() if not attributes or k in attributes}
+
+    def command(self, request):
+        command = request.get('Command')
+        options = request.get('ClientOptions', {})
+        attributes = options.get('ReturnAttributes')
+        if command == 'Browse':
+            apps = [self.filter(app, attributes) for app in self.device.installed_apps()]
+            for i in range(0, len(apps), self.page_size):
+                page = apps[i : i + self.page_size]
+                self.conn.send({'Status': 'BrowsingApplications', 'CurrentList': page, 'CurrentAmount': len(page)})
+            self.conn.send({'Status': 'Complete'})
+        elif command == 'Lookup':
+            bundle_ids = options.get('BundleIDs', [])
+            apps = self.device.installed_apps()
+            result = {
+                app['CFBundleIdentifier']: self.filter(app, attributes)
+                for app in apps
+                if app['CFBundleIdentifier'] in bundle_ids
+            }
+            self.conn.send({'Status': 'Complete', 'LookupResult': result})
+        elif command == 'Uninstall':
+            bundleId = request.get('ApplicationIdentifier')
+            if self.device.app_path(bundleId) is None:
+                self.conn.send({'Error': 'APIInternalError', 'ErrorDescription': f'{bundleId} is not installed'})
+                return
+            for percent, status in [(10, 'RemovingApplication'), (50, 'GeneratingApplicationMap')]:
+                self.conn.send({'Status': status, 'PercentComplete': percent})
+            time.sleep(0.2)
+            self.device.uninstall(bundleId)
+            self.conn.send({'Status': 'Complete'})
+        else:
+            self.conn.send({'Error': 'UnknownCommand'})
+
+
+class UsbmuxdHandler:
+    '''
+    Fake usbmuxd: lists the simulated devices, has pair records and connects to ssh (22), zxtouch (6000),
+    lockdownd (62078) and installation_proxy
+    '''
+
+    def __init__(self, simulator, sock):
+        self.simulator = simulator
+        self.sock = sock
+
+    def recv(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def reply(self, tag, message):
+        payload = plistlib.dumps(message)
+        self.sock.sendall(usbmux.HEADER.pack(usbmux.HEADER.size + len(payload), 1, 8, tag) + payload)
+
+    def handle(self):
+        devices = list(self.simulator.devices.values())
+        while True:
+            try:
+                length, _, _, tag = usbmux.HEADER.unpack(self.recv(usbmux.HEADER.size))
+                request = plistlib.loads(self.recv(length - usbmux.HEADER.size))
+            except (EOFError, OSError, plistlib.InvalidFileException):
+                self.sock.close()
+                return
+            if request.get('MessageType') == 'ListDevices':
+                entries = [
+                    {
+                        'DeviceID': i,
+                        'MessageType': 'Attached',
+                        'Properties': {'ConnectionType': 'USB', 'DeviceID': i, 'SerialNumber': device.udid},
+                    }
+                    for i, device in enumerate(devices, start=1)
+                ]
+                self.reply(tag, {'DeviceList': entries})
+            elif request.get('MessageType') == 'Connect':
+                device_id, port = request.get('DeviceID', 0), socket.ntohs(request.get('PortNumber', 0))
+                if not 1 <= device_id <= len(devices):
+                    self.reply(tag, {'MessageType': 'Result', 'Number': 2})
+                elif port not in (22, 6000, lockdown.LOCKDOWN_PORT, INSTALLATION_PROXY_PORT):
+                    self.reply(tag, {'MessageType': 'Result', 'Number': 3})
+                else:
+                    # the connection is a tunnel to the port from now on
+                    self.reply(tag, {'MessageType': 'Result', 'Number': 0})
+                    device = devices[device_id - 1]
+                    if port == 22:
+                        self.simulator.serve_ssh(device, self.sock)
+                    elif port == 6000:
+                        ZXTouchHandler(device, self.sock).handle()
+                    elif port == lockdown.LOCKDOWN_PORT:
+                        LockdownHandler(device, self.sock).handle()
+                    else:
+                        InstallationProxyHandler(device, self.sock).handle()
+                    return
+            elif request.get('MessageType') == 'ReadPairRecord':
+                udid = request.get('PairRecordID')
+                if not any(device.udid == udid for device in devices):
+                    self.reply(tag, {'MessageType': 'Result', 'Number': 2})
+                    continue
+                record = {'HostID': 'SIMULATED-HOST', 'SystemBUID': 'SIMULATED-BUID', 'DeviceCertificate': b''}
+                self.reply(tag, {'PairRecordData': plistlib.dumps(record)})
+            else:
+                self.reply(tag, {'MessageType': 'Result', 'Number': 1})
+
+
+class SSHServer(paramiko.ServerInterface):
+    '''
+    Accepts every public key and runs exec requests with sh in the fake device tree
+    '''
+
+    def __init__(self, simulator, device):
+        self.simulator = simulator
+        self.device = device
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.run, args=(channel, command.decode('utf-8')), daemon=True)
+        thread.start()
+        return True
+
+    def run(self, channel, command):
+        device = self.device
+        cmd = device.rewrite(command)
+        env = dict(
+            os.environ,
+            PATH=self.simulator.device_bin + os.pathsep + os.environ.get('PATH', ''),
+            IPADUMPER_SIM_UDID=device.udid,
+            HOME=device.path('/private/var/root'),
+        )
+        p = subprocess.Popen(
+            ['sh', '-c', cmd],
+            cwd=device.path('/private/var/root'),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+        )
+
+        def pump_stdin():
+            try:
+                while True:
+                    data = channel.recv(32768)
+                    if not data:
+                        break
+                    p.stdin.write(data)
+                    p.stdin.flush()
+            except (OSError, EOFError):
+                pass
+            finally:
+                try:
+                    p.stdin.close()
+                except OSError:
+                    pass
+
+        stderr = []
+        threads = [
+            threading.Thread(target=pump_stdin, daemon=True),
+            threading.Thread(target=lambda: stderr.append(p.stderr.read()), daemon=True),
+        ]
+        for t in threads:
+            t.start()
+
+        try:
+            first = p.stdout.read1(32768)
+            if command.lstrip().startswith('scp ') or b'\0' in first:
+                # binary (scp protocol, zip to stdout), stream it unchanged
+                data = first
+                while data:
+                    channel.sendall(data)
+                    data = p.stdout.read1(32768)
+            else:
+                out = first + p.stdout.read()
+                if b'\0' not in out:
+                    out = device.unrewrite(out.decode('utf-8', errors='surrogateescape')).encode(
+                        'utf-8', errors='surrogateescape'
+                    )
+                channel.sendall(out)
+            threads[1].join()
+            channel.sendall_stderr(device.unrewrite(stderr[0].decode('utf-8', errors='replace')).encode('utf-8'))
+            channel.send_exit_status(p.wait())
+        except OSError:
+            p.kill()
+            p.wait()
+        finally:
+            channel.close()
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    '''
+    S3 compatible storage for the sinks: objects are files in server.root/<bucket>/<key>
+    PutObject, multipart uploads, HeadObject, GetObject and ListObjectsV2; signatures are not checked.
+    '''
+
+    def parse(self):
+        url = urlsplit(self.path)
+        bucket, _, key = unquote(url.path).lstrip('/').partition('/')
+        query = {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        return bucket, key, query
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def error(self, status, code):
+        self.reply(status, f'<Error><Code>{code}</Code></Error>'.encode('utf-8'))
+
+    def object_path(self, bucket, key):
+        path = os.path.normpath(os.path.join(self.server.root, bucket, key))
+        return path if path.startswith(os.path.join(self.server.root, bucket) + os.sep) else None
+
+    def upload_dir(self, upload_id):
+        return os.path.join(self.server.root, '.uploads', os.path.basename(upload_id))
+
+    def write_object(self, path, chunks):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp, path)
+
+    def do_PUT(self):
+        bucket, key, query = self.parse()
+        path = self.object_path(bucket, key)
+        data = self.body()
+        if path is None:
+            return self.error(400, 'InvalidObjectName')
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        if 'uploadId' in query:
+            directory = self.upload_dir(query['uploadId'])
+            if not os.path.isdir(directory):
+                return self.error(404, 'NoSuchUpload')
+            with open(os.path.join(directory, str(int(query['partNumber']))), 'wb') as f:
+                f.write(data)
+        else:
+            self.write_object(path, [data])
+        self.reply(200, headers={'ETag': etag})
+
+    def do_POST(self):
+        bucket, key, query = self.parse()
+        body = self.body()
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            os.makedirs(self.upload_dir(upload_id))
+            xml = f'<InitiateMultipartUploadResult><Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>'
+            xml += f'<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>'
+            return self.reply(200, xml.encode('utf-8'))
+        directory = self.upload_dir(query.get('uploadId', ''))
+        if not os.path.isdir(directory):
+            return self.error(404, 'NoSuchUpload')
+        numbers = [int(n) for n in re.findall(rb'<PartNumber>(\d+)</PartNumber>', body)]
+        paths = [os.path.join(directory, str(n)) for n in numbers]
+        if numbers != sorted(numbers) or not all(os.path.exists(path) for path in paths):
+            return self.error(400, 'InvalidPart')
+        if any(os.path.getsize(path) < self.server.min_part_size for path in paths[:-1]):
+            return self.error(400, 'EntityTooSmall')
+
+        def chunks():
+            for path in paths:
+                with open(path, 'rb') as f:
+                    yield f.read()
+
+        self.write_object(self.object_path(bucket, key), chunks())
+        shutil.rmtree(directory, ignore_errors=True)
+        xml = f'<CompleteMultipartUploadResult><Key>{escape(key)}</Key></CompleteMultipartUploadResult>'
+        self.reply(200, xml.encode('utf-8'))
+
+    def do_DELETE(self):
+        bucket, key, query = self.parse()
+        if 'uploadId' in query:
+            shutil.rmtree(self.upload_dir(query['uploadId']), ignore_errors=True)
+        else:
+            try:
+                os.unlink(self.object_path(bucket, key))
+            except (FileNotFoundError, TypeError):
+                pass
+        self.reply(204)
+
+    def do_GET(self):
+        bucket, key, query = self.parse()
+        if key == '':
+            return self.list(bucket, query)
+        path = self.object_path(bucket, key)
+        if path is None or not os.path.isfile(path):
+            return self.error(404, 'NoSuchKey')
+        with open(path, 'rb') as f:
+            self.reply(200, f.read())
+
+    def do_HEAD(self):
+        bucket, key, query = self.parse()
+        path = self.object_path(bucket, key)
+        if path is None or not os.path.isfile(path):
+            return self.reply(404)
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+
+    def list(self, bucket, query):
+        root = os.path.join(self.server.root, bucket)
+        keys = []
+        for directory, _, filenames in os.walk(root):
+            keys += [os.path.relpath(os.path.join(directory, name), root).replace(os.sep, '/') for name in filenames]
+        prefix, after = query.get('prefix', ''), query.get('continuation-token', '')
+        keys = sorted(k for k in keys if k.startswith(prefix) and k > after and not k.endswith('.tmp'))
+        page = keys[: int(query.get('max-keys', 1000))]
+        contents = ''.join(f'<Contents><Key>{escape(k)}</Key></Contents>' for k in page)
+        truncated = len(page) < len(keys)
+        token = f'<NextContinuationToken>{escape(page[-1])}</NextContinuationToken>' if truncated else ''
+        xml = (
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            + f'<Name>{escape(bucket)}</Name>{contents}<IsTruncated>{str(truncated).lower()}</IsTruncated>{token}'
+            + '</ListBucketResult>'
+        )
+        self.reply(200, xml.encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockScript:
+    def __init__(self, session):
+        self.session = session
+        self.callbacks = []
+        self.exports_sync = self
+        self.exports = self
+        self.gate = False
+
+    def on(self, signal, callback):
+        if signal == 'message':
+            self.callbacks.append(callback)
+
+    def load(self):
+        self.session.scripts.append(self)
+
+    def unload(self):
+        if self in self.session.scripts:
+            self.session.scripts.remove(self)
+
+    def send(self, payload):
+        for callback in self.callbacks:
+            callback({'type': 'send', 'payload': payload}, None)
+
+    # rpc exports
+
+    def armlaunchgate(self):
+        self.gate = True
+        return True
+
+    def post(self, message):
+        if message.get('type') == 'dump':
+            threading.Thread(target=self.dump, name='mock-dump', daemon=True).start()
+
+    def dump(self):
+        device = self.session.frida_device.device
+        bundleId = self.session.bundleId
+        app_path = device.app_path(bundleId)
+        if app_path is None:
+            self.send({'warn': f'{bundleId} is not installed'})
+            self.send({'done': 'ok'})
+            return
+
+        host_app_path = device.path(app_path)
+        for dirpath, _, filenames in os.walk(host_app_path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                with open(path, 'rb') as f:
+                    header = f.read(4096)
+                try:
+                    if not macho.is_macho(header) or not macho.is_encrypted(header):
+                        continue
+                except ValueError:
+                    continue
+                dump = f'{device.data_dir(bundleId)}/{filename}.fid'
+                os.makedirs(device.path(device.data_dir(bundleId)), exist_ok=True)
+                start = time.time()
+                size = decrypt_macho(path, device.path(dump))
+                time.sleep(size / 2**20 / device.decrypt_MiBps)
+                ms = int((time.time() - start) * 1000)
+                stats = {'bytes': size, 'patched': 4, 'copy_ms': ms, 'patch_ms': 0, 'method': 'mock'}
+                self.send({'dump': dump, 'path': device.unrewrite(path), 'stats': stats})
+        self.send({'app': app_path})
+        self.send({'done': 'ok'})
+
+
+class MockSession:
+    def __init__(self, frida_device, pid, bundleId):
+        self.frida_device = frida_device
+        self.pid = pid
+        self.bundleId = bundleId
+        self.scripts = []
+        self.detached_callbacks = []
+
+    def on(self, signal, callback):
+        if signal == 'detached':
+            self.detached_callbacks.append(callback)
+
+    def compile_script(self, source, name=None):
+        return source.encode('utf-8')
+
+    def create_script(self, source, name=None):
+        return MockScript(self)
+
+    def create_script_from_bytes(self, data, name=None):
+        return MockScript(self)
+
+    def detach(self):
+        for callback in self.detached_callbacks:
+            callback('application-requested', None)
+
+
+class MockFridaDevice:
+    '''
+    Frida device which "runs" dump.js against the fake device tree
+    '''
+
+    def __init__(self, device, launch_latency=0.3):
+        self.device = device
+        self.launch_latency = launch_latency
+        self.lock = threading.Lock()
+        self.processes = {}  # pid -> bundleId
+        self.sessions = {}  # pid -> list of MockSession
+        self.next_pid = 1000
+
+    def spawn(self, argv):
+        bundleId = argv[0]
+        if self.device.app_path(bundleId) is None:
+            raise frida.ExecutableNotFoundError(f'unable to find application with identifier \'{bundleId}\'')
+        with self.lock:
+            self.next_pid += 1
+            self.processes[self.next_pid] = bundleId
+            return self.next_pid
+
+    def attach(self, pid):
+        with self.lock:
+            if pid not in self.processes or self.device.app_path(self.processes[pid]) is None:
+                self.processes.pop(pid, None)
+                raise frida.ProcessNotFoundError(f'unable to find process with pid {pid}')
+            session = MockSession(self, pid, self.processes[pid])
+            self.sessions.setdefault(pid, []).append(session)
+            return session
+
+    def resume(self, pid):
+        def launched():
+            time.sleep(self.launch_latency)
+            for session in self.sessions.get(pid, []):
+                for script in session.scripts:
+                    if script.gate:
+                        script.send({'launched': True})
+
+        threading.Thread(target=launched, daemon=True).start()
+
+    def kill(self, pid):
+        with self.lock:
+            self.processes.pop(pid, None)
+
+    def enumerate_applications(self, identifiers=None, scope=None):
+        with self.lock:
+            running = {bundleId: pid for pid, bundleId in self.processes.items()}
+        apps = []
+        for app in self.device.installed_apps():
+            bundleId = app['CFBundleIdentifier']
+            if identifiers is None or bundleId in identifiers:
+                apps.append(MockApplication(bundleId, app['CFBundleDisplayName'], running.get(bundleId, 0)))
+        return apps
+
+    def is_lost(self):
+        return False
+
+
+class Simulator:
+    '''
+    Simulated device rig for benchmarks and development without a jailbroken device
+    - SSH server which runs commands with sh in a fake device tree. Absolute device paths in commands are rewritten
+      to the tree (and back in the output). uiopen, activator and fouldecrypt are fake commands.
+    - zxtouch server which renders the App Store screen, answers template matches and handles taps
+    - stub ideviceinstaller, ideviceinfo, iproxy and idevicescreenshot executables, they forward their arguments
+      to the simulator over a Unix socket
+    - usbmuxd socket which connects to the SSH and zxtouch servers and to a fake lockdownd with installation_proxy
+      (USBMUXD_SOCKET_ADDRESS in environ())
+    - mock Frida device which sends dump.js messages
+    - iTunes search API for the simulated apps
+    - S3 compatible storage for the S3 sink (AWS_ENDPOINT_URL and keys in environ(), objects in s3_root)
+
+        with Simulator(apps=10) as sim:
+            os.environ.update(sim.environ())
+            a = AppleDL(udid=sim.udid, ssh_key_filename=sim.client_key_path, frida_device=sim.frida_device(), ...)
+    '''
+
+    def __init__(
+        self,
+        apps=10,
+        app_size_MiB=4,
+        frameworks=1,
+        purchased_rate=0.0,
+        devices=1,
+        root=None,
+        seed=0,
+        log_level='info',
+        **device_args,
+    ):
+        '''
+        apps: number of apps in the catalogue (itunes ids 1000000001, ...)
+        device_args: passed to SimDevice (install_latency, bandwidth_MiBps, popup_rate, ...)
+        '''
+        self.log = get_logger(log_level, name=__name__)
+        self.temp_dir = tempfile.mkdtemp(prefix='ipadumper-sim-') if root is None else None
+        self.root = root or self.temp_dir
+        self.bin = os.path.join(self.root, 'bin')
+        self.device_bin = os.path.join(self.root, 'device-bin')
+        self.socket_path = os.path.join(self.root, 'control.sock')
+        self.usbmuxd_path = os.path.join(self.root, 'usbmuxd.sock')
+        self.s3_root = os.path.join(self.root, 's3')
+        self.client_key_path = os.path.join(self.root, 'client_key')
+        self.servers = []
+        self.listeners = {}  # local port -> listening socket of iproxy
+
+        rng = random.Random(seed)
+        self.catalogue = {}
+        for i in range(apps):
+            itunes_id = 1000000001 + i
+            self.catalogue[itunes_id] = SimApp(
+                itunes_id,
+                f'com.simulated.app{i}',
+                f'App{i}',
+                f'1.{i}',
+                app_size_MiB,
+                frameworks,
+                rng.random() < purchased_rate,
+            )
+
+        self.devices = {}
+        for i in range(devices):
+            udid = f'00008030-SIMULATED{i:07d}'
+            root = os.path.join(self.root, 'devices', udid)
+            os.makedirs(root, exist_ok=True)
+            self.devices[udid] = SimDevice(
+                root, udid, self.catalogue, seed=seed + i, log_level=log_level, **device_args
+            )
+        self.udid = next(iter(self.devices))
+
+        self.host_key = paramiko.RSAKey.generate(2048)
+        paramiko.RSAKey.generate(2048).write_private_key_file(self.client_key_path)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def environ(self):
+        '''
+        return environment variables for the host side (stub executables first in PATH, fake iTunes API)
+        '''
+        return {
+            'PATH': self.bin + os.pathsep + os.environ.get('PATH', ''),
+            'IPADUMPER_SIM_SOCKET': self.socket_path,
+            'USBMUXD_SOCKET_ADDRESS': f'UNIX:{self.usbmuxd_path}',
+            'IPADUMPER_ITUNES_URL': f'http://127.0.0.1:{self.itunes_server.server_address[1]}',
+            'AWS_ENDPOINT_URL': f'http://127.0.0.1:{self.s3_server.server_address[1]}',
+            'AWS_ACCESS_KEY_ID': 'simulator',
+            'AWS_SECRET_ACCESS_KEY': 'simulator',
+        }
+
+    def frida_device(self, udid=None):
+        return MockFridaDevice(self.devices[udid or self.udid])
+
+    def start(self):
+        # stub executables
+        for directory, commands in [(self.bin, HOST_COMMANDS), (self.device_bin, DEVICE_COMMANDS)]:
+            os.makedirs(directory, exist_ok=True)
+            for command in commands:
+                self.__write_stub(os.path.join(directory, command))
+        for device in self.devices.values():
+            self.__write_stub(device.path('/usr/local/bin/fouldecrypt'))
+
+        simulator = self
+
+        class ControlHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = json.loads(self.rfile.readline())
+                simulator.control(request, self.connection, self.wfile)
+
+        control = socketserver.ThreadingUnixStreamServer(self.socket_path, ControlHandler)
+        control.daemon_threads = True
+        self.servers.append(control)
+        threading.Thread(target=control.serve_forever, name='sim-control', daemon=True).start()
+
+        class UsbmuxdRequestHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                UsbmuxdHandler(simulator, self.request).handle()
+
+        usbmuxd = socketserver.ThreadingUnixStreamServer(self.usbmuxd_path, UsbmuxdRequestHandler)
+        usbmuxd.daemon_threads = True
+        self.servers.append(usbmuxd)
+        threading.Thread(target=usbmuxd.serve_forever, name='sim-usbmuxd', daemon=True).start()
+
+        catalogue = self.catalogue
+
+        class ITunesHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                m = re.search(r'term=(\d+)', self.path)
+                app = catalogue.get(int(m.group(1))) if m else None
+                results = []
+                if app is not None:
+                    results.append(
+                        {
+                            'trackName': app.name,
+                            'trackId': app.itunes_id,
+                            'version': app.version,
+                            'bundleId': app.bundleId,
+                            'fileSizeBytes': str(app.size_MiB * 2**20),
+                            'price': 0.0,
+                            'currency': 'USD',
+                        }
+                    )
+                body = json.dumps({'resultCount': len(results), 'results': results}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.itunes_server = ThreadingHTTPServer(('127.0.0.1', 0), ITunesHandler)
+        self.servers.append(self.itunes_server)
+        threading.Thread(target=self.itunes_server.serve_forever, name='sim-itunes', daemon=True).start()
+
+        self.s3_server = ThreadingHTTPServer(('127.0.0.1', 0), S3Handler)
+        self.s3_server.root = self.s3_root
+        self.s3_server.min_part_size = 5 * 2**20
+        os.makedirs(self.s3_root, exist_ok=True)
+        self.servers.append(self.s3_server)
+        threading.Thread(target=self.s3_server.serve_forever, name='sim-s3', daemon=True).start()
+        self.log.debug(f'Simulator started in {self.root}')
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        for listener in list(self.listeners.values()):
+            listener.close()
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def __write_stub(self, path):
+        with open(path, 'w') as f:
+            f.write(STUB.format(python=sys.executable))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    def device(self, args, udid=None):
+        '''
+        return device selected with --udid (or udid) and remaining arguments
+        '''
+        if '--udid' in args:
+            i = args.index('--udid')
+            udid = args[i + 1]
+            args = args[:i] + args[i + 2 :]
+        return self.devices.get(udid or self.udid), args
+
+    def control(self, request, connection, wfile):
+        '''
+        Handle a stub executable
+        '''
+        command, args = request['argv'][0], request['argv'][1:]
+        device, args = self.device(args, request.get('udid'))
+        reply = {'returncode': 0}
+        if device is None:
+            reply = {'returncode': 1, 'stderr': 'ERROR: Device not found\n'}
+        elif command == 'ideviceinfo':
+            reply['stdout'] = f'DeviceName: Simulated\nProductType: iPhone12,1\nUniqueDeviceID: {device.udid}\n'
+        elif command == 'ideviceinstaller':
+            reply['returncode'], reply['stdout'], reply['stderr'] = device.ideviceinstaller(args)
+        elif command == 'idevicescreenshot':
+            try:
+                device.screenshot(args[0])
+                reply['stdout'] = f'Screenshot saved to {args[0]}\n'
+            except (RuntimeError, OSError) as e:
+                reply = {'returncode': 1, 'stderr': f'{str(e)}\n'}
+        elif command == 'uiopen':
+            device.open_url(args[0] if args else '')
+        elif command == 'fouldecrypt':
+            reply['returncode'], reply['stdout'], reply['stderr'] = device.fouldecrypt(args)
+        elif command == 'df':
+            reply['returncode'], reply['stdout'], reply['stderr'] = device.df(args)
+        elif command == 'iproxy':
+            self.iproxy(device, int(args[0]), int(args[1]), connection, wfile)
+            return
+        wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+    def iproxy(self, device, local_port, device_port, connection, wfile):
+        '''
+        Listen on local_port and serve ssh (22) or zxtouch (6000) until the iproxy stub exits
+        '''
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            listener.bind(('127.0.0.1', local_port))
+        except OSError as e:
+            wfile.write(json.dumps({'returncode': 1, 'stderr': f'{str(e)}\n'}).encode('utf-8') + b'\n')
+            return
+        listener.listen(16)
+        self.listeners[local_port] = listener
+
+        def accept():
+            while True:
+                try:
+                    sock, _ = listener.accept()
+                except OSError:
+                    return
+                if device_port == 22:
+                    target = self.serve_ssh
+                elif device_port == 6000:
+                    target = ZXTouchHandler(device, sock).handle
+                else:
+                    sock.close()
+                    continue
+                args = (device, sock) if device_port == 22 else ()
+                threading.Thread(target=target, args=args, name=f'sim-{device_port}', daemon=True).start()
+
+        threading.Thread(target=accept, name=f'sim-iproxy-{local_port}', daemon=True).start()
+        wfile.write(json.dumps({'hold': True}).encode('utf-8') + b'\n')
+        wfile.flush()
+        # wait until the stub is killed
+        try:
+            while connection.recv(1024):
+                pass
+        except OSError:
+            pass
+        listener.close()
+        self.listeners.pop(local_port, None)
+
+    def serve_ssh(self, device, sock):
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self.host_key)
+        try:
+            transport.start_server(server=SSHServer(self, device))
+        except (paramiko.SSHException, EOFError):
+            return
+        channels = []  # keep references, paramiko closes channels when they are garbage collected
+        while transport.is_active():
+            channel = transport.accept(1)
+            channels = [c for c in channels if not c.closed]
+            if channel is not None:
+                channels.append(channel)
@@ -0,0 +1,454 @@
+# stdlib
+import datetime
+import hashlib
+import hmac
+import os
+import subprocess
+import tempfile
+import time
+from urllib.parse import quote, urlparse
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+# external
+import requests
+
+# internal
+from ipadumper.utils import get_logger
+
+
+CHUNK_SIZE = 2**20
+PART_SIZE = 8 * 2**20  # S3 parts must be at least 5 MiB (except the last one)
+EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+
+
+class SinkError(OSError):
+    '''
+    Storing an IPA failed
+    '''
+
+
+class SinkUnavailable(SinkError, ConnectionError):
+    '''
+    The storage can't be reached or is overloaded, a retry may help
+    '''
+
+
+class Writer:
+    '''
+    IPA which is streamed into a sink, it only appears in the sink once it is committed
+    As context manager it is committed at the end of the block and aborted if an exception is raised.
+
+        with sink.open('123_com.app.name_1.0.ipa') as f:
+            f.write(data)
+    '''
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def commit(self):
+        raise NotImplementedError
+
+    def abort(self):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+            return
+        try:
+            self.commit()
+        except BaseException:
+            self.abort()
+            raise
+
+
+class Sink:
+    '''
+    Where dumped IPAs are stored
+    '''
+
+    def open(self, name):
+        '''
+        return Writer for an IPA, an existing IPA with the same name is replaced when the writer is committed
+        '''
+        raise NotImplementedError
+
+    def names(self):
+        '''
+        return iterable of the names of all stored IPAs
+        '''
+        raise NotImplementedError
+
+    def size(self, name):
+        '''
+        return size of a stored IPA in bytes
+        '''
+        raise NotImplementedError
+
+    def local_path(self, name):
+        '''
+        return path of a stored IPA in the local file system or None if the sink is remote
+        '''
+        return None
+
+
+class LocalWriter(Writer):
+    def __init__(self, directory, name):
+        self.path = os.path.join(directory, name)
+        fd, self.tmp = tempfile.mkstemp(dir=directory, prefix=f'.{name}.', suffix='.part')
+        self.f = os.fdopen(fd, 'wb')
+        self.bytes = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.bytes += len(data)
+
+    def commit(self):
+        self.f.close()
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        self.f.close()
+        try:
+            os.unlink(self.tmp)
+        except FileNotFoundError:
+            pass
+
+
+class LocalSink(Sink):
+    '''
+    Directory, IPAs are written to a hidden temporary file which is renamed when it is complete
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def __str__(self):
+        return self.directory
+
+    def open(self, name):
+        return LocalWriter(self.directory, name)
+
+    def names(self):
+        with os.scandir(self.directory) as entries:
+            return [e.name for e in entries if e.name.endswith('.ipa') and not e.name.startswith('.') and e.is_file()]
+
+    def size(self, name):
+        return os.path.getsize(self.local_path(name))
+
+    def local_path(self, name):
+        return os.path.join(self.directory, name)
+
+
+class ContentAddressedWriter(LocalWriter):
+    def __init__(self, sink, name):
+        super().__init__(sink.objects, name)
+        self.sink = sink
+        self.name = name
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        super().write(data)
+        self.hash.update(data)
+
+    def commit(self):
+        self.f.close()
+        digest = self.hash.hexdigest()
+        obj = self.sink.object_path(digest)
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        if os.path.exists(obj):
+            os.unlink(self.tmp)
+        else:
+            os.replace(self.tmp, obj)
+        # absolute, so the link still works when it is moved (e.g. to failed/ by the verifier)
+        link = os.path.join(self.sink.directory, f'.{self.name}.link')
+        if os.path.lexists(link):
+            os.unlink(link)
+        os.symlink(os.path.abspath(obj), link)
+        os.replace(link, os.path.join(self.sink.directory, self.name))
+
+
+class ContentAddressedSink(LocalSink):
+    '''
+    Directory which stores every distinct IPA once in objects/<sha256[:2]>/<sha256>
+    The IPAs are symlinks to the objects, e.g. the same version dumped twice only takes the space once.
+    '''
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.objects = os.path.join(directory, 'objects')
+        os.makedirs(self.objects, exist_ok=True)
+
+    def __str__(self):
+        return f'cas:{self.directory}'
+
+    def open(self, name):
+        return ContentAddressedWriter(self, name)
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+
+def sign(method, host, path, query, headers, payload_hash, region, access_key, secret_key, now=None, service='s3'):
+    '''
+    AWS Signature Version 4
+    path: URL encoded path, query: URL encoded query string (sorted), payload_hash: hex SHA-256 of the body
+    return headers with host, x-amz-date, x-amz-content-sha256 and authorization
+    '''
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    scope = f'{amz_date[:8]}/{region}/{service}/aws4_request'
+    headers = {k.lower(): str(v).strip() for k, v in headers.items()}
+    headers.update({'host': host, 'x-amz-date': amz_date, 'x-amz-content-sha256': payload_hash})
+    signed = ';'.join(sorted(headers))
+    canonical = '\n'.join(
+        [method, path, query, ''.join(f'{k}:{headers[k]}\n' for k in sorted(headers)), signed, payload_hash]
+    )
+    string_to_sign = '\n'.join(
+        ['AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical.encode('utf-8')).hexdigest()]
+    )
+    key = f'AWS4{secret_key}'.encode('utf-8')
+    for part in scope.split('/'):
+        key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+    headers['authorization'] = (
+        f'AWS4-HMAC-SHA256 Credential={access_key}/{scope}, SignedHeaders={signed}, Signature={signature}'
+    )
+    return headers
+
+
+def parse_xml(content):
+    '''
+    return root element without namespaces
+    '''
+    root = ET.fromstring(content)
+    for element in root.iter():
+        element.tag = element.tag.rpartition('}')[2]
+    return root
+
+
+class S3Writer(Writer):
+    '''
+    Uploads every full part while the IPA is written, only one part is buffered
+    IPAs smaller than a part are uploaded with a single PUT.
+    '''
+
+    def __init__(self, sink, key):
+        self.sink = sink
+        self.key = key
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []  # (part number, ETag)
+        self.bytes = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes += len(data)
+        while len(self.buffer) >= self.sink.part_size:
+            self.__upload_part(bytes(self.buffer[: self.sink.part_size]))
+            del self.buffer[: self.sink.part_size]
+
+    def __upload_part(self, data):
+        if self.upload_id is None:
+            reply = self.sink.request('POST', self.key, {'uploads': ''})
+            self.upload_id = parse_xml(reply.content).findtext('UploadId')
+        number = len(self.parts) + 1
+        reply = self.sink.request('PUT', self.key, {'partNumber': number, 'uploadId': self.upload_id}, data)
+        self.parts.append((number, reply.headers['ETag']))
+
+    def commit(self):
+        if self.upload_id is None:
+            self.sink.request('PUT', self.key, data=bytes(self.buffer))
+            self.buffer = bytearray()
+            return
+        if len(self.buffer) > 0:
+            self.__upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        parts = ''.join(
+            f'<Part><PartNumber>{n}</PartNumber><ETag>{escape(etag)}</ETag></Part>' for n, etag in self.parts
+        )
+        body = f'<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>'.encode('utf-8')
+        reply = self.sink.request('POST', self.key, {'uploadId': self.upload_id}, body)
+        # the upload can still fail after the status line was sent
+        if parse_xml(reply.content).tag == 'Error':
+            raise SinkError(f'Completing upload of {self.key} failed: {reply.text}')
+        self.upload_id = None
+
+    def abort(self):
+        self.buffer = bytearray()
+        if self.upload_id is None:
+            return
+        try:
+            self.sink.request('DELETE', self.key, {'uploadId': self.upload_id})
+        except SinkError as e:
+            self.sink.log.warning(f'Could not abort upload of {self.key}: {str(e)}')
+        self.upload_id = None
+
+
+class S3Sink(Sink):
+    '''
+    Bucket of S3 or an S3 compatible storage (MinIO, Ceph, ...), IPAs are streamed with multipart uploads
+    Requests are signed with AWS Signature Version 4 and use path style URLs (endpoint/bucket/key).
+    Endpoint, region and keys default to the environment variables of the AWS CLI:
+    AWS_ENDPOINT_URL, AWS_REGION, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and AWS_SESSION_TOKEN
+    '''
+
+    def __init__(
+        self,
+        bucket,
+        prefix='',
+        endpoint_url=None,
+        region=None,
+        access_key=None,
+        secret_key=None,
+        part_size=PART_SIZE,
+        page_size=1000,
+        retries=3,
+        timeout=60,
+        log_level='info',
+    ):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') != '' else ''
+        self.region = region or os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION') or 'us-east-1'
+        endpoint_url = endpoint_url or os.environ.get('AWS_ENDPOINT_URL') or f'https://s3.{self.region}.amazonaws.com'
+        self.endpoint = urlparse(endpoint_url.rstrip('/'))
+        self.access_key = access_key or os.environ.get('AWS_ACCESS_KEY_ID', '')
+        self.secret_key = secret_key or os.environ.get('AWS_SECRET_ACCESS_KEY', '')
+        self.session_token = os.environ.get('AWS_SESSION_TOKEN')
+        self.part_size = part_size
+        self.page_size = page_size  # keys per ListObjectsV2 request
+        self.retries = retries
+        self.timeout = timeout
+        self.log = get_logger(log_level, name=__name__)
+        self.session = requests.Session()
+
+    def __str__(self):
+        return f's3://{self.bucket}/{self.prefix}'
+
+    def request(self, method, key=None, params=None, data=b'', headers=None):
+        '''
+        Send a signed request, connection errors and server errors are retried
+        key: object key or None for the bucket
+        return response
+        raise SinkUnavailable if the storage can't be reached, SinkError for other errors
+        '''
+        path = f'{self.endpoint.path}/{quote(self.bucket)}'
+        if key is not None:
+            path += '/' + quote(key, safe='/-_.~')
+        query = '&'.join(
+            f"{quote(str(k), safe='-_.~')}={quote(str(v), safe='-_.~')}" for k, v in sorted((params or {}).items())
+        )
+        url = f'{self.endpoint.scheme}://{self.endpoint.netloc}{path}' + (f'?{query}' if query != '' else '')
+        headers = dict(headers or {})
+        if self.session_token:
+            headers['x-amz-security-token'] = self.session_token
+        payload_hash = hashlib.sha256(data).hexdigest() if len(data) > 0 else EMPTY_SHA256
+
+        for attempt in range(self.retries + 1):
+            signed = sign(
+                method,
+                self.endpoint.netloc,
+                path,
+                query,
+                headers,
+                payload_hash,
+                self.region,
+                self.access_key,
+                self.secret_key,
+            )
+            try:
+                reply = self.session.request(method, url, data=data, headers=signed, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = SinkUnavailable(f'{method} {path}: {str(e)}')
+            else:
+                if reply.status_code < 300:
+                    return reply
+                message = f'{method} {path}: {reply.status_code} {self.__error_code(reply)}'
+                if reply.status_code < 500 and reply.status_code != 429:
+                    raise SinkError(message)
+                error = SinkUnavailable(message)
+            if attempt < self.retries:
+                self.log.debug(f'{str(error)}, retry {attempt + 1}/{self.retries}')
+                time.sleep(2**attempt)
+        raise error
+
+    def __error_code(self, reply):
+        try:
+            return parse_xml(reply.content).findtext('Code') or reply.reason
+        except ET.ParseError:
+            return reply.reason
+
+    def open(self, name):
+        return S3Writer(self, self.prefix + name)
+
+    def names(self):
+        params = {'list-type': 2, 'max-keys': self.page_size, 'prefix': self.prefix}
+        while True:
+            root = parse_xml(self.request('GET', params=params).content)
+            for contents in root.findall('Contents'):
+                yield contents.findtext('Key')[len(self.prefix) :]
+            token = root.findtext('NextContinuationToken')
+            if root.findtext('IsTruncated') != 'true' or not token:
+                return
+            params['continuation-token'] = token
+
+    def size(self, name):
+        return int(self.request('HEAD', self.prefix + name).headers['Content-Length'])
+
+
+def for_path(path):
+    '''
+    return LocalSink of the directory of path and the file name
+    '''
+    return LocalSink(os.path.dirname(os.path.abspath(path))), os.path.basename(path)
+
+
+def parse_url(url):
+    '''
+    return kind (local, cas or s3), bucket and prefix of a sink URL
+    raise ValueError for unknown URLs
+    '''
+    if url in (None, '', 'local', 'cas'):
+        return url or 'local', None, None
+    parsed = urlparse(url) if isinstance(url, str) else None
+    if parsed is None or parsed.scheme != 's3' or parsed.netloc == '':
+        raise ValueError(f'Unknown sink {url}, use local, cas or s3://bucket/prefix')
+    return 's3', parsed.netloc, parsed.path
+
+
+def from_url(url, directory, log_level='info'):
+    '''
+    return Sink for a URL:
+    local (or None): directory
+    cas: content addressed in directory
+    s3://bucket/prefix: S3 bucket (endpoint and keys from the environment, see S3Sink)
+    raise ValueError for unknown URLs
+    '''
+    kind, bucket, prefix = parse_url(url)
+    if kind == 'local':
+        return LocalSink(directory)
+    if kind == 'cas':
+        return ContentAddressedSink(directory)
+    return S3Sink(bucket, prefix, log_level=log_level)
+
+
+def pipe(args, writer, cwd=None):
+    '''
+    Run a command and stream its stdout into writer (e.g. zip -qrX - Payload)
+    raise subprocess.CalledProcessError if it failed
+    '''
+    with subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as p:
+        try:
+            for chunk in iter(lambda: p.stdout.read(CHUNK_SIZE), b''):
+                writer.write(chunk)
+        except BaseException:
+            p.kill()
+            raise
+        stderr = p.stderr.read()
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, args, stderr=stderr)
@@ -0,0 +1,146 @@
+# stdlib
+import threading
+import time
+
+# internal
+from ipadumper.utils import get_logger
+
+
+class StorageBudget:
+    '''
+    Free space on the device minus the space which is reserved for apps that are installing or getting dumped
+    Free space is read with df over SSH. An app reserves (install_factor + dump_factor) * fileSizeMiB until its
+    installation is finished (the download and the unpacked app) and dump_factor * fileSizeMiB until it is
+    uninstalled (decrypted binaries, _tmp directory or out.zip of the dump).
+
+        storage = StorageBudget(a.ssh_cmd)
+        if storage.reserve(itunes_id, fileSizeMiB):
+            ...install...
+            storage.installed(itunes_id)
+            ...dump and uninstall...
+            storage.release(itunes_id)
+    '''
+
+    def __init__(
+        self,
+        ssh_cmd,
+        path='/private/var',
+        install_factor=2.0,
+        dump_factor=1.0,
+        headroom_MiB=1024,
+        max_age=5,
+        max_failures=3,
+        log_level='info',
+        device=None,
+    ):
+        '''
+        ssh_cmd: function which runs a command on the device and returns exitcode, stdout, stderr
+        path: mount point of the data partition
+        headroom_MiB: space which is always kept free (iOS gets unstable on a full disk)
+        max_age: seconds until the free space is read again
+        max_failures: storage admission is disabled after this many failed reads in a row
+        '''
+        self.ssh_cmd = ssh_cmd
+        self.path = path
+        self.install_factor = install_factor
+        self.dump_factor = dump_factor
+        self.headroom_MiB = headroom_MiB
+        self.max_age = max_age
+        self.max_failures = max_failures
+        self.log = get_logger(log_level, name=__name__, device=device)
+        self.lock = threading.Lock()
+        self.reservations = {}  # key -> [MiB until installed, MiB until released]
+        self.free = None
+        self.read_time = 0
+        self.failures = 0
+        self.disabled = False
+
+    def free_MiB(self, refresh=False):
+        '''
+        return free space on the device in MiB or None if it is unknown
+        When reading fails, the last value which was read is returned and the next call reads again.
+        '''
+        if self.disabled:
+            return None
+        if not refresh and self.free is not None and time.monotonic() - self.read_time < self.max_age:
+            return self.free
+        ret, stdout, stderr = self.ssh_cmd(f'df -k {self.path}')
+        lines = stdout.splitlines()
+        try:
+            # Filesystem 1024-blocks Used Available Capacity ... (long device names are not wrapped with -k on iOS)
+            column = lines[0].split().index('Available')
+            free = int(lines[-1].split()[column]) / 1024
+        except (IndexError, ValueError):
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                self.log.warning(
+                    f'Could not read free space {self.failures} times, storage admission is disabled: '
+                    + f'{ret} {stdout} {stderr}'
+                )
+                self.disabled = True
+                return None
+            self.log.warning(
+                f'Could not read free space ({self.failures}/{self.max_failures} failures): {ret} {stdout} {stderr}'
+            )
+            self.read_time = 0  # read again on the next call
+            return self.free
+        self.free = free
+        self.failures = 0
+        self.read_time = time.monotonic()
+        return self.free
+
+    def reserved_MiB(self):
+        with self.lock:
+            return sum(install + dump for install, dump in self.reservations.values())
+
+    def available_MiB(self, refresh=False):
+        '''
+        return free space minus reservations and headroom in MiB or None if the free space is unknown
+        '''
+        free = self.free_MiB(refresh=refresh)
+        if free is None:
+            return None
+        return free - self.reserved_MiB() - self.headroom_MiB
+
+    def needed_MiB(self, size_MiB):
+        return (self.install_factor + self.dump_factor) * size_MiB
+
+    def fits(self, size_MiB):
+        '''
+        return True if size_MiB fits on the device (or the free space is unknown)
+        '''
+        available = self.available_MiB()
+        return available is None or size_MiB <= available
+
+    def reserve(self, key, size_MiB):
+        '''
+        Reserve space for installing and dumping an app with fileSizeMiB size_MiB
+        return True if the reservation fits
+        '''
+        needed = self.needed_MiB(size_MiB)
+        if not self.fits(needed):
+            # reservations which were released since the last read may have freed space
+            available = self.available_MiB(refresh=True)
+            if available is not None and needed > available:
+                self.log.debug(f'{key}: needs {needed:.0f} MiB, {available:.0f} MiB available')
+                return False
+        with self.lock:
+            self.reservations[key] = [self.install_factor * size_MiB, self.dump_factor * size_MiB]
+        return True
+
+    def installed(self, key):
+        '''
+        The installation of the app is finished, the installed app is part of the free space from now on
+        '''
+        with self.lock:
+            if key in self.reservations:
+                self.reservations[key][0] = 0
+        self.read_time = 0
+
+    def release(self, key):
+        '''
+        The app is uninstalled, release its reservation
+        '''
+        with self.lock:
+            self.reservations.pop(key, None)
+        self.read_time = 0
@@ -0,0 +1,145 @@
+# stdlib
+from collections import deque
+from contextlib import contextmanager
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+# arguments which are inherited from the parent span
+INHERITED = ('device', 'app')
+
+
+class Span:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def set(self, **args):
+        '''
+        Add arguments (e.g. byte counts) to the span
+        '''
+        self.args.update(args)
+
+
+class Tracer:
+    '''
+    Collects spans of all threads and exports them in the Chrome trace event format
+    (load it in chrome://tracing or https://ui.perfetto.dev)
+    Every device is shown as a process and every thread as a thread of that process.
+    Spans nest per thread and per asyncio task (the stack is a context variable).
+    When disabled, span() only yields a dummy span.
+    '''
+
+    def __init__(self, enabled=False, max_events=1000000):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.stack = contextvars.ContextVar('spans', default=())
+        self.events = deque(maxlen=max_events)
+        self.metadata = []  # process and thread names, never dropped
+        self.pids = {}  # device -> pid
+        self.tids = {}  # (pid, thread or track name) -> tid
+        self.origin = time.perf_counter()
+
+    def __now_us(self, t=None):
+        return ((time.perf_counter() if t is None else t) - self.origin) * 1e6
+
+    def __ids(self, device, track=None):
+        '''
+        return pid of device and tid of the current thread or of a named track
+        '''
+        track = track or threading.current_thread().name
+        with self.lock:
+            if device not in self.pids:
+                pid = self.pids[device] = len(self.pids) + 1
+                self.metadata.append(
+                    {'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': str(device)}}
+                )
+            pid = self.pids[device]
+            if (pid, track) not in self.tids:
+                tid = self.tids[(pid, track)] = len(self.tids) + 1
+                self.metadata.append(
+                    {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': track}}
+                )
+            return pid, self.tids[(pid, track)]
+
+    def inherited(self):
+        '''
+        return arguments which would be inherited by a new span of the current thread
+        (pass them to spans of worker threads)
+        '''
+        stack = self.stack.get()
+        if len(stack) == 0:
+            return {}
+        return {k: stack[-1].args[k] for k in INHERITED if k in stack[-1].args}
+
+    @contextmanager
+    def span(self, name, **args):
+        '''
+        Record a span. device and app are inherited from the enclosing span of the same thread.
+
+            with TRACER.span('scp', path=path) as span:
+                span.set(bytes=transferred)
+        '''
+        if not self.enabled:
+            yield Span(name, {})
+            return
+        span = Span(name, {**self.inherited(), **args})
+        token = self.stack.set(self.stack.get() + (span,))
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            self.stack.reset(token)
+            self.add(name, start, time.perf_counter(), **span.args)
+
+    def add(self, name, start, end, track=None, **args):
+        '''
+        Record a span with explicit start and end (time.perf_counter()) e.g. for waits which span many ticks
+        track: name of the row (default: current thread)
+        '''
+        if not self.enabled:
+            return
+        args.setdefault('thread', threading.current_thread().name)
+        pid, tid = self.__ids(args.get('device', 'host'), track)
+        event = {
+            'name': name,
+            'ph': 'X',
+            'ts': round(self.__now_us(start), 1),
+            'dur': round((end - start) * 1e6, 1),
+            'pid': pid,
+            'tid': tid,
+            'args': {k: v if isinstance(v, (int, float, bool)) or v is None else str(v) for k, v in args.items()},
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def export_chrome(self, path):
+        '''
+        Write collected events as Chrome trace event JSON
+        '''
+        with self.lock:
+            events = self.metadata + list(self.events)
+        # the devices of multidump export to the same path
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.trace')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+
+
+TRACER = Tracer()
+
+
+def enable():
+    TRACER.enabled = True
+
+
+def span(name, **args):
+    return TRACER.span(name, **args)
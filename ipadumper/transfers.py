@@ -0,0 +1,217 @@
+# stdlib
+from contextlib import contextmanager
+import itertools
+import threading
+import time
+
+# external
+from tqdm import tqdm  # progress bar
+
+
+# transfers an uninstall waits for: they free storage on the device
+PRIORITY_UNINSTALL = 1
+
+
+class Bucket:
+    '''
+    Token bucket with a rate in bytes per second (None: unlimited)
+    Tokens may become negative, so chunks larger than the burst size are possible.
+    '''
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else (rate / 4 if rate else 0)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def delay(self, now):
+        '''
+        return seconds until the bucket has tokens again
+        '''
+        if self.rate is None:
+            return 0
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return 0 if self.tokens > 0 else -self.tokens / self.rate
+
+    def take(self, nbytes):
+        if self.rate is not None:
+            self.tokens -= nbytes
+
+
+class Transfer:
+    '''
+    Handle of a running transfer, pass progress() as progress callback of SCPClient
+    '''
+
+    def __init__(self, scheduler, device, bus, priority, name):
+        self.scheduler = scheduler
+        self.device = device
+        self.bus = bus
+        self.priority = priority
+        self.name = name
+        self.bytes = 0
+        self.last_sent = 0
+
+    def consume(self, nbytes):
+        '''
+        Account nbytes, blocks while the budgets of the device or its bus are used up
+        '''
+        if nbytes > 0:
+            self.scheduler.acquire(self, nbytes)
+            self.bytes += nbytes
+
+    def progress(self, filename, size, sent):
+        if sent < self.last_sent:
+            self.last_sent = 0  # next file
+        self.consume(sent - self.last_sent)
+        self.last_sent = 0 if sent == size else sent
+
+
+class TransferScheduler:
+    '''
+    Shares the bandwidth of USB buses between transfers of all devices
+    - budgets per bus and per device (bytes per second, None: unlimited)
+    - transfers with a higher priority (e.g. the ones an uninstall waits for) are served first
+    - weighted fair queuing between devices: every chunk gets a virtual finish time
+      (last finish time of the device + bytes / weight) and the smallest one is served first
+    - one progress bar with the throughput of all transfers
+
+    Budgets are enforced in the progress callback of scp, so a throttled transfer stops reading from its channel
+    and the device stops sending. Without budgets chunks are only counted.
+    '''
+
+    def __init__(self, bus_rate=None, device_rate=None, weights={}):
+        '''
+        bus_rate, device_rate: default budgets in bytes per second
+        weights: device -> weight for fair queuing (default: 1)
+        '''
+        self.bus_rate = bus_rate
+        self.device_rate = device_rate
+        self.weights = dict(weights)
+        self.cond = threading.Condition()
+        self.buses = {}  # bus -> Bucket
+        self.devices = {}  # device -> Bucket
+        self.finish = {}  # device -> virtual finish time of its last chunk
+        self.virtual = 0.0  # virtual time: finish time of the last served chunk
+        self.waiting = []  # (-priority, finish time, seq, transfer, bytes)
+        self.seq = itertools.count()
+        self.active = 0
+        self.shown = 0  # transfers which want a progress bar
+        self.bar = None
+        self.total = 0
+
+    def configure(self, bus_rate=None, device_rate=None, weights={}):
+        '''
+        Set default budgets (bytes per second) and weights
+        '''
+        with self.cond:
+            self.bus_rate = bus_rate
+            self.device_rate = device_rate
+            self.weights.update(weights)
+            self.buses = {}
+            self.devices = {}
+
+    def set_limit(self, device=None, bus=None, rate=None):
+        '''
+        Set the budget of one device or bus (bytes per second, None: unlimited)
+        '''
+        with self.cond:
+            if device is not None:
+                self.devices[device] = Bucket(rate)
+            if bus is not None:
+                self.buses[bus] = Bucket(rate)
+
+    def __bucket(self, buckets, key, rate):
+        if key not in buckets:
+            buckets[key] = Bucket(rate)
+        return buckets[key]
+
+    def __limited(self, transfer):
+        bus = self.__bucket(self.buses, transfer.bus, self.bus_rate)
+        device = self.__bucket(self.devices, transfer.device, self.device_rate)
+        return bus, device
+
+    @contextmanager
+    def transfer(self, device, bus='host', priority=0, name='', disable_progress=True):
+        '''
+        Register a transfer
+        device: device label, bus: name of the bus (devices on the same hub or host controller share it)
+        priority: higher is served first
+        '''
+        t = Transfer(self, device, bus, priority, name)
+        with self.cond:
+            self.active += 1
+            if not disable_progress:
+                self.shown += 1
+                if self.bar is None:
+                    self.bar = tqdm(unit='B', unit_scale=True, desc='transfers', miniters=1, smoothing=0.1)
+        try:
+            yield t
+        finally:
+            with self.cond:
+                self.active -= 1
+                if not disable_progress:
+                    self.shown -= 1
+                    if self.shown == 0 and self.bar is not None:
+                        self.bar.close()
+                        self.bar = None
+
+    def throttled(self, transfer):
+        '''
+        return True if a budget applies to the transfer (acquire() may block)
+        '''
+        with self.cond:
+            bus, device = self.__limited(transfer)
+            return bus.rate is not None or device.rate is not None
+
+    def acquire(self, transfer, nbytes):
+        '''
+        Block until the chunk of the transfer may be sent
+        '''
+        with self.cond:
+            bus, device = self.__limited(transfer)
+            if bus.rate is not None or device.rate is not None:
+                self.__wait(transfer, nbytes, bus, device)
+            self.total += nbytes
+            if self.bar is not None:
+                self.bar.set_postfix_str(f'{self.active} active', refresh=False)
+                self.bar.update(nbytes)
+
+    def __wait(self, transfer, nbytes, bus, device):
+        weight = self.weights.get(transfer.device, 1)
+        finish = max(self.virtual, self.finish.get(transfer.device, 0)) + nbytes / weight
+        self.finish[transfer.device] = finish
+        entry = (-transfer.priority, finish, next(self.seq), transfer, nbytes)
+        self.waiting.append(entry)
+        try:
+            while True:
+                now = time.monotonic()
+                # the first waiting chunk (by priority and finish time) whose budgets allow it is served
+                shortest = None
+                for e in sorted(self.waiting, key=lambda e: e[:3]):
+                    b, d = self.__limited(e[3])
+                    delay = max(b.delay(now), d.delay(now))
+                    if delay == 0:
+                        if e is entry:
+                            b.take(nbytes)
+                            d.take(nbytes)
+                            self.virtual = finish
+                            return
+                        break  # another chunk goes first
+                    shortest = delay if shortest is None else min(shortest, delay)
+                self.cond.wait(timeout=shortest)
+        finally:
+            self.waiting.remove(entry)
+            self.cond.notify_all()
+
+    def stats(self):
+        '''
+        return total bytes and number of active transfers
+        '''
+        with self.cond:
+            return self.total, self.active
+
+
+# shared by all devices of this process
+SCHEDULER = TransferScheduler()
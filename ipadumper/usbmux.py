@@ -0,0 +1,158 @@
+# stdlib
+from collections import namedtuple
+import os
+import plistlib
+import socket
+import struct
+import sys
+
+
+Device = namedtuple('Device', ['id', 'udid', 'connection_type'])
+
+# header: length (including header), version, message type, tag
+HEADER = struct.Struct('<IIII')
+VERSION_PLIST = 1
+MESSAGE_PLIST = 8
+
+# results of a connect request
+RESULTS = {0: 'OK', 1: 'bad command', 2: 'bad device', 3: 'connection refused', 6: 'bad version'}
+
+
+class UsbmuxError(ConnectionError):
+    pass
+
+
+def default_address():
+    '''
+    return address of usbmuxd: path of the Unix socket or (host, port)
+    USBMUXD_SOCKET_ADDRESS overrides it like in libusbmuxd (UNIX:/path or host:port)
+    '''
+    address = os.environ.get('USBMUXD_SOCKET_ADDRESS')
+    if address:
+        if address.startswith('UNIX:'):
+            return address[len('UNIX:') :]
+        host, _, port = address.rpartition(':')
+        return host, int(port)
+    if sys.platform == 'win32':
+        return '127.0.0.1', 27015
+    return '/var/run/usbmuxd'
+
+
+class Usbmux:
+    '''
+    Client for usbmuxd which opens connections to ports of a device without iproxy
+
+        mux = Usbmux()
+        sock = mux.connect(mux.device(udid), 22)
+        sshclient.connect('localhost', sock=sock)
+    '''
+
+    def __init__(self, address=None, timeout=15):
+        '''
+        address: Unix socket path or (host, port) (default: default_address())
+        '''
+        self.address = default_address() if address is None else address
+        self.timeout = timeout
+        self.tag = 0
+
+    def available(self):
+        '''
+        return True if usbmuxd is reachable
+        '''
+        try:
+            self.__socket().close()
+        except OSError:
+            return False
+        return True
+
+    def __socket(self):
+        if isinstance(self.address, str):
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(self.timeout)
+        try:
+            s.connect(self.address)
+        except OSError:
+            s.close()
+            raise
+        return s
+
+    def __request(self, s, message):
+        '''
+        Send plist message and return the reply
+        '''
+        self.tag += 1
+        message = {'ClientVersionString': 'ipadumper', 'ProgName': 'ipadumper', **message}
+        payload = plistlib.dumps(message)
+        s.sendall(HEADER.pack(HEADER.size + len(payload), VERSION_PLIST, MESSAGE_PLIST, self.tag) + payload)
+        length, _, _, _ = HEADER.unpack(self.__recv(s, HEADER.size))
+        return plistlib.loads(self.__recv(s, length - HEADER.size))
+
+    def __recv(self, s, size):
+        data = b''
+        while len(data) < size:
+            chunk = s.recv(size - len(data))
+            if not chunk:
+                raise UsbmuxError('usbmuxd closed the connection')
+            data += chunk
+        return data
+
+    def devices(self):
+        '''
+        return list of Device(id, udid, connection_type) (USB devices first)
+        '''
+        with self.__socket() as s:
+            reply = self.__request(s, {'MessageType': 'ListDevices'})
+        devices = []
+        for entry in reply.get('DeviceList', []):
+            properties = entry.get('Properties', {})
+            udid = properties.get('SerialNumber', '')
+            # usbmuxd reports UDIDs of newer devices without the dash
+            if len(udid) == 24 and '-' not in udid:
+                udid = f'{udid[:8]}-{udid[8:]}'
+            devices.append(Device(entry['DeviceID'], udid, properties.get('ConnectionType', 'USB')))
+        return sorted(devices, key=lambda d: d.connection_type != 'USB')
+
+    def device(self, udid=None):
+        '''
+        return Device with the UDID (or the first device) or None
+        '''
+        for device in self.devices():
+            if udid is None or device.udid.replace('-', '') == udid.replace('-', ''):
+                return device
+        return None
+
+    def read_pair_record(self, udid):
+        '''
+        return pair record of the device (dict with HostID, SystemBUID, HostCertificate, HostPrivateKey, ...)
+        raise UsbmuxError if the device is not paired
+        '''
+        with self.__socket() as s:
+            reply = self.__request(s, {'MessageType': 'ReadPairRecord', 'PairRecordID': udid})
+        if 'PairRecordData' not in reply:
+            raise UsbmuxError(f"No pair record for {udid}: {RESULTS.get(reply.get('Number'), reply.get('Number'))}")
+        return plistlib.loads(reply['PairRecordData'])
+
+    def connect(self, device, port, timeout=None):
+        '''
+        Connect to a TCP port of the device
+        device: Device or device id
+        timeout: timeout of the returned socket (None: blocking without timeout)
+        return socket which is connected to the port
+        raise UsbmuxError if the connection failed
+        '''
+        device_id = device.id if isinstance(device, Device) else device
+        s = self.__socket()
+        try:
+            message = {'MessageType': 'Connect', 'DeviceID': device_id, 'PortNumber': socket.htons(port)}
+            reply = self.__request(s, message)
+        except (OSError, plistlib.InvalidFileException) as e:
+            s.close()
+            raise UsbmuxError(f'Could not connect to port {port}: {str(e)}')
+        number = reply.get('Number', -1)
+        if number != 0:
+            s.close()
+            raise UsbmuxError(f'Could not connect to port {port}: {RESULTS.get(number, number)}')
+        s.settimeout(timeout)
+        return s
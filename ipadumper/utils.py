@@ -1,9 +1,13 @@
 # stdlib
+import atexit
 from datetime import datetime
 import logging
+import logging.handlers
 import os
+import queue
 import requests
 import socket
+import threading
 
 # external
 import coloredlogs  # colored logs
@@ -14,8 +18,9 @@ def itunes_info(itunes_id, log_level='info', country='us'):
     return: trackName, trackId, version, bundleId, fileSizeMiB, price, currency
     '''
     log = get_logger(log_level, name=__name__)
-    log.debug('Get app info from itunes.apple.com')
-    url = f'https://itunes.apple.com/{country}/search?limit=200&term={str(itunes_id)}&media=software'
+    base_url = os.environ.get('IPADUMPER_ITUNES_URL', 'https://itunes.apple.com')
+    log.debug(f'Get app info from {base_url}')
+    url = f'{base_url}/{country}/search?limit=200&term={str(itunes_id)}&media=software'
     j = requests.get(url).json()
     if j['resultCount'] == 0:
         log.error('no result with that itunes id found')
@@ -41,69 +46,119 @@ def itunes_info(itunes_id, log_level='info', country='us'):
     return trackName, version, bundleId, fileSizeMiB, price, currency
 
 
-def get_logger(log_level, name=__name__):
+LOG_FORMAT = '%(asctime)s %(threadName)-16s %(levelname)-8s %(device_prefix)s%(message)s'
+LOG_DATEFMT = '%Y-%m-%d %H:%M:%S'
+
+FIELD_STYLES = {
+    'asctime': {'color': 'green'},
+    'hostname': {'color': 'magenta'},
+    'levelname': {'color': 'red', 'bold': True},
+    'name': {'color': 'magenta'},
+    'programname': {'color': 'cyan'},
+    'username': {'color': 'yellow'},
+}
+
+LEVEL_STYLES = {
+    'critical': {'color': 'red', 'bold': True},
+    'debug': {'color': 'green'},
+    'error': {'color': 'red'},
+    'info': {},
+    'notice': {'color': 'magenta'},
+    'spam': {'color': 'green', 'faint': True},
+    'success': {'color': 'green', 'bold': True},
+    'verbose': {'color': 'blue'},
+    'warning': {'color': 'yellow'},
+}
+
+_logging_lock = threading.Lock()
+_listener = None  # QueueListener which writes the records of all threads
+
+
+class _DeviceFilter(logging.Filter):
+    '''
+    Make sure every record has a device (set by the LoggerAdapter of get_logger) and a prefix for the format
+    '''
+
+    def filter(self, record):
+        device = getattr(record, 'device', None)
+        record.device = device
+        record.device_prefix = f'[{device}] ' if device else ''
+        return True
+
+
+def setup_logging(log_file=None, max_bytes=10 * 2**20, backup_count=5, console=True):
+    '''
+    Configure logging of the ipadumper loggers once per process (later calls do nothing)
+    Records are put into a queue and written to the terminal and a rotating file by a listener thread,
+    so threads never block on I/O and every record is written once.
+
+    :param log_file: path of the log file (default: <date>_<time>.log), '' to disable the log file
+    :param max_bytes: size after which the log file is rotated
+    :param backup_count: number of rotated files to keep
+    :param console: log to stderr
+    :return: True if logging was configured by this call
+    '''
+    global _listener
+    with _logging_lock:
+        if _listener is not None:
+            return False
+
+        handlers = []
+        if console:
+            handler = logging.StreamHandler()
+            handler.setFormatter(
+                coloredlogs.ColoredFormatter(
+                    LOG_FORMAT, LOG_DATEFMT, level_styles=LEVEL_STYLES, field_styles=FIELD_STYLES
+                )
+            )
+            handlers.append(handler)
+        if log_file is None:
+            log_file = datetime.now().strftime('%F_%T') + '.log'
+        if log_file != '':
+            handler = logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=max_bytes, backupCount=backup_count, delay=True
+            )
+            handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATEFMT))
+            handlers.append(handler)
+
+        q = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(q)
+        queue_handler.addFilter(_DeviceFilter())
+        package_logger = logging.getLogger(__package__)
+        package_logger.addHandler(queue_handler)
+        package_logger.propagate = False  # no logging of libs
+
+        _listener = logging.handlers.QueueListener(q, *handlers)
+        _listener.start()
+        atexit.register(_listener.stop)
+        return True
+
+
+def get_logger(log_level, name=__name__, device=None):
     '''
     Colored logging
+    Logging is configured with setup_logging on the first call, afterwards this only sets the level.
+    The level of a device is set on its own child logger (name.device), so devices with different levels
+    don't change each other's logging.
 
     :param log_level:  'warning', 'info', 'debug'
     :param name: logger name (use __name__ variable)
-    :return: Logger
-    '''
-
-    fmt = '%(asctime)s %(threadName)-16s %(levelname)-8s %(message)s'
-    datefmt = '%Y-%m-%d %H:%M:%S'
-
-    fs = {
-        'asctime': {'color': 'green'},
-        'hostname': {'color': 'magenta'},
-        'levelname': {'color': 'red', 'bold': True},
-        'name': {'color': 'magenta'},
-        'programname': {'color': 'cyan'},
-        'username': {'color': 'yellow'},
-    }
-
-    ls = {
-        'critical': {'color': 'red', 'bold': True},
-        'debug': {'color': 'green'},
-        'error': {'color': 'red'},
-        'info': {},
-        'notice': {'color': 'magenta'},
-        'spam': {'color': 'green', 'faint': True},
-        'success': {'color': 'green', 'bold': True},
-        'verbose': {'color': 'blue'},
-        'warning': {'color': 'yellow'},
-    }
-
-    logger = logging.getLogger(name)
-
-    # log to file
-    now_str = datetime.now().strftime('%F_%T')
-    handler = logging.FileHandler(f'{now_str}.log')
-    formatter = logging.Formatter(fmt, datefmt)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-
-    # logger.propagate = False  # no logging of libs
-    coloredlogs.install(level=log_level, logger=logger, fmt=fmt, datefmt=datefmt, level_styles=ls, field_styles=fs)
-    return logger
-
-
-def progress_helper(t):
-    '''
-    returns progress function
+    :param device: add device (e.g. UDID) to every record of the returned logger
+    :return: Logger or LoggerAdapter
     '''
-    last_sent = [0]
-
-    def progress(filename, size, sent):
-        if isinstance(filename, bytes):
-            filename = filename.decode('utf-8')
-        t.desc = os.path.basename(filename)
-        t.total = size
-        displayed = t.update(sent - last_sent[0])
-        last_sent[0] = 0 if size == sent else sent
-        return displayed
-
-    return progress
+    setup_logging()
+    if device is None:
+        logger = logging.getLogger(name)
+        logger.setLevel(log_level.upper())
+        return logger
+    logger = logging.getLogger(f'{name}.{device}')
+    logger.setLevel(log_level.upper())
+    return logging.LoggerAdapter(logger, {'device': device})
+
+
+def default_position_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'ipadumper', 'positions.json')
 
 
 def free_port():
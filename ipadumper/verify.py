@@ -0,0 +1,247 @@
+# stdlib
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import io
+import json
+import mmap
+import multiprocessing
+import os
+import threading
+import time
+import zipfile
+
+# internal
+from ipadumper import macho
+from ipadumper.utils import get_logger
+
+
+# bytes of every Mach-O (and of every slice of a fat Mach-O) which are kept for parsing the load commands
+HEADER_SIZE = 65536
+CHUNK_SIZE = 2**20
+
+
+class _MappedFile(io.RawIOBase):
+    '''
+    File object for a mmap (mmap has no seekable() before Python 3.13, zipfile needs it)
+    '''
+
+    def __init__(self, mm):
+        self.mm = mm
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.mm.seek(offset, whence)
+        return self.mm.tell()
+
+    def tell(self):
+        return self.mm.tell()
+
+    def read(self, size=-1):
+        return self.mm.read(size)
+
+    def readinto(self, b):
+        data = self.mm.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+
+def _read_windows(f, windows, pos, size=HEADER_SIZE):
+    '''
+    Read a zip member to the end (which checks the CRC) and keep size bytes at each offset
+    f: file object of the member, pos bytes are already read
+    windows: dict offset -> bytearray with the bytes before pos, it is filled up to size bytes
+    return total size of the member
+    '''
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return pos
+        end_pos = pos + len(chunk)
+        for offset, window in windows.items():
+            start = offset + len(window)  # next missing byte
+            end = min(offset + size, end_pos)
+            if pos <= start < end:
+                window += chunk[start - pos : end - pos]
+        pos = end_pos
+
+
+def check_macho(name, head, f):
+    '''
+    Check all slices of a Mach-O inside an IPA
+    head: first HEADER_SIZE bytes of the member
+    f: file object of the member positioned after head
+    return list of errors (empty if the binary is complete) and list of still encrypted slices
+    '''
+    errors = []
+    encrypted = []
+    try:
+        slices = macho.fat_slices(head)
+    except ValueError as e:
+        return [f'{name}: {str(e)}'], encrypted
+    if len(slices) == 0:
+        slices = [(0, 0, 0, None)]
+
+    # collect the headers of all slices while the member is read to the end
+    windows = {offset: bytearray(head[offset : offset + HEADER_SIZE]) for _, _, offset, _ in slices}
+    total = _read_windows(f, windows, len(head))
+
+    for cputype, cpusubtype, offset, size in slices:
+        label = name if len(slices) == 1 else f'{name} (cputype {cputype:#x}/{cpusubtype:#x})'
+        size = total - offset if size is None else size
+        if offset + size > total:
+            errors.append(f'{label}: slice ends at {offset + size}, file has {total} bytes')
+            continue
+        try:
+            info = macho.encryption_info(bytes(windows[offset]))
+        except ValueError as e:
+            errors.append(f'{label}: {str(e)}')
+            continue
+        if info is None:
+            continue
+        cryptoff, cryptsize, cryptid, _ = info
+        if cryptid != 0:
+            encrypted.append(f'{label}: encrypted (cryptid {cryptid})')
+        if cryptoff + cryptsize > size:
+            errors.append(f'{label}: encrypted range ends at {cryptoff + cryptsize}, slice has {size} bytes')
+    return errors, encrypted
+
+
+def verify_ipa(path):
+    '''
+    Check an IPA: zip integrity (CRC of every member) and all Mach-Os decrypted and not truncated
+    Binaries of app extensions (*.appex) which are still encrypted are no error, the Frida dump can't decrypt
+    them (they never run in the process of the app). They are listed in encrypted_extensions.
+    Runs in a worker process, the file is read with mmap.
+    return dict with path, ok, errors, encrypted_extensions, sha256, size, binaries, seconds
+    '''
+    start = time.perf_counter()
+    result = {
+        'path': path,
+        'ok': False,
+        'errors': [],
+        'encrypted_extensions': [],
+        'sha256': None,
+        'size': 0,
+        'binaries': 0,
+    }
+    try:
+        with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            result['size'] = len(mm)
+            result['sha256'] = hashlib.sha256(mm).hexdigest()
+            with zipfile.ZipFile(_MappedFile(mm)) as zf:
+                names = zf.namelist()
+                if not any(n.startswith('Payload/') and '.app/' in n for n in names):
+                    result['errors'].append('no Payload/*.app in IPA')
+                for info in zf.infolist():
+                    if info.is_dir():
+                        continue
+                    with zf.open(info) as f:
+                        head = f.read(HEADER_SIZE)
+                        if macho.is_macho(head):
+                            result['binaries'] += 1
+                            errors, encrypted = check_macho(info.filename, head, f)
+                            result['errors'] += errors
+                            if '.appex/' in info.filename:
+                                result['encrypted_extensions'] += encrypted
+                            else:
+                                result['errors'] += encrypted
+                        else:
+                            while f.read(CHUNK_SIZE):
+                                pass
+    except (OSError, ValueError, zipfile.BadZipFile, EOFError) as e:
+        # BadZipFile: CRC mismatch or truncated archive, ValueError: empty file can't be mapped
+        result['errors'].append(f'{type(e).__name__}: {str(e)}')
+    result['ok'] = len(result['errors']) == 0
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+class Verifier:
+    '''
+    Verifies IPAs in a process pool so device work does not wait for it
+    Results of verified IPAs are appended to a catalog (JSON lines).
+
+        verifier = Verifier(catalog_path, on_result=callback)
+        verifier.submit(path, app)
+        verifier.wait()
+    '''
+
+    def __init__(self, catalog_path=None, workers=2, on_result=None, log_level='info'):
+        '''
+        catalog_path: JSON lines file with one entry per verified IPA (None: no catalog)
+        on_result: called with (result, info) in a thread of this process after an IPA was verified
+        '''
+        self.log = get_logger(log_level, name=__name__)
+        self.catalog_path = catalog_path
+        self.on_result = on_result
+        # spawn: forking a process with SSH and Frida threads is not safe
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.idle = threading.Condition(self.lock)
+
+    def submit(self, path, info={}):
+        '''
+        Verify IPA in the pool
+        info: added to the catalog entry and passed to on_result (e.g. itunes_id, bundleId)
+        '''
+        future = self.executor.submit(verify_ipa, os.path.abspath(path))
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(lambda f: self.__done(f, path, info))
+        return future
+
+    def __done(self, future, path, info):
+        try:
+            result = future.result()
+        except Exception as e:  # the worker process died
+            result = {'path': path, 'ok': False, 'errors': [f'{type(e).__name__}: {str(e)}'], 'seconds': 0}
+        if result['ok']:
+            self.log.info(f"{os.path.basename(result['path'])}: verified {result['binaries']} binaries")
+            if len(result.get('encrypted_extensions', [])) > 0:
+                extensions = '; '.join(result['encrypted_extensions'])
+                self.log.warning(f"{os.path.basename(result['path'])}: app extensions are encrypted: {extensions}")
+        else:
+            self.log.error(f"{os.path.basename(result['path'])}: verification failed: {'; '.join(result['errors'])}")
+
+        try:
+            if result['ok'] and self.catalog_path is not None:
+                entry = {
+                    **info,
+                    'file': os.path.basename(result['path']),
+                    'sha256': result['sha256'],
+                    'size': result['size'],
+                    'binaries': result['binaries'],
+                    'verified': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                }
+                if len(result['encrypted_extensions']) > 0:
+                    entry['encrypted_extensions'] = result['encrypted_extensions']
+                with self.lock, open(self.catalog_path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+            if self.on_result is not None:
+                self.on_result(result, info)
+        finally:
+            with self.lock:
+                self.pending.discard(future)
+                self.idle.notify_all()
+
+    def busy(self):
+        with self.lock:
+            return len(self.pending) > 0
+
+    def wait(self, timeout=None):
+        '''
+        Wait until all submitted IPAs are verified
+        return True if nothing is pending
+        '''
+        with self.lock:
+            return self.idle.wait_for(lambda: len(self.pending) == 0, timeout=timeout)
+
+    def shutdown(self):
+        self.wait()
+        self.executor.shutdown()
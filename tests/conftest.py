@@ -0,0 +1,6 @@
+# internal
+from ipadumper.utils import setup_logging
+
+
+# no log file in the working directory
+setup_logging(log_file='')
@@ -0,0 +1,62 @@
+# stdlib
+import plistlib
+
+# external
+import paramiko
+import pytest
+
+# internal
+from ipadumper import simulator
+from ipadumper.containers import ContainerIndex
+from ipadumper.usbmux import Usbmux
+
+
+@pytest.fixture(scope='module')
+def sim():
+    with simulator.Simulator(apps=2, app_size_MiB=1, log_level='warning') as sim:
+        yield sim
+
+
+@pytest.fixture
+def index(sim):
+    usbmux = Usbmux(address=sim.environ()['USBMUXD_SOCKET_ADDRESS'][len('UNIX:') :])
+    sshclient = paramiko.SSHClient()
+    sshclient.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    sshclient.connect(
+        'localhost', username='root', key_filename=sim.client_key_path, sock=usbmux.connect(usbmux.device(), 22)
+    )
+    yield ContainerIndex(sshclient, log_level='warning')
+    sshclient.close()
+
+
+def test_reinstalled_app_moves_container(sim, index):
+    device = sim.devices[sim.udid]
+    app = list(sim.catalogue.values())[0]
+    old_path = device.install_now(app)
+    old = index.get(app.bundleId)
+    assert index.path(app.bundleId) == old_path
+
+    device.uninstall(app.bundleId)
+    new_path = device.install_now(app)
+    new = index.get(app.bundleId)
+    assert new.uuid != old.uuid
+    assert index.container_path(new) == new_path
+
+    device.uninstall(app.bundleId)
+    assert index.get(app.bundleId) is None
+
+
+def test_updated_app_in_place(sim, index):
+    device = sim.devices[sim.udid]
+    app = list(sim.catalogue.values())[1]
+    path = device.install_now(app)
+    container = index.get(app.bundleId)
+    assert container.version == app.version
+
+    info_path = device.path(f'{path}/{container.app_dir}/Info.plist')
+    with open(info_path, 'rb') as f:
+        info = plistlib.load(f)
+    info['CFBundleShortVersionString'] = '2.0'
+    with open(info_path, 'wb') as f:
+        plistlib.dump(info, f)
+    assert index.get(app.bundleId) == container._replace(version='2.0')
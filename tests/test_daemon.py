@@ -0,0 +1,94 @@
+# stdlib
+import sys
+import types
+
+# external
+import pytest
+
+# internal
+from ipadumper import daemon, main, transfers
+from ipadumper.daemon import Daemon, Session
+
+
+class FakeAppleDL:
+    '''
+    Warm session without a device, records the state of the daemon while a job runs
+    '''
+
+    def __init__(self):
+        self.device_label = 'phone'
+        self.core = types.SimpleNamespace(transfer_bus='hub1')
+        self.metrics_textfile = None
+        self.running = True
+        self.seen = []
+
+    def bulk_decrypt(self, itunes_ids, **kwargs):
+        scheduler = transfers.SCHEDULER
+        self.seen.append(
+            {
+                'device_rate': scheduler.devices[self.device_label].rate,
+                'bus_rate': scheduler.buses[self.core.transfer_bus].rate,
+                'metrics_textfile': self.metrics_textfile,
+            }
+        )
+        return True
+
+    def cleanup(self):
+        self.running = False
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    a = FakeAppleDL()
+
+    def create(self):
+        self.a = a
+
+    monkeypatch.setattr(Session, 'create', create)
+    monkeypatch.setattr(Session, 'warm', lambda self: True)
+    return a
+
+
+@pytest.fixture
+def socket_path(tmp_path, fake):
+    path = str(tmp_path / 'daemon.sock')
+    d = Daemon(path, udids=['phone'], log_level='warning')
+    assert d.start()
+    yield path
+    d.stop()
+
+
+def run_main(monkeypatch, socket_path, argv):
+    monkeypatch.setattr(sys, 'argv', ['ipadumper', '--log_file', '', '--socket', socket_path] + argv)
+    with pytest.raises(SystemExit) as e:
+        main.main()
+    return e.value.code
+
+
+def test_options_reach_daemon(monkeypatch, tmp_path, fake, socket_path):
+    served = []
+    start_http_server = daemon.metrics.start_http_server
+
+    def serve(port):
+        served.append(port)
+        return start_http_server(port)
+
+    monkeypatch.setattr(daemon.metrics, 'start_http_server', serve)
+    ids = tmp_path / 'ids.txt'
+    ids.write_text('')
+    argv = ['bulk_decrypt', str(ids), str(tmp_path / 'out'), '--udid', 'phone']
+    options = ['--bus_MiBps', '8', '--device_MiBps', '2', '--metrics_textfile', 'metrics.prom', '--metrics_port', '0']
+    monkeypatch.chdir(tmp_path)
+    assert run_main(monkeypatch, socket_path, argv + options) == 0
+    assert fake.seen == [
+        {'device_rate': 2 * 2**20, 'bus_rate': 8 * 2**20, 'metrics_textfile': str(tmp_path / 'metrics.prom')}
+    ]
+    assert served == [0]
+    # the options only apply while the job runs
+    assert transfers.SCHEDULER.devices['phone'].rate is None
+    assert transfers.SCHEDULER.buses['hub1'].rate is None
+    assert fake.metrics_textfile is None
+
+    # a job without options keeps the ones of the daemon
+    assert run_main(monkeypatch, socket_path, argv) == 0
+    assert fake.seen[-1] == {'device_rate': None, 'bus_rate': None, 'metrics_textfile': None}
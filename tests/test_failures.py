@@ -0,0 +1,154 @@
+# stdlib
+import json
+import socket
+import subprocess
+
+# external
+import pytest
+
+# internal
+from ipadumper import failures
+from ipadumper.failures import DeadLetters, Result, Retrier, RetryPolicy, classify_exception, fail, ok
+from ipadumper.ingest import Entry, parse_line
+
+
+# exceptions named like the ones of Frida, paramiko and requests
+class TransportError(Exception):
+    pass
+
+
+class ProcessNotFoundError(Exception):
+    pass
+
+
+class ReadTimeout(OSError):
+    pass
+
+
+class SSHException(Exception):
+    pass
+
+
+class NoValidConnectionsError(SSHException):
+    pass
+
+
+@pytest.mark.parametrize(
+    'exception, failure',
+    [
+        (TransportError('connection closed'), failures.TRANSIENT),
+        (NoValidConnectionsError('port 22'), failures.TRANSIENT),
+        (ConnectionResetError(), failures.TRANSIENT),
+        (EOFError(), failures.TRANSIENT),
+        (ProcessNotFoundError('pid 42'), failures.CRASHED),
+        (ReadTimeout(), failures.TIMEOUT),
+        (socket.timeout(), failures.TIMEOUT),
+        (subprocess.CalledProcessError(1, 'zip'), failures.ERROR),
+        (KeyError('bundleId'), failures.ERROR),
+    ],
+)
+def test_classify_exception(exception, failure):
+    assert classify_exception(exception) == failure
+
+
+def test_retry_policy_backoff():
+    policy = RetryPolicy(4, 2, factor=3, max_backoff=30)
+    assert [policy.delay(retry) for retry in range(1, 5)] == [2, 6, 18, 30]
+
+
+class Attempts:
+    '''
+    Stage which returns or raises the queued outcomes, records the calls of it and of recover
+    '''
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def __call__(self):
+        self.calls.append('run')
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def recover(self, result):
+        self.calls.append(('recover', result.failure))
+
+
+def retrier(**policies):
+    sleeps = []
+    r = Retrier(policies=policies, log_level='warning', sleep=sleeps.append)
+    return r, sleeps
+
+
+@pytest.mark.parametrize('failure', failures.CLASSES)
+def test_failure_classes_use_their_policy(failure):
+    r, sleeps = retrier()
+    policy = failures.DEFAULT_POLICIES[failure]
+    stage = Attempts(*[fail(failure, 'failed')] * (policy.attempts + 1))
+    result = r.run('dump', stage, recover=stage.recover)
+    assert result.failure == failure and result.stage == 'dump'
+    assert result.attempts == policy.attempts + 1
+    assert stage.calls.count('run') == policy.attempts + 1
+    assert sleeps == [policy.delay(retry) for retry in range(1, policy.attempts + 1)]
+    assert r.retries.get(failure, 0) == policy.attempts
+
+
+def test_recover_between_attempts():
+    r, sleeps = retrier(transient=RetryPolicy(3, 1))
+    stage = Attempts(TransportError('device lost'), fail(failures.TRANSIENT, 'ssh'), True)
+    result = r.run('install', stage, recover=stage.recover, label='com.app')
+    assert result and result.attempts == 3
+    assert stage.calls == ['run', ('recover', 'transient'), 'run', ('recover', 'transient'), 'run']
+    assert sleeps == [1, 2]
+
+
+def test_attempts_are_bounded_by_policy_of_last_failure():
+    # the retries of all classes count, a crash after a transient failure gets one more retry
+    r, _ = retrier(transient=RetryPolicy(3), crashed=RetryPolicy(2))
+    stage = Attempts(TransportError(), ProcessNotFoundError(), ProcessNotFoundError(), True)
+    result = r.run('dump', stage)
+    assert result.failure == failures.CRASHED and result.attempts == 3
+    assert r.retries == {failures.TRANSIENT: 1, failures.CRASHED: 1}
+
+
+def test_no_retry_on_error():
+    r, sleeps = retrier()
+    stage = Attempts(KeyError('bundleId'))
+    result = r.run('dump', stage, recover=stage.recover)
+    assert result.failure == failures.ERROR and result.message == "KeyError: 'bundleId'"
+    assert stage.calls == ['run'] and sleeps == []
+    # plain bools are results too
+    assert r.run('dump', lambda: True)
+    assert r.run('dump', lambda: False).failure == failures.ERROR
+
+
+def test_dead_letter_after_retries(tmp_path):
+    path = str(tmp_path / 'dead_letters.jsonl')
+    dead_letters = DeadLetters(path)
+    r, _ = retrier(timeout=RetryPolicy(2))
+    app = {'itunes_id': 123, 'country': 'de', 'bundleId': 'com.app', 'version': '1.0', 'fileSizeMiB': 10}
+    result = r.run('dump', Attempts(*[fail(failures.TIMEOUT, 'no reply')] * 3))
+    assert not result
+    dead_letters.add(app, result)
+    dead_letters.add({'itunes_id': 456}, fail(failures.NOT_FREE, 'price 0.99', 'install'))
+
+    with open(path) as f:
+        lines = f.readlines()
+    entry = json.loads(lines[0])
+    assert entry['itunes_id'] == 123 and entry['country'] == 'de' and entry['bundleId'] == 'com.app'
+    assert (entry['failure'], entry['message'], entry['stage'], entry['attempts']) == ('timeout', 'no reply', 'dump', 3)
+    assert 'fileSizeMiB' not in entry
+    assert len(dead_letters) == 2
+    assert dead_letters.counts() == {failures.TIMEOUT: 1, failures.NOT_FREE: 1}
+    # the file can be fed to bulk_decrypt again
+    assert [parse_line(line) for line in lines] == [Entry(123, 'de'), Entry(456)]
+
+
+def test_result():
+    assert ok() and repr(ok()) == 'Result(ok)'
+    assert failures.as_result(True, 'scp').stage == 'scp'
+    result = failures.as_result(fail(failures.CRASHED, 'gone'), 'dump')
+    assert not result and isinstance(result, Result) and result.stage == 'dump'
+    assert result.as_dict() == {'failure': 'crashed', 'message': 'gone', 'stage': 'dump'}
@@ -0,0 +1,52 @@
+# external
+import pytest
+
+# internal
+from ipadumper import simulator
+from ipadumper.fridasession import FridaSession
+
+
+@pytest.fixture(scope='module')
+def sim():
+    with simulator.Simulator(apps=2, app_size_MiB=1, log_level='warning') as sim:
+        for app in sim.catalogue.values():
+            sim.devices[sim.udid].install_now(app)
+        yield sim
+
+
+@pytest.fixture
+def apps(sim):
+    return [app.bundleId for app in sim.catalogue.values()]
+
+
+def test_reattach_to_running_app(sim, apps):
+    frida_session = FridaSession(sim.frida_device(), log_level='warning')
+    session, pid, spawned = frida_session.open(apps[0])
+    assert spawned
+    session.detach()
+    session, cached_pid, spawned = frida_session.open(apps[0])
+    assert (cached_pid, spawned) == (pid, False)
+
+
+def test_reused_pid_is_not_attached(sim, apps):
+    frida_device = sim.frida_device()
+    frida_session = FridaSession(frida_device, log_level='warning')
+    session, pid, _ = frida_session.open(apps[0])
+    session.detach()
+    # the app exited and its pid was reused by another app
+    frida_device.processes[pid] = apps[1]
+    session, new_pid, spawned = frida_session.open(apps[0])
+    assert spawned and new_pid != pid
+    assert frida_session.pid(apps[0]) == new_pid
+
+
+def test_kill_forgets_pid(sim, apps):
+    frida_device = sim.frida_device()
+    frida_session = FridaSession(frida_device, log_level='warning')
+    session, pid, _ = frida_session.open(apps[0])
+    session.detach()
+    frida_session.kill(apps[0], pid)
+    assert frida_session.pid(apps[0]) is None
+    assert pid not in frida_device.processes
+    # killing an app which is already gone is not an error
+    frida_session.kill(apps[0], pid)
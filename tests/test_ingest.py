@@ -0,0 +1,114 @@
+# stdlib
+import json
+import time
+
+# external
+import pytest
+
+# internal
+from ipadumper.ingest import Deduper, Entry, Feed, Lease, parse_line, read_entries
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_parse_line():
+    assert parse_line('') is None
+    assert parse_line('   \n') is None
+    assert parse_line('# apps of the week') is None
+    assert parse_line('123456789\n') == Entry(123456789, None, 0)
+    assert parse_line('id123456789 # from the store URL') == Entry(123456789, None, 0)
+    assert parse_line('123456789 DE 5') == Entry(123456789, 'de', 5)
+    assert parse_line('123456789,-1,us') == Entry(123456789, 'us', -1)
+    assert parse_line('{"itunes_id": 1, "country": "jp", "priority": 2}') == Entry(1, 'jp', 2)
+    assert parse_line('{"trackId": "2", "bundleId": "com.app"}') == Entry(2, None, 0)
+    for line in ['com.app.name', '123 germany', '{"country": "de"}']:
+        with pytest.raises(ValueError):
+            parse_line(line)
+
+
+def test_read_entries_skips_invalid_lines():
+    lines = ['1\n', '\n', '# comment\n', 'invalid\n', '{"itunes_id": 2\n', '3 fr\n']
+    assert list(read_entries(lines, log_level='warning')) == [Entry(1), Entry(3, 'fr')]
+
+
+def test_deduper_seeds_from_names_and_catalog(tmp_path):
+    (tmp_path / '111_com.app.one_1.0.ipa').write_bytes(b'')
+    (tmp_path / 'notes.txt').write_text('')
+    with open(tmp_path / 'catalog.jsonl', 'w') as f:
+        f.write(json.dumps({'itunes_id': 222, 'bundleId': 'com.app.two'}) + '\n')
+        f.write('not json\n')
+        f.write(json.dumps({'bundleId': 'com.app.three'}) + '\n')
+
+    deduper = Deduper()
+    assert deduper.seed(str(tmp_path)) == 2
+    assert deduper.seen(111) and deduper.seen(222)
+    assert not deduper.seen(333)
+    assert deduper.seen(333)
+
+    # names of a sink replace the listing of the output directory, the catalog is still read
+    deduper = Deduper()
+    assert deduper.seed(str(tmp_path), names=['444_com.app.four_2.0.ipa']) == 2
+    assert deduper.seen(444) and deduper.seen(222)
+    assert not deduper.seen(111)
+
+    assert Deduper().seed(str(tmp_path / 'missing')) == 0
+
+
+def test_deduper_grows():
+    deduper = Deduper(capacity=10)
+    assert not any(deduper.seen(i) for i in range(100))
+    assert len(deduper.filters) > 1
+    assert all(deduper.seen(i) for i in range(100))
+
+
+def test_feed_is_bounded_to_window():
+    pulled = []
+
+    def entries():
+        for i in range(100):
+            pulled.append(i)
+            yield Entry(i)
+
+    feed = Feed(entries(), window=5, log_level='warning')
+    try:
+        wait_until(lambda: len(pulled) == 6)
+        time.sleep(0.05)
+        # the reader waits with the 6th entry until there is room
+        assert len(pulled) == 6 and len(feed.heap) == 5
+        assert feed.get(timeout=1) == Entry(0)
+        wait_until(lambda: len(pulled) == 7)
+        assert len(feed.heap) == 5
+    finally:
+        feed.close()
+
+
+def test_feed_priority_and_duplicates():
+    deduper = Deduper()
+    deduper.seen(2)
+    feed = Feed(iter([Entry(1), Entry(2), Entry(3, priority=5), Entry(1)]), deduper=deduper, log_level='warning')
+    wait_until(lambda: feed.exhausted)
+    assert [feed.get(), feed.get()] == [Entry(3, priority=5), Entry(1)]
+    assert feed.get() is None and feed.done()
+    assert (feed.read, feed.duplicates) == (4, 2)
+
+
+def test_drained_lease_gives_entries_back():
+    feed = Feed(iter([Entry(1), Entry(2), Entry(3)]), log_level='warning')
+    wait_until(lambda: feed.exhausted)
+    first, second = Lease(feed), Lease(feed)
+    taken = [first.get(), first.get()]
+    assert taken == [Entry(1), Entry(2)] and first.read == 2
+
+    first.drain()
+    assert first.get() is None and first.done() and not first.ready()
+    # the entry which was not started goes to the other consumer before the unread ones
+    first.requeue(taken[1])
+    assert first.read == 1
+    assert second.get() == Entry(2)
+    assert second.get() == Entry(3)
+    assert second.get() is None and second.done()
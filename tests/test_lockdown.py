@@ -0,0 +1,126 @@
+# stdlib
+import socket
+import threading
+import time
+
+# external
+import pytest
+
+# internal
+from ipadumper import simulator
+from ipadumper.lockdown import InstallationProxy, Lockdown, LockdownError
+from ipadumper.usbmux import Usbmux
+
+
+@pytest.fixture(scope='module')
+def sim():
+    with simulator.Simulator(apps=3, app_size_MiB=1, log_level='warning') as sim:
+        yield sim
+
+
+def sim_usbmux(sim):
+    return Usbmux(address=sim.environ()['USBMUXD_SOCKET_ADDRESS'][len('UNIX:') :])
+
+
+@pytest.fixture
+def lockdown(sim):
+    lockdown = Lockdown(sim.udid, usbmux=sim_usbmux(sim), timeout=0.5, log_level='warning')
+    lockdown.connect()
+    yield lockdown
+    lockdown.close()
+
+
+def hang_once(monkeypatch, handler, method):
+    '''
+    Let the first call of the handler method of the simulator hang (like a stuck lockdownd)
+    '''
+    original = getattr(handler, method)
+    hung = threading.Event()
+
+    def patched(self, request):
+        if not hung.is_set():
+            hung.set()
+            time.sleep(2)
+            return None if method == 'command' else {}
+        return original(self, request)
+
+    monkeypatch.setattr(handler, method, patched)
+    return hung
+
+
+def test_get_value(lockdown, sim):
+    assert lockdown.session_id is not None
+    assert lockdown.get_value('ProductVersion') == '14.4'
+    assert lockdown.get_value('UniqueDeviceID') == sim.udid
+    with pytest.raises(LockdownError):
+        lockdown.get_value('NoSuchKey')
+
+
+def test_unknown_device(sim):
+    with pytest.raises(LockdownError):
+        Lockdown('no-such-udid', usbmux=sim_usbmux(sim), log_level='warning').connect()
+
+
+def test_browse_lookup_uninstall(lockdown, sim):
+    device = sim.devices[sim.udid]
+    apps = list(sim.catalogue.values())[:2]
+    for app in apps:
+        device.install_now(app)
+    proxy = InstallationProxy(lockdown, log_level='warning')
+    try:
+        installed = {app['CFBundleIdentifier']: app for app in proxy.browse()}
+        assert {app.bundleId for app in apps} <= set(installed)
+        assert installed[apps[0].bundleId]['CFBundleVersion'] == apps[0].version
+
+        assert set(proxy.lookup([apps[1].bundleId, 'com.not.installed'])) == {apps[1].bundleId}
+
+        progress = []
+        proxy.uninstall(apps[1].bundleId, progress=lambda percent, status: progress.append(percent))
+        assert progress == [10, 50]
+        assert device.app_path(apps[1].bundleId) is None
+        with pytest.raises(LockdownError):
+            proxy.uninstall(apps[1].bundleId)
+    finally:
+        proxy.close()
+
+
+def test_hung_lockdownd_reconnects(lockdown, monkeypatch):
+    hung = hang_once(monkeypatch, simulator.LockdownHandler, 'reply')
+    start = time.time()
+    assert lockdown.get_value('DeviceName') == 'Simulated'
+    assert hung.is_set()
+    assert time.time() - start < 2
+
+
+def test_hung_installation_proxy_reconnects(lockdown, sim, monkeypatch):
+    sim.devices[sim.udid].install_now(list(sim.catalogue.values())[2])
+    proxy = InstallationProxy(lockdown, log_level='warning')
+    try:
+        hung = hang_once(monkeypatch, simulator.InstallationProxyHandler, 'command')
+        start = time.time()
+        assert proxy.browse()
+        assert hung.is_set()
+        assert time.time() - start < 2
+    finally:
+        proxy.close()
+
+
+def test_hung_installation_proxy_times_out(lockdown, monkeypatch):
+    monkeypatch.setattr(simulator.InstallationProxyHandler, 'command', lambda self, request: time.sleep(2))
+    proxy = InstallationProxy(lockdown, log_level='warning')
+    try:
+        start = time.time()
+        with pytest.raises(socket.timeout):
+            proxy.browse()
+        assert time.time() - start < 2
+    finally:
+        proxy.close()
+
+
+def test_usbmux_connect_timeout(sim):
+    usbmux = sim_usbmux(sim)
+    s = usbmux.connect(usbmux.device(sim.udid), 62078, timeout=0.5)
+    try:
+        assert s.gettimeout() == 0.5
+    finally:
+        s.close()
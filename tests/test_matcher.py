@@ -0,0 +1,106 @@
+# stdlib
+import json
+
+# external
+import pytest
+
+# internal
+from ipadumper import matcher
+from ipadumper.matcher import PositionCache, np
+
+
+def test_set_keeps_newer_positions_in_file(tmp_path):
+    path = str(tmp_path / 'positions.json')
+    PositionCache(path).set('phone/get', (10, 10))
+    # both caches loaded the same file, a keeps a stale copy of the position b moves
+    a, b = PositionCache(path), PositionCache(path)
+    b.set('phone/get', (100, 100))
+    a.set('phone/install', (50, 50))
+    with open(path) as f:
+        assert json.load(f) == {'phone/get': [100, 100], 'phone/install': [50, 50]}
+    assert a.get('phone/get') == (100, 100)
+
+
+needs_numpy = pytest.mark.skipif(not matcher.available(), reason='numpy and Pillow are not installed')
+
+# template name -> (width, height) of the generated buttons
+SIZES = {'dissallow': (64, 32), 'get': (48, 24), 'cloud': (24, 24), 'install': (64, 24)}
+
+
+def blocky_noise(rng, width, height, block=4):
+    '''
+    return random grayscale pattern of block x block cells, stays the same when scaled by 0.5
+    '''
+    cells = rng.integers(0, 256, size=(height // block, width // block), dtype=np.uint8)
+    return np.kron(cells, np.ones((block, block), dtype=np.uint8))
+
+
+@pytest.fixture
+def templates(tmp_path):
+    '''
+    return image directory with random templates and the templates as arrays
+    '''
+    rng = np.random.default_rng(1)
+    arrays = {}
+    for name, path in matcher.TEMPLATES.items():
+        arrays[name] = blocky_noise(rng, *SIZES[name])
+        path = tmp_path / 'images' / 'dark' / path.format(lang='en')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        matcher.Image.fromarray(arrays[name]).save(path)
+    return str(tmp_path / 'images'), arrays
+
+
+def screen(templates={}, seed=2):
+    '''
+    return 320x480 screenshot with the templates (name -> (array, (x, y) of the top left corner)) pasted in
+    '''
+    img = blocky_noise(np.random.default_rng(seed), 320, 480, block=8) // 4 + 96
+    for t, (x, y) in templates.values():
+        img[y : y + t.shape[0], x : x + t.shape[1]] = t
+    return matcher.Image.fromarray(img)
+
+
+@needs_numpy
+def test_classify(templates):
+    path, arrays = templates
+    m = matcher.ScreenMatcher(path, log_level='warning')
+    state, xy = m.classify(screen({'get': (arrays['get'], (200, 400))}))
+    assert state == 'get'
+    assert xy == (200 + 24, 400 + 12)
+    score, _ = m.match(screen({'get': (arrays['get'], (200, 400))}), ['get'])['get']
+    assert score == pytest.approx(1, abs=0.01)
+
+    # dissallow wins over get
+    both = {'get': (arrays['get'], (200, 400)), 'dissallow': (arrays['dissallow'], (40, 200))}
+    assert m.classify(screen(both)) == ('dissallow', (40 + 32, 200 + 16))
+
+    assert m.classify(screen()) == (matcher.STATE_LOADING, None)
+    # only the relevant templates are matched
+    assert m.classify(screen(both), names=['cloud', 'install']) == (matcher.STATE_LOADING, None)
+
+
+@needs_numpy
+def test_classify_with_position_cache(templates, monkeypatch):
+    path, arrays = templates
+    cache = PositionCache()
+    m = matcher.ScreenMatcher(path, position_cache=cache, roi_margin=16, log_level='warning')
+    shapes = []
+    ncc = matcher._ncc
+    monkeypatch.setattr(matcher, '_ncc', lambda img, *args: shapes.append(img.shape) or ncc(img, *args))
+
+    assert m.classify(screen({'get': (arrays['get'], (200, 400))}), names=['get']) == ('get', (224, 412))
+    assert cache.get(cache.key((320, 480), 'dark', 'en', 'get')) == (224, 412)
+    assert shapes == [(240, 160)]
+
+    # the next screenshot is only searched around the cached position
+    shapes.clear()
+    assert m.classify(screen({'get': (arrays['get'], (202, 398))}, seed=3), names=['get']) == ('get', (226, 410))
+    assert shapes == [((24 + 2 * 16) // 2, (48 + 2 * 16) // 2)]
+    assert cache.stats()['get'] == (1, 0, 1.0)
+
+    # the button moved out of the region, the whole screen is searched and the new position is cached
+    shapes.clear()
+    assert m.classify(screen({'get': (arrays['get'], (40, 100))}), names=['get']) == ('get', (64, 112))
+    assert len(shapes) == 2 and shapes[1] == (240, 160)
+    assert cache.stats()['get'] == (1, 1, 0.5)
+    assert cache.get(cache.key((320, 480), 'dark', 'en', 'get')) == (64, 112)
@@ -0,0 +1,53 @@
+# stdlib
+import json
+import random
+
+# internal
+from ipadumper import planner
+
+
+CONFIG = {
+    'default': {
+        'address': 'localhost',
+        'local_ssh_port': 0,
+        'ssh_key_filename': 'iphone',
+        'local_zxtouch_port': 0,
+        'image_base_path_device': '/private/var/mobile/Library/ZXTouch/scripts/appstoredownload.bdl',
+        'image_base_path_local': '',
+        'theme': 'dark',
+        'lang': 'en',
+        'timeout': 15,
+        'log_level': 'warning',
+        'country': 'us',
+        'parallel': 3,
+        'timeout_per_MiB': 0.5,
+        'output_directory': 'ipa_output',
+    },
+    'devices': [{'name': 'phone0', 'udid': 'udid0'}, {'name': 'phone1', 'udid': 'udid1'}],
+}
+
+
+def test_advance_finishes_tied_downloads():
+    model = planner.DeviceModel('phone0', planner.Timings(log_level='warning'), random.Random(0), download_MiBps=10)
+    app = planner.App(1, 100.0, 0.0, 'us', True)
+    model.waiting = [planner.Install(app, 100.0, 1.0), planner.Install(app, 100.0, 2.0)]
+    model.advance(20.0)
+    assert [i.remaining for i in model.waiting] == [0, 0]
+    assert [i.installed_at for i in model.waiting] == [21.0, 22.0]
+    assert model.next_install() == 21.0
+
+
+def test_plan_random_sizes_without_history(tmp_path):
+    rng = random.Random(1)
+    metadata = tmp_path / 'metadata.jsonl'
+    with open(metadata, 'w') as f:
+        for i in range(2000):
+            app = {'itunes_id': 1000000000 + i, 'fileSizeMiB': rng.randint(20, 2000), 'price': 0, 'country': 'us'}
+            f.write(json.dumps(app) + '\n')
+    config = tmp_path / 'config.json'
+    config.write_text(json.dumps(CONFIG))
+
+    report = planner.plan(str(metadata), str(config), log_level='warning')
+    assert report['apps'] == 2000
+    assert sum(report['outcomes'].values()) == 2000
+    assert len(planner.format_report(report)) > 0
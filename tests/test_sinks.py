@@ -0,0 +1,153 @@
+# stdlib
+from http.server import ThreadingHTTPServer
+import os
+import threading
+
+# external
+import pytest
+
+# internal
+from ipadumper import sinks
+from ipadumper.simulator import S3Handler
+
+
+PART_SIZE = 1024
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), S3Handler)
+    server.root = str(tmp_path / 's3')
+    server.min_part_size = PART_SIZE
+    os.makedirs(server.root)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sink(server):
+    return s3_sink(server)
+
+
+def s3_sink(server, prefix='dumps', **kwargs):
+    return sinks.S3Sink(
+        'ipas',
+        prefix,
+        endpoint_url=f'http://127.0.0.1:{server.server_address[1]}',
+        access_key='key',
+        secret_key='secret',
+        part_size=PART_SIZE,
+        retries=0,
+        log_level='warning',
+        **kwargs,
+    )
+
+
+def stored(server, name):
+    path = os.path.join(server.root, 'ipas', 'dumps', name)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def uploads(server):
+    directory = os.path.join(server.root, '.uploads')
+    return os.listdir(directory) if os.path.isdir(directory) else []
+
+
+def test_multipart_upload(server, sink):
+    data = os.urandom(5 * PART_SIZE - 120)
+    with sink.open('a.ipa') as writer:
+        for i in range(0, len(data), 700):
+            writer.write(data[i : i + 700])
+        assert writer.upload_id is not None
+    assert len(writer.parts) == 5
+    assert stored(server, 'a.ipa') == data
+    assert sink.size('a.ipa') == len(data)
+    assert uploads(server) == []
+
+
+def test_small_ipa_is_put(server, sink):
+    with sink.open('small.ipa') as writer:
+        writer.write(b'small')
+    assert writer.parts == []
+    assert stored(server, 'small.ipa') == b'small'
+
+
+def test_exception_aborts_upload(server, sink):
+    with pytest.raises(RuntimeError):
+        with sink.open('a.ipa') as writer:
+            writer.write(os.urandom(3 * PART_SIZE))
+            assert len(uploads(server)) == 1
+            raise RuntimeError('zip failed')
+    assert stored(server, 'a.ipa') is None
+    assert uploads(server) == []
+
+
+def test_aborted_writer(server, sink):
+    writer = sink.open('a.ipa')
+    writer.write(os.urandom(2 * PART_SIZE + 1))
+    writer.abort()
+    assert writer.upload_id is None
+    assert stored(server, 'a.ipa') is None
+    assert uploads(server) == []
+    # nothing was uploaded yet
+    writer = sink.open('b.ipa')
+    writer.write(b'data')
+    writer.abort()
+    assert stored(server, 'b.ipa') is None
+
+
+def test_failed_complete_aborts_upload(server, sink):
+    server.min_part_size = 4 * PART_SIZE  # parts are EntityTooSmall
+    with pytest.raises(sinks.SinkError, match='EntityTooSmall'):
+        with sink.open('a.ipa') as writer:
+            writer.write(os.urandom(3 * PART_SIZE))
+    assert stored(server, 'a.ipa') is None
+    assert uploads(server) == []
+
+
+def test_names_are_paginated(server):
+    sink = s3_sink(server, page_size=2)
+    names = [f'{i}.ipa' for i in range(5)]
+    for name in names:
+        with sink.open(name) as writer:
+            writer.write(name.encode('utf-8'))
+    with s3_sink(server, prefix='other').open('0.ipa') as writer:
+        writer.write(b'outside of the prefix')
+
+    requests = []
+    request = sink.request
+
+    def counting_request(method, key=None, params=None, **kwargs):
+        requests.append(dict(params or {}))
+        return request(method, key, params, **kwargs)
+
+    sink.request = counting_request
+    assert sorted(sink.names()) == names
+    assert len(requests) == 3
+    assert all(params['max-keys'] == 2 for params in requests)
+
+
+def test_content_addressed_symlink_replacement(tmp_path):
+    sink = sinks.ContentAddressedSink(str(tmp_path))
+    for data in (b'first dump', b'second dump'):
+        with sink.open('a.ipa') as writer:
+            writer.write(data)
+        path = os.path.join(str(tmp_path), 'a.ipa')
+        assert os.path.islink(path)
+        with open(path, 'rb') as f:
+            assert f.read() == data
+    # the same IPA under another name shares the object
+    with sink.open('b.ipa') as writer:
+        writer.write(b'second dump')
+    assert os.readlink(os.path.join(str(tmp_path), 'b.ipa')) == os.readlink(path)
+    objects = [name for _, _, names in os.walk(sink.objects) for name in names]
+    assert len(objects) == 2
+    assert sorted(sink.names()) == ['a.ipa', 'b.ipa']
+    # no temporary files or links are left
+    assert sorted(os.listdir(str(tmp_path))) == ['a.ipa', 'b.ipa', 'objects']
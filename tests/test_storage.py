@@ -0,0 +1,60 @@
+# internal
+from ipadumper.storage import StorageBudget
+
+
+DF = 'Filesystem 1024-blocks Used Available Capacity Mounted on\n/dev/disk0s1s2 62000000 1000000 {} 2% /private/var\n'
+
+
+class FakeDF:
+    '''
+    ssh_cmd which answers df with the queued outputs (None: garbage)
+    '''
+
+    def __init__(self, *free_MiB):
+        self.outputs = list(free_MiB)
+        self.calls = 0
+
+    def __call__(self, cmd):
+        self.calls += 1
+        free = self.outputs.pop(0)
+        if free is None:
+            return 1, '', 'df: connection reset'
+        return 0, DF.format(free * 1024), ''
+
+
+def test_failed_read_keeps_last_value_and_retries():
+    ssh_cmd = FakeDF(4096, None, 2048)
+    storage = StorageBudget(ssh_cmd, headroom_MiB=1024, max_age=60)
+    assert storage.free_MiB() == 4096
+    assert storage.free_MiB(refresh=True) == 4096
+    assert not storage.disabled
+    # the failed read is not cached
+    assert storage.free_MiB() == 2048
+    assert ssh_cmd.calls == 3
+    assert storage.failures == 0
+
+
+def test_unknown_free_space_admits():
+    storage = StorageBudget(FakeDF(None, 4096, 4096), headroom_MiB=1024, max_age=60)
+    assert storage.reserve('a', 100000)
+    assert storage.available_MiB(refresh=True) == 4096 - storage.reserved_MiB() - 1024
+    assert not storage.reserve('b', 1000)
+
+
+def test_repeated_failures_disable_admission():
+    ssh_cmd = FakeDF(None, None, None)
+    storage = StorageBudget(ssh_cmd, max_failures=3)
+    for _ in range(3):
+        assert storage.free_MiB(refresh=True) is None
+    assert storage.disabled
+    assert storage.free_MiB(refresh=True) is None
+    assert ssh_cmd.calls == 3
+
+
+def test_release_reads_again():
+    ssh_cmd = FakeDF(3000, 5000)
+    storage = StorageBudget(ssh_cmd, install_factor=2.0, dump_factor=1.0, headroom_MiB=0, max_age=60)
+    assert storage.reserve('a', 500)
+    assert storage.available_MiB() == 1500
+    storage.release('a')
+    assert storage.available_MiB() == 5000
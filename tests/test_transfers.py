@@ -0,0 +1,147 @@
+# stdlib
+import threading
+import time
+
+# external
+import pytest
+
+# internal
+from ipadumper import transfers
+from ipadumper.transfers import Bucket, TransferScheduler
+
+
+CHUNK = 4096
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(transfers.time, 'monotonic', clock)
+    return clock
+
+
+def test_bucket(clock):
+    bucket = Bucket(rate=1000)
+    assert bucket.burst == 250
+    assert bucket.delay(clock()) == 0
+    bucket.take(750)
+    # 500 bytes are missing, they are refilled in 0.5s
+    assert bucket.delay(clock()) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.delay(clock()) == 0
+    # tokens never exceed the burst
+    clock.now += 100
+    bucket.delay(clock())
+    assert bucket.tokens == 250
+
+    unlimited = Bucket()
+    unlimited.take(10**9)
+    assert unlimited.delay(clock()) == 0
+
+
+def send(scheduler, device, nbytes, bus='host', log=None, start=None):
+    '''
+    Send nbytes in chunks through the scheduler
+    log: list of (time, device, bytes sent so far) after every chunk
+    '''
+    if start is not None:
+        start.wait()
+    with scheduler.transfer(device, bus) as t:
+        while t.bytes < nbytes:
+            t.consume(min(CHUNK, nbytes - t.bytes))
+            if log is not None:
+                log.append((time.monotonic(), device, t.bytes))
+    return t
+
+
+def timed(func, *args, **kwargs):
+    start = time.monotonic()
+    func(*args, **kwargs)
+    return time.monotonic() - start
+
+
+def parallel(*jobs):
+    '''
+    Run send jobs (args) at the same time
+    return seconds until all are done
+    '''
+    start = threading.Barrier(len(jobs))
+    threads = [threading.Thread(target=lambda a=a: send(*a, start=start)) for a in jobs]
+    begin = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.monotonic() - begin
+
+
+def test_device_limit():
+    scheduler = TransferScheduler(device_rate=400000)
+    # the burst (a quarter of the rate) goes out at once, the rest at the rate
+    seconds = timed(send, scheduler, 'a', 200000)
+    assert 0.2 < seconds < 0.5
+    assert scheduler.stats() == (200000, 0)
+    # another device has its own budget
+    scheduler.set_limit(device='b', rate=800000)
+    assert 0.2 < timed(send, scheduler, 'b', 400000) < 0.5
+
+
+def test_bus_limit():
+    scheduler = TransferScheduler(bus_rate=400000)
+    # two devices on the same bus share its budget, another bus has its own
+    seconds = parallel((scheduler, 'a', 100000, 'hub1'), (scheduler, 'b', 100000, 'hub1'))
+    assert 0.2 < seconds < 0.5
+    scheduler = TransferScheduler(bus_rate=400000)
+    seconds = parallel((scheduler, 'c', 100000, 'hub1'), (scheduler, 'd', 100000, 'hub2'))
+    assert seconds < 0.15
+
+
+def test_set_limit_none_removes_limit():
+    scheduler = TransferScheduler()
+    scheduler.set_limit(device='a', rate=1000)
+    scheduler.set_limit(bus='hub1', rate=1000)
+    with scheduler.transfer('a', 'host') as t:
+        assert scheduler.throttled(t)
+    scheduler.set_limit(device='a', rate=None)
+    with scheduler.transfer('a', 'host') as t:
+        assert not scheduler.throttled(t)
+    assert timed(send, scheduler, 'a', 10**6) < 0.2
+    scheduler.set_limit(bus='hub1', rate=None)
+    assert timed(send, scheduler, 'b', 10**6, 'hub1') < 0.2
+
+    # configure replaces the defaults and the limits of single devices
+    scheduler.configure(device_rate=1000)
+    with scheduler.transfer('a', 'host') as t:
+        assert scheduler.throttled(t)
+
+
+def fair_share(scheduler, nbytes, rate=800000):
+    '''
+    Send nbytes from devices a and b on one bus with rate at the same time
+    return bytes per device when the first one finished
+    '''
+    # without a burst neither device gets ahead before the other one starts
+    scheduler.buses['hub1'] = Bucket(rate, burst=CHUNK)
+    log = []
+    parallel((scheduler, 'a', nbytes, 'hub1', log), (scheduler, 'b', nbytes, 'hub1', log))
+    first = min((t for t, _, sent in log if sent == nbytes))
+    return {device: max(sent for t, d, sent in log if d == device and t <= first) for device in ('a', 'b')}
+
+
+def test_devices_on_a_bus_get_fair_shares():
+    sent = fair_share(TransferScheduler(), 200000)
+    assert min(sent.values()) >= 200000 * 0.8
+
+
+def test_weights():
+    sent = fair_share(TransferScheduler(weights={'a': 3}), 200000)
+    assert sent['a'] == 200000
+    assert 200000 / 3 * 0.7 < sent['b'] < 200000 / 3 * 1.5
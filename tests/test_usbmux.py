@@ -0,0 +1,137 @@
+# stdlib
+import plistlib
+import socket
+import socketserver
+import threading
+
+# external
+import pytest
+
+# internal
+from ipadumper import usbmux
+from ipadumper.usbmux import Device, Usbmux, UsbmuxError
+
+
+DEVICES = [
+    {'DeviceID': 3, 'Properties': {'SerialNumber': 'aaaa', 'ConnectionType': 'Network'}},
+    {'DeviceID': 5, 'Properties': {'SerialNumber': '00008030001A2B3C4D5E6F70', 'ConnectionType': 'USB'}},
+    {'DeviceID': 7, 'Properties': {'SerialNumber': '0123456789abcdef0123456789abcdef01234567'}},
+]
+PORTS = {5: {22}}  # device id -> open ports
+
+
+class FakeUsbmuxd(socketserver.StreamRequestHandler):
+    '''
+    Answers plist messages like usbmuxd, a successful Connect turns the connection into an echo of the port
+    '''
+
+    def handle(self):
+        while True:
+            header = self.rfile.read(usbmux.HEADER.size)
+            if len(header) < usbmux.HEADER.size:
+                return
+            length, version, message_type, tag = usbmux.HEADER.unpack(header)
+            request = plistlib.loads(self.rfile.read(length - usbmux.HEADER.size))
+            self.server.requests.append((version, message_type, request))
+            reply = self.reply(request)
+            if reply is None:
+                return  # crashed
+            payload = plistlib.dumps(reply)
+            self.wfile.write(usbmux.HEADER.pack(usbmux.HEADER.size + len(payload), version, message_type, tag))
+            self.wfile.write(payload)
+            if request['MessageType'] == 'Connect' and reply['Number'] == 0:
+                while True:
+                    data = self.request.recv(4096)
+                    if not data:
+                        return
+                    self.request.sendall(data)
+
+    def reply(self, request):
+        kind = request['MessageType']
+        if kind == 'ListDevices':
+            return {'DeviceList': DEVICES}
+        if kind == 'ReadPairRecord':
+            if request['PairRecordID'] != '00008030-001A2B3C4D5E6F70':
+                return {'MessageType': 'Result', 'Number': 2}
+            return {'PairRecordData': plistlib.dumps({'HostID': 'HOST', 'SystemBUID': 'BUID'})}
+        if kind == 'Connect':
+            port = socket.ntohs(request['PortNumber'])
+            if request['DeviceID'] == 9:
+                return None
+            if request['DeviceID'] not in PORTS:
+                return {'MessageType': 'Result', 'Number': 2}
+            return {'MessageType': 'Result', 'Number': 0 if port in PORTS[request['DeviceID']] else 3}
+        return {'MessageType': 'Result', 'Number': 1}
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = socketserver.ThreadingUnixStreamServer(str(tmp_path / 'usbmuxd'), FakeUsbmuxd)
+    server.daemon_threads = True
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def mux(server):
+    return Usbmux(address=server.server_address, timeout=2)
+
+
+def test_default_address(monkeypatch):
+    monkeypatch.setenv('USBMUXD_SOCKET_ADDRESS', 'UNIX:/tmp/mux')
+    assert usbmux.default_address() == '/tmp/mux'
+    monkeypatch.setenv('USBMUXD_SOCKET_ADDRESS', '127.0.0.1:27015')
+    assert usbmux.default_address() == ('127.0.0.1', 27015)
+
+
+def test_list_devices(server, mux):
+    assert mux.available()
+    assert mux.devices() == [
+        Device(5, '00008030-001A2B3C4D5E6F70', 'USB'),
+        Device(7, '0123456789abcdef0123456789abcdef01234567', 'USB'),
+        Device(3, 'aaaa', 'Network'),
+    ]
+    version, message_type, request = server.requests[-1]
+    assert (version, message_type) == (usbmux.VERSION_PLIST, usbmux.MESSAGE_PLIST)
+    assert request['MessageType'] == 'ListDevices' and request['ProgName'] == 'ipadumper'
+
+    assert mux.device().id == 5
+    assert mux.device('00008030001A2B3C4D5E6F70').id == 5
+    assert mux.device('aaaa').id == 3
+    assert mux.device('missing') is None
+
+
+def test_unavailable(tmp_path):
+    mux = Usbmux(address=str(tmp_path / 'missing'))
+    assert not mux.available()
+    with pytest.raises(OSError):
+        mux.devices()
+
+
+def test_connect(server, mux):
+    s = mux.connect(mux.device(), 22, timeout=2)
+    with s:
+        s.sendall(b'SSH-2.0-test\r\n')
+        assert s.recv(100) == b'SSH-2.0-test\r\n'
+        assert s.gettimeout() == 2
+    request = server.requests[-1][2]
+    assert request['DeviceID'] == 5 and request['PortNumber'] == socket.htons(22)
+
+
+def test_connect_errors(mux):
+    with pytest.raises(UsbmuxError, match='connection refused'):
+        mux.connect(5, 6000)
+    with pytest.raises(UsbmuxError, match='bad device'):
+        mux.connect(4, 22)
+    with pytest.raises(UsbmuxError, match='closed the connection'):
+        mux.connect(9, 22)
+
+
+def test_read_pair_record(mux):
+    assert mux.read_pair_record('00008030-001A2B3C4D5E6F70') == {'HostID': 'HOST', 'SystemBUID': 'BUID'}
+    with pytest.raises(UsbmuxError, match='bad device'):
+        mux.read_pair_record('aaaa')
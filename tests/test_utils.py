@@ -0,0 +1,14 @@
+# stdlib
+import logging
+
+# internal
+from ipadumper.utils import get_logger
+
+
+def test_device_log_levels_are_independent():
+    module = get_logger('info', name='ipadumper.test_utils')
+    a = get_logger('debug', name='ipadumper.test_utils', device='A')
+    b = get_logger('warning', name='ipadumper.test_utils', device='B')
+    assert a.isEnabledFor(logging.DEBUG)
+    assert not b.isEnabledFor(logging.INFO) and b.isEnabledFor(logging.WARNING)
+    assert module.level == logging.INFO
@@ -0,0 +1,147 @@
+# stdlib
+import io
+import json
+import struct
+import zipfile
+
+# external
+import pytest
+
+# internal
+from ipadumper import macho
+from ipadumper.verify import HEADER_SIZE, Verifier, check_macho, verify_ipa
+
+
+CPU_TYPE_ARM64 = 0x0100000C
+CPU_TYPE_ARM = 0xC
+
+
+def thin(size=0x8000, cryptid=0, cryptoff=0x4000, cryptsize=0x2000):
+    '''
+    return little endian 64 bit Mach-O with an LC_ENCRYPTION_INFO_64 load command
+    '''
+    header = struct.pack('<IIIIIIII', macho.MH_MAGIC_64, CPU_TYPE_ARM64, 0, 2, 1, 24, 0, 0)
+    command = struct.pack('<IIIIII', macho.LC_ENCRYPTION_INFO_64, 24, cryptoff, cryptsize, cryptid, 0)
+    data = header + command
+    return data + b'\xaa' * (size - len(data))
+
+
+def fat(*slices, truncate=0):
+    '''
+    return fat Mach-O with the thin Mach-Os in slices, aligned to 0x1000
+    truncate: bytes cut off at the end
+    '''
+    offset = 0x1000
+    header = struct.pack('>II', macho.FAT_MAGIC, len(slices))
+    body = b''
+    for i, data in enumerate(slices):
+        cputype = CPU_TYPE_ARM64 if i == 0 else CPU_TYPE_ARM
+        header += struct.pack('>IIIII', cputype, 0, offset + len(body), len(data), 14)
+        body += data + b'\0' * (-len(data) % 0x1000)
+    data = header + b'\0' * (offset - len(header)) + body
+    return data[: len(data) - truncate]
+
+
+def check(name, data):
+    f = io.BytesIO(data)
+    return check_macho(name, f.read(HEADER_SIZE), f)
+
+
+def ipa(path, members):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('Payload/App.app/Info.plist', b'<plist/>')
+        for name, data in members.items():
+            zf.writestr(f'Payload/App.app/{name}', data)
+    return str(path)
+
+
+def test_check_macho_thin_and_fat():
+    assert check('App', thin()) == ([], [])
+    assert check('App', fat(thin(), thin(size=0x6000))) == ([], [])
+    # a slice larger than HEADER_SIZE is read to the end
+    assert check('App', fat(thin(size=3 * HEADER_SIZE), thin())) == ([], [])
+
+
+def test_check_macho_encrypted():
+    assert check('App', thin(cryptid=1)) == ([], ['App: encrypted (cryptid 1)'])
+    errors, encrypted = check('App', fat(thin(), thin(cryptid=1)))
+    assert errors == []
+    assert encrypted == [f'App (cputype {CPU_TYPE_ARM:#x}/0x0): encrypted (cryptid 1)']
+
+
+def test_check_macho_truncated():
+    errors, _ = check('App', fat(thin(), thin(), truncate=0x1000))
+    assert errors == [f'App (cputype {CPU_TYPE_ARM:#x}/0x0): slice ends at 69632, file has 65536 bytes']
+    # the encrypted range is beyond the end of the binary
+    errors, _ = check('App', thin(size=0x5000))
+    assert errors == ['App: encrypted range ends at 24576, slice has 20480 bytes']
+    # load commands are cut off
+    errors, _ = check('App', thin()[:40])
+    assert errors == ['App: load commands are truncated']
+    # fat header is cut off
+    errors, _ = check('App', fat(thin(), thin())[:20])
+    assert errors == ['App: fat header is truncated']
+
+
+def test_verify_ipa(tmp_path):
+    path = ipa(
+        tmp_path / 'ok.ipa',
+        {'App': fat(thin(), thin()), 'Frameworks/A.framework/A': thin(), 'PlugIns/W.appex/W': thin(cryptid=1)},
+    )
+    result = verify_ipa(path)
+    assert result['ok'] and result['errors'] == []
+    assert result['binaries'] == 3
+    assert result['encrypted_extensions'] == ['Payload/App.app/PlugIns/W.appex/W: encrypted (cryptid 1)']
+    assert result['size'] == len(open(path, 'rb').read())
+
+    result = verify_ipa(ipa(tmp_path / 'encrypted.ipa', {'App': thin(cryptid=1)}))
+    assert not result['ok']
+    assert result['errors'] == ['Payload/App.app/App: encrypted (cryptid 1)']
+
+    result = verify_ipa(ipa(tmp_path / 'truncated.ipa', {'App': fat(thin(), thin(), truncate=0x1000)}))
+    assert not result['ok'] and 'slice ends at' in result['errors'][0]
+
+
+def test_verify_ipa_broken_zip(tmp_path):
+    path = ipa(tmp_path / 'cut.ipa', {'App': thin()})
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[: len(data) // 2])
+    result = verify_ipa(path)
+    assert not result['ok'] and result['errors'][0].startswith('BadZipFile')
+
+    empty = tmp_path / 'empty.ipa'
+    empty.write_bytes(b'')
+    assert not verify_ipa(str(empty))['ok']
+
+    with zipfile.ZipFile(tmp_path / 'nopayload.ipa', 'w') as zf:
+        zf.writestr('App', thin())
+    assert verify_ipa(str(tmp_path / 'nopayload.ipa'))['errors'] == ['no Payload/*.app in IPA']
+
+
+@pytest.fixture
+def verifier(tmp_path):
+    verifier = Verifier(str(tmp_path / 'catalog.jsonl'), workers=1, log_level='warning')
+    yield verifier
+    verifier.shutdown()
+
+
+def test_verifier_catalog(tmp_path, verifier):
+    ok = ipa(tmp_path / '1_com.app_1.0.ipa', {'App': thin(), 'PlugIns/W.appex/W': thin(cryptid=1)})
+    broken = ipa(tmp_path / '2_com.other_1.0.ipa', {'App': thin(cryptid=1)})
+    verifier.submit(ok, {'itunes_id': 1, 'bundleId': 'com.app'})
+    verifier.submit(broken, {'itunes_id': 2, 'bundleId': 'com.other'})
+    assert verifier.wait(timeout=60)
+
+    with open(tmp_path / 'catalog.jsonl') as f:
+        entries = [json.loads(line) for line in f]
+    # only verified IPAs are in the catalog
+    assert len(entries) == 1
+    entry = entries[0]
+    assert entry['itunes_id'] == 1 and entry['bundleId'] == 'com.app'
+    assert entry['file'] == '1_com.app_1.0.ipa'
+    assert entry['binaries'] == 2
+    assert entry['size'] == len(open(ok, 'rb').read())
+    assert entry['sha256'] == verify_ipa(ok)['sha256']
+    assert entry['encrypted_extensions'] == ['Payload/App.app/PlugIns/W.appex/W: encrypted (cryptid 1)']